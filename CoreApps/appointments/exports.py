@@ -0,0 +1,145 @@
+"""
+Exportación de recordatorios/leads (AdminReminderExportView) con memoria acotada.
+
+- El queryset se recorre con .iterator(chunk_size): nunca se materializa la tabla completa.
+- XLSX: workbook write_only de openpyxl (las filas se vuelcan a disco según se agregan). El ancho de
+  columnas se estima con una muestra de las primeras filas, porque en modo write_only debe fijarse
+  antes de escribir y no hay segunda pasada sobre las celdas.
+- CSV: generador para StreamingHttpResponse; la descarga empieza con la primera fila.
+Los filtros (estado, origen, rango de fechas, búsqueda) permiten exportar solo un subconjunto.
+"""
+import csv
+import datetime
+import itertools
+import tempfile
+import openpyxl
+from openpyxl.utils import get_column_letter
+from django.db.models import Q
+
+from .models import AppointmentReminder
+
+ENCABEZADOS = [
+    "ID", "Estado", "Paciente", "Email", "Cédula", "Teléfono",
+    "Producto / Servicio", "Fecha Aplicación", "Próxima Aplicación",
+    "Origen", "Notas"
+]
+
+TAMANO_ITERADOR = 2000
+# Filas usadas para estimar el ancho de las columnas del Excel
+TAMANO_MUESTRA = 200
+ANCHO_MINIMO = 8
+ANCHO_MAXIMO = 60
+
+
+def _fecha(valor):
+    if not valor:
+        return None
+    try:
+        return datetime.date.fromisoformat(valor)
+    except ValueError:
+        return None
+
+
+def filtrar_recordatorios(params):
+    """
+    Queryset de la exportación según los parámetros GET:
+    estado (repetible), origen, desde/hasta (sobre la próxima aplicación) y q (paciente, cédula, teléfono, producto).
+    """
+    qs = AppointmentReminder.objects.select_related(
+        'paciente', 'medicamento_catalogo', 'cita_origen'
+    ).order_by('-fecha_creacion')
+
+    estados = [e for e in params.getlist('estado') if e]
+    if estados:
+        qs = qs.filter(estado__in=estados)
+    if params.get('origen'):
+        qs = qs.filter(origen=params['origen'])
+    desde, hasta = _fecha(params.get('desde')), _fecha(params.get('hasta'))
+    if desde:
+        qs = qs.filter(fecha_limite_sugerida__gte=desde)
+    if hasta:
+        qs = qs.filter(fecha_limite_sugerida__lte=hasta)
+    busqueda = (params.get('q') or '').strip()
+    if busqueda:
+        qs = qs.filter(
+            Q(paciente__first_name__icontains=busqueda) | Q(paciente__last_name__icontains=busqueda) |
+            Q(paciente__cedula__icontains=busqueda) | Q(paciente__telefono__icontains=busqueda) |
+            Q(medicamento_catalogo__nombre__icontains=busqueda) | Q(medicamento_externo__icontains=busqueda)
+        )
+    return qs
+
+
+def fila_recordatorio(item):
+    # Producto
+    if item.medicamento_catalogo:
+        producto = item.medicamento_catalogo.nombre
+    else:
+        producto = item.medicamento_externo or "General"
+
+    # Fechas
+    fecha_app = ""
+    if item.cita_origen:
+        fecha_app = item.cita_origen.fecha
+    elif item.fecha_ultima_aplicacion:
+        fecha_app = item.fecha_ultima_aplicacion
+
+    return [
+        item.id,
+        item.estado,
+        item.paciente.get_full_name(),
+        item.paciente.email,
+        item.paciente.cedula or "",
+        item.paciente.telefono or "",
+        producto,
+        fecha_app,
+        item.fecha_limite_sugerida or "",
+        item.origen,
+        item.notas,
+    ]
+
+
+def _filas(queryset):
+    return (fila_recordatorio(item) for item in queryset.iterator(chunk_size=TAMANO_ITERADOR))
+
+
+def anchos_desde_muestra(filas):
+    """Ancho por columna según el valor más largo de la muestra (y del encabezado), con tope"""
+    anchos = [len(h) for h in ENCABEZADOS]
+    for fila in filas:
+        for i, valor in enumerate(fila):
+            anchos[i] = max(anchos[i], len(str(valor)))
+    return [min(max(a + 2, ANCHO_MINIMO), ANCHO_MAXIMO) for a in anchos]
+
+
+def exportar_xlsx(queryset):
+    """Escribe el Excel en un archivo temporal y lo devuelve abierto al inicio (se borra al cerrarlo)"""
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet("Recordatorios")
+
+    filas = _filas(queryset)
+    muestra = list(itertools.islice(filas, TAMANO_MUESTRA))
+    for i, ancho in enumerate(anchos_desde_muestra(muestra), start=1):
+        ws.column_dimensions[get_column_letter(i)].width = ancho
+
+    ws.append(ENCABEZADOS)
+    for fila in itertools.chain(muestra, filas):
+        ws.append(fila)
+
+    archivo = tempfile.TemporaryFile()
+    wb.save(archivo)
+    archivo.seek(0)
+    return archivo
+
+
+class _Eco:
+    """Pseudo-buffer para csv.writer: devuelve la línea escrita en vez de guardarla"""
+    def write(self, valor):
+        return valor
+
+
+def exportar_csv(queryset):
+    """Generador de líneas CSV (con BOM para que Excel respete las tildes)"""
+    writer = csv.writer(_Eco())
+    yield '\ufeff' + writer.writerow(ENCABEZADOS)
+    for fila in _filas(queryset):
+        yield writer.writerow(fila)
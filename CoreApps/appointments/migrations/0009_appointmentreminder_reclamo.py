@@ -0,0 +1,23 @@
+# Generated by Django 6.0 on 2026-10-18 16:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('appointments', '0008_appointmentreminder_dosis_actual'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appointmentreminder',
+            name='reclamado_hasta',
+            field=models.DateTimeField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='appointmentreminder',
+            name='reclamado_por',
+            field=models.CharField(blank=True, editable=False, max_length=100, null=True),
+        ),
+    ]
@@ -135,6 +135,10 @@ class AppointmentReminder(models.Model):
     notas = models.TextField(blank=True)
     fecha_creacion = models.DateTimeField(auto_now_add=True)
 
+    # Lease del worker de notificaciones que lo está enviando (CoreApps/notifications/leases.py)
+    reclamado_por = models.CharField(max_length=100, blank=True, null=True, editable=False)
+    reclamado_hasta = models.DateTimeField(blank=True, null=True, editable=False, db_index=True)
+
     class Meta:
         verbose_name = "Recordatorio / Lead"
         verbose_name_plural = "Recordatorios y Leads"
@@ -266,88 +266,29 @@ class AdminRequiredMixin(UserPassesTestMixin):
 
 # --- VISTAS ---
 
-import openpyxl
-from django.http import HttpResponse
+from django.http import FileResponse, StreamingHttpResponse
+from django.utils import timezone
+from .exports import filtrar_recordatorios, exportar_xlsx, exportar_csv
 
 class AdminReminderExportView(LoginRequiredMixin, AdminRequiredMixin, View):
+    """
+    Exporta los recordatorios (todos o filtrados por estado/origen/fechas/búsqueda, ver exports.py)
+    en Excel (?formato=xlsx, por defecto) o CSV (?formato=csv, se transmite mientras se genera).
+    """
     def get(self, request, *args, **kwargs):
-        # 1. Crear Workbook y Sheet
-        wb = openpyxl.Workbook()
-        ws = wb.active
-        ws.title = "Recordatorios"
-
-        # 2. Encabezados
-        headers = [
-            "ID", "Estado", "Paciente", "Email", "Cédula", "Teléfono", 
-            "Producto / Servicio", "Fecha Aplicación", "Próxima Aplicación", 
-            "Origen", "Notas"
-        ]
-        ws.append(headers)
-
-        # 3. Obtener Datos (Todos)
-        reminders = AppointmentReminder.objects.all().select_related(
-            'paciente', 'medicamento_catalogo', 'cita_origen'
-        ).order_by('-fecha_creacion')
-
-        # 4. Llenar filas
-        for item in reminders:
-            # Datos Paciente
-            paciente_nombre = item.paciente.get_full_name()
-            cedula = item.paciente.cedula if item.paciente.cedula else ""
-            telefono = item.paciente.telefono if item.paciente.telefono else ""
-            
-            # Producto
-            producto = ""
-            if item.medicamento_catalogo:
-                producto = item.medicamento_catalogo.nombre
-            else:
-                producto = item.medicamento_externo or "General"
-
-            # Fechas
-            fecha_app = ""
-            if item.cita_origen:
-                fecha_app = item.cita_origen.fecha
-            elif item.fecha_ultima_aplicacion:
-                fecha_app = item.fecha_ultima_aplicacion
-
-            fecha_prox = item.fecha_limite_sugerida if item.fecha_limite_sugerida else ""
-
-            row = [
-                item.id,
-                item.estado,
-                paciente_nombre,
-                item.paciente.email,
-                cedula,
-                telefono,
-                producto,
-                fecha_app,
-                fecha_prox,
-                item.origen,
-                item.notas
-            ]
-            ws.append(row)
-
-        # 5. Ajustar ancho de columnas (Opcional, básico)
-        for col in ws.columns:
-            max_length = 0
-            column = col[0].column_letter # A, B, C...
-            for cell in col:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            adjusted_width = (max_length + 2)
-            ws.column_dimensions[column].width = adjusted_width
-
-        # 6. Respuesta HTTP
-        response = HttpResponse(
+        reminders = filtrar_recordatorios(request.GET)
+        nombre = f"recordatorios_leads_{timezone.localdate():%Y%m%d}"
+
+        if request.GET.get('formato') == 'csv':
+            response = StreamingHttpResponse(exportar_csv(reminders), content_type='text/csv; charset=utf-8')
+            response['Content-Disposition'] = f'attachment; filename="{nombre}.csv"'
+            return response
+
+        # FileResponse envía el archivo temporal por bloques y lo cierra (y borra) al terminar
+        return FileResponse(
+            exportar_xlsx(reminders), as_attachment=True, filename=f"{nombre}.xlsx",
             content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
         )
-        response['Content-Disposition'] = 'attachment; filename="recordatorios_leads.xlsx"'
-        
-        wb.save(response)
-        return response
 
 class AdminReminderListView(LoginRequiredMixin, AdminRequiredMixin, ListView):
     model = AppointmentReminder
@@ -370,7 +311,10 @@ class AdminReminderListView(LoginRequiredMixin, AdminRequiredMixin, ListView):
         context['historial'] = AppointmentReminder.objects.exclude(
             estado__in=['PENDIENTE', 'FALLO_ENVIO']
         ).select_related('paciente', 'medicamento_catalogo', 'cita_origen').order_by('-fecha_creacion')
-        
+
+        # Opciones del filtro de exportación
+        context['estados'] = AppointmentReminder.ESTADOS
+        context['origenes'] = AppointmentReminder.ORIGEN_CHOICES
         return context
 
 class AdminReminderDeleteView(LoginRequiredMixin, AdminRequiredMixin, DeleteView):
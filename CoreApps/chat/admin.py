@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import WhatsAppConversation, WhatsAppMessage
+from .models import WhatsAppConversation, WhatsAppMessage, WebhookInbox, MediaCacheEntry
 
 class WhatsAppMessageInline(admin.TabularInline):
     model = WhatsAppMessage
@@ -24,3 +24,15 @@ class WhatsAppMessageAdmin(admin.ModelAdmin):
     list_display = ('conversacion', 'es_entrante', 'fecha', 'estado_envio')
     search_fields = ('conversacion__telefono', 'contenido')
     list_filter = ('es_entrante', 'estado_envio')
+
+@admin.register(WebhookInbox)
+class WebhookInboxAdmin(admin.ModelAdmin):
+    list_display = ('id', 'evento', 'estado', 'intentos', 'fecha_recepcion', 'fecha_procesado')
+    list_filter = ('estado', 'evento')
+    readonly_fields = ('fecha_recepcion', 'fecha_tomado', 'fecha_procesado')
+
+@admin.register(MediaCacheEntry)
+class MediaCacheEntryAdmin(admin.ModelAdmin):
+    list_display = ('ruta', 'mimetype', 'tamano', 'ultimo_acceso', 'fecha_creacion')
+    search_fields = ('ruta', 'sha256')
+    readonly_fields = ('clave', 'sha256', 'ruta', 'tamano', 'fecha_creacion', 'ultimo_acceso')
@@ -0,0 +1,247 @@
+"""
+Captura de payloads de webhooks de WASender para depuración y replay.
+
+Reemplaza el append síncrono a `logs_webhook_debug.json`: el webhook solo encola el payload
+en una cola acotada (sin tocar disco) y un hilo en segundo plano lo escribe en segmentos JSONL.
+Cada segmento rota por tamaño o por día, se comprime con gzip al cerrarse y los más antiguos
+se eliminan. Si la cola está llena el payload se descarta (la captura nunca frena al webhook).
+Los segmentos sin comprimir que dejó un proceso caído (su PID va en el nombre) se comprimen al
+arrancar el escritor y en cada rotación, para que también entren en la purga.
+
+Formato de cada línea: {"ts": <epoch>, "event": <evento>, "payload": <payload original>}
+"""
+import os
+import glob
+import gzip
+import json
+import time
+import queue
+import random
+import shutil
+import atexit
+import logging
+import datetime
+import threading
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+PREFIJO_SEGMENTO = 'webhooks-'
+
+
+class WebhookCaptureSink:
+    """Sink asíncrono con rotación, compresión y muestreo por tipo de evento"""
+
+    def __init__(self, directorio=None, max_bytes=None, max_segmentos=None, muestreo=None, max_cola=None):
+        self.habilitado = getattr(settings, 'WEBHOOK_CAPTURE_ENABLED', True)
+        self.directorio = directorio or getattr(
+            settings, 'WEBHOOK_CAPTURE_DIR', os.path.join(settings.BASE_DIR, 'logs', 'webhooks')
+        )
+        self.max_bytes = max_bytes or getattr(settings, 'WEBHOOK_CAPTURE_MAX_BYTES', 20 * 1024 * 1024)
+        self.max_segmentos = max_segmentos or getattr(settings, 'WEBHOOK_CAPTURE_MAX_SEGMENTS', 60)
+        self.segundos_huerfano = getattr(settings, 'WEBHOOK_CAPTURE_STALE_SECONDS', 2 * 24 * 3600)
+        self.muestreo = muestreo if muestreo is not None else getattr(settings, 'WEBHOOK_CAPTURE_SAMPLING', {})
+        self._cola = queue.Queue(maxsize=max_cola or getattr(settings, 'WEBHOOK_CAPTURE_QUEUE_SIZE', 1000))
+        self._hilo = None
+        self._lock = threading.Lock()
+        # Estado del segmento abierto (solo lo toca el hilo escritor)
+        self._archivo = None
+        self._ruta = None
+        self._dia = None
+        self._bytes = 0
+        self.descartados = 0
+
+    # --- Lado del webhook (no bloqueante) ---
+
+    def debe_capturar(self, evento):
+        """Aplica la tasa de muestreo del evento (o la de 'default')"""
+        tasa = self.muestreo.get(evento, self.muestreo.get('default', 1.0))
+        return tasa >= 1 or (tasa > 0 and random.random() < tasa)
+
+    def capturar(self, payload, evento=None):
+        """Encola el payload para escritura. Retorna False si se omitió (muestreo, desactivado o cola llena)"""
+        if not self.habilitado:
+            return False
+        if evento is None and isinstance(payload, dict):
+            evento = payload.get('event')
+        if not self.debe_capturar(evento):
+            return False
+        self._iniciar()
+        try:
+            self._cola.put_nowait((time.time(), evento, payload))
+            return True
+        except queue.Full:
+            self.descartados += 1
+            if self.descartados % 100 == 1:
+                logger.warning(f"Captura de webhooks saturada: {self.descartados} payloads descartados")
+            return False
+
+    def _iniciar(self):
+        if self._hilo is not None:
+            return
+        with self._lock:
+            if self._hilo is None:
+                self._hilo = threading.Thread(target=self._escritor, name='webhook-capture', daemon=True)
+                self._hilo.start()
+                atexit.register(self.detener)
+
+    def detener(self, timeout=5):
+        """Vacía la cola y cierra el segmento abierto (se llama al salir del proceso)"""
+        if self._hilo is None:
+            return
+        try:
+            self._cola.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self._hilo.join(timeout=timeout)
+        self._hilo = None
+
+    # --- Hilo escritor ---
+
+    def _escritor(self):
+        self._recoger_huerfanos()
+        while True:
+            try:
+                item = self._cola.get(timeout=1.0)
+            except queue.Empty:
+                # Cola vacía: volcamos el buffer para que el segmento sea legible en caliente
+                # y cerramos el del día anterior (un escritor vivo nunca deja un segmento viejo abierto)
+                if self._archivo:
+                    self._archivo.flush()
+                    if self._dia != datetime.date.today():
+                        self._cerrar_segmento()
+                continue
+            if item is None:
+                break
+            try:
+                ts, evento, payload = item
+                linea = json.dumps({'ts': ts, 'event': evento, 'payload': payload}, ensure_ascii=False, default=str) + '\n'
+                self._escribir(linea.encode('utf-8'), ts)
+            except Exception as e:
+                logger.error(f"Error escribiendo captura de webhook: {e}")
+        self._cerrar_segmento()
+
+    def _escribir(self, datos, ts):
+        dia = datetime.date.fromtimestamp(ts)
+        if self._archivo and (self._dia != dia or self._bytes + len(datos) > self.max_bytes):
+            self._cerrar_segmento()
+        if not self._archivo:
+            self._abrir_segmento(ts)
+        self._archivo.write(datos)
+        self._bytes += len(datos)
+
+    def _abrir_segmento(self, ts):
+        os.makedirs(self.directorio, exist_ok=True)
+        # El PID evita que varios workers (gunicorn, consumidor de la bandeja) escriban el mismo archivo
+        sello = datetime.datetime.fromtimestamp(ts).strftime('%Y%m%d-%H%M%S-%f')
+        self._ruta = os.path.join(self.directorio, f"{PREFIJO_SEGMENTO}{sello}-{os.getpid()}.jsonl")
+        self._archivo = open(self._ruta, 'ab')
+        self._dia = datetime.date.fromtimestamp(ts)
+        self._bytes = 0
+
+    def _cerrar_segmento(self):
+        if not self._archivo:
+            return
+        ruta = self._ruta
+        self._archivo.close()
+        self._archivo = self._ruta = self._dia = None
+        self._bytes = 0
+        self._comprimir(ruta)
+        self._recoger_huerfanos()
+
+    def _comprimir(self, ruta):
+        # Archivo temporal + os.replace: dos procesos recogiendo el mismo huérfano no mezclan sus escrituras
+        temporal = f"{ruta}.gz.{os.getpid()}"
+        try:
+            with open(ruta, 'rb') as origen, gzip.open(temporal, 'wb') as destino:
+                shutil.copyfileobj(origen, destino)
+            os.replace(temporal, ruta + '.gz')
+            os.remove(ruta)
+        except FileNotFoundError:
+            pass  # Otro proceso ya lo comprimió
+        except OSError as e:
+            logger.error(f"No se pudo comprimir el segmento {ruta}: {e}")
+
+    def _recoger_huerfanos(self):
+        """Comprime los segmentos abiertos que ya no tienen escritor vivo y aplica la purga"""
+        for ruta in glob.glob(os.path.join(self.directorio, f'{PREFIJO_SEGMENTO}*.jsonl')):
+            if ruta != self._ruta and self._huerfano(ruta):
+                self._comprimir(ruta)
+        self._purgar()
+
+    def _huerfano(self, ruta):
+        """El proceso del nombre ya no existe, o el segmento lleva más de `segundos_huerfano` sin escribirse"""
+        try:
+            if time.time() - os.path.getmtime(ruta) > self.segundos_huerfano:
+                return True
+        except OSError:
+            return False  # Otro proceso lo acaba de comprimir
+        pid = os.path.basename(ruta)[:-len('.jsonl')].rsplit('-', 1)[-1]
+        if not pid.isdigit() or os.name != 'posix':
+            return False
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except OSError:
+            pass  # Existe pero es de otro usuario
+        return False
+
+    def _purgar(self):
+        """Conserva solo los `max_segmentos` segmentos comprimidos más recientes"""
+        comprimidos = sorted(glob.glob(os.path.join(self.directorio, f'{PREFIJO_SEGMENTO}*.jsonl.gz')))
+        for ruta in comprimidos[:-self.max_segmentos]:
+            try:
+                os.remove(ruta)
+            except OSError:
+                pass
+
+
+def listar_segmentos(directorio=None):
+    """Segmentos de captura (comprimidos y abiertos) en orden cronológico"""
+    directorio = directorio or getattr(settings, 'WEBHOOK_CAPTURE_DIR', os.path.join(settings.BASE_DIR, 'logs', 'webhooks'))
+    rutas = glob.glob(os.path.join(directorio, f'{PREFIJO_SEGMENTO}*.jsonl.gz'))
+    rutas += glob.glob(os.path.join(directorio, f'{PREFIJO_SEGMENTO}*.jsonl'))
+    return sorted(rutas, key=lambda r: os.path.basename(r).replace('.gz', ''))
+
+
+def leer_capturas(rutas, eventos=None, desde=None, hasta=None):
+    """
+    Itera los registros capturados ({'ts', 'event', 'payload'}) de una lista de archivos.
+    Acepta segmentos .jsonl/.jsonl.gz y el formato antiguo de logs_webhook_debug.json (payloads separados por '---').
+    `desde`/`hasta` son epoch en segundos.
+    """
+    for ruta in rutas:
+        for registro in _leer_archivo(ruta):
+            if eventos and registro.get('event') not in eventos:
+                continue
+            ts = registro.get('ts')
+            if ts is not None and ((desde and ts < desde) or (hasta and ts > hasta)):
+                continue
+            yield registro
+
+
+def _leer_archivo(ruta):
+    abrir = gzip.open if ruta.endswith('.gz') else open
+    with abrir(ruta, 'rt', encoding='utf-8', errors='replace') as f:
+        if ruta.endswith('.json'):
+            # Formato antiguo: un JSON por bloque separado por '---', sin marca de tiempo
+            for bloque in f.read().split('\n---\n'):
+                bloque = bloque.strip()
+                if not bloque:
+                    continue
+                try:
+                    payload = json.loads(bloque)
+                except json.JSONDecodeError:
+                    continue
+                yield {'ts': None, 'event': payload.get('event') if isinstance(payload, dict) else None, 'payload': payload}
+            return
+        for linea in f:
+            try:
+                yield json.loads(linea)
+            except json.JSONDecodeError:
+                continue  # Última línea truncada de un segmento abierto
+
+
+# Instancia compartida por proceso
+capturas = WebhookCaptureSink()
@@ -0,0 +1,115 @@
+"""
+Canal de eventos en tiempo real del Inbox y del drawer del Pipeline (Server-Sent Events).
+
+La ingesta (webhook, envíos manuales) publica eventos ligeros tras el commit; el endpoint SSE
+(`ChatEventsStreamView`, requiere servidor ASGI) los reenvía a los operadores conectados y el
+frontend responde pidiendo el delta (?since=) del listado o del chat abierto.
+
+Eventos:
+    mensaje  {'contactos': [ids]}            mensajes nuevos o modificados
+    estado   {'contactos': [ids]}            acuses de entrega/lectura o lectura por operador
+    fusion   {'desde': id, 'hacia': id}      un contacto fantasma (LID) se fusionó con el real
+
+El canal está desactivado por defecto (settings.CHAT_EVENTS_SSE): con WSGI el stream infinito
+retendría un worker por pestaña sin llegar a enviar nada. Solo se sirve si está activado y la
+petición llega por ASGI; si no, el endpoint responde 204 y el navegador deja de reconectar.
+
+El backend es intercambiable (settings.CHAT_EVENTS_BACKEND). El incluido, InProcessBackend, solo
+reparte eventos dentro del mismo proceso: los publicados desde otro proceso (worker de campañas,
+consumidor de la bandeja) no llegan, por eso el frontend mantiene el polling a su ritmo normal y
+los eventos solo adelantan el delta.
+"""
+import asyncio
+import logging
+import threading
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+
+class InProcessBackend:
+    """Pub/sub en memoria: una asyncio.Queue acotada por conexión SSE"""
+
+    def __init__(self, max_cola=100):
+        self.max_cola = max_cola
+        self._suscriptores = set()
+        self._lock = threading.Lock()
+
+    def suscribir(self):
+        """Debe llamarse desde el event loop de la conexión"""
+        suscripcion = (asyncio.get_running_loop(), asyncio.Queue(maxsize=self.max_cola))
+        with self._lock:
+            self._suscriptores.add(suscripcion)
+        return suscripcion
+
+    def desuscribir(self, suscripcion):
+        with self._lock:
+            self._suscriptores.discard(suscripcion)
+
+    def hay_suscriptores(self):
+        return bool(self._suscriptores)
+
+    async def escuchar(self, suscripcion, timeout):
+        """Espera el siguiente evento; lanza asyncio.TimeoutError si no llega ninguno a tiempo"""
+        _, cola = suscripcion
+        return await asyncio.wait_for(cola.get(), timeout)
+
+    def publicar(self, evento):
+        """Thread-safe: se puede llamar desde hilos síncronos (vistas WSGI/ASGI, consumidores)"""
+        with self._lock:
+            suscriptores = list(self._suscriptores)
+        for suscripcion in suscriptores:
+            loop, cola = suscripcion
+            try:
+                loop.call_soon_threadsafe(self._entregar, cola, evento)
+            except RuntimeError:
+                self.desuscribir(suscripcion)  # Event loop cerrado: conexión muerta
+
+    @staticmethod
+    def _entregar(cola, evento):
+        try:
+            cola.put_nowait(evento)
+        except asyncio.QueueFull:
+            pass  # Cliente lento: el polling de respaldo lo pondrá al día
+
+
+def sse_habilitado():
+    """El frontend solo abre el EventSource si el despliegue lo activa (requiere ASGI)"""
+    return getattr(settings, 'CHAT_EVENTS_SSE', False)
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                ruta = getattr(settings, 'CHAT_EVENTS_BACKEND', 'CoreApps.chat.events.InProcessBackend')
+                _backend = import_string(ruta)()
+    return _backend
+
+
+def hay_suscriptores():
+    """Permite omitir el trabajo extra de publicar (ej. consultar contactos afectados) si nadie escucha"""
+    return get_backend().hay_suscriptores()
+
+
+def publicar(tipo, **datos):
+    """Publica un evento cuando la transacción en curso confirme (o de inmediato si no hay transacción)"""
+    backend = get_backend()
+    if not backend.hay_suscriptores():
+        return
+    evento = {'tipo': tipo, **datos}
+
+    def _enviar():
+        try:
+            backend.publicar(evento)
+        except Exception as e:
+            logger.error(f"Error publicando evento de chat {tipo}: {e}")
+
+    transaction.on_commit(_enviar)
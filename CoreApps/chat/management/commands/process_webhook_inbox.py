@@ -0,0 +1,158 @@
+import json
+import time
+import datetime
+import threading
+from django.core.management.base import BaseCommand
+from django.db import transaction, close_old_connections
+from django.db.models import F, Q
+from django.utils import timezone
+from CoreApps.chat.models import WebhookInbox
+from CoreApps.chat.views import WasenderWebhookView
+from CoreApps.chat.capture import capturas
+from CoreApps.notifications.wasender_client import wasender
+
+
+class Command(BaseCommand):
+    help = 'Consumidor de la bandeja de webhooks de WASender (modo WASENDER_WEBHOOK_ASYNC).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1, help='Hilos consumidores en este proceso (con más de 1 no se garantiza el orden entre eventos de un mismo contacto)')
+        parser.add_argument('--batch-size', type=int, default=50, help='Eventos reclamados por lote')
+        parser.add_argument('--idle-sleep', type=float, default=1.0, help='Segundos de espera cuando la bandeja está vacía')
+        parser.add_argument('--max-intentos', type=int, default=5, help='Reintentos antes de marcar un evento como ERROR')
+        parser.add_argument('--backoff-segundos', type=int, default=30, help='Espera antes del primer reintento de un evento fallido (se duplica en cada intento)')
+        parser.add_argument('--stale-minutes', type=int, default=10, help='Minutos tras los que un evento PROCESANDO se considera huérfano')
+        parser.add_argument('--purge-days', type=int, default=7, help='Días que se conservan los eventos PROCESADOS')
+        parser.add_argument('--once', action='store_true', help='Drena la bandeja una vez y termina')
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.stop_event = threading.Event()
+        workers = max(1, options['workers'])
+
+        self.stdout.write(self.style.SUCCESS(f'✅ [Inbox] Iniciando {workers} consumidor(es) de webhooks...'))
+        if workers > 1:
+            # Un acuse puede aplicarse antes que el messages.upsert de su mensaje (otro hilo) y perderse
+            self.stdout.write(self.style.WARNING('⚠️ Con varios consumidores los eventos de un mismo contacto pueden procesarse fuera de orden.'))
+        self._mantenimiento()
+
+        if options['once']:
+            while self._procesar_lote():
+                pass
+            return
+
+        hilos = [threading.Thread(target=self._loop_consumidor, name=f'inbox-{i}', daemon=True) for i in range(workers)]
+        for h in hilos:
+            h.start()
+
+        try:
+            ultimo_mantenimiento = time.monotonic()
+            while any(h.is_alive() for h in hilos):
+                time.sleep(1)
+                if time.monotonic() - ultimo_mantenimiento > 60:
+                    self._mantenimiento()
+                    ultimo_mantenimiento = time.monotonic()
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.WARNING('\n🛑 Consumidor detenido por el usuario (Ctrl+C).'))
+            self.stop_event.set()
+            for h in hilos:
+                h.join(timeout=30)
+
+    def _loop_consumidor(self):
+        while not self.stop_event.is_set():
+            close_old_connections()
+            try:
+                procesados = self._procesar_lote()
+            except Exception as e:
+                self.stdout.write(self.style.ERROR(f"🔥 Error en consumidor de bandeja: {e}"))
+                procesados = 0
+                self.stop_event.wait(5)
+            if not procesados:
+                self.stop_event.wait(self.options['idle_sleep'])
+        close_old_connections()
+
+    def _reclamar_lote(self):
+        """
+        Reclama un lote de eventos PENDIENTES en orden de llegada sin bloquear a otros consumidores (SKIP LOCKED).
+        Los que fallaron esperan hasta `disponible_desde`.
+        """
+        with transaction.atomic():
+            ids = list(
+                WebhookInbox.objects.select_for_update(skip_locked=True)
+                .filter(estado='PENDIENTE')
+                .filter(Q(disponible_desde__isnull=True) | Q(disponible_desde__lte=timezone.now()))
+                .order_by('id')
+                .values_list('id', flat=True)[:self.options['batch_size']]
+            )
+            if ids:
+                WebhookInbox.objects.filter(id__in=ids).update(
+                    estado='PROCESANDO',
+                    intentos=F('intentos') + 1,
+                    fecha_tomado=timezone.now()
+                )
+        return list(WebhookInbox.objects.filter(id__in=ids).order_by('id')) if ids else []
+
+    def _procesar_lote(self):
+        lote = self._reclamar_lote()
+        view = WasenderWebhookView()
+        # Los acuses de todo el lote se agrupan y se aplican al final con un UPDATE por estado
+        estados_acumulados = {}
+        items_estado = []
+
+        for item in lote:
+            try:
+                payload = json.loads(item.payload)
+                capturas.capturar(payload)
+                item.evento = payload.get('event') if isinstance(payload, dict) else None
+                view.process_payload(payload, estados_acumulados=estados_acumulados)
+                item.estado = 'PROCESADO'
+                item.error_log = None
+                item.fecha_procesado = timezone.now()
+                if item.evento in view.EVENTOS_ESTADO:
+                    items_estado.append(item)
+                    continue
+            except json.JSONDecodeError as e:
+                item.estado = 'ERROR'
+                item.error_log = f"JSON inválido: {e}"
+            except Exception as e:
+                self._marcar_fallo(item, e)
+            item.save(update_fields=['evento', 'estado', 'error_log', 'fecha_procesado', 'disponible_desde'])
+
+        if items_estado:
+            try:
+                view.aplicar_estados(estados_acumulados)
+            except Exception as e:
+                for item in items_estado:
+                    self._marcar_fallo(item, e)
+            WebhookInbox.objects.bulk_update(items_estado, ['evento', 'estado', 'error_log', 'fecha_procesado', 'disponible_desde'])
+
+        return len(lote)
+
+    def _marcar_fallo(self, item, error):
+        # Se reintenta con espera exponencial (30 s, 1 min, 2 min...) hasta agotar los intentos
+        item.estado = 'ERROR' if item.intentos >= self.options['max_intentos'] else 'PENDIENTE'
+        item.error_log = str(error)
+        item.fecha_procesado = None
+        espera = self.options['backoff_segundos'] * 2 ** max(item.intentos - 1, 0)
+        item.disponible_desde = timezone.now() + datetime.timedelta(seconds=espera)
+        self.stdout.write(self.style.ERROR(f"   ❌ Evento #{item.id} falló (intento {item.intentos}): {error}"))
+
+    def _mantenimiento(self):
+        """Reencola eventos huérfanos (consumidor caído) y purga los ya procesados"""
+        ahora = timezone.now()
+        limite_huerfanos = ahora - datetime.timedelta(minutes=self.options['stale_minutes'])
+        huerfanos = WebhookInbox.objects.filter(estado='PROCESANDO').filter(
+            Q(fecha_tomado__lt=limite_huerfanos) | Q(fecha_tomado__isnull=True)
+        ).update(estado='PENDIENTE')
+        if huerfanos:
+            self.stdout.write(f"🧹 [Inbox] {huerfanos} eventos huérfanos reencolados.")
+
+        limite_purga = ahora - datetime.timedelta(days=self.options['purge_days'])
+        borrados, _ = WebhookInbox.objects.filter(estado='PROCESADO', fecha_procesado__lt=limite_purga).delete()
+        if borrados:
+            self.stdout.write(f"🧹 [Inbox] {borrados} eventos procesados purgados.")
+
+        # Latencias de WASender de este proceso (descarga de multimedia, decrypt) desde el último resumen
+        if wasender.resumen_pendiente():
+            for linea in wasender.resumen():
+                self.stdout.write(f"📈 [Inbox] {linea}")
@@ -0,0 +1,64 @@
+import json
+import datetime
+from django.core.management.base import BaseCommand, CommandError
+from CoreApps.chat.models import WebhookInbox
+from CoreApps.chat.views import WasenderWebhookView
+from CoreApps.chat.capture import listar_segmentos, leer_capturas
+
+
+class Command(BaseCommand):
+    help = 'Re-procesa payloads de webhooks capturados (segmentos de logs/webhooks o el antiguo logs_webhook_debug.json).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('archivos', nargs='*', help='Segmentos a leer (por defecto todos los de WEBHOOK_CAPTURE_DIR)')
+        parser.add_argument('--dir', help='Directorio de segmentos alternativo')
+        parser.add_argument('--event', action='append', dest='eventos', help='Filtrar por evento (repetible)')
+        parser.add_argument('--since', help='Solo capturas desde esta fecha/hora (ISO, ej. 2026-03-01T08:00)')
+        parser.add_argument('--until', help='Solo capturas hasta esta fecha/hora (ISO)')
+        parser.add_argument('--limit', type=int, default=0, help='Máximo de payloads a re-procesar')
+        parser.add_argument('--enqueue', action='store_true', help='Encolar en WebhookInbox en lugar de procesar en línea')
+        parser.add_argument('--dry-run', action='store_true', help='Solo listar lo que se re-procesaría')
+
+    def handle(self, *args, **options):
+        rutas = options['archivos'] or listar_segmentos(options['dir'])
+        if not rutas:
+            raise CommandError('No se encontraron segmentos de captura.')
+
+        desde = self._parse_fecha(options['since'])
+        hasta = self._parse_fecha(options['until'])
+        view = WasenderWebhookView()
+        total, errores = 0, 0
+
+        self.stdout.write(self.style.SUCCESS(f'✅ [Replay] Leyendo {len(rutas)} segmento(s)...'))
+        for registro in leer_capturas(rutas, eventos=options['eventos'], desde=desde, hasta=hasta):
+            if options['limit'] and total >= options['limit']:
+                break
+            total += 1
+            payload = registro.get('payload')
+            if options['dry_run']:
+                self.stdout.write(f"   • {registro.get('event')} ({self._formatear_ts(registro.get('ts'))})")
+                continue
+            try:
+                if options['enqueue']:
+                    WebhookInbox.objects.create(payload=payload if isinstance(payload, str) else json.dumps(payload))
+                else:
+                    if isinstance(payload, str):
+                        payload = json.loads(payload)
+                    view.process_payload(payload)
+            except Exception as e:
+                errores += 1
+                self.stdout.write(self.style.ERROR(f"   ❌ Error en {registro.get('event')}: {e}"))
+
+        accion = 'listados' if options['dry_run'] else ('encolados' if options['enqueue'] else 'procesados')
+        self.stdout.write(self.style.SUCCESS(f'🏁 [Replay] {total} payloads {accion}, {errores} errores.'))
+
+    def _parse_fecha(self, valor):
+        if not valor:
+            return None
+        try:
+            return datetime.datetime.fromisoformat(valor).timestamp()
+        except ValueError:
+            raise CommandError(f'Fecha inválida: {valor}')
+
+    def _formatear_ts(self, ts):
+        return datetime.datetime.fromtimestamp(ts).isoformat(timespec='seconds') if ts else 'sin fecha'
@@ -0,0 +1,274 @@
+"""
+Caché de multimedia decriptada de WhatsApp (usada por MediaProxyView).
+
+- Direccionada por contenido: el archivo se nombra con el sha256 de sus bytes (`ab/abcd....ogg`),
+  así un mismo adjunto reenviado a varios contactos ocupa disco una sola vez.
+- El índice (MediaCacheEntry) mapea mediaKey -> archivo, con tamaño y último acceso.
+- Escritura atómica: se descarga a un temporal en el mismo directorio y se publica con os.replace.
+- Presupuesto de bytes (CHAT_MEDIA_CACHE_MAX_BYTES) con expulsión LRU por último acceso.
+- Single-flight: peticiones simultáneas del mismo adjunto esperan a una única descarga en curso.
+"""
+import os
+import hashlib
+import logging
+import tempfile
+import threading
+import datetime
+from django.conf import settings
+from django.db import IntegrityError
+from django.db.models import Max, Sum
+from django.utils import timezone
+
+from CoreApps.notifications.wasender_client import wasender
+from .models import MediaCacheEntry
+
+logger = logging.getLogger(__name__)
+
+# Clave del mensaje de WhatsApp que espera /decrypt-media según el tipo de adjunto
+TIPOS_WHATSAPP = {
+    'AUDIO': 'audioMessage',
+    'IMAGE': 'imageMessage',
+    'VIDEO': 'videoMessage',
+    'DOCUMENT': 'documentMessage',
+}
+
+
+class MediaNoDisponible(Exception):
+    """El adjunto no se pudo obtener; `status` es el código HTTP que debe devolver el proxy"""
+
+    def __init__(self, mensaje, status=404):
+        super().__init__(mensaje)
+        self.status = status
+
+
+def status_proxy(status_code):
+    """
+    Código que devuelve el proxy ante un error de WASender o de la descarga: 4xx = adjunto expirado o
+    inválido (404, definitivo); 429 y 5xx = fallo temporal (503 / 502, el prefetch lo reintenta).
+    """
+    if status_code == 429:
+        return 503
+    if status_code >= 500:
+        return 502
+    return 404
+
+
+def extension_para(mimetype):
+    extension = 'bin'
+    if mimetype:
+        if 'audio' in mimetype: extension = 'ogg'
+        elif 'image' in mimetype: extension = 'jpg'
+        elif 'video' in mimetype: extension = 'mp4'
+        elif 'pdf' in mimetype: extension = 'pdf'
+        elif '/' in mimetype: extension = mimetype.split('/')[-1].split(';')[0]
+    return extension
+
+
+class MediaCache:
+
+    # No se reescribe el último acceso en cada hit: basta con esta resolución para el LRU
+    RESOLUCION_ACCESO = datetime.timedelta(minutes=5)
+
+    def __init__(self, directorio=None, max_bytes=None):
+        self.directorio = directorio or getattr(
+            settings, 'CHAT_MEDIA_CACHE_DIR', os.path.join(settings.MEDIA_ROOT, 'wasender_cache')
+        )
+        self.max_bytes = max_bytes or getattr(settings, 'CHAT_MEDIA_CACHE_MAX_BYTES', 2 * 1024 ** 3)
+        self._lock = threading.Lock()
+        self._en_vuelo = {}  # clave -> [Lock, usuarios]
+
+    # --- Consulta ---
+
+    @staticmethod
+    def clave_para(mensaje):
+        if not mensaje.media_key:
+            return None
+        return hashlib.sha256(mensaje.media_key.encode('utf-8')).hexdigest()
+
+    def ruta_absoluta(self, entrada):
+        return os.path.join(self.directorio, entrada.ruta)
+
+    def obtener(self, mensaje):
+        """Entrada de caché válida (archivo presente) o None"""
+        clave = self.clave_para(mensaje)
+        if not clave:
+            return None
+        entrada = MediaCacheEntry.objects.filter(clave=clave).first()
+        if not entrada:
+            return None
+        if not os.path.exists(self.ruta_absoluta(entrada)):
+            entrada.delete()  # Archivo borrado a mano o expulsado por otro proceso
+            return None
+        ahora = timezone.now()
+        if ahora - entrada.ultimo_acceso > self.RESOLUCION_ACCESO:
+            MediaCacheEntry.objects.filter(pk=entrada.pk).update(ultimo_acceso=ahora)
+            entrada.ultimo_acceso = ahora
+        return entrada
+
+    def obtener_o_descargar(self, mensaje, max_bytes=None):
+        """
+        Devuelve la entrada de caché, decriptando y descargando el adjunto si hace falta.
+        Las llamadas concurrentes para el mismo adjunto comparten una sola descarga.
+        """
+        entrada = self.obtener(mensaje)
+        if entrada:
+            return entrada
+        clave = self.clave_para(mensaje)
+        if not clave or not mensaje.media_url:
+            raise MediaNoDisponible('Multimedia no decriptable')
+
+        vuelo = self._reservar_vuelo(clave)
+        try:
+            with vuelo[0]:
+                # Quien esperaba encuentra el archivo ya publicado por la descarga anterior
+                entrada = self.obtener(mensaje) or self._importar_legado(mensaje, clave)
+                if entrada:
+                    return entrada
+                return self._descargar(mensaje, clave, max_bytes=max_bytes)
+        finally:
+            self._liberar_vuelo(clave)
+
+    def _reservar_vuelo(self, clave):
+        with self._lock:
+            vuelo = self._en_vuelo.setdefault(clave, [threading.Lock(), 0])
+            vuelo[1] += 1
+            return vuelo
+
+    def _liberar_vuelo(self, clave):
+        with self._lock:
+            vuelo = self._en_vuelo.get(clave)
+            if vuelo:
+                vuelo[1] -= 1
+                if vuelo[1] <= 0:
+                    del self._en_vuelo[clave]
+
+    # --- Descarga ---
+
+    def _solicitar_url_publica(self, mensaje):
+        """Pide a WASender la URL pública del adjunto decriptado"""
+        payload = {
+            "data": {
+                "messages": {
+                    "key": {
+                        "id": mensaje.wasender_message_id or f"temp_{mensaje.id}"
+                    },
+                    "message": {
+                        TIPOS_WHATSAPP.get(mensaje.media_type, 'documentMessage'): {
+                            "url": mensaje.media_url,
+                            "mimetype": mensaje.mimetype or "application/octet-stream",
+                            "mediaKey": mensaje.media_key
+                        }
+                    }
+                }
+            }
+        }
+        headers = {
+            "Authorization": f"Bearer {settings.WASENDER_API_KEY}",
+            "Content-Type": "application/json"
+        }
+        decrypt_endpoint = f"{settings.WASENDER_BASE_URL.rstrip('/')}/decrypt-media"
+
+        logger.info(f"Iniciando decriptación para mensaje {mensaje.id} (Endpoint: /decrypt-media)")
+        resp = wasender.post('decrypt', decrypt_endpoint, json=payload, headers=headers, idempotent=True)
+        if resp.status_code != 200:
+            logger.warning(f"Multimedia no decriptable para mensaje {mensaje.id}: {resp.status_code} - {resp.text}")
+            if status_proxy(resp.status_code) != 404:
+                raise MediaNoDisponible('WASender no está disponible en este momento, inténtalo más tarde', status=status_proxy(resp.status_code))
+            # Ej: mensaje muy antiguo cuya URL de WhatsApp ya expiró
+            raise MediaNoDisponible('El archivo multimedia ya no está disponible en WhatsApp', status=404)
+
+        public_url = resp.json().get('publicUrl')
+        if not public_url:
+            logger.error(f"Falla en respuesta WASender (publicUrl no encontrado): {resp.text}")
+            raise MediaNoDisponible('No se obtuvo URL decriptada', status=500)
+        return public_url
+
+    def _descargar(self, mensaje, clave, max_bytes=None):
+        public_url = self._solicitar_url_publica(mensaje)
+        logger.info(f"Descargando y cacheando multimedia desde: {public_url}")
+
+        os.makedirs(self.directorio, exist_ok=True)
+        fd, temporal = tempfile.mkstemp(dir=self.directorio, prefix='.descarga-')
+        try:
+            digest, tamano = hashlib.sha256(), 0
+            with wasender.get('download', public_url, stream=True) as media_resp:
+                if media_resp.status_code != 200:
+                    raise MediaNoDisponible('Error al descargar el archivo decriptado', status=status_proxy(media_resp.status_code))
+                with os.fdopen(fd, 'wb') as f:
+                    fd = None
+                    for chunk in media_resp.iter_content(chunk_size=64 * 1024):
+                        tamano += len(chunk)
+                        if max_bytes and tamano > max_bytes:
+                            raise MediaNoDisponible('El archivo supera el tamaño máximo permitido', status=413)
+                        digest.update(chunk)
+                        f.write(chunk)
+            return self._publicar(temporal, clave, digest.hexdigest(), tamano, mensaje.mimetype)
+        finally:
+            if fd is not None:
+                os.close(fd)
+            if os.path.exists(temporal):
+                os.remove(temporal)
+
+    def _importar_legado(self, mensaje, clave):
+        """Adopta los archivos del esquema anterior (msg_<id>.<ext>) sin volver a llamar a WASender"""
+        legado = os.path.join(self.directorio, f"msg_{mensaje.id}.{extension_para(mensaje.mimetype)}")
+        if not os.path.exists(legado):
+            return None
+        digest = hashlib.sha256()
+        with open(legado, 'rb') as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b''):
+                digest.update(chunk)
+        return self._publicar(legado, clave, digest.hexdigest(), os.path.getsize(legado), mensaje.mimetype)
+
+    def _publicar(self, origen, clave, sha256, tamano, mimetype):
+        """Mueve el archivo a su ruta por contenido (atómico) y registra la entrada en el índice"""
+        relativa = os.path.join(sha256[:2], f"{sha256}.{extension_para(mimetype)}")
+        destino = os.path.join(self.directorio, relativa)
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        if os.path.exists(destino):
+            os.remove(origen)  # Mismo contenido ya cacheado por otro mensaje
+        else:
+            os.replace(origen, destino)
+
+        try:
+            entrada, _ = MediaCacheEntry.objects.update_or_create(
+                clave=clave,
+                defaults={'sha256': sha256, 'ruta': relativa, 'tamano': tamano,
+                          'mimetype': mimetype, 'ultimo_acceso': timezone.now()}
+            )
+        except IntegrityError:
+            entrada = MediaCacheEntry.objects.get(clave=clave)  # Otro proceso la registró a la vez
+        logger.info(f"Archivo guardado en caché: {relativa}")
+        self.aplicar_presupuesto()
+        return entrada
+
+    # --- Presupuesto / LRU ---
+
+    def bytes_en_uso(self):
+        # Cada archivo cuenta una vez aunque varias entradas lo compartan
+        return MediaCacheEntry.objects.values('sha256').annotate(t=Max('tamano')).aggregate(total=Sum('t'))['total'] or 0
+
+    def aplicar_presupuesto(self):
+        """Expulsa las entradas menos usadas hasta quedar en el 90% del presupuesto"""
+        total = self.bytes_en_uso()
+        if total <= self.max_bytes:
+            return 0
+        objetivo = int(self.max_bytes * 0.9)
+        expulsadas = 0
+        for entrada in MediaCacheEntry.objects.order_by('ultimo_acceso', 'id').iterator():
+            if total <= objetivo:
+                break
+            entrada.delete()
+            expulsadas += 1
+            if not MediaCacheEntry.objects.filter(sha256=entrada.sha256).exists():
+                try:
+                    os.remove(self.ruta_absoluta(entrada))
+                except FileNotFoundError:
+                    pass
+                total -= entrada.tamano
+        logger.info(f"Caché multimedia: {expulsadas} entradas expulsadas (LRU)")
+        return expulsadas
+
+
+# Instancia compartida por proceso
+media_cache = MediaCache()
@@ -0,0 +1,99 @@
+"""
+Prefetch de multimedia entrante: decripta y cachea los adjuntos en segundo plano apenas llegan
+por webhook, antes de que expire la URL de WhatsApp y sin que el operador espere al abrirlos.
+
+- Pool de hilos acotado (CHAT_MEDIA_PREFETCH_WORKERS) con límite de trabajos pendientes:
+  si se satura, el adjunto se omite y se decripta bajo demanda como antes (MediaProxyView).
+- Tamaño máximo por tipo (CHAT_MEDIA_PREFETCH_MAX_BYTES); los tipos no listados no se prefetchean.
+- Reintentos con backoff exponencial y jitter solo para fallos transitorios (red, 5xx, 429).
+"""
+import random
+import logging
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import transaction, close_old_connections
+
+from .models import ChatMensaje
+from .media_cache import media_cache, MediaNoDisponible
+
+logger = logging.getLogger(__name__)
+
+MAX_BYTES_POR_TIPO = {
+    'AUDIO': 16 * 1024 * 1024,
+    'IMAGE': 10 * 1024 * 1024,
+    'DOCUMENT': 20 * 1024 * 1024,
+    'VIDEO': 32 * 1024 * 1024,
+}
+
+
+class MediaPrefetcher:
+
+    def __init__(self):
+        self.habilitado = getattr(settings, 'CHAT_MEDIA_PREFETCH_ENABLED', True)
+        self.workers = getattr(settings, 'CHAT_MEDIA_PREFETCH_WORKERS', 2)
+        self.max_pendientes = getattr(settings, 'CHAT_MEDIA_PREFETCH_MAX_PENDING', 200)
+        self.max_intentos = getattr(settings, 'CHAT_MEDIA_PREFETCH_RETRIES', 3)
+        self.backoff_base = getattr(settings, 'CHAT_MEDIA_PREFETCH_BACKOFF', 5)
+        self.max_bytes = getattr(settings, 'CHAT_MEDIA_PREFETCH_MAX_BYTES', MAX_BYTES_POR_TIPO)
+        self._executor = None
+        self._pendientes = 0
+        self._lock = threading.Lock()
+
+    def programar(self, mensaje_ids):
+        """Encola los mensajes para prefetch cuando confirme la transacción en curso"""
+        mensaje_ids = [m for m in mensaje_ids if m]
+        if not self.habilitado or not mensaje_ids:
+            return
+        transaction.on_commit(lambda: [self._enviar(mensaje_id, 1) for mensaje_id in mensaje_ids])
+
+    def _enviar(self, mensaje_id, intento):
+        with self._lock:
+            if self._pendientes >= self.max_pendientes:
+                logger.warning(f"Prefetch multimedia saturado: se omite el mensaje {mensaje_id}")
+                return
+            self._pendientes += 1
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='media-prefetch')
+        self._executor.submit(self._procesar, mensaje_id, intento)
+
+    def _procesar(self, mensaje_id, intento):
+        close_old_connections()
+        try:
+            mensaje = ChatMensaje.objects.filter(id=mensaje_id).first()
+            if not mensaje or not mensaje.media_key or not mensaje.media_url:
+                return
+            max_bytes = self.max_bytes.get(mensaje.media_type)
+            if not max_bytes:
+                return
+            media_cache.obtener_o_descargar(mensaje, max_bytes=max_bytes)
+            logger.info(f"Prefetch multimedia OK para mensaje {mensaje_id}")
+        except MediaNoDisponible as e:
+            # 404 (expirado) o 413 (demasiado grande) son definitivos; 502/503 (WASender caído o 429) no
+            if e.status >= 500:
+                self._reintentar(mensaje_id, intento, e)
+            else:
+                logger.info(f"Prefetch multimedia omitido para mensaje {mensaje_id}: {e}")
+        except requests.RequestException as e:
+            self._reintentar(mensaje_id, intento, e)
+        except Exception as e:
+            logger.error(f"Error en prefetch multimedia del mensaje {mensaje_id}: {e}")
+        finally:
+            with self._lock:
+                self._pendientes -= 1
+            close_old_connections()
+
+    def _reintentar(self, mensaje_id, intento, error):
+        if intento >= self.max_intentos:
+            logger.warning(f"Prefetch multimedia agotó reintentos para mensaje {mensaje_id}: {error}")
+            return
+        # Backoff exponencial con jitter; el temporizador no ocupa un hilo del pool mientras espera
+        espera = self.backoff_base * (2 ** (intento - 1)) * random.uniform(0.5, 1.5)
+        temporizador = threading.Timer(espera, self._enviar, args=(mensaje_id, intento + 1))
+        temporizador.daemon = True
+        temporizador.start()
+
+
+# Instancia compartida por proceso
+prefetcher = MediaPrefetcher()
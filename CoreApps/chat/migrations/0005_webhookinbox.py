@@ -0,0 +1,33 @@
+# Generated by Django 6.0 on 2026-10-18 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_chatmensaje_media_key_chatmensaje_mimetype'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebhookInbox',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('payload', models.TextField(verbose_name='Body crudo del webhook')),
+                ('evento', models.CharField(blank=True, max_length=100, null=True)),
+                ('estado', models.CharField(choices=[('PENDIENTE', 'Pendiente'), ('PROCESANDO', 'Procesando'), ('PROCESADO', 'Procesado'), ('ERROR', 'Error')], default='PENDIENTE', max_length=20)),
+                ('intentos', models.PositiveIntegerField(default=0)),
+                ('error_log', models.TextField(blank=True, null=True)),
+                ('fecha_recepcion', models.DateTimeField(auto_now_add=True)),
+                ('fecha_tomado', models.DateTimeField(blank=True, help_text='Momento en que un consumidor reclamó el evento', null=True)),
+                ('fecha_procesado', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'Evento de Webhook (Bandeja)',
+                'verbose_name_plural': 'Eventos de Webhook (Bandeja)',
+                'ordering': ['id'],
+                'indexes': [models.Index(fields=['estado', 'id'], name='chat_webhoo_estado_ad7cce_idx')],
+            },
+        ),
+    ]
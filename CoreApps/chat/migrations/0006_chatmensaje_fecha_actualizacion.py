@@ -0,0 +1,32 @@
+# Generated by Django 6.0 on 2026-10-18 11:48
+
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import F
+
+
+def poblar_fecha_actualizacion(apps, schema_editor):
+    """Los mensajes existentes toman como marca de cambio su propia fecha de creación"""
+    ChatMensaje = apps.get_model('chat', 'ChatMensaje')
+    ChatMensaje.objects.update(fecha_actualizacion=F('fecha_mensaje'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_webhookinbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmensaje',
+            name='fecha_actualizacion',
+            field=models.DateTimeField(auto_now=True, db_index=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.RunPython(poblar_fecha_actualizacion, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='chatmensaje',
+            index=models.Index(fields=['contacto', 'fecha_actualizacion'], name='chat_msg_contacto_cambio_idx'),
+        ),
+    ]
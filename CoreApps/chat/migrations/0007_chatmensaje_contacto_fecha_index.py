@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-18 12:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_chatmensaje_fecha_actualizacion'),
+        ('crm_marketing', '0018_crmcontact_ultimo_mensaje'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chatmensaje',
+            index=models.Index(fields=['contacto', 'fecha_mensaje'], name='chat_msg_contacto_fecha_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 6.0 on 2026-10-18 13:05
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_chatmensaje_contacto_fecha_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaCacheEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('clave', models.CharField(help_text='sha256 del mediaKey de WhatsApp', max_length=64, unique=True)),
+                ('sha256', models.CharField(db_index=True, help_text='sha256 del contenido decriptado', max_length=64)),
+                ('ruta', models.CharField(help_text='Ruta relativa dentro del directorio de caché', max_length=255)),
+                ('tamano', models.BigIntegerField()),
+                ('mimetype', models.CharField(blank=True, max_length=100, null=True)),
+                ('fecha_creacion', models.DateTimeField(auto_now_add=True)),
+                ('ultimo_acceso', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+            options={
+                'verbose_name': 'Multimedia en Caché',
+                'verbose_name_plural': 'Multimedia en Caché',
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-18 18:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_mediacacheentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhookinbox',
+            name='disponible_desde',
+            field=models.DateTimeField(blank=True, help_text='Tras un fallo, no se reintenta antes de este momento', null=True),
+        ),
+    ]
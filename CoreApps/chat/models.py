@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 from CoreApps.crm_marketing.models import CrmContact
 #modelo para el crm
 class WhatsAppConversation(models.Model):
@@ -71,6 +72,9 @@ class ChatMensaje(models.Model):
     wasender_message_id = models.CharField(max_length=200, blank=True, null=True, unique=True)
     estado_envio = models.CharField(max_length=20, choices=ESTADO_CHOICES, default='ENVIADO')
     fecha_mensaje = models.DateTimeField(auto_now_add=True)
+    # Marca de cambio para la sincronización incremental del Inbox (?since=).
+    # Los .update()/bulk_update no tocan auto_now: hay que asignarla explícitamente.
+    fecha_actualizacion = models.DateTimeField(auto_now=True, db_index=True)
     
     # Para saber si un operador ya vio un mensaje "Entrante"
     leido_por_operador = models.BooleanField(default=False)
@@ -79,7 +83,85 @@ class ChatMensaje(models.Model):
         verbose_name = "Mensaje de Chat CRM"
         verbose_name_plural = "Mensajes de Chat CRM"
         ordering = ['fecha_mensaje']
+        indexes = [
+            models.Index(fields=['contacto', 'fecha_actualizacion'], name='chat_msg_contacto_cambio_idx'),
+            models.Index(fields=['contacto', 'fecha_mensaje'], name='chat_msg_contacto_fecha_idx'),
+        ]
+
+    @classmethod
+    def recalcular_ultimo_mensaje(cls, contacto_ids):
+        """
+        Recalcula CrmContact.ultimo_mensaje / fecha_ultimo_mensaje de los contactos indicados con un solo UPDATE.
+        Usar tras escrituras que no disparan señales (bulk_create, .update(), .delete() masivos, fusiones).
+        """
+        from django.db.models import OuterRef, Subquery
+        from CoreApps.crm_marketing.models import CrmContact
+        contacto_ids = list(contacto_ids)
+        if not contacto_ids:
+            return
+        ultimo = cls.objects.filter(contacto_id=OuterRef('pk')).order_by('-fecha_mensaje', '-id')
+        CrmContact.objects.filter(id__in=contacto_ids).update(
+            ultimo_mensaje=Subquery(ultimo.values('id')[:1]),
+            fecha_ultimo_mensaje=Subquery(ultimo.values('fecha_mensaje')[:1]),
+        )
 
     def __str__(self):
         prefijo = "⬅️" if self.direccion == 'INBOUND' else "➡️"
         return f"{prefijo} {self.contacto.nombres}: {str(self.texto)[:30]}"
+
+
+class WebhookInbox(models.Model):
+    """
+    Bandeja durable de eventos crudos de WASender.
+    En modo asíncrono el webhook solo guarda aquí el body y responde 200;
+    el comando `process_webhook_inbox` drena y procesa los eventos por lotes.
+    """
+    ESTADOS = [
+        ('PENDIENTE', 'Pendiente'),
+        ('PROCESANDO', 'Procesando'),
+        ('PROCESADO', 'Procesado'),
+        ('ERROR', 'Error'),
+    ]
+
+    payload = models.TextField(verbose_name="Body crudo del webhook")
+    evento = models.CharField(max_length=100, blank=True, null=True)
+    estado = models.CharField(max_length=20, choices=ESTADOS, default='PENDIENTE')
+    intentos = models.PositiveIntegerField(default=0)
+    error_log = models.TextField(blank=True, null=True)
+
+    fecha_recepcion = models.DateTimeField(auto_now_add=True)
+    fecha_tomado = models.DateTimeField(null=True, blank=True, help_text="Momento en que un consumidor reclamó el evento")
+    disponible_desde = models.DateTimeField(null=True, blank=True, help_text="Tras un fallo, no se reintenta antes de este momento")
+    fecha_procesado = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = "Evento de Webhook (Bandeja)"
+        verbose_name_plural = "Eventos de Webhook (Bandeja)"
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['estado', 'id']),
+        ]
+
+    def __str__(self):
+        return f"#{self.id} {self.evento or 'sin evento'} [{self.estado}]"
+
+
+class MediaCacheEntry(models.Model):
+    """
+    Índice de la caché de multimedia decriptada (CoreApps/chat/media_cache.py).
+    Los archivos se guardan por hash de contenido: varias entradas (ej. un reenvío) pueden compartir archivo.
+    """
+    clave = models.CharField(max_length=64, unique=True, help_text="sha256 del mediaKey de WhatsApp")
+    sha256 = models.CharField(max_length=64, db_index=True, help_text="sha256 del contenido decriptado")
+    ruta = models.CharField(max_length=255, help_text="Ruta relativa dentro del directorio de caché")
+    tamano = models.BigIntegerField()
+    mimetype = models.CharField(max_length=100, blank=True, null=True)
+    fecha_creacion = models.DateTimeField(auto_now_add=True)
+    ultimo_acceso = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        verbose_name = "Multimedia en Caché"
+        verbose_name_plural = "Multimedia en Caché"
+
+    def __str__(self):
+        return f"{self.ruta} ({self.tamano} bytes)"
@@ -0,0 +1,17 @@
+from django.db.models import Q
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from CoreApps.crm_marketing.models import CrmContact
+from .models import ChatMensaje
+from . import events
+
+
+@receiver(post_save, sender=ChatMensaje)
+def actualizar_ultimo_mensaje(sender, instance, created, **kwargs):
+    """Mueve el puntero de último mensaje del contacto (solo si el nuevo mensaje es más reciente) y avisa al Inbox"""
+    if created:
+        CrmContact.objects.filter(pk=instance.contacto_id).filter(
+            Q(fecha_ultimo_mensaje__isnull=True) | Q(fecha_ultimo_mensaje__lte=instance.fecha_mensaje)
+        ).update(ultimo_mensaje=instance.pk, fecha_ultimo_mensaje=instance.fecha_mensaje)
+    events.publicar('mensaje', contactos=[instance.contacto_id])
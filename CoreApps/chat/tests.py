@@ -1,3 +1,178 @@
-from django.test import TestCase
+import os
+import shutil
+import hashlib
+import datetime
+import tempfile
+from unittest import mock
+from django.contrib.auth import get_user_model
+from django.test import TestCase, RequestFactory
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import http_date
 
-# Create your tests here.
+from CoreApps.crm_marketing.models import CrmContact, CampanaDifusion, MensajeCampana
+from .models import ChatMensaje, MediaCacheEntry
+from .media_cache import media_cache
+from .views import WasenderWebhookView, MediaProxyView, ChatListAPIView
+
+
+def acuse(wasender_id, status):
+    return {'key': {'id': wasender_id}, 'update': {'status': status}}
+
+
+class AcusesEstadoTests(TestCase):
+    """Acuses de WASender: se agrupan por estado y los estados solo avanzan (ENVIADO -> ENTREGADO -> LEIDO)"""
+
+    def setUp(self):
+        self.vista = WasenderWebhookView()
+        self.contacto = CrmContact.objects.create(nombres='Ana', apellidos='Paz', telefono='+593990000001')
+        campana = CampanaDifusion.objects.create(nombre='Prueba', mensaje_plantilla='Hola')
+        self.campana_msg = MensajeCampana.objects.create(
+            campana=campana, contacto=self.contacto, estado='ENVIADO', wasender_message_id='camp-1'
+        )
+        self.chat_msg = ChatMensaje.objects.create(
+            contacto=self.contacto, direccion='OUTBOUND', texto='Hola', wasender_message_id='chat-1'
+        )
+
+    def _estados(self):
+        self.campana_msg.refresh_from_db()
+        self.chat_msg.refresh_from_db()
+        return self.campana_msg.estado, self.chat_msg.estado_envio
+
+    def test_avanza_en_ambas_tablas(self):
+        self.vista.process_payload({'event': 'messages.update', 'data': [acuse('camp-1', 'DELIVERED'), acuse('chat-1', 3)]})
+        self.assertEqual(self._estados(), ('ENTREGADO', 'ENTREGADO'))
+
+    def test_entregado_tardio_no_pisa_leido(self):
+        self.vista.process_payload({'event': 'messages.update', 'data': [acuse('camp-1', 'READ'), acuse('chat-1', 4)]})
+        self.vista.process_payload({'event': 'messages.update', 'data': [acuse('camp-1', 'DELIVERED'), acuse('chat-1', 'DELIVERED')]})
+        self.assertEqual(self._estados(), ('LEIDO', 'LEIDO'))
+
+    def test_evento_de_lectura_marca_leido(self):
+        self.vista.process_payload({'event': 'message.read', 'data': acuse('chat-1', '')})
+        self.assertEqual(self._estados(), ('ENVIADO', 'LEIDO'))
+
+    def test_error_se_corrige_con_un_acuse_real(self):
+        ChatMensaje.objects.filter(pk=self.chat_msg.pk).update(estado_envio='ERROR')
+        self.vista.process_payload({'event': 'messages.update', 'data': acuse('chat-1', 'DELIVERED')})
+        self.assertEqual(self._estados(), ('ENVIADO', 'ENTREGADO'))
+
+    def test_acumulado_se_aplica_al_final_del_lote(self):
+        acumulado = {}
+        self.vista.process_payload({'event': 'messages.update', 'data': acuse('camp-1', 'READ')}, estados_acumulados=acumulado)
+        self.vista.process_payload({'event': 'messages.update', 'data': acuse('camp-1', 'DELIVERED')}, estados_acumulados=acumulado)
+        self.assertEqual(self._estados(), ('ENVIADO', 'ENVIADO'))
+
+        self.vista.aplicar_estados(acumulado)
+        self.assertEqual(self._estados(), ('LEIDO', 'ENVIADO'))
+
+
+class MediaRangosTests(TestCase):
+    """Multimedia en caché: GET condicional (304) y rangos de bytes (206/416)"""
+
+    CONTENIDO = bytes(range(256)) * 4  # 1024 bytes
+
+    def setUp(self):
+        directorio = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directorio)
+        parche = mock.patch.object(media_cache, 'directorio', directorio)
+        parche.start()
+        self.addCleanup(parche.stop)
+
+        sha256 = hashlib.sha256(self.CONTENIDO).hexdigest()
+        with open(os.path.join(directorio, f'{sha256}.ogg'), 'wb') as f:
+            f.write(self.CONTENIDO)
+        self.entrada = MediaCacheEntry.objects.create(
+            clave='a' * 64, sha256=sha256, ruta=f'{sha256}.ogg', tamano=len(self.CONTENIDO), mimetype='audio/ogg'
+        )
+        self.etag = f'"{sha256}"'
+        self.factory = RequestFactory()
+
+    def _servir(self, **cabeceras):
+        request = self.factory.get('/chat/media/1/', headers=cabeceras)
+        return MediaProxyView()._servir_archivo(request, self.entrada, 'audio/ogg')
+
+    def test_completo_con_cabeceras_de_cache(self):
+        response = self._servir()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.CONTENIDO)
+        self.assertEqual(response['ETag'], self.etag)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+    def test_rango(self):
+        response = self._servir(Range='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/1024')
+        self.assertEqual(response['Content-Length'], '10')
+        self.assertEqual(b''.join(response.streaming_content), self.CONTENIDO[10:20])
+
+    def test_rango_abierto_y_sufijo(self):
+        response = self._servir(Range='bytes=1000-')
+        self.assertEqual(response['Content-Range'], 'bytes 1000-1023/1024')
+        self.assertEqual(b''.join(response.streaming_content), self.CONTENIDO[1000:])
+
+        response = self._servir(Range='bytes=-4')
+        self.assertEqual(response['Content-Range'], 'bytes 1020-1023/1024')
+        self.assertEqual(b''.join(response.streaming_content), self.CONTENIDO[-4:])
+
+    def test_rango_fuera_del_archivo(self):
+        response = self._servir(Range='bytes=2048-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */1024')
+
+    def test_if_range_distinto_sirve_completo(self):
+        response = self._servir(Range='bytes=0-9', **{'If-Range': '"otro"'})
+        self.assertEqual(response.status_code, 200)
+
+        response = self._servir(Range='bytes=0-9', **{'If-Range': self.etag})
+        self.assertEqual(response.status_code, 206)
+
+    def test_no_modificado(self):
+        self.assertEqual(self._servir(**{'If-None-Match': self.etag}).status_code, 304)
+        self.assertEqual(self._servir(**{'If-None-Match': '"otro"'}).status_code, 200)
+
+        desde = http_date(self.entrada.fecha_creacion.timestamp() + 60)
+        self.assertEqual(self._servir(**{'If-Modified-Since': desde}).status_code, 304)
+
+
+class ListaChatsDeltaTests(TestCase):
+    """Delta del listado de chats (?since=): si no cabe en una respuesta, se pide una carga completa"""
+
+    def setUp(self):
+        operador = get_user_model().objects.create_superuser(
+            email='operador@example.com', password='x', username='operador', first_name='O', last_name='P', cedula='0000000001'
+        )
+        self.client.force_login(operador)
+        self.url = reverse('chat:api_chat_list')
+        self.since = (timezone.now() - datetime.timedelta(minutes=1)).isoformat()
+
+    def _crear_chats(self, cantidad):
+        contactos = CrmContact.objects.bulk_create(
+            [CrmContact(nombres=f'C{i}', apellidos='X', telefono=f'+5939{i:08d}') for i in range(cantidad)]
+        )
+        ChatMensaje.objects.bulk_create(
+            [ChatMensaje(contacto=c, direccion='INBOUND', texto='Hola') for c in contactos]
+        )
+        ChatMensaje.recalcular_ultimo_mensaje([c.id for c in contactos])
+
+    def test_delta_completo_avanza_el_token(self):
+        self._crear_chats(3)
+        data = self.client.get(self.url, {'since': self.since}).json()
+        self.assertTrue(data['delta'])
+        self.assertFalse(data['truncado'])
+        self.assertEqual(len(data['chats']), 3)
+        self.assertNotEqual(data['sync_token'], self.since)
+
+    def test_delta_truncado_conserva_el_token(self):
+        self._crear_chats(ChatListAPIView.MAX_PAGE_SIZE + 1)
+        data = self.client.get(self.url, {'since': self.since}).json()
+        self.assertTrue(data['truncado'])
+        self.assertEqual(data['sync_token'], self.since)
+        self.assertIsNone(data['next_cursor'])
+
+        # La carga completa sí pagina por cursor y entrega un token nuevo
+        data = self.client.get(self.url, {'limit': ChatListAPIView.MAX_PAGE_SIZE}).json()
+        self.assertFalse(data['delta'])
+        self.assertFalse(data['truncado'])
+        self.assertIsNotNone(data['next_cursor'])
+        self.assertNotEqual(data['sync_token'], self.since)
@@ -9,6 +9,7 @@ urlpatterns = [
     
     # Endpoints AJAX para Frontend
     path('api/chats/', views.ChatListAPIView.as_view(), name='api_chat_list'),
+    path('api/chats/events/', views.ChatEventsStreamView.as_view(), name='api_chat_events'),
     path('api/chats/<int:contacto_id>/', views.ChatHistoryAPIView.as_view(), name='api_chat_history'),
     path('api/chats/<int:contacto_id>/send/', views.ChatSendAPIView.as_view(), name='api_chat_send'),
     path('api/chats/<int:contacto_id>/send-location/', views.ChatSendLocationAPIView.as_view(), name='api_chat_send_location'),
@@ -4,7 +4,8 @@ from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 from django.utils import timezone, timezone as dj_timezone
 from django.db import models, transaction
 from django.db.models import Max
-from django.http import JsonResponse, HttpResponseRedirect, StreamingHttpResponse, FileResponse
+from django.http import JsonResponse, HttpResponse, HttpResponseRedirect, StreamingHttpResponse, FileResponse
+from django.core.handlers.asgi import ASGIRequest
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 from django.views import View
@@ -15,12 +16,21 @@ import uuid
 import datetime
 import logging
 import json
+import asyncio
 
 from CoreApps.crm_marketing.models import MensajeCampana, CrmContact
-from .models import WhatsAppConversation, WhatsAppMessage, ChatMensaje
+from CoreApps.crm_marketing.identity import identidades
+from .models import WhatsAppConversation, WhatsAppMessage, ChatMensaje, WebhookInbox
+from .capture import capturas
+from . import events
+from .media_cache import media_cache, MediaNoDisponible
+from .media_prefetch import prefetcher
 
 logger = logging.getLogger(__name__)
 
+# Progresión de estados de entrega de WhatsApp: nunca se retrocede
+PROGRESION_ESTADOS = ['ENVIADO', 'ENTREGADO', 'LEIDO']
+
 class SupervisorChatMixin(LoginRequiredMixin, UserPassesTestMixin):
     """Permite acceso a personal de marketing y ventas (staff) al inbox"""
     def test_func(self):
@@ -48,6 +58,7 @@ class InboxView(SupervisorChatMixin, TemplateView):
         
         # Si viene un contact_id por URL, lo pasamos al contexto para que el JS lo abra
         context['auto_open_contact_id'] = self.request.GET.get('contact_id')
+        context['chat_events_sse'] = events.sse_habilitado()
         
         return context
 
@@ -57,7 +68,12 @@ class WasenderWebhookView(View):
     """
     Recibe los eventos desde WASenderAPI (ej. message.sent, message.read)
     Documentación oficial: https://wasenderapi.com/api-docs/webhooks/webhook-setup
+
+    Si WASENDER_WEBHOOK_ASYNC está activo, solo se valida la firma y se encola el body
+    crudo en WebhookInbox; el procesamiento lo hace el comando `process_webhook_inbox`.
     """
+    EVENTOS_ESTADO = ['message.sent', 'messages.update', 'message.read', 'message.ack', 'message-receipt.update']
+
     def post(self, request, *args, **kwargs):
         try:
             # 1. Verificación de Seguridad (opcional si está configurado en .env)
@@ -66,52 +82,16 @@ class WasenderWebhookView(View):
                 if signature != settings.WASENDER_WEBHOOK_SECRET:
                     logger.warning(f"Intento de webhook con firma inválida. Recibida: {signature}")
                     return JsonResponse({'error': 'Invalid signature'}, status=401)
-            payload = json.loads(request.body)
-            try:
-                import os, json as local_json
-                debug_path = os.path.join(settings.BASE_DIR, 'logs_webhook_debug.json')
-                with open(debug_path, 'a', encoding='utf-8') as f:
-                    f.write(local_json.dumps(payload) + "\n---\n")
-            except Exception as e:
-                logger.error(f"Error saving debug: {e}")
-            if not isinstance(payload, dict):
-                return JsonResponse({'error': 'Invalid payload format'}, status=400)
-                
-            event = payload.get('event')
 
-            # 2. Manejo de prueba de conexión
-            if event == 'webhook.test':
-                return JsonResponse({'received': True, 'msg': 'Connection successful'}, status=200)
-            
-            data = payload.get('data', {})
-            if not isinstance(data, (dict, list)):
-                return JsonResponse({'status': 'ok'})
+            # Modo asíncrono: encolar y responder de inmediato
+            if getattr(settings, 'WASENDER_WEBHOOK_ASYNC', False):
+                WebhookInbox.objects.create(payload=request.body.decode('utf-8', errors='replace'))
+                return JsonResponse({'status': 'queued'})
 
-            # 3. Procesamiento de Mensajes (Nuevos o Actualizados)
-            if event in ['message.sent', 'messages.update', 'message.read', 'message.ack', 'message-receipt.update']:
-                self._handle_status_updates(event, data)
-            
-            elif event in ['messages.upsert', 'messages.received', 'message.received']:
-                # Soporte para variaciones de nombre de evento
-                messages_to_process = []
-                if (event == 'messages.upsert') and isinstance(data, dict):
-                    # WASender puede enviar dict o list en 'messages'
-                    msgs = data.get('messages', [])
-                    messages_to_process = msgs if isinstance(msgs, list) else [msgs]
-                else:
-                    # Caso messages.received o similar donde data es el objeto
-                    messages_to_process = [data] if isinstance(data, dict) else []
-                
-                for msg_data in messages_to_process:
-                    self._save_whatsapp_message(msg_data)
-            
-            elif event in ['contacts.upsert', 'contacts.update']:
-                self._handle_contact_sync(data)
-            
-            else:
-                pass # Evento ignorado
-            
-            return JsonResponse({'status': 'ok'})
+            payload = json.loads(request.body)
+            capturas.capturar(payload)  # Copia para depuración/replay (asíncrona y muestreada)
+            respuesta, status = self.process_payload(payload)
+            return JsonResponse(respuesta, status=status)
             
         except json.JSONDecodeError:
             return JsonResponse({'error': 'Invalid JSON'}, status=400)
@@ -119,10 +99,67 @@ class WasenderWebhookView(View):
             logger.error(f"Error procesando webhook de WASender: {e}", exc_info=True)
             return JsonResponse({'error': str(e)}, status=500)
 
+    def process_payload(self, payload, estados_acumulados=None):
+        """
+        Despacha un payload ya decodificado según su evento.
+        Retorna (respuesta, status_http). Lo usan el webhook síncrono y el consumidor de la bandeja;
+        este último pasa `estados_acumulados` para aplicar los acuses de todo un lote de una vez.
+        """
+        if not isinstance(payload, dict):
+            return {'error': 'Invalid payload format'}, 400
+            
+        event = payload.get('event')
+
+        # 2. Manejo de prueba de conexión
+        if event == 'webhook.test':
+            return {'received': True, 'msg': 'Connection successful'}, 200
+        
+        data = payload.get('data', {})
+        if not isinstance(data, (dict, list)):
+            return {'status': 'ok'}, 200
+
+        # 3. Procesamiento de Mensajes (Nuevos o Actualizados)
+        if event in self.EVENTOS_ESTADO:
+            self._handle_status_updates(event, data, acumulado=estados_acumulados)
+        
+        elif event in ['messages.upsert', 'messages.received', 'message.received']:
+            # Soporte para variaciones de nombre de evento
+            messages_to_process = []
+            if (event == 'messages.upsert') and isinstance(data, dict):
+                # WASender puede enviar dict o list en 'messages'
+                msgs = data.get('messages', [])
+                messages_to_process = msgs if isinstance(msgs, list) else [msgs]
+            else:
+                # Caso messages.received o similar donde data es el objeto
+                messages_to_process = [data] if isinstance(data, dict) else []
+            
+            if len(messages_to_process) > 1:
+                # Ráfagas (ej. sincronización de historial): ruta por lotes
+                self._save_whatsapp_messages_batch(messages_to_process)
+            else:
+                for msg_data in messages_to_process:
+                    self._save_whatsapp_message(msg_data)
+        
+        elif event in ['contacts.upsert', 'contacts.update']:
+            self._handle_contact_sync(data)
+        
+        else:
+            pass # Evento ignorado
+        
+        return {'status': 'ok'}, 200
+
     def _handle_contact_sync(self, data):
         """Sincroniza nombres de contactos desde la agenda de WhatsApp"""
         try:
-            contacts_list = data if isinstance(data, list) else [data]
+            contacts_list = [c for c in (data if isinstance(data, list) else [data]) if isinstance(c, dict)]
+            if len(contacts_list) > 1:
+                # Agenda completa (ej. sync_lids.py): una consulta por tipo de identificador para calentar la caché
+                jids = [c.get('id') for c in contacts_list if c.get('id')]
+                identidades.precargar(
+                    jid=jids,
+                    telefono=[j.split('@')[0] if j.startswith('+') else '+' + j.split('@')[0] for j in jids],
+                    lid=[c.get('lid') for c in contacts_list],
+                )
             for c_data in contacts_list:
                 jid = c_data.get('id', '')
                 name = c_data.get('name') or c_data.get('notify')
@@ -137,12 +174,9 @@ class WasenderWebhookView(View):
                 if not telefono_puro.startswith('+'):
                     telefono_puro = f"+{telefono_puro}"
                 
-                from django.db.models import Q
-                query = Q(whatsapp_jid=jid) | Q(telefono=telefono_puro)
-                if lid:
-                    query |= Q(whatsapp_lid=lid)
-                
-                contacto = CrmContact.objects.filter(query).first()
+                contacto = (identidades.get_contact('jid', jid) or
+                            identidades.get_contact('telefono', telefono_puro) or
+                            identidades.get_contact('lid', lid))
                 if contacto:
                     updated_fields = []
                     if lid and contacto.whatsapp_lid != lid:
@@ -167,19 +201,25 @@ class WasenderWebhookView(View):
                         
                     if updated_fields:
                         contacto.save(update_fields=updated_fields)
+                        identidades.recordar(contacto)
                         logger.info(f"Contacto actualizado desde agenda: {name} ({telefono_puro})")
         except Exception as e:
             logger.error(f"Error en _handle_contact_sync: {e}")
 
-    def _handle_status_updates(self, event, data):
-        """Maneja el rastro de lectura/entrega para campañas y chat en vivo"""
+    def _handle_status_updates(self, event, data, acumulado=None):
+        """
+        Maneja el rastro de lectura/entrega para campañas y chat en vivo.
+        Agrupa los acuses por estado destino y los aplica con un UPDATE ... IN (...) por estado y tabla.
+        Si se pasa `acumulado`, solo se agregan ahí (el consumidor de la bandeja los aplica por lote).
+        """
+        ids_por_estado = acumulado if acumulado is not None else {}
         updates = data if isinstance(data, list) else [data]
         for upd in updates:
             if not isinstance(upd, dict): continue
             key = upd.get('key', {})
             wasender_id = key.get('id')
             if wasender_id:
-                status_str = upd.get('update', {}).get('status', '').upper()
+                status_str = str(upd.get('update', {}).get('status', '')).upper()
                 
                 # Mapeo robusto de estados de WASender
                 # 3 = Delivered (Check Gris), 4 o 'READ' = Read (Check Azul)
@@ -190,288 +230,513 @@ class WasenderWebhookView(View):
                 else:
                     nuevo_estado = 'ENVIADO'
                 
+                ids_por_estado.setdefault(nuevo_estado, set()).add(wasender_id)
+
+        if acumulado is None:
+            self.aplicar_estados(ids_por_estado)
+
+    def aplicar_estados(self, ids_por_estado, chunk_size=500):
+        """
+        Aplica {estado: {wasender_ids}} a MensajeCampana y ChatMensaje.
+        Los estados solo avanzan (ENVIADO -> ENTREGADO -> LEIDO): un "entregado" tardío no pisa un "leído".
+        """
+        for nuevo_estado, ids in ids_por_estado.items():
+            # Estados desde los que se puede avanzar al nuevo (ERROR se corrige si llega un acuse real)
+            previos = ['ERROR'] + PROGRESION_ESTADOS[:PROGRESION_ESTADOS.index(nuevo_estado)]
+            ids = list(ids)
+            for i in range(0, len(ids), chunk_size):
+                lote = ids[i:i + chunk_size]
                 # Actualizar para campañas
-                MensajeCampana.objects.filter(wasender_message_id=wasender_id).update(estado=nuevo_estado)
+                MensajeCampana.objects.filter(
+                    wasender_message_id__in=lote, estado__in=['PENDIENTE'] + previos
+                ).update(estado=nuevo_estado)
                 
                 # Actualizar para el chat en vivo
-                ChatMensaje.objects.filter(wasender_message_id=wasender_id).update(estado_envio=nuevo_estado)
+                chat_qs = ChatMensaje.objects.filter(wasender_message_id__in=lote, estado_envio__in=previos)
+                # Contactos afectados para el canal en tiempo real (solo si hay operadores conectados)
+                contactos = set(chat_qs.values_list('contacto_id', flat=True)) if events.hay_suscriptores() else set()
+                chat_qs.update(estado_envio=nuevo_estado, fecha_actualizacion=timezone.now())
+                if contactos:
+                    events.publicar('estado', contactos=sorted(contactos))
 
-    def _save_whatsapp_message(self, msg_data):
-        """Procesa y guarda un mensaje individual en el CrmContact y ChatMensaje"""
-        try:
-            if not isinstance(msg_data, dict): return
-            
-            # WASender a veces mete el mensaje dentro de una clave 'messages' incluso en eventos individuales
-            if 'messages' in msg_data and isinstance(msg_data['messages'], dict):
-                msg_data = msg_data['messages']
-            
-            key = msg_data.get('key', {})
-            if not isinstance(key, dict): return
-            
-            from_me = key.get('fromMe', False)
+    def _parse_whatsapp_message(self, msg_data):
+        """
+        Normaliza un mensaje crudo de WASender (identidad, texto y multimedia).
+        Retorna un dict o None si el mensaje debe ignorarse (grupos, sin número, etc.)
+        """
+        if not isinstance(msg_data, dict): return None
+        
+        # WASender a veces mete el mensaje dentro de una clave 'messages' incluso en eventos individuales
+        if 'messages' in msg_data and isinstance(msg_data['messages'], dict):
+            msg_data = msg_data['messages']
+        
+        key = msg_data.get('key', {})
+        if not isinstance(key, dict): return None
+        
+        from_me = key.get('fromMe', False)
+        
+        # Identificación del teléfono
+        remote_jid = key.get('remoteJid', '')
+        
+        if not from_me:
+            # Si lo envía el cliente, su tel puede venir en senderPn si JID es oculto (LID)
+            sender_pn = key.get('senderPn', '') or msg_data.get('senderPn', '')
+            target_jid = sender_pn if sender_pn else remote_jid
+        else:
+            # Si lo enviamos nosotros, remoteJid es el chat del cliente
+            target_jid = remote_jid
             
-            # Identificación del teléfono
-            remote_jid = key.get('remoteJid', '')
+        if not target_jid or '@g.us' in target_jid: return None
+        
+        # Formatear teléfono
+        telefono_puro = target_jid.split('@')[0]
+        if not telefono_puro.startswith('+'):
+            telefono_puro = f"+{telefono_puro}"
+        
+        if telefono_puro == '+': # No procesar si no hay número
+            return None
+
+        # Extraer texto del cuerpo o del objeto message
+        message_content = msg_data.get('message', {})
+        if not isinstance(message_content, dict): message_content = {}
+        
+        text_content = (message_content.get('conversation') or 
+                       message_content.get('extendedTextMessage', {}).get('text') or 
+                       msg_data.get('messageBody') or
+                       "[Media/Otro formato]")
+        
+        # Detección de Multimedia
+        media_url = None
+        media_type = 'TEXT'
+        media_key = None
+        mimetype = None
+        
+        if 'audioMessage' in message_content:
+            media_type = 'AUDIO'
+            msg_obj = message_content['audioMessage']
+            media_url = msg_obj.get('url')
+            media_key = msg_obj.get('mediaKey')
+            mimetype = msg_obj.get('mimetype', 'audio/ogg')
+            text_content = "[🎙️ Mensaje de voz]"
+        elif 'imageMessage' in message_content:
+            media_type = 'IMAGE'
+            msg_obj = message_content['imageMessage']
+            media_url = msg_obj.get('url')
+            media_key = msg_obj.get('mediaKey')
+            mimetype = msg_obj.get('mimetype', 'image/jpeg')
+            text_content = "[📷 Imagen]"
+        elif 'videoMessage' in message_content:
+            media_type = 'VIDEO'
+            msg_obj = message_content['videoMessage']
+            media_url = msg_obj.get('url')
+            media_key = msg_obj.get('mediaKey')
+            mimetype = msg_obj.get('mimetype', 'video/mp4')
+            text_content = "[🎥 Video]"
+        elif 'documentMessage' in message_content:
+            media_type = 'DOCUMENT'
+            msg_obj = message_content['documentMessage']
+            media_url = msg_obj.get('url')
+            media_key = msg_obj.get('mediaKey')
+            mimetype = msg_obj.get('mimetype', 'application/pdf')
+            text_content = f"[📄 Documento: {msg_obj.get('fileName', 'Archivo')}]"
+        elif 'locationMessage' in message_content or 'liveLocationMessage' in message_content:
+            media_type = 'TEXT' # O LOCATION si tuvieras soporte de enum, pero TEXT evita crasheos.
+            msg_obj = message_content.get('locationMessage') or message_content.get('liveLocationMessage')
+            lat = msg_obj.get('degreesLatitude')
+            lon = msg_obj.get('degreesLongitude')
+            name = msg_obj.get('name', 'Ubicación')
+            address = msg_obj.get('address', '')
+            media_url = f"https://www.google.com/maps/search/?api=1&query={lat},{lon}"
+            mimetype = 'text/location'
             
-            if not from_me:
-                # Si lo envía el cliente, su tel puede venir en senderPn si JID es oculto (LID)
-                sender_pn = key.get('senderPn', '') or msg_data.get('senderPn', '')
-                target_jid = sender_pn if sender_pn else remote_jid
-            else:
-                # Si lo enviamos nosotros, remoteJid es el chat del cliente
-                target_jid = remote_jid
-                
-            if not target_jid or '@g.us' in target_jid: return 
+            texto_construido = f"[📍 Ubicación] {name}"
+            if address: texto_construido += f" - {address}"
+            text_content = texto_construido
+            # Lo guardamos como TEXT pero aprovechamos media_url para el link de Maps.
+
+        return {
+            'from_me': from_me,
+            'remote_jid': remote_jid,
+            'target_jid': target_jid,
+            'push_name': msg_data.get('pushName'),
+            'wasender_id': key.get('id', '') or msg_data.get('id', ''),
+            'texto': text_content,
+            'media_url': media_url,
+            'media_type': media_type,
+            'media_key': media_key,
+            'mimetype': mimetype,
+        }
+
+    def _actualizar_identidad_contacto(self, contacto, msg):
+        """Completa LID/JID/teléfono/nombre de un contacto existente. Retorna los campos modificados"""
+        remote_jid, target_jid, from_me = msg['remote_jid'], msg['target_jid'], msg['from_me']
+        updated_fields = []
+        
+        if '@lid' in remote_jid and contacto.whatsapp_lid != remote_jid:
+            contacto.whatsapp_lid = remote_jid
+            updated_fields.append('whatsapp_lid')
+        elif '@s.whatsapp.net' in remote_jid and contacto.whatsapp_jid != remote_jid:
+            contacto.whatsapp_jid = remote_jid
+            updated_fields.append('whatsapp_jid')
+        
+        # Autosanador en sitio para "huérfanos" 
+        if not from_me and target_jid and '@s.whatsapp.net' in target_jid:
+            real_phone = '+' + target_jid.split('@')[0]
+            if not contacto.telefono or (len(contacto.telefono) > 13 and not contacto.telefono.startswith('+5')):
+                # Si es un contacto que no pudo fusionarse (porque no existía), pero acaba de darnos su número:
+                contacto.telefono = real_phone
+                updated_fields.append('telefono')
+                if not contacto.whatsapp_jid:
+                    contacto.whatsapp_jid = target_jid
+                    updated_fields.append('whatsapp_jid')
+
+        if not from_me:
+            push_name = msg['push_name']
+            nombres_genericos = ["Hola Enfermera", "Contacto WhatsApp", "Nuevo Contacto"]
+            if push_name and push_name not in nombres_genericos and (not contacto.nombres or any(g in contacto.nombres for g in nombres_genericos)):
+                contacto.nombres = push_name
+                updated_fields.append('nombres')
+        
+        return updated_fields
+
+    # Campos que puede modificar _registrar_actividad
+    CAMPOS_ACTIVIDAD = [
+        'fecha_ultima_actividad', 'fecha_creacion_lead', 'etapa_comercial',
+        'fecha_primer_contacto', 'tiempo_respuesta_inicial'
+    ]
+
+    def _registrar_actividad(self, contacto, from_me, now):
+        """Lógica de Autonomía y Trazabilidad (Fase 25 y 33) sobre el contacto en memoria"""
+        contacto.fecha_ultima_actividad = now
+        
+        if not from_me:
+            # Mensaje ENTRANTE: 
+            # 1. Marcar inicio de Lead si no lo tiene
+            if not contacto.fecha_creacion_lead:
+                contacto.fecha_creacion_lead = now
             
-            # Formatear teléfono
-            telefono_puro = target_jid.split('@')[0]
-            if not telefono_puro.startswith('+'):
-                telefono_puro = f"+{telefono_puro}"
+            # 2. Lógica de Re-Apertura (Fase 33)
+            # Si el contacto estaba en una etapa finalizada y vuelve a escribir, lo regresamos a Lead
+            etapas_finales = ['GANADO', 'PERDIDO', 'DESCARTADO']
+            if contacto.etapa_comercial in etapas_finales:
+                contacto.etapa_comercial = 'LEAD'
+                contacto.fecha_creacion_lead = now # Reiniciar contador de sangre fría para el nuevo interés
+                contacto.fecha_primer_contacto = None # Resetear para medir nueva respuesta
+        else:
+            # Mensaje SALIENTE (Desde CRM o Móvil): Mover etapa y registrar respuesta
+            if contacto.etapa_comercial == 'LEAD':
+                contacto.etapa_comercial = 'CONTACTADO'
             
-            if telefono_puro == '+': # No procesar si no hay número
-                return
+            if not contacto.fecha_primer_contacto:
+                contacto.fecha_primer_contacto = now
+                if contacto.fecha_creacion_lead:
+                    contacto.tiempo_respuesta_inicial = now - contacto.fecha_creacion_lead
 
-            # Extraer texto del cuerpo o del objeto message
-            message_content = msg_data.get('message', {})
-            if not isinstance(message_content, dict): message_content = {}
-            
-            text_content = (message_content.get('conversation') or 
-                           message_content.get('extendedTextMessage', {}).get('text') or 
-                           msg_data.get('messageBody') or
-                           "[Media/Otro formato]")
+    def _save_whatsapp_message(self, msg_data):
+        """Procesa y guarda un mensaje individual en el CrmContact y ChatMensaje"""
+        try:
+            msg = self._parse_whatsapp_message(msg_data)
+            if msg:
+                self._save_whatsapp_message_parsed(msg)
+        except Exception as e:
+            logger.error(f"Error en _save_whatsapp_message: {e}", exc_info=True)
+
+    def _save_whatsapp_message_parsed(self, msg):
+        """Guarda un mensaje ya normalizado, bloqueando/creando/fusionando el contacto según haga falta"""
+        from_me = msg['from_me']
+        remote_jid = msg['remote_jid']
+        target_jid = msg['target_jid']
+        text_content = msg['texto']
+        media_type = msg['media_type']
+        wasender_id = msg['wasender_id']
+
+        # 2. Buscar/Crear contacto con bloqueo de fila para evitar duplicados concurrentes
+        with transaction.atomic():
+            # Intentamos obtener el contacto con bloqueo de fila
+            contacto = None
+            # 1. Buscar por LID y por Teléfono/JID simultáneamente
+            contacto_por_lid = None
+            if '@lid' in remote_jid:
+                contacto_por_lid = identidades.get_contact('lid', remote_jid, for_update=True)
             
-            wasender_id = key.get('id', '') or msg_data.get('id', '')
+            contacto_por_jid = None
+            if target_jid and '@s.whatsapp.net' in target_jid:
+                tel_busqueda = '+' + target_jid.split('@')[0]
+                contacto_por_jid = (identidades.get_contact('telefono', tel_busqueda, for_update=True) or
+                                    identidades.get_contact('jid', target_jid, for_update=True))
+            elif not '@lid' in target_jid:
+                # En caso de que target_jid sea ya un teléfono puro
+                tel_busqueda = target_jid if target_jid.startswith('+') else '+' + target_jid.split('@')[0]
+                contacto_por_jid = identidades.get_contact('telefono', tel_busqueda, for_update=True)
 
-            # 2. Buscar/Crear contacto con bloqueo de fila para evitar duplicados concurrentes
-            with transaction.atomic():
-                # Normalizar para búsqueda
-                telefono_busqueda = remote_jid.split('@')[0]
-                if not telefono_busqueda.startswith('+'):
-                    telefono_busqueda = '+' + telefono_busqueda
+            # 2. Lógica de Fusión (Auto-Sanación) de Fantasmas
+            contacto = None
+            if contacto_por_lid and contacto_por_jid and contacto_por_lid.id != contacto_por_jid.id:
+                # Se detectó un fantasma (creado por LID) y el contacto real (JID).
+                # Fusionamos el historial del fantasma hacia el contacto real.
+                ChatMensaje.objects.filter(contacto=contacto_por_lid).update(contacto=contacto_por_jid, fecha_actualizacion=timezone.now())
+                ChatMensaje.recalcular_ultimo_mensaje([contacto_por_jid.id])
                 
-                # Intentamos obtener el contacto con bloqueo de fila
-                contacto = None
-                # 1. Buscar por LID y por Teléfono/JID simultáneamente
-                contacto_por_lid = None
-                if '@lid' in remote_jid:
-                    contacto_por_lid = CrmContact.objects.filter(whatsapp_lid=remote_jid).select_for_update().first()
-                
-                contacto_por_jid = None
-                if target_jid and '@s.whatsapp.net' in target_jid:
-                    tel_busqueda = '+' + target_jid.split('@')[0]
-                    from django.db.models import Q
-                    contacto_por_jid = CrmContact.objects.filter(Q(telefono=tel_busqueda) | Q(whatsapp_jid=target_jid)).select_for_update().first()
-                elif not '@lid' in target_jid:
-                    # En caso de que target_jid sea ya un teléfono puro
-                    tel_busqueda = target_jid if target_jid.startswith('+') else '+' + target_jid.split('@')[0]
-                    contacto_por_jid = CrmContact.objects.filter(telefono=tel_busqueda).select_for_update().first()
-
-                # 2. Lógica de Fusión (Auto-Sanación) de Fantasmas
-                contacto = None
-                if contacto_por_lid and contacto_por_jid and contacto_por_lid.id != contacto_por_jid.id:
-                    # Se detectó un fantasma (creado por LID) y el contacto real (JID).
-                    # Fusionamos el historial del fantasma hacia el contacto real.
-                    ChatMensaje.objects.filter(contacto=contacto_por_lid).update(contacto=contacto_por_jid)
-                    
-                    update_fields = []
-                    if not contacto_por_jid.whatsapp_lid:
-                        contacto_por_jid.whatsapp_lid = contacto_por_lid.whatsapp_lid
-                        update_fields.append('whatsapp_lid')
-                    if not contacto_por_jid.whatsapp_jid:
-                        contacto_por_jid.whatsapp_jid = target_jid
-                        update_fields.append('whatsapp_jid')
-                    if update_fields:
-                        contacto_por_jid.save(update_fields=update_fields)
-                        
-                    contacto_por_lid.delete()
-                    contacto = contacto_por_jid
-                elif contacto_por_jid:
-                    contacto = contacto_por_jid
-                elif contacto_por_lid:
-                    contacto = contacto_por_lid
-
-                # 3. Creación o Actualización si no hubo fusión
-                if not contacto:
-                    # Crear nuevo contacto
-                    nombres_wa = msg_data.get('pushName') if not from_me else None
-                    if not nombres_wa or "Hola Enfermera" in nombres_wa:
-                        nombres_wa = "Nuevo Contacto"
-
-                    tel_final = target_jid.split('@')[0] if target_jid else remote_jid.split('@')[0]
-                    if not tel_final.startswith('+'):
-                        tel_final = '+' + tel_final
-
-                    lid_val = remote_jid if '@lid' in remote_jid else None
-                    jid_val = target_jid if '@s.whatsapp.net' in target_jid else None
-
-                    contacto = CrmContact.objects.create(
-                        nombres=nombres_wa,
-                        apellidos="",
-                        telefono=tel_final,
-                        whatsapp_jid=jid_val,
-                        whatsapp_lid=lid_val,
-                        es_organico=True,
-                    )
-                else:
-                    # Actualizar info si es necesario (ej: si antes no tenía JID o el nombre era genérico)
-                    updated_fields = []
-                    
-                    if '@lid' in remote_jid and contacto.whatsapp_lid != remote_jid:
-                        contacto.whatsapp_lid = remote_jid
-                        updated_fields.append('whatsapp_lid')
-                    elif '@s.whatsapp.net' in remote_jid and contacto.whatsapp_jid != remote_jid:
-                        contacto.whatsapp_jid = remote_jid
-                        updated_fields.append('whatsapp_jid')
-                    
-                    # Autosanador en sitio para "huérfanos" 
-                    if not from_me and target_jid and '@s.whatsapp.net' in target_jid:
-                        real_phone = '+' + target_jid.split('@')[0]
-                        if not contacto.telefono or (len(contacto.telefono) > 13 and not contacto.telefono.startswith('+5')):
-                            # Si es un contacto que no pudo fusionarse (porque no existía), pero acaba de darnos su número:
-                            contacto.telefono = real_phone
-                            updated_fields.append('telefono')
-                            if not contacto.whatsapp_jid:
-                                contacto.whatsapp_jid = target_jid
-                                updated_fields.append('whatsapp_jid')
-
-                    if not from_me:
-                        push_name = msg_data.get('pushName')
-                        nombres_genericos = ["Hola Enfermera", "Contacto WhatsApp", "Nuevo Contacto"]
-                        if push_name and push_name not in nombres_genericos and (not contacto.nombres or any(g in contacto.nombres for g in nombres_genericos)):
-                            contacto.nombres = push_name
-                            updated_fields.append('nombres')
+                update_fields = []
+                if not contacto_por_jid.whatsapp_lid:
+                    contacto_por_jid.whatsapp_lid = contacto_por_lid.whatsapp_lid
+                    update_fields.append('whatsapp_lid')
+                if not contacto_por_jid.whatsapp_jid:
+                    contacto_por_jid.whatsapp_jid = target_jid
+                    update_fields.append('whatsapp_jid')
+                if update_fields:
+                    contacto_por_jid.save(update_fields=update_fields)
                     
-                    if updated_fields:
-                        contacto.save(update_fields=updated_fields)
+                events.publicar('fusion', desde=contacto_por_lid.id, hacia=contacto_por_jid.id)
+                contacto_por_lid.delete()
+                contacto = contacto_por_jid
+            elif contacto_por_jid:
+                contacto = contacto_por_jid
+            elif contacto_por_lid:
+                contacto = contacto_por_lid
 
-                # --- Lógica de Autonomía y Trazabilidad (Fase 25 y 33) ---
-                now = timezone.now()
-                contacto.fecha_ultima_actividad = now
-                contact_updated = True
+            # 3. Creación o Actualización si no hubo fusión
+            if not contacto:
+                # Crear nuevo contacto
+                nombres_wa = msg['push_name'] if not from_me else None
+                if not nombres_wa or "Hola Enfermera" in nombres_wa:
+                    nombres_wa = "Nuevo Contacto"
+
+                tel_final = target_jid.split('@')[0] if target_jid else remote_jid.split('@')[0]
+                if not tel_final.startswith('+'):
+                    tel_final = '+' + tel_final
+
+                lid_val = remote_jid if '@lid' in remote_jid else None
+                jid_val = target_jid if '@s.whatsapp.net' in target_jid else None
+
+                contacto = CrmContact.objects.create(
+                    nombres=nombres_wa,
+                    apellidos="",
+                    telefono=tel_final,
+                    whatsapp_jid=jid_val,
+                    whatsapp_lid=lid_val,
+                    es_organico=True,
+                )
+                campos_identidad = []
+            else:
+                # Actualizar info si es necesario (ej: si antes no tenía JID o el nombre era genérico)
+                campos_identidad = self._actualizar_identidad_contacto(contacto, msg)
+
+            # --- Lógica de Autonomía y Trazabilidad (Fase 25 y 33) ---
+            self._registrar_actividad(contacto, from_me, timezone.now())
+            # Solo los campos tocados: la instancia puede venir de la caché y el puntero de último mensaje
+            # lo mueve el propio chat
+            contacto.save(update_fields=campos_identidad + self.CAMPOS_ACTIVIDAD)
+            identidades.recordar(contacto)
+        
+        # 2. Guardar Mensaje
+        if wasender_id:
+            # Deduplicación para mensajes salientes (evitar doble confirmación de webhook)
+            if from_me and wasender_id:
+                tiempo_limite = timezone.now() - datetime.timedelta(minutes=2)
+                query = ChatMensaje.objects.filter(
+                    contacto=contacto,
+                    direccion='OUTBOUND',
+                    wasender_message_id__startswith='local_',
+                    fecha_mensaje__gte=tiempo_limite
+                )
                 
-                if not from_me:
-                    # Mensaje ENTRANTE: 
-                    # 1. Marcar inicio de Lead si no lo tiene
-                    if not contacto.fecha_creacion_lead:
-                        contacto.fecha_creacion_lead = now
-                    
-                    # 2. Lógica de Re-Apertura (Fase 33)
-                    # Si el contacto estaba en una etapa finalizada y vuelve a escribir, lo regresamos a Lead
-                    etapas_finales = ['GANADO', 'PERDIDO', 'DESCARTADO']
-                    if contacto.etapa_comercial in etapas_finales:
-                        contacto.etapa_comercial = 'LEAD'
-                        contacto.fecha_creacion_lead = now # Reiniciar contador de sangre fría para el nuevo interés
-                        contacto.fecha_primer_contacto = None # Resetear para medir nueva respuesta
+                if media_type == 'TEXT':
+                    query = query.filter(texto=text_content)
                 else:
-                    # Mensaje SALIENTE (Desde CRM o Móvil): Mover etapa y registrar respuesta
-                    if contacto.etapa_comercial == 'LEAD':
-                        contacto.etapa_comercial = 'CONTACTADO'
+                    query = query.filter(media_type=media_type)
                     
-                    if not contacto.fecha_primer_contacto:
-                        contacto.fecha_primer_contacto = now
-                        if contacto.fecha_creacion_lead:
-                            contacto.tiempo_respuesta_inicial = now - contacto.fecha_creacion_lead
+                msg_preexistente = query.order_by('fecha_mensaje').first()
+                
+                if msg_preexistente:
+                    # Reemplazamos el ID temporal local por el Real de WhatsApp para enrutar el estado de Envío correctamente
+                    from django.db import IntegrityError
+                    msg_preexistente.wasender_message_id = wasender_id
+                    msg_preexistente.estado_envio = 'ENTREGADO'
+                    try:
+                        msg_preexistente.save(update_fields=['wasender_message_id', 'estado_envio', 'fecha_actualizacion'])
+                    except IntegrityError:
+                        # Si hubo conflicto, ya existía, por tanto lo ignoramos o eliminamos el temporal
+                        msg_preexistente.delete()
+                    return
 
-                if contact_updated:
-                    contacto.save()
-            
-            # 2. Guardar Mensaje
+            # Si no existía, usar update_or_create para manejar reintentos de webhook transparentemente
+            mensaje_obj, creado = ChatMensaje.objects.update_or_create(
+                wasender_message_id=wasender_id,
+                defaults=self._mensaje_defaults(contacto, msg)
+            )
+            if creado and msg['media_key']:
+                # Decriptar y cachear en segundo plano antes de que expire la URL de WhatsApp
+                prefetcher.programar([mensaje_obj.id])
+
+    def _mensaje_defaults(self, contacto, msg):
+        """Campos de ChatMensaje derivados de un mensaje ya normalizado"""
+        return {
+            'contacto': contacto,
+            'direccion': 'OUTBOUND' if msg['from_me'] else 'INBOUND',
+            'texto': msg['texto'],
+            'media_url': msg['media_url'],
+            'media_type': msg['media_type'],
+            'media_key': msg['media_key'],
+            'mimetype': msg['mimetype'],
+            'estado_envio': 'ENTREGADO'
+        }
+
+    def _save_whatsapp_messages_batch(self, messages):
+        """
+        Ruta por lotes para payloads messages.upsert con muchos mensajes (ej. sincronización de historial).
+        Resuelve contactos con una consulta por tipo de identificador, deduplica por wasender_message_id
+        en memoria y escribe los mensajes con bulk_create. Los casos que requieren crear o fusionar
+        contactos, o reconciliar un envío local_, se delegan a la ruta individual.
+        """
+        # 1. Normalizar y deduplicar (el último payload de un mismo ID gana)
+        parsed = []
+        posicion_por_id = {}
+        for msg_data in messages:
+            msg = self._parse_whatsapp_message(msg_data)
+            if not msg: continue
+            wasender_id = msg['wasender_id']
+            if wasender_id and wasender_id in posicion_por_id:
+                parsed[posicion_por_id[wasender_id]] = msg
+                continue
             if wasender_id:
-                # Detección de Multimedia
-                media_url = None
-                media_type = 'TEXT'
-                media_key = None
-                mimetype = None
-                
-                if 'audioMessage' in message_content:
-                    media_type = 'AUDIO'
-                    msg_obj = message_content['audioMessage']
-                    media_url = msg_obj.get('url')
-                    media_key = msg_obj.get('mediaKey')
-                    mimetype = msg_obj.get('mimetype', 'audio/ogg')
-                    text_content = "[🎙️ Mensaje de voz]"
-                elif 'imageMessage' in message_content:
-                    media_type = 'IMAGE'
-                    msg_obj = message_content['imageMessage']
-                    media_url = msg_obj.get('url')
-                    media_key = msg_obj.get('mediaKey')
-                    mimetype = msg_obj.get('mimetype', 'image/jpeg')
-                    text_content = "[📷 Imagen]"
-                elif 'videoMessage' in message_content:
-                    media_type = 'VIDEO'
-                    msg_obj = message_content['videoMessage']
-                    media_url = msg_obj.get('url')
-                    media_key = msg_obj.get('mediaKey')
-                    mimetype = msg_obj.get('mimetype', 'video/mp4')
-                    text_content = "[🎥 Video]"
-                elif 'documentMessage' in message_content:
-                    media_type = 'DOCUMENT'
-                    msg_obj = message_content['documentMessage']
-                    media_url = msg_obj.get('url')
-                    media_key = msg_obj.get('mediaKey')
-                    mimetype = msg_obj.get('mimetype', 'application/pdf')
-                    text_content = f"[📄 Documento: {msg_obj.get('fileName', 'Archivo')}]"
-                elif 'locationMessage' in message_content or 'liveLocationMessage' in message_content:
-                    media_type = 'TEXT' # O LOCATION si tuvieras soporte de enum, pero TEXT evita crasheos.
-                    msg_obj = message_content.get('locationMessage') or message_content.get('liveLocationMessage')
-                    lat = msg_obj.get('degreesLatitude')
-                    lon = msg_obj.get('degreesLongitude')
-                    name = msg_obj.get('name', 'Ubicación')
-                    address = msg_obj.get('address', '')
-                    media_url = f"https://www.google.com/maps/search/?api=1&query={lat},{lon}"
-                    mimetype = 'text/location'
-                    
-                    texto_construido = f"[📍 Ubicación] {name}"
-                    if address: texto_construido += f" - {address}"
-                    text_content = texto_construido
-                    # Lo guardamos como TEXT pero aprovechamos media_url para el link de Maps.
-
-                # Deduplicación para mensajes salientes (evitar doble confirmación de webhook)
-                import datetime
-                if from_me and wasender_id:
-                    tiempo_limite = timezone.now() - datetime.timedelta(minutes=2)
-                    query = ChatMensaje.objects.filter(
-                        contacto=contacto,
-                        direccion='OUTBOUND',
-                        wasender_message_id__startswith='local_',
-                        fecha_mensaje__gte=tiempo_limite
-                    )
-                    
-                    if media_type == 'TEXT':
-                        query = query.filter(texto=text_content)
+                posicion_por_id[wasender_id] = len(parsed)
+            parsed.append(msg)
+
+        if not parsed:
+            return
+
+        # 2. Una consulta por tipo de identificador
+        lids, jids, telefonos = set(), set(), set()
+        for msg in parsed:
+            remote_jid, target_jid = msg['remote_jid'], msg['target_jid']
+            if '@lid' in remote_jid:
+                lids.add(remote_jid)
+            if '@s.whatsapp.net' in target_jid:
+                jids.add(target_jid)
+                telefonos.add('+' + target_jid.split('@')[0])
+            elif not '@lid' in target_jid:
+                telefonos.add(target_jid if target_jid.startswith('+') else '+' + target_jid.split('@')[0])
+
+        id_por_lid = identidades.resolve_ids('lid', lids)
+        id_por_jid = identidades.resolve_ids('jid', jids)
+        id_por_tel = identidades.resolve_ids('telefono', telefonos)
+
+        # Contactos con envíos locales recientes: sus salientes necesitan la reconciliación individual
+        tiempo_limite = timezone.now() - datetime.timedelta(minutes=2)
+        ids_candidatos = set(id_por_lid.values()) | set(id_por_jid.values()) | set(id_por_tel.values())
+        con_envios_locales = set(ChatMensaje.objects.filter(
+            contacto_id__in=ids_candidatos,
+            direccion='OUTBOUND',
+            wasender_message_id__startswith='local_',
+            fecha_mensaje__gte=tiempo_limite
+        ).values_list('contacto_id', flat=True)) if ids_candidatos else set()
+
+        resueltos, individuales = [], []
+        for msg in parsed:
+            remote_jid, target_jid = msg['remote_jid'], msg['target_jid']
+            id_lid = id_por_lid.get(remote_jid) if '@lid' in remote_jid else None
+            id_jid = None
+            if '@s.whatsapp.net' in target_jid:
+                id_tel = id_por_tel.get('+' + target_jid.split('@')[0])
+                id_wa = id_por_jid.get(target_jid)
+                if id_tel and id_wa and id_tel != id_wa:
+                    individuales.append(msg)  # Ambigüedad teléfono/JID: se resuelve con la ruta individual
+                    continue
+                id_jid = id_tel or id_wa
+            elif not '@lid' in target_jid:
+                id_jid = id_por_tel.get(target_jid if target_jid.startswith('+') else '+' + target_jid.split('@')[0])
+
+            if (id_lid and id_jid and id_lid != id_jid) or not (id_lid or id_jid) or not msg['wasender_id']:
+                individuales.append(msg)  # Fusión de fantasmas, contacto nuevo o mensaje sin ID
+                continue
+            contacto_id = id_jid or id_lid
+            if msg['from_me'] and contacto_id in con_envios_locales:
+                individuales.append(msg)
+                continue
+            # Identificador con el que se resolvió: se revalida tras el bloqueo (la caché puede estar obsoleta)
+            if id_jid and '@s.whatsapp.net' in target_jid:
+                resuelto_por = [('telefono', '+' + target_jid.split('@')[0]), ('jid', target_jid)]
+            elif id_jid:
+                resuelto_por = [('telefono', target_jid if target_jid.startswith('+') else '+' + target_jid.split('@')[0])]
+            else:
+                resuelto_por = [('lid', remote_jid)]
+            resueltos.append((contacto_id, resuelto_por, msg))
+
+        # 3. Casos especiales primero: pueden crear contactos que luego reutiliza el resto del lote
+        for msg in individuales:
+            try:
+                self._save_whatsapp_message_parsed(msg)
+            except Exception as e:
+                logger.error(f"Error en _save_whatsapp_message: {e}", exc_info=True)
+
+        if not resueltos:
+            return
+
+        rezagados = []
+        try:
+            with transaction.atomic():
+                # Bloqueo en orden de ID para no provocar deadlocks entre lotes concurrentes
+                contactos = {c.id: c for c in CrmContact.objects.select_for_update().filter(
+                    id__in={cid for cid, _, _ in resueltos}
+                ).order_by('id')}
+
+                campos_contacto = set(self.CAMPOS_ACTIVIDAD)
+                now = timezone.now()
+                pendientes = []
+                for contacto_id, resuelto_por, msg in resueltos:
+                    contacto = contactos.get(contacto_id)
+                    if not any(identidades.coincide(contacto, tipo, valor) for tipo, valor in resuelto_por):
+                        # Eliminado, fusionado o re-asignado en paralelo: se reintenta por la ruta individual
+                        for tipo, valor in resuelto_por:
+                            identidades.olvidar(tipo, valor)
+                        rezagados.append(msg)
+                        continue
+                    campos_contacto.update(self._actualizar_identidad_contacto(contacto, msg))
+                    self._registrar_actividad(contacto, msg['from_me'], now)
+                    pendientes.append((contacto, msg))
+
+                if pendientes:
+                    CrmContact.objects.bulk_update({c.id: c for c, _ in pendientes}.values(), list(campos_contacto))
+
+                # 4. Mensajes: los existentes (reintentos) se actualizan, los nuevos van en bulk_create
+                existentes = {m.wasender_message_id: m for m in ChatMensaje.objects.filter(
+                    wasender_message_id__in=[msg['wasender_id'] for _, msg in pendientes]
+                )}
+                contactos_previos = {m.contacto_id for m in existentes.values()}
+                nuevos, actualizados = [], []
+                for contacto, msg in pendientes:
+                    defaults = self._mensaje_defaults(contacto, msg)
+                    existente = existentes.get(msg['wasender_id'])
+                    if existente:
+                        for campo, valor in defaults.items():
+                            setattr(existente, campo, valor)
+                        existente.fecha_actualizacion = now
+                        actualizados.append(existente)
                     else:
-                        query = query.filter(media_type=media_type)
-                        
-                    msg_preexistente = query.order_by('fecha_mensaje').first()
-                    
-                    if msg_preexistente:
-                        # Reemplazamos el ID temporal local por el Real de WhatsApp para enrutar el estado de Envío correctamente
-                        from django.db import IntegrityError
-                        msg_preexistente.wasender_message_id = wasender_id
-                        msg_preexistente.estado_envio = 'ENTREGADO'
-                        try:
-                            msg_preexistente.save(update_fields=['wasender_message_id', 'estado_envio'])
-                        except IntegrityError:
-                            # Si hubo conflicto, ya existía, por tanto lo ignoramos o eliminamos el temporal
-                            msg_preexistente.delete()
-                        return
-
-                # Si no existía, usar update_or_create para manejar reintentos de webhook transparentemente
-                ChatMensaje.objects.update_or_create(
-                    wasender_message_id=wasender_id,
-                    defaults={
-                        'contacto': contacto,
-                        'direccion': 'OUTBOUND' if from_me else 'INBOUND',
-                        'texto': text_content,
-                        'media_url': media_url,
-                        'media_type': media_type,
-                        'media_key': media_key,
-                        'mimetype': mimetype,
-                        'estado_envio': 'ENTREGADO'
-                    }
-                )
+                        nuevos.append(ChatMensaje(wasender_message_id=msg['wasender_id'], **defaults))
+
+                if actualizados:
+                    ChatMensaje.objects.bulk_update(actualizados, ['contacto', 'direccion', 'texto', 'media_url', 'media_type', 'media_key', 'mimetype', 'estado_envio', 'fecha_actualizacion'])
+                if nuevos:
+                    ChatMensaje.objects.bulk_create(nuevos, ignore_conflicts=True)
+                    # bulk_create con ignore_conflicts no devuelve IDs en MySQL: se resuelven por wasender_message_id
+                    con_media = [m.wasender_message_id for m in nuevos if m.media_key]
+                    if con_media:
+                        prefetcher.programar(list(ChatMensaje.objects.filter(
+                            wasender_message_id__in=con_media
+                        ).values_list('id', flat=True)))
+                # bulk_create no dispara señales: puntero de último mensaje de todos los contactos del lote
+                ChatMensaje.recalcular_ultimo_mensaje({c.id for c, _ in pendientes} | contactos_previos)
+                events.publicar('mensaje', contactos=sorted({c.id for c, _ in pendientes} | contactos_previos))
         except Exception as e:
-            logger.error(f"Error en _save_whatsapp_message: {e}", exc_info=True)
+            logger.error(f"Error en _save_whatsapp_messages_batch: {e}", exc_info=True)
+
+        for msg in rezagados:
+            try:
+                self._save_whatsapp_message_parsed(msg)
+            except Exception as e:
+                logger.error(f"Error en _save_whatsapp_message: {e}", exc_info=True)
 
 
 # ==========================================
@@ -480,24 +745,86 @@ class WasenderWebhookView(View):
 from django.db.models import Max
 from CoreApps.notifications.services import WASenderService
 
+# Margen de solape de la sincronización incremental: cubre transacciones que confirman
+# después de emitir el token. El frontend fusiona por ID, así que repetir filas es inocuo.
+SYNC_OVERLAP = datetime.timedelta(seconds=5)
+
+def _nuevo_sync_token():
+    return timezone.now().isoformat()
+
+def _parse_sync_token(valor):
+    """Convierte un `since` del cliente en el límite inferior de fecha_actualizacion (o None)"""
+    if not valor:
+        return None
+    try:
+        return datetime.datetime.fromisoformat(valor) - SYNC_OVERLAP
+    except ValueError:
+        return None
+
+def _build_keyset_cursor(fecha, pk):
+    """Cursor opaco '<fecha ISO>|<id>' para paginar por (fecha, id) descendente"""
+    return f"{fecha.isoformat()}|{pk}"
+
+def _parse_keyset_cursor(valor):
+    if not valor or '|' not in valor:
+        return None
+    fecha, _, pk = valor.rpartition('|')
+    try:
+        return datetime.datetime.fromisoformat(fecha), int(pk)
+    except ValueError:
+        return None
+
 class ChatListAPIView(SupervisorChatMixin, View):
-    """Devuelve la lista de contactos ordenados por el último mensaje recibido/enviado"""
+    """
+    Devuelve la lista de contactos ordenados por el último mensaje recibido/enviado.
+    Lee el puntero desnormalizado CrmContact.ultimo_mensaje (una consulta con JOIN) y pagina por cursor
+    sobre (fecha_ultimo_mensaje, id): ?limit=50&cursor=<next_cursor de la página anterior>
+    Con ?since=<sync_token> solo devuelve los chats con mensajes nuevos o modificados desde entonces.
+    Si cambiaron más de MAX_PAGE_SIZE chats el delta no cabe: se responde `truncado` con el mismo
+    sync_token y el cliente hace una carga completa.
+    """
+    PAGE_SIZE = 50
+    MAX_PAGE_SIZE = 500
+
     def get(self, request, *args, **kwargs):
         force_contact_id = request.GET.get('force_contact_id')
-        
-        # Obtenemos contactos que tengan historial de chat
-        from django.db.models import Q, Max
-        qs = CrmContact.objects.filter(
-            Q(historial_chat__isnull=False) | Q(id=force_contact_id) if force_contact_id else Q(historial_chat__isnull=False)
-        ).distinct()
-        
-        contactos = qs.annotate(
-            ultimo_msg_fecha=Max('historial_chat__fecha_mensaje')
-        ).order_by('-ultimo_msg_fecha')
+        try:
+            limit = min(max(int(request.GET.get('limit', self.PAGE_SIZE)), 1), self.MAX_PAGE_SIZE)
+        except ValueError:
+            limit = self.PAGE_SIZE
+        cursor = _parse_keyset_cursor(request.GET.get('cursor'))
+        since = _parse_sync_token(request.GET.get('since'))
+        sync_token = _nuevo_sync_token()
+
+        from django.db.models import Q
+        qs = CrmContact.objects.filter(fecha_ultimo_mensaje__isnull=False).select_related('ultimo_mensaje')
+        if since:
+            # Delta: contactos con actividad (mensajes nuevos, acuses, lecturas) desde el token
+            qs = qs.filter(id__in=ChatMensaje.objects.filter(fecha_actualizacion__gte=since).values('contacto_id'))
+            limit, cursor, force_contact_id = self.MAX_PAGE_SIZE, None, None
+        if cursor:
+            fecha, ultimo_id = cursor
+            qs = qs.filter(Q(fecha_ultimo_mensaje__lt=fecha) | Q(fecha_ultimo_mensaje=fecha, id__lt=ultimo_id))
+        contactos = list(qs.order_by('-fecha_ultimo_mensaje', '-id')[:limit + 1])
+        hay_mas = len(contactos) > limit
+        contactos = contactos[:limit]
+        next_cursor = _build_keyset_cursor(contactos[-1].fecha_ultimo_mensaje, contactos[-1].id) if hay_mas and not since else None
+        truncado = bool(since) and hay_mas
+        if truncado:
+            # No se avanza el token: los chats que no cupieron se perderían hasta la próxima carga completa
+            sync_token = request.GET.get('since')
+
+        # Contacto forzado (viene del Pipeline): se incluye aunque no tenga chat o no esté en esta página
+        if force_contact_id and force_contact_id.isdigit() and not cursor and not any(c.id == int(force_contact_id) for c in contactos):
+            forzado = CrmContact.objects.select_related('ultimo_mensaje').filter(id=force_contact_id).first()
+            if forzado:
+                contactos.append(forzado)
+
+        campanas = CrmContact.get_campanas_nombres_bulk([c.id for c in contactos])
         
         data = []
         for c in contactos:
-            ultimo_mensaje = c.historial_chat.order_by('-fecha_mensaje').first()
+            ultimo_mensaje = c.ultimo_mensaje
             fecha_str = ''
             if ultimo_mensaje:
                 fecha_local = timezone.localtime(ultimo_mensaje.fecha_mensaje)
@@ -513,32 +840,70 @@ class ChatListAPIView(SupervisorChatMixin, View):
                 'direccion_ultimo': ultimo_mensaje.direccion if ultimo_mensaje else '',
                 'no_leido': not ultimo_mensaje.leido_por_operador if ultimo_mensaje and ultimo_mensaje.direccion == 'INBOUND' else False,
                 'es_organico': c.es_organico,
-                'campanas': c.get_campanas_nombres(),
-                'es_proveedor': c.es_proveedor
+                'campanas': campanas.get(c.id, []),
+                'es_proveedor': c.es_proveedor,
+                'orden': c.fecha_ultimo_mensaje.isoformat() if c.fecha_ultimo_mensaje else ''
             })
-        return JsonResponse({'chats': data})
+        return JsonResponse({
+            'chats': data, 'next_cursor': next_cursor, 'sync_token': sync_token, 'delta': bool(since), 'truncado': truncado
+        })
 
 class ChatHistoryAPIView(SupervisorChatMixin, View):
-    """Devuelve el historial de un chat específico"""
+    """
+    Devuelve el historial de un chat específico, paginado hacia atrás por cursor sobre (fecha_mensaje, id):
+    la primera carga trae los últimos `limit` mensajes y ?before=<older_cursor> trae los anteriores.
+    Con ?since=<sync_token> solo devuelve los mensajes creados o modificados (estado, lectura) desde entonces.
+    """
+    PAGE_SIZE = 50
+    MAX_PAGE_SIZE = 200
+    CAMPOS = ('id', 'direccion', 'texto', 'media_url', 'media_type', 'mimetype', 'fecha_mensaje', 'estado_envio')
+
     def get(self, request, contacto_id, *args, **kwargs):
         contacto = CrmContact.objects.get(id=contacto_id)
-        mensajes = ChatMensaje.objects.filter(contacto=contacto).order_by('fecha_mensaje')
+        try:
+            limit = min(max(int(request.GET.get('limit', self.PAGE_SIZE)), 1), self.MAX_PAGE_SIZE)
+        except ValueError:
+            limit = self.PAGE_SIZE
+        before = _parse_keyset_cursor(request.GET.get('before'))
+        since = _parse_sync_token(request.GET.get('since'))
+        sync_token = _nuevo_sync_token()
+
+        from django.db.models import Q
+        mensajes = ChatMensaje.objects.filter(contacto=contacto)
+        older_cursor = None
+        if since:
+            filas = list(mensajes.filter(fecha_actualizacion__gte=since).order_by('fecha_mensaje', 'id').values(*self.CAMPOS))
+        else:
+            if before:
+                fecha, mensaje_id = before
+                mensajes = mensajes.filter(Q(fecha_mensaje__lt=fecha) | Q(fecha_mensaje=fecha, id__lt=mensaje_id))
+            # Índice (contacto, fecha_mensaje): se leen solo los `limit` más recientes y se devuelven en orden cronológico
+            filas = list(mensajes.order_by('-fecha_mensaje', '-id').values(*self.CAMPOS)[:limit + 1])
+            if len(filas) > limit:
+                filas = filas[:limit]
+                older_cursor = _build_keyset_cursor(filas[-1]['fecha_mensaje'], filas[-1]['id'])
+            filas.reverse()
         
-        # Marcar como leídos por el operador
-        mensajes.filter(direccion='INBOUND', leido_por_operador=False).update(leido_por_operador=True)
+        # Marcar como leídos por el operador (solo si hay pendientes: evita un UPDATE en cada poll)
+        if not before:
+            no_leidos = ChatMensaje.objects.filter(contacto=contacto, direccion='INBOUND', leido_por_operador=False)
+            if no_leidos.exists():
+                no_leidos.update(leido_por_operador=True, fecha_actualizacion=timezone.now())
+                events.publicar('estado', contactos=[contacto.id])
         
+        zona = timezone.get_current_timezone()
         data = []
-        for m in mensajes:
-            fecha_local = timezone.localtime(m.fecha_mensaje)
+        for m in filas:
             data.append({
-                'id': m.id,
-                'direccion': m.direccion,
-                'texto': m.texto,
-                'media_url': m.media_url,
-                'media_type': m.media_type,
-                'mimetype': m.mimetype,
-                'fecha': fecha_local.strftime('%H:%M - %d/%m/%y'),
-                'estado': m.estado_envio
+                'id': m['id'],
+                'direccion': m['direccion'],
+                'texto': m['texto'],
+                'media_url': m['media_url'],
+                'media_type': m['media_type'],
+                'mimetype': m['mimetype'],
+                'fecha': m['fecha_mensaje'].astimezone(zona).strftime('%H:%M - %d/%m/%y'),
+                'orden': _build_keyset_cursor(m['fecha_mensaje'], m['id']),
+                'estado': m['estado_envio']
             })
         return JsonResponse({
             'contacto': {
@@ -548,7 +913,9 @@ class ChatHistoryAPIView(SupervisorChatMixin, View):
                 'es_organico': contacto.es_organico,
                 'campanas': contacto.get_campanas_nombres()
             },
-            'mensajes': data
+            'mensajes': data,
+            'older_cursor': older_cursor,
+            'sync_token': sync_token
         })
 
 @method_decorator(csrf_exempt, name='dispatch')
@@ -755,15 +1122,54 @@ class ClearChatHistoryAPIView(SupervisorChatMixin, View):
             mensajes = ChatMensaje.objects.filter(contacto=contacto)
             total = mensajes.count()
             mensajes.delete()
+            ChatMensaje.recalcular_ultimo_mensaje([contacto.id])
             return JsonResponse({'success': True, 'total_eliminados': total})
         except Exception as e:
             return JsonResponse({'error': str(e)}, status=500)
 
 
+class ChatEventsStreamView(View):
+    """
+    Stream SSE de eventos del chat (nuevo mensaje, cambio de estado, fusión de contactos).
+    Vista asíncrona: requiere servidor ASGI (uvicorn/daphne) para no retener un worker por conexión.
+    Con CHAT_EVENTS_SSE desactivado o bajo WSGI responde 204 (el EventSource no reintenta).
+    """
+    async def get(self, request, *args, **kwargs):
+        user = await request.auser()
+        if not user.is_authenticated or not user.is_staff:
+            return JsonResponse({'error': 'No autorizado'}, status=403)
+        if not events.sse_habilitado() or not isinstance(request, ASGIRequest):
+            return HttpResponse(status=204)
+
+        heartbeat = getattr(settings, 'CHAT_EVENTS_HEARTBEAT', 15)
+        backend = events.get_backend()
+
+        async def stream():
+            suscripcion = backend.suscribir()
+            try:
+                # El navegador reconecta solo tras 3 s si se corta la conexión
+                yield "retry: 3000\n\n"
+                while True:
+                    try:
+                        evento = await backend.escuchar(suscripcion, heartbeat)
+                    except asyncio.TimeoutError:
+                        yield ": ping\n\n"  # Mantiene viva la conexión a través de proxies
+                        continue
+                    yield f"event: {evento['tipo']}\ndata: {json.dumps(evento)}\n\n"
+            finally:
+                backend.desuscribir(suscripcion)
+
+        response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'  # Nginx: no acumular el stream en buffer
+        return response
+
+
 class MediaProxyView(SupervisorChatMixin, View):
     """
     Vista Proxy que decripta un archivo multimedia de WhatsApp usando la API de WASender
     y sirve el contenido directamente (Streaming) para evitar problemas de .enc y 0:00.
+    Los archivos decriptados se sirven desde la caché por contenido (media_cache.py).
     """
     def get(self, request, mensaje_id, *args, **kwargs):
         from django.http import HttpResponseRedirect
@@ -779,124 +1185,16 @@ class MediaProxyView(SupervisorChatMixin, View):
             if not mensaje.media_url or not mensaje.media_key:
                 logger.warning(f"Multimedia no decriptable para mensaje {mensaje_id} (posiblemente antiguo)")
                 return JsonResponse({'error': 'Multimedia no decriptable'}, status=404)
-            
-            # 1. Determinar el tipo de mensaje para el payload de WASender
-            # El payload requiere que la llave coincida con el tipo de mensaje de WhatsApp
-            type_map = {
-                'AUDIO': 'audioMessage',
-                'IMAGE': 'imageMessage',
-                'VIDEO': 'videoMessage',
-                'DOCUMENT': 'documentMessage'
-            }
-            msg_key = type_map.get(mensaje.media_type, 'documentMessage')
-
-            # 2. Preparar payload ESTRUCTURADO según documentación oficial
-            payload = {
-                "data": {
-                    "messages": {
-                        "key": {
-                            "id": mensaje.wasender_message_id or "unknown_id"
-                        },
-                        "message": {
-                            msg_key: {
-                                "url": mensaje.media_url,
-                                "mediaKey": mensaje.media_key,
-                                "mimetype": mensaje.mimetype or "application/octet-stream"
-                            }
-                        }
-                    }
-                }
-            }
-            
-            # 2. CACHÉ LOCAL: Verificamos si el archivo ya fue decriptado y guardado antes
-            cache_dir = os.path.join(settings.MEDIA_ROOT, 'wasender_cache')
-            if not os.path.exists(cache_dir):
-                os.makedirs(cache_dir, exist_ok=True)
-            
-            # Generar nombre de archivo basado en ID y mimetype
-            extension = 'bin'
-            if mensaje.mimetype:
-                if 'audio' in mensaje.mimetype: extension = 'ogg'
-                elif 'image' in mensaje.mimetype: extension = 'jpg'
-                elif 'video' in mensaje.mimetype: extension = 'mp4'
-                elif 'pdf' in mensaje.mimetype: extension = 'pdf'
-                elif '/' in mensaje.mimetype: extension = mensaje.mimetype.split('/')[-1]
-
-            cache_filename = f"msg_{mensaje_id}.{extension}"
-            cache_path = os.path.join(cache_dir, cache_filename)
-
-            if os.path.exists(cache_path):
-                logger.info(f"Sirviendo desde caché local: {cache_filename}")
-                response = FileResponse(open(cache_path, 'rb'), content_type=mensaje.mimetype)
-                if mensaje.media_type == 'DOCUMENT':
-                    response['Content-Disposition'] = f'inline; filename="documento_{mensaje_id}.pdf"'
-                return response
-
-            # 3. Llamada a la API de decriptación si no está en caché
-            api_key = settings.WASENDER_API_KEY
-            base_url = settings.WASENDER_BASE_URL.rstrip('/')
-            decrypt_endpoint = f"{base_url}/decrypt-media"
-            
-            # Construir el payload anidado según la nueva documentación oficial
-            media_msg_key = "imageMessage"
-            if mensaje.media_type == 'AUDIO': media_msg_key = "audioMessage"
-            elif mensaje.media_type == 'VIDEO': media_msg_key = "videoMessage"
-            elif mensaje.media_type == 'DOCUMENT': media_msg_key = "documentMessage"
-            
-            payload = {
-                "data": {
-                    "messages": {
-                        "key": {
-                            "id": mensaje.wasender_message_id or f"temp_{uuid.uuid4()}"
-                        },
-                        "message": {
-                            media_msg_key: {
-                                "url": mensaje.media_url,
-                                "mimetype": mensaje.mimetype or "application/octet-stream",
-                                "mediaKey": mensaje.media_key
-                            }
-                        }
-                    }
-                }
-            }
 
-            headers = {
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json"
-            }
-            
-            logger.info(f"Iniciando decriptación para mensaje {mensaje_id} (Endpoint: /decrypt-media)")
-            resp_init = requests.post(decrypt_endpoint, json=payload, headers=headers, timeout=15)
-            
-            if resp_init.status_code == 200:
-                data = resp_init.json()
-                # La documentación confirma que la clave es 'publicUrl'
-                public_url = data.get('publicUrl')
-                
-                if not public_url:
-                    logger.error(f"Falla en respuesta WASender (publicUrl no encontrado): {data}")
-                    return JsonResponse({'error': 'No se obtuvo URL decriptada'}, status=500)
+            try:
+                entrada = media_cache.obtener_o_descargar(mensaje)
+            except MediaNoDisponible as e:
+                return JsonResponse({'error': str(e)}, status=e.status)
 
-                # 4. DESCARGA Y CACHEO: Descargamos el archivo, lo guardamos y lo servimos
-                logger.info(f"Descargando y cacheando multimedia desde: {public_url}")
-                media_resp = requests.get(public_url, stream=True, timeout=30)
-                
-                if media_resp.status_code == 200:
-                    with open(cache_path, 'wb') as f:
-                        for chunk in media_resp.iter_content(chunk_size=8192):
-                            f.write(chunk)
-                    
-                    logger.info(f"Archivo guardado en caché: {cache_filename}")
-                    response = FileResponse(open(cache_path, 'rb'), content_type=mensaje.mimetype)
-                    if mensaje.media_type == 'DOCUMENT':
-                        response['Content-Disposition'] = f'inline; filename="documento_{mensaje_id}.pdf"'
-                    return response
-                else:
-                    return JsonResponse({'error': 'Error al descargar el archivo decriptado'}, status=media_resp.status_code)
-            else:
-                # Si falla decriptación y no está en caché (ej: mensaje muy antiguo)
-                logger.warning(f"Multimedia no decriptable para mensaje {mensaje_id}: {resp_init.status_code} - {resp_init.text}")
-                return JsonResponse({'error': 'El archivo multimedia ya no está disponible en WhatsApp'}, status=404)
+            response = self._servir_archivo(request, entrada, mensaje.mimetype)
+            if mensaje.media_type == 'DOCUMENT':
+                response['Content-Disposition'] = f'inline; filename="documento_{mensaje_id}.pdf"'
+            return response
                 
         except ChatMensaje.DoesNotExist:
             return JsonResponse({'error': 'Mensaje no encontrado'}, status=404)
@@ -904,3 +1202,87 @@ class MediaProxyView(SupervisorChatMixin, View):
             logger.error(f"Fallo crítico en MediaProxyView: {e}")
             return JsonResponse({'error': 'Error interno del servidor'}, status=500)
 
+    def _servir_archivo(self, request, entrada, content_type):
+        """
+        Sirve un archivo de la caché con soporte de GET condicional (ETag / Last-Modified -> 304)
+        y de rangos de bytes (206), necesarios para que el navegador pueda adelantar audios y videos.
+        """
+        from django.http import HttpResponse
+        from django.utils.http import http_date, parse_http_date_safe
+
+        ruta = media_cache.ruta_absoluta(entrada)
+        tamano = os.path.getsize(ruta)
+        # El archivo se nombra por su sha256: el ETag fuerte es el propio hash y el contenido nunca cambia
+        etag = f'"{entrada.sha256}"'
+        ultima_modificacion = int(entrada.fecha_creacion.timestamp())
+        cabeceras = {
+            'ETag': etag,
+            'Last-Modified': http_date(ultima_modificacion),
+            'Accept-Ranges': 'bytes',
+            'Cache-Control': 'private, max-age=31536000, immutable',
+        }
+
+        # 1. GET condicional
+        if_none_match = request.headers.get('If-None-Match')
+        if_modified_since = parse_http_date_safe(request.headers.get('If-Modified-Since', ''))
+        if (if_none_match and (if_none_match.strip() == '*' or etag in [e.strip() for e in if_none_match.split(',')])) or \
+                (not if_none_match and if_modified_since and ultima_modificacion <= if_modified_since):
+            response = HttpResponse(status=304)
+            for k, v in cabeceras.items():
+                response[k] = v
+            return response
+
+        # 2. Rango de bytes (solo un rango; si If-Range no coincide se sirve completo)
+        rango = self._parse_rango(request.headers.get('Range'), tamano)
+        if_range = request.headers.get('If-Range')
+        if rango and if_range and if_range.strip() not in (etag, cabeceras['Last-Modified']):
+            rango = None
+
+        if rango == 'invalido':
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{tamano}'
+            return response
+
+        if rango:
+            inicio, fin = rango
+            response = StreamingHttpResponse(self._leer_rango(ruta, inicio, fin - inicio + 1), status=206, content_type=content_type)
+            response['Content-Length'] = str(fin - inicio + 1)
+            response['Content-Range'] = f'bytes {inicio}-{fin}/{tamano}'
+        else:
+            response = FileResponse(open(ruta, 'rb'), content_type=content_type)
+
+        for k, v in cabeceras.items():
+            response[k] = v
+        return response
+
+    @staticmethod
+    def _parse_rango(cabecera, tamano):
+        """'bytes=inicio-fin' -> (inicio, fin) inclusivo; None si no aplica; 'invalido' si no es satisfacible"""
+        if not cabecera or not cabecera.startswith('bytes=') or ',' in cabecera:
+            return None
+        inicio, _, fin = cabecera[len('bytes='):].strip().partition('-')
+        try:
+            if inicio == '':
+                # Sufijo: los últimos N bytes
+                n = int(fin)
+                if n <= 0:
+                    return 'invalido'
+                return max(tamano - n, 0), tamano - 1
+            inicio = int(inicio)
+            fin = int(fin) if fin else tamano - 1
+        except ValueError:
+            return None
+        if inicio >= tamano or fin < inicio:
+            return 'invalido'
+        return inicio, min(fin, tamano - 1)
+
+    @staticmethod
+    def _leer_rango(ruta, inicio, longitud, chunk_size=64 * 1024):
+        with open(ruta, 'rb') as f:
+            f.seek(inicio)
+            while longitud > 0:
+                datos = f.read(min(chunk_size, longitud))
+                if not datos:
+                    break
+                longitud -= len(datos)
+                yield datos
@@ -1,10 +1,11 @@
 from django.contrib import admin
-from .models import Farmacia, Etiqueta, CrmContact, CampanaDifusion, DiffusionLog, ProductoCRM, CrmConfig, MensajeCampana, CrmMediaTemplate
+from .models import Farmacia, Etiqueta, CrmContact, CampanaDifusion, DiffusionLog, ProductoCRM, CrmConfig, MensajeCampana, CrmMediaTemplate, ImportJob, SegmentoGuardado, EtiquetadoMasivo
+from .segment_refresh import refrescador
 
 
 @admin.register(CrmConfig)
 class CrmConfigAdmin(admin.ModelAdmin):
-    list_display = ('id', 'tiempo_alerta_leads', 'fecha_actualizacion')
+    list_display = ('id', 'tiempo_alerta_leads', 'campanas_mensajes_por_minuto', 'campanas_envios_simultaneos', 'fecha_actualizacion')
 
 @admin.register(MensajeCampana)
 class MensajeCampanaAdmin(admin.ModelAdmin):
@@ -12,6 +13,34 @@ class MensajeCampanaAdmin(admin.ModelAdmin):
     list_filter = ('estado', 'campana')
 
 
+@admin.register(ImportJob)
+class ImportJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'tipo', 'estado', 'usuario', 'filas_procesadas', 'total_filas', 'nuevos', 'actualizados', 'omitidos', 'fecha_creacion')
+    list_filter = ('tipo', 'estado')
+    readonly_fields = ('fecha_creacion', 'fecha_inicio', 'fecha_latido', 'fecha_fin')
+
+
+@admin.register(SegmentoGuardado)
+class SegmentoGuardadoAdmin(admin.ModelAdmin):
+    list_display = ('nombre', 'total_miembros', 'requiere_recalculo', 'fecha_recalculo', 'usuario')
+    search_fields = ('nombre',)
+    readonly_fields = ('total_miembros', 'requiere_recalculo', 'fecha_recalculo')
+
+    def save_model(self, request, obj, form, change):
+        if 'filtros' in form.changed_data:
+            obj.requiere_recalculo = True
+        super().save_model(request, obj, form, change)
+        if obj.requiere_recalculo:
+            refrescador.programar(obj.pk)
+
+
+@admin.register(EtiquetadoMasivo)
+class EtiquetadoMasivoAdmin(admin.ModelAdmin):
+    list_display = ('id', 'operacion', 'etiqueta', 'estado', 'usuario', 'procesados', 'total', 'afectados', 'fecha_creacion')
+    list_filter = ('operacion', 'estado')
+    readonly_fields = ('fecha_creacion', 'fecha_latido', 'fecha_fin')
+
+
 @admin.register(Farmacia)
 class FarmaciaAdmin(admin.ModelAdmin):
     list_display = ('codigo', 'nombre', 'ciudad')
@@ -35,6 +64,12 @@ class CrmContactAdmin(admin.ModelAdmin):
     list_filter = ('ciudad', 'farmacia_origen', 'etiquetas', 'es_edad_estimada')
     filter_horizontal = ('etiquetas', 'medicamentos_comprados')
 
+    def save_model(self, request, obj, form, change):
+        if change:
+            # El chat pudo mover el puntero del último mensaje mientras se editaba
+            obj.refresh_from_db(fields=CrmContact.CAMPOS_ULTIMO_MENSAJE)
+        super().save_model(request, obj, form, change)
+
 
 @admin.register(CampanaDifusion)
 class CampanaDifusionAdmin(admin.ModelAdmin):
@@ -50,7 +85,7 @@ class CampanaDifusionAdmin(admin.ModelAdmin):
             'fields': ('ciudades_objetivo', 'etiquetas_objetivo', 'farmacias_objetivo')
         }),
         ('Audiencia - Segmentación Avanzada', {
-            'fields': ('medicamentos_objetivo', 'edad_minima', 'edad_maxima')
+            'fields': ('medicamentos_objetivo', 'edad_minima', 'edad_maxima', 'segmento')
         }),
     )
 
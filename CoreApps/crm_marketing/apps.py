@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class CrmMarketingConfig(AppConfig):
     name = 'CoreApps.crm_marketing'
+
+    def ready(self):
+        import CoreApps.crm_marketing.signals
@@ -0,0 +1,222 @@
+"""
+Dispatcher de campañas de difusión (usado por `whatsapp_worker_holaenfermera`).
+
+El ritmo anti-spam es una política de la cuenta (CrmConfig), no un sleep fijo en el bucle:
+- TokenBucket: N mensajes por minuto repartidos uniformemente + jitter aleatorio por envío,
+  compartido entre todos los workers (el turno vive en CrmConfig).
+- Hasta `campanas_envios_simultaneos` peticiones a WASender en curso a la vez, para que la latencia
+  de la API no reduzca el ritmo permitido.
+`paso()` nunca duerme: lanza como mucho un envío y devuelve cuánto falta para el siguiente turno,
+que el planificador del worker (CoreApps/notifications/scheduler.py) agenda como temporizador.
+"""
+import time
+import uuid
+import random
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from CoreApps.notifications import leases
+from CoreApps.notifications.services import WASenderService
+from .models import CrmConfig, CampanaDifusion, MensajeCampana
+from .rendering import compilar_plantilla, datos_contacto
+
+
+class TokenBucket:
+    """
+    Limitador por programación virtual (GCRA): cada reserva obtiene el siguiente hueco libre.
+    `capacidad` permite ráfagas tras un periodo inactivo; con 1 los envíos quedan equiespaciados.
+    El siguiente turno se guarda en la fila de CrmConfig y se reserva bajo select_for_update:
+    todos los workers comparten el mismo ritmo de la cuenta en lugar de multiplicarlo.
+    """
+
+    def __init__(self, por_minuto, capacidad=1, jitter=0):
+        self.configurar(por_minuto, capacidad, jitter)
+
+    def configurar(self, por_minuto, capacidad=1, jitter=0):
+        self.intervalo = 60.0 / max(float(por_minuto), 0.1)
+        self.capacidad = max(capacidad, 1)
+        self.jitter = max(jitter, 0)
+
+    def _turno(self, siguiente, ahora):
+        rafaga = ahora - datetime.timedelta(seconds=(self.capacidad - 1) * self.intervalo)
+        return max(siguiente, rafaga) if siguiente else rafaga
+
+    def espera(self):
+        """Segundos hasta el próximo turno libre (0 = disponible), sin consumirlo"""
+        siguiente = CrmConfig.objects.filter(id=1).values_list('campanas_siguiente_turno', flat=True).first()
+        ahora = timezone.now()
+        return max((self._turno(siguiente, ahora) - ahora).total_seconds(), 0)
+
+    def tomar(self):
+        """Consume un turno si está disponible; devuelve 0 o los segundos que faltan"""
+        with transaction.atomic():
+            siguiente = (CrmConfig.objects.select_for_update().filter(id=1)
+                         .values_list('campanas_siguiente_turno', flat=True).first())
+            ahora = timezone.now()
+            turno = self._turno(siguiente, ahora)
+            if turno > ahora:
+                return (turno - ahora).total_seconds()
+            # El jitter retrasa el turno siguiente: los envíos no quedan exactamente equiespaciados
+            proximo = turno + datetime.timedelta(seconds=self.intervalo + random.uniform(0, self.jitter))
+            CrmConfig.objects.filter(id=1).update(campanas_siguiente_turno=proximo)
+            return 0
+
+
+def renderizar_mensaje(plantilla, contacto):
+    """Reemplazos dinámicos de la plantilla de campaña con los datos del contacto"""
+    return compilar_plantilla(plantilla).renderizar(datos_contacto(contacto))
+
+
+class CampaignDispatcher:
+
+    # Segundos entre relecturas de CrmConfig (los cambios del panel aplican sin reiniciar el worker)
+    RELECTURA_CONFIG = 30
+    # Reconsulta cuando todos los cupos están ocupados (antes si un envío termina y avisa)
+    ESPERA_CUPO = 5
+
+    def __init__(self, stdout, style, al_liberar=None, worker_id=None, lease_segundos=300):
+        self.stdout = stdout
+        self.style = style
+        self.al_liberar = al_liberar  # callback cuando termina un envío (libera un cupo)
+        # Lease por mensaje: otros workers no lo toman mientras esté vigente
+        self.worker_id = worker_id or leases.nuevo_worker_id()
+        self.lease_segundos = lease_segundos
+        self.bucket = TokenBucket(por_minuto=2.4)
+        self.simultaneos = 0
+        self._executor = None
+        self._en_vuelo = set()
+        self._lock = threading.Lock()
+        self._config_leida = None
+
+    def pendientes(self, ahora):
+        return MensajeCampana.objects.filter(
+            estado='PENDIENTE',
+            campana__estado__in=['PROGRAMADA', 'ENVIANDO']
+        ).filter(
+            Q(campana__fecha_programada__isnull=True) | Q(campana__fecha_programada__lte=ahora)
+        ).order_by('id')
+
+    def _configurar(self):
+        if self._config_leida and time.monotonic() - self._config_leida < self.RELECTURA_CONFIG:
+            return
+        config = CrmConfig.get_solo()
+        self.bucket.configurar(config.campanas_mensajes_por_minuto, jitter=config.campanas_jitter_segundos)
+        simultaneos = max(config.campanas_envios_simultaneos, 1)
+        if simultaneos != self.simultaneos:
+            if self._executor:
+                self._executor.shutdown(wait=False)  # Los envíos en curso terminan en el pool anterior
+            self._executor = ThreadPoolExecutor(max_workers=simultaneos, thread_name_prefix='campanas')
+            self.simultaneos = simultaneos
+        self._config_leida = time.monotonic()
+
+    def en_vuelo(self):
+        with self._lock:
+            return len(self._en_vuelo)
+
+    def paso(self, ahora):
+        """
+        Lanza como mucho un envío de campaña. Devuelve los segundos hasta el siguiente paso,
+        o None si la cola está vacía.
+        """
+        self._configurar()
+        with self._lock:
+            if len(self._en_vuelo) >= self.simultaneos:
+                return self.ESPERA_CUPO
+        espera = self.bucket.espera()
+        if espera:
+            return espera
+        if not leases.disponibles(self.pendientes(ahora)).exists():
+            return None
+        # El turno se reserva antes de reclamar: otro worker pudo tomarlo desde la consulta anterior
+        espera = self.bucket.tomar()
+        if espera:
+            return espera
+
+        ids = leases.reclamar(self.pendientes(ahora), self.worker_id, 1, self.lease_segundos)
+        if not ids:
+            return None
+        # El texto ya viene renderizado desde el encolado: basta el teléfono del contacto
+        msg = MensajeCampana.objects.select_related('campana', 'contacto').get(id=ids[0])
+
+        if msg.campana.estado == 'PROGRAMADA':
+            CampanaDifusion.objects.filter(id=msg.campana_id, estado='PROGRAMADA').update(estado='ENVIANDO')
+        with self._lock:
+            self._en_vuelo.add(msg.id)
+        self._executor.submit(self._enviar, msg)
+        return 0
+
+    def detener(self):
+        """Espera los envíos en curso y suelta los leases que queden (apagado ordenado)"""
+        if self._executor:
+            self._executor.shutdown(wait=True)
+        leases.liberar(MensajeCampana, self.worker_id)
+
+    def _enviar(self, msg):
+        try:
+            self._enviar_mensaje(msg)
+            self._completar_campana(msg.campana)
+        except Exception as e:
+            self.stdout.write(self.style.ERROR(f"      🔥 Error procesando mensaje de campaña {msg.id}: {e}"))
+        finally:
+            with self._lock:
+                self._en_vuelo.discard(msg.id)
+            close_old_connections()
+            if self.al_liberar:
+                self.al_liberar()
+
+    def _completar_campana(self, campana):
+        """Marca la campaña como COMPLETADA cuando su último mensaje pendiente se procesó"""
+        if MensajeCampana.objects.filter(campana=campana, estado='PENDIENTE').exists():
+            return
+        if CampanaDifusion.objects.filter(id=campana.id, estado='ENVIANDO').update(estado='COMPLETADA'):
+            self.stdout.write(self.style.SUCCESS(f"🎯 Campaña '{campana.nombre}' FINALIZADA."))
+
+    def _enviar_mensaje(self, msg):
+        telefono = msg.contacto.telefono
+        texto_final = msg.texto_renderizado
+        if texto_final is None:
+            # Encolado antes de precalcular los textos
+            texto_final = renderizar_mensaje(msg.campana.mensaje_plantilla, msg.contacto)
+        self.stdout.write(f"   👉 Campaña ({msg.campana.nombre}) a {telefono}...")
+
+        exito = False
+        try:
+            resp_service = WASenderService.send_message(telefono, texto_final)
+            if isinstance(resp_service, dict):
+                exito = True
+                try:
+                    msg.wasender_message_id = resp_service.get('data', {}).get('key', {}).get('id', '')
+                except Exception:
+                    pass
+            elif resp_service == True:
+                exito = True
+        except Exception as e:
+            msg.error_log = str(e)
+
+        if exito:
+            msg.estado = 'ENVIADO'
+            self.stdout.write(self.style.SUCCESS(f"      ✅ Masivo Enviado a {telefono}."))
+
+            # Sincronizar con el historial de Chat CRM
+            try:
+                from CoreApps.chat.models import ChatMensaje
+                ChatMensaje.objects.create(
+                    contacto=msg.contacto,
+                    direccion='OUTBOUND',
+                    texto=texto_final,
+                    wasender_message_id=msg.wasender_message_id or f"local_camp_{uuid.uuid4().hex[:12]}",
+                    estado_envio='ENVIADO'
+                )
+            except Exception as e_sync:
+                self.stdout.write(self.style.ERROR(f"      ⚠️ Error sincronizando chat: {e_sync}"))
+        else:
+            msg.estado = 'ERROR'
+            self.stdout.write(self.style.ERROR(f"      ❌ Masivo Fallido a {telefono}."))
+
+        if not leases.cerrar(msg, self.worker_id, estado=msg.estado,
+                             wasender_message_id=msg.wasender_message_id, error_log=msg.error_log):
+            self.stdout.write(self.style.WARNING(f"      ⚠️ Lease del mensaje {msg.id} caducado: otro worker lo reclamó."))
@@ -0,0 +1,158 @@
+"""
+Encolado en bloque de los mensajes de una campaña (CampaignExecuteView).
+
+En lugar de un get_or_create por contacto dentro de la petición web:
+- Los ids de la audiencia se recorren por rangos de id (keyset, sin OFFSET) y cada lote se inserta
+  con bulk_create(ignore_conflicts=True): el unique_together ('campana', 'contacto') descarta los
+  que ya existían, así relanzar un encolado interrumpido es seguro.
+- Cada lote se lee con una sola consulta .values() (con los JOINs de ciudad/farmacia que pida la
+  plantilla) y el texto personalizado se renderiza ahí mismo con el plan compilado (rendering.py).
+- Audiencias grandes se encolan en un hilo de fondo; mientras tanto la campaña queda en ENCOLANDO
+  (el dispatcher solo envía PROGRAMADA/ENVIANDO) y `audiencia_procesada` avanza por lote.
+- El encolado lo hace un solo proceso a la vez (token `reclamado_por`): cada lote confirma junto con su
+  progreso, el punto de reanudación (`encolado_ultimo_id`) y el latido, solo si el token sigue vigente.
+  Relanzar una campaña cuyo encolado sigue latiendo se rechaza (EncoladoEnCurso); si el proceso web
+  murió a mitad, el carril de mantenimiento del worker la retoma desde el último lote confirmado.
+"""
+import logging
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import transaction, close_old_connections
+from django.db.models import F, Q
+from django.utils import timezone
+
+from CoreApps.notifications.leases import nuevo_worker_id
+from .models import CampanaDifusion, MensajeCampana
+from .import_jobs import ReclamoPerdido
+from .rendering import compilar_plantilla
+
+logger = logging.getLogger(__name__)
+
+
+class EncoladoEnCurso(Exception):
+    """Otro proceso está encolando la campaña (su latido sigue vigente)"""
+
+
+class CampaignEnqueuer:
+
+    def __init__(self):
+        self.tamano_lote = getattr(settings, 'CRM_CAMPANA_LOTE_ENCOLADO', 2000)
+        self.umbral_sincrono = getattr(settings, 'CRM_CAMPANA_ENCOLADO_SINCRONO', 5000)
+        self.segundos_huerfano = getattr(settings, 'CRM_CAMPANA_ENCOLADO_STALE_SECONDS', 300)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def lanzar(self, campana):
+        """
+        Pasa la campaña a ENCOLANDO y encola su audiencia: en la petición si es pequeña, o en
+        segundo plano. Devuelve los mensajes creados, o None si quedó encolándose en segundo plano.
+        Acepta campañas en BORRADOR o con un encolado huérfano (ENCOLANDO sin latido reciente), que
+        sigue desde su último lote confirmado. Lanza EncoladoEnCurso si otro proceso la está encolando.
+        """
+        total = campana.contar_audiencia()
+        token = self.reclamar(campana.pk, total=total, desde_borrador=True)
+        if not token:
+            if CampanaDifusion.objects.filter(pk=campana.pk, estado='ENCOLANDO').exists():
+                raise EncoladoEnCurso(campana.pk)
+            raise CampanaDifusion.DoesNotExist
+        if total <= self.umbral_sincrono:
+            return self.encolar(campana.pk, token)
+        transaction.on_commit(lambda: self._enviar(campana.pk, token))
+        return None
+
+    def _enviar(self, campana_id, token):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='campanas-encolado')
+        self._executor.submit(self._procesar, campana_id, token)
+
+    def _procesar(self, campana_id, token):
+        close_old_connections()
+        try:
+            self.encolar(campana_id, token)
+        except Exception:
+            # Queda en ENCOLANDO: al caducar su latido se retoma desde el último lote sin duplicar
+            logger.exception(f"Error encolando la campaña {campana_id}")
+        finally:
+            close_old_connections()
+
+    # --- Reclamo y reanudación ---
+
+    def huerfanas(self):
+        """Campañas en ENCOLANDO cuyo proceso dejó de latir (o nunca llegó a empezar)"""
+        limite = timezone.now() - datetime.timedelta(seconds=self.segundos_huerfano)
+        return CampanaDifusion.objects.filter(
+            Q(fecha_latido__isnull=True) | Q(fecha_latido__lt=limite), estado='ENCOLANDO'
+        )
+
+    def reclamar(self, campana_id, total=None, desde_borrador=False):
+        """
+        UPDATE condicional: solo un proceso gana el encolado. Desde BORRADOR el progreso empieza de cero;
+        una huérfana conserva el suyo. Devuelve el token del reclamo o None.
+        """
+        token = nuevo_worker_id()
+        campos = {'estado': 'ENCOLANDO', 'reclamado_por': token, 'fecha_latido': timezone.now()}
+        if total is not None:
+            campos['total_audiencia'] = total
+        if desde_borrador and CampanaDifusion.objects.filter(pk=campana_id, estado='BORRADOR').update(
+            audiencia_procesada=0, encolado_ultimo_id=0, **campos
+        ):
+            return token
+        return token if self.huerfanas().filter(pk=campana_id).update(**campos) else None
+
+    def retomar_huerfanas(self):
+        """Reclama las campañas huérfanas y las encola en el hilo de fondo de este proceso; devuelve cuántas"""
+        retomadas = 0
+        for campana_id in list(self.huerfanas().values_list('pk', flat=True)):
+            token = self.reclamar(campana_id)
+            if token:
+                self._enviar(campana_id, token)
+                retomadas += 1
+        return retomadas
+
+    # --- Encolado ---
+
+    def encolar(self, campana_id, token):
+        """
+        Inserta un MensajeCampana PENDIENTE (con su texto final) por contacto de la audiencia, desde el último
+        lote confirmado; devuelve los creados, o None si otro proceso retomó la campaña.
+        """
+        campana = CampanaDifusion.objects.get(pk=campana_id)
+        plan = compilar_plantilla(campana.mensaje_plantilla)
+        audiencia = campana.get_audiencia().order_by('id').values('id', *plan.campos)
+        antes = MensajeCampana.objects.filter(campana_id=campana_id).count()
+
+        ultimo = campana.encolado_ultimo_id
+        try:
+            while True:
+                filas = list(audiencia.filter(id__gt=ultimo)[:self.tamano_lote])
+                if not filas:
+                    break
+                ultimo = filas[-1]['id']
+                with transaction.atomic():
+                    MensajeCampana.objects.bulk_create(
+                        [MensajeCampana(campana_id=campana_id, contacto_id=fila['id'], estado='PENDIENTE',
+                                        texto_renderizado=plan.renderizar(fila)) for fila in filas],
+                        ignore_conflicts=True
+                    )
+                    vigente = CampanaDifusion.objects.filter(pk=campana_id, reclamado_por=token).update(
+                        audiencia_procesada=F('audiencia_procesada') + len(filas),
+                        encolado_ultimo_id=ultimo, fecha_latido=timezone.now()
+                    )
+                    if not vigente:
+                        raise ReclamoPerdido(campana_id)
+        except ReclamoPerdido:
+            logger.warning(f"Encolado de la campaña {campana_id} retomado por otro proceso; se abandona sin confirmar el lote en curso")
+            return None
+
+        # Recién aquí el dispatcher del worker empieza a tomar sus mensajes
+        CampanaDifusion.objects.filter(pk=campana_id, estado='ENCOLANDO', reclamado_por=token).update(
+            estado='PROGRAMADA', reclamado_por=None
+        )
+        return MensajeCampana.objects.filter(campana_id=campana_id).count() - antes
+
+
+# Instancia compartida por proceso
+encolador = CampaignEnqueuer()
@@ -0,0 +1,144 @@
+"""
+Resolución de identidad de contactos de WhatsApp (JID, LID, teléfono) -> CrmContact.
+
+Las búsquedas van a columnas indexadas (una por tipo de identificador, nunca un OR)
+y el resultado (solo el id) queda en una caché LRU acotada por proceso.
+Cada acierto de caché se valida contra la fila real al leerla por PK, así que
+una entrada obsoleta (contacto fusionado, eliminado o re-asignado en otro proceso)
+nunca devuelve un contacto equivocado: simplemente se descarta y se vuelve a consultar.
+"""
+import threading
+from collections import OrderedDict
+from django.conf import settings
+
+from .models import CrmContact
+
+# Tipo de identificador -> campo de CrmContact
+CAMPOS_IDENTIDAD = {
+    'lid': 'whatsapp_lid',
+    'jid': 'whatsapp_jid',
+    'telefono': 'telefono',
+}
+
+
+class ContactIdentityResolver:
+    """Caché LRU (tipo, valor) -> contacto_id con invalidación por contacto"""
+
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries or getattr(settings, 'CRM_IDENTITY_CACHE_SIZE', 20000)
+        self._cache = OrderedDict()
+        self._claves_por_contacto = {}
+        self._lock = threading.Lock()
+
+    # --- Operaciones de caché ---
+
+    def _leer(self, clave):
+        with self._lock:
+            contacto_id = self._cache.get(clave)
+            if contacto_id is not None:
+                self._cache.move_to_end(clave)
+            return contacto_id
+
+    def _guardar(self, clave, contacto_id):
+        with self._lock:
+            anterior = self._cache.pop(clave, None)
+            if anterior is not None and anterior != contacto_id:
+                self._claves_por_contacto.get(anterior, set()).discard(clave)
+            self._cache[clave] = contacto_id
+            self._claves_por_contacto.setdefault(contacto_id, set()).add(clave)
+            while len(self._cache) > self.max_entries:
+                clave_vieja, id_viejo = self._cache.popitem(last=False)
+                claves = self._claves_por_contacto.get(id_viejo)
+                if claves is not None:
+                    claves.discard(clave_vieja)
+                    if not claves:
+                        del self._claves_por_contacto[id_viejo]
+
+    def _olvidar(self, clave):
+        with self._lock:
+            contacto_id = self._cache.pop(clave, None)
+            if contacto_id is not None:
+                self._claves_por_contacto.get(contacto_id, set()).discard(clave)
+
+    def olvidar(self, tipo, valor):
+        """Descarta una entrada concreta (ej. validación fallida tras un bloqueo)"""
+        self._olvidar((tipo, valor))
+
+    def invalidate_contact(self, contacto_id):
+        """Elimina todas las entradas que apuntan a un contacto (fusión o borrado)"""
+        with self._lock:
+            for clave in self._claves_por_contacto.pop(contacto_id, set()):
+                self._cache.pop(clave, None)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self._claves_por_contacto.clear()
+
+    def recordar(self, contacto):
+        """Cachea todos los identificadores actuales de un contacto ya cargado"""
+        for tipo, campo in CAMPOS_IDENTIDAD.items():
+            valor = getattr(contacto, campo)
+            if valor:
+                self._guardar((tipo, valor), contacto.id)
+
+    @staticmethod
+    def coincide(contacto, tipo, valor):
+        """True si el contacto sigue teniendo ese identificador"""
+        return contacto is not None and getattr(contacto, CAMPOS_IDENTIDAD[tipo]) == valor
+
+    # --- Resolución ---
+
+    def resolve_ids(self, tipo, valores):
+        """
+        Resuelve muchos valores de un mismo tipo. Retorna {valor: contacto_id} solo con los encontrados.
+        Los fallos de caché se resuelven con UNA consulta indexada (campo__in).
+        """
+        campo = CAMPOS_IDENTIDAD[tipo]
+        resultado, faltantes = {}, []
+        for valor in set(v for v in valores if v):
+            contacto_id = self._leer((tipo, valor))
+            if contacto_id is None:
+                faltantes.append(valor)
+            else:
+                resultado[valor] = contacto_id
+
+        if faltantes:
+            # Respetamos el orden por defecto del modelo: el primero gana si hay duplicados
+            for valor, contacto_id in CrmContact.objects.filter(**{f'{campo}__in': faltantes}).values_list(campo, 'id'):
+                if valor not in resultado:
+                    resultado[valor] = contacto_id
+                    self._guardar((tipo, valor), contacto_id)
+        return resultado
+
+    def precargar(self, **valores_por_tipo):
+        """Calienta la caché para lotes (ej. sincronización de agenda): precargar(jid=[...], lid=[...])"""
+        for tipo, valores in valores_por_tipo.items():
+            if valores:
+                self.resolve_ids(tipo, valores)
+
+    def get_contact(self, tipo, valor, for_update=False):
+        """
+        Retorna el CrmContact con ese identificador o None.
+        Con caché: lectura por PK (opcionalmente con select_for_update) y validación del identificador.
+        """
+        if not valor:
+            return None
+        campo = CAMPOS_IDENTIDAD[tipo]
+        qs = CrmContact.objects.select_for_update() if for_update else CrmContact.objects.all()
+
+        contacto_id = self._leer((tipo, valor))
+        if contacto_id is not None:
+            contacto = qs.filter(pk=contacto_id).first()
+            if self.coincide(contacto, tipo, valor):
+                return contacto
+            self._olvidar((tipo, valor))
+
+        contacto = qs.filter(**{campo: valor}).first()
+        if contacto:
+            self._guardar((tipo, valor), contacto.id)
+        return contacto
+
+
+# Instancia compartida por proceso
+identidades = ContactIdentityResolver()
@@ -0,0 +1,289 @@
+"""
+Ejecución de importaciones masivas (ImportJob) en segundo plano, por trozos.
+
+- El archivo se lee en streaming: openpyxl en modo read_only para .xlsx y pd.read_csv con chunksize
+  para .csv (los .xls antiguos se leen completos y se recortan). Nunca se carga el libro entero.
+- Cada trozo se importa con el motor del tipo (ContactImporter / PatientImporter) y se confirma en UNA
+  transacción junto con los contadores y `filas_procesadas`: si el proceso muere, el trabajo se
+  reanuda desde el último trozo confirmado, sin duplicar ni perder filas.
+- `fecha_latido` lo refresca un hilo aparte, en transacciones cortas propias, también mientras un
+  trozo lento (ej. hash de contraseñas) sigue abierto. Un trabajo PROCESANDO sin latido durante el
+  límite de huérfano (CRM_IMPORT_STALE_SECONDS, ampliado según el tamaño del trozo) lo puede retomar
+  otro proceso (run_import_jobs).
+- Cada reclamo genera un token (`reclamado_por`); cada trozo verifica que el trabajo sigue siendo
+  suyo antes de confirmar, así un proceso desplazado nunca importa dos veces ni duplica contadores.
+"""
+import logging
+import datetime
+import itertools
+import threading
+import openpyxl
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import connection, transaction, close_old_connections
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from CoreApps.notifications.leases import nuevo_worker_id
+from .models import ImportJob
+
+logger = logging.getLogger(__name__)
+
+# Motor de importación por tipo de trabajo: clase con importar(df) -> {'nuevos', 'actualizados', 'omitidos', 'errores', 'extras'?}
+MOTORES = {
+    'CONTACTOS': 'CoreApps.crm_marketing.importer.ContactImporter',
+    'PACIENTES': 'CoreApps.users.importer.PatientImporter',
+}
+
+# Tope de errores guardados por trabajo (el JSON no debe crecer sin límite con archivos muy sucios)
+MAX_ERRORES = 20000
+
+
+class ReclamoPerdido(Exception):
+    """Otro proceso retomó el trabajo: el trozo en curso se revierte y este proceso lo abandona"""
+
+
+class Latido:
+    """
+    Refresca `fecha_latido` cada `intervalo` segundos desde un hilo con su propia conexión (autocommit,
+    sin esperar al trozo en curso). Si el trabajo dejó de ser de este token marca `perdido` y se detiene.
+    """
+
+    def __init__(self, job_id, token, intervalo):
+        self.job_id = job_id
+        self.token = token
+        self.intervalo = intervalo
+        self.perdido = False
+        self._parar = threading.Event()
+        self._hilo = threading.Thread(target=self._latir, name=f'import-latido-{job_id}', daemon=True)
+
+    def __enter__(self):
+        self._hilo.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._parar.set()
+        self._hilo.join()
+
+    def _latir(self):
+        try:
+            while not self._parar.wait(self.intervalo):
+                try:
+                    vigente = ImportJob.objects.filter(id=self.job_id, reclamado_por=self.token).update(
+                        fecha_latido=timezone.now()
+                    )
+                except Exception:
+                    logger.exception(f"No se pudo registrar el latido de la importación {self.job_id}")
+                    continue
+                if not vigente:
+                    self.perdido = True
+                    return
+        finally:
+            connection.close()  # Conexión propia de este hilo
+
+
+def _formato(nombre):
+    return nombre.rsplit('.', 1)[-1].lower() if '.' in nombre else ''
+
+
+def contar_filas(archivo, nombre):
+    """Filas de datos (sin encabezado) aproximadas, para la barra de progreso"""
+    formato = _formato(nombre)
+    if formato == 'xlsx':
+        libro = openpyxl.load_workbook(archivo, read_only=True, data_only=True)
+        try:
+            return max((libro.active.max_row or 1) - 1, 0)
+        finally:
+            libro.close()
+    if formato == 'csv':
+        return max(sum(1 for _ in archivo) - 1, 0)
+    return len(pd.read_excel(archivo))
+
+
+def leer_por_trozos(archivo, nombre, tamano, desde=0):
+    """
+    Genera (df, siguiente) con hasta `tamano` filas de datos a partir de la fila `desde` (0 = primera
+    fila bajo el encabezado). El índice del DataFrame es la posición original de cada fila, así los
+    números de fila de los errores coinciden con el Excel; `siguiente` es el punto de reanudación.
+    Las filas completamente vacías se descartan pero cuentan para la posición.
+    """
+    formato = _formato(nombre)
+    if formato == 'xlsx':
+        libro = openpyxl.load_workbook(archivo, read_only=True, data_only=True)
+        try:
+            filas = libro.active.iter_rows(values_only=True)
+            encabezado = [
+                str(c).strip() if c is not None else f'_col{i}'
+                for i, c in enumerate(next(filas, ()))
+            ]
+            ancho = len(encabezado)
+            filas = itertools.islice(filas, desde, None)
+            inicio = desde
+            while True:
+                bloque = list(itertools.islice(filas, tamano))
+                if not bloque:
+                    break
+                datos, indice = [], []
+                for posicion, fila in enumerate(bloque, start=inicio):
+                    if any(v is not None and str(v).strip() != '' for v in fila):
+                        datos.append(tuple(fila[:ancho]) + (None,) * (ancho - len(fila)))
+                        indice.append(posicion)
+                inicio += len(bloque)
+                yield pd.DataFrame(datos, columns=encabezado, index=indice), inicio
+        finally:
+            libro.close()
+        return
+
+    if formato == 'csv':
+        lector = pd.read_csv(archivo, dtype=object, chunksize=tamano, skiprows=range(1, desde + 1), skip_blank_lines=False)
+        inicio = desde
+        for trozo in lector:
+            trozo.columns = trozo.columns.str.strip()
+            trozo.index = pd.RangeIndex(inicio, inicio + len(trozo))
+            inicio += len(trozo)
+            yield trozo.dropna(how='all'), inicio
+        return
+
+    # .xls (formato binario antiguo): sin lector en streaming, se lee completo y se recorta
+    df = pd.read_excel(archivo)
+    df.columns = df.columns.astype(str).str.strip()
+    for inicio in range(desde, len(df), tamano):
+        trozo = df.iloc[inicio:inicio + tamano]
+        yield trozo.dropna(how='all'), inicio + len(trozo)
+
+
+class ImportJobRunner:
+
+    def __init__(self):
+        self.tamano_trozo = getattr(settings, 'CRM_IMPORT_CHUNK_SIZE', 2000)
+        # El límite nunca es menor que lo que puede tardar un trozo completo en el peor caso
+        self.segundos_huerfano = max(
+            getattr(settings, 'CRM_IMPORT_STALE_SECONDS', 300),
+            self.tamano_trozo * getattr(settings, 'CRM_IMPORT_SEGUNDOS_POR_FILA', 0.5)
+        )
+        # Varios latidos caben en el límite: un latido perdido no basta para declarar huérfano el trabajo
+        self.intervalo_latido = max(self.segundos_huerfano / 5, 1)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    # --- Cola en segundo plano (proceso web) ---
+
+    def programar(self, job_id):
+        """Ejecuta el trabajo en un hilo de fondo cuando confirme la transacción en curso"""
+        transaction.on_commit(lambda: self._enviar(job_id))
+
+    def _enviar(self, job_id):
+        with self._lock:
+            if self._executor is None:
+                # Un solo hilo: las importaciones grandes se procesan una tras otra, no compiten por la BD
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='import-jobs')
+        self._executor.submit(self._procesar, job_id)
+
+    def _procesar(self, job_id):
+        close_old_connections()
+        try:
+            self.ejecutar(job_id)
+        except Exception:
+            logger.exception(f"Error ejecutando la importación {job_id}")
+        finally:
+            close_old_connections()
+
+    # --- Reclamo y reanudación ---
+
+    def _reclamables(self, reintentar_error=False):
+        limite = timezone.now() - datetime.timedelta(seconds=self.segundos_huerfano)
+        condicion = Q(estado='PENDIENTE') | (
+            Q(estado='PROCESANDO') & (Q(fecha_latido__isnull=True) | Q(fecha_latido__lt=limite))
+        )
+        if reintentar_error:
+            condicion |= Q(estado='ERROR')
+        return ImportJob.objects.filter(condicion)
+
+    def reanudables(self):
+        """Trabajos pendientes o huérfanos (su proceso dejó de latir) que se pueden retomar"""
+        return self._reclamables().order_by('fecha_creacion')
+
+    def reclamar(self, job_id, reintentar_error=False):
+        """
+        UPDATE condicional: solo un proceso gana el trabajo aunque varios lo intenten a la vez.
+        Devuelve el token del reclamo, o None si no se pudo reclamar.
+        """
+        token = nuevo_worker_id()
+        reclamado = self._reclamables(reintentar_error).filter(id=job_id).update(
+            estado='PROCESANDO', fecha_latido=timezone.now(), reclamado_por=token, mensaje_error=None, fecha_fin=None
+        )
+        return token if reclamado else None
+
+    def _cerrar(self, job, token, **campos):
+        """Guarda el estado final solo si el trabajo sigue siendo de este token"""
+        for campo, valor in campos.items():
+            setattr(job, campo, valor)
+        return bool(ImportJob.objects.filter(id=job.id, reclamado_por=token).update(reclamado_por=None, **campos))
+
+    # --- Ejecución ---
+
+    def ejecutar(self, job_id, reintentar_error=False, al_avanzar=None, motor=None, tamano_trozo=None):
+        """
+        Procesa el trabajo desde `filas_procesadas` hasta el final. Devuelve el ImportJob actualizado,
+        o None si no se pudo reclamar (terminado o en manos de otro proceso).
+        `al_avanzar(job)` se llama tras confirmar cada trozo; `motor` permite pasar un motor ya
+        configurado (p. ej. PatientImporter con opciones del comando).
+        """
+        token = self.reclamar(job_id, reintentar_error)
+        if not token:
+            return None
+        job = ImportJob.objects.get(id=job_id)
+        motor = motor or import_string(MOTORES[job.tipo])()
+        tamano_trozo = tamano_trozo or self.tamano_trozo
+        if not job.fecha_inicio:
+            job.fecha_inicio = timezone.now()
+            job.save(update_fields=['fecha_inicio'])
+
+        try:
+            if not job.total_filas:
+                with job.archivo.open('rb') as archivo:
+                    job.total_filas = contar_filas(archivo, job.archivo.name)
+                job.save(update_fields=['total_filas'])
+
+            with Latido(job.id, token, self.intervalo_latido), job.archivo.open('rb') as archivo:
+                for trozo, siguiente in leer_por_trozos(archivo, job.archivo.name, tamano_trozo, job.filas_procesadas):
+                    self._confirmar_trozo(job, token, motor, trozo, siguiente)
+                    if al_avanzar:
+                        al_avanzar(job)
+        except ReclamoPerdido:
+            logger.warning(f"Importación {job.id} retomada por otro proceso; se abandona sin confirmar el trozo en curso")
+            return None
+        except Exception as e:
+            logger.exception(f"Importación {job.id} interrumpida en la fila {job.filas_procesadas + 2}")
+            self._cerrar(job, token, estado='ERROR', mensaje_error=str(e), fecha_fin=timezone.now())
+            return job
+
+        # El conteo inicial de .xlsx puede incluir filas vacías
+        self._cerrar(job, token, estado='COMPLETADO', total_filas=job.filas_procesadas, fecha_fin=timezone.now())
+        return job
+
+    def _confirmar_trozo(self, job, token, motor, trozo, siguiente):
+        """Importa el trozo y avanza el punto de reanudación en la misma transacción, si el trabajo sigue siendo nuestro"""
+        with transaction.atomic():
+            if not trozo.empty:
+                resultado = motor.importar(trozo)
+                job.nuevos += resultado['nuevos']
+                job.actualizados += resultado['actualizados']
+                job.omitidos += resultado['omitidos']
+                job.errores.extend(resultado['errores'][:max(MAX_ERRORES - len(job.errores), 0)])
+                for clave, valor in resultado.get('extras', {}).items():
+                    job.extras[clave] = job.extras.get(clave, 0) + valor
+            # Bloquea la fila hasta el commit: un reclamo concurrente espera y ve el latido nuevo
+            if not ImportJob.objects.select_for_update().filter(id=job.id, reclamado_por=token).exists():
+                raise ReclamoPerdido(job.id)
+            job.filas_procesadas = siguiente
+            job.fecha_latido = timezone.now()
+            job.save(update_fields=[
+                'nuevos', 'actualizados', 'omitidos', 'errores', 'extras', 'filas_procesadas', 'fecha_latido'
+            ])
+
+
+# Instancia compartida por proceso
+import_runner = ImportJobRunner()
@@ -0,0 +1,292 @@
+"""
+Motor de importación masiva de contactos CRM desde Excel (plantilla de DownloadImportTemplateView).
+
+En lugar de 5-8 consultas por fila:
+1. Normaliza teléfonos, cédulas, nombres y fechas con operaciones vectorizadas de pandas.
+2. Resuelve ciudades, farmacias y productos con una consulta por catálogo (crea los faltantes en bloque).
+3. Hace upsert de los contactos con bulk_create(update_conflicts=True) por cédula.
+4. Inserta las filas M2M de medicamentos en bloque sobre la tabla intermedia.
+
+Reglas heredadas de la importación fila a fila: se omiten filas sin teléfono o con los teléfonos de
+ejemplo de la plantilla, la cédula de 9 dígitos recupera su cero inicial y, si falta, se usa el
+teléfono; si una cédula se repite en el archivo gana su última fila.
+
+Un contacto sin cédula (llegó por WhatsApp) cuyo teléfono aparece en el archivo con una cédula nueva
+se adopta: se le asigna esa cédula y el upsert lo actualiza como a cualquier existente.
+"""
+import datetime
+import pandas as pd
+from django.db import connection, transaction
+
+from CoreApps.main.models import Ciudad
+from .identity import identidades
+from .models import CrmContact, Farmacia, ProductoCRM
+from .segment_refresh import refrescador
+
+COLUMNAS = [
+    'CEDULA', 'TELEFONO', 'NOMBRES', 'APELLIDOS', 'EMAIL', 'FECHA_NACIMIENTO', 'EDAD',
+    'CIUDAD', 'DIRECCION', 'CODIGO_FARMACIA', 'MEDICAMENTO'
+]
+TELEFONOS_EJEMPLO = ['0991234567', '0987654321']
+
+CAMPOS_UPSERT = [
+    'telefono', 'nombres', 'apellidos', 'email', 'zona_barrio', 'ciudad', 'farmacia_origen',
+    'fecha_nacimiento', 'es_edad_estimada',
+]
+
+TAMANO_LOTE = 1000
+
+
+def _texto(serie):
+    """Serie de texto limpia: sin NaN/'None', sin espacios y sin el '.0' que Excel agrega a los números"""
+    s = serie.astype('string').str.strip().fillna('')
+    s = s.mask(s.isin(['None', 'nan', 'NaT', '<NA>']), '')
+    return s.str.replace(r'\.0$', '', regex=True)
+
+
+def _por_lotes(valores, tamano=TAMANO_LOTE):
+    valores = list(valores)
+    for i in range(0, len(valores), tamano):
+        yield valores[i:i + tamano]
+
+
+def normalizar(df):
+    """
+    DataFrame crudo del Excel -> DataFrame normalizado (una fila por fila válida del archivo)
+    con la columna `fila` (número de fila en Excel) y los valores listos para el modelo.
+    """
+    filas = df.index.to_numpy() + 2  # +1 encabezado, +1 base 1
+    df = df.reindex(columns=COLUMNAS).reset_index(drop=True)
+    n = pd.DataFrame({'fila': filas})
+
+    telefono = _texto(df['TELEFONO'])
+    n['telefono_crudo'] = telefono
+    n['telefono'] = (
+        telefono.mask(telefono.str.startswith('09'), '+593' + telefono.str[1:])
+        .mask(telefono.str.startswith('9'), '+593' + telefono)
+    )
+
+    cedula = _texto(df['CEDULA'])
+    cedula = cedula.mask((cedula.str.len() == 9) & cedula.str.isdigit(), '0' + cedula)
+    n['cedula'] = cedula.mask(cedula == '', telefono)
+
+    nombres = _texto(df['NOMBRES'])
+    n['nombres'] = nombres.mask(nombres == '', 'Desconocido')
+    n['apellidos'] = _texto(df['APELLIDOS'])
+    n['email'] = _texto(df['EMAIL'])
+    n['zona_barrio'] = _texto(df['DIRECCION'])
+    n['ciudad'] = _texto(df['CIUDAD'])
+    n['farmacia'] = _texto(df['CODIGO_FARMACIA'])
+    n['medicamento'] = _texto(df['MEDICAMENTO'])
+
+    # Fecha de nacimiento exacta o, si no hay, estimada desde la edad (1 de enero de ese año)
+    fecha = pd.to_datetime(
+        df['FECHA_NACIMIENTO'].mask(_texto(df['FECHA_NACIMIENTO']) == ''),
+        errors='coerce', format='mixed'
+    )
+    edad = pd.to_numeric(df['EDAD'], errors='coerce')
+    edad = edad.where((edad >= 0) & (edad < 150)).floordiv(1)
+    estimar = fecha.isna() & edad.notna()
+    fecha[estimar] = pd.to_datetime(
+        pd.DataFrame({'year': datetime.date.today().year - edad[estimar], 'month': 1, 'day': 1}),
+        errors='coerce'
+    )
+    n['fecha_nacimiento'] = [f.date() if pd.notna(f) else None for f in fecha]
+    n['es_edad_estimada'] = estimar & fecha.notna()
+
+    # Filas sin teléfono o con los ejemplos de la plantilla se ignoran (también si Excel les quitó el 0)
+    ejemplos = ['+593' + t[1:] for t in TELEFONOS_EJEMPLO]
+    return n[(n['telefono_crudo'] != '') & ~n['telefono'].isin(ejemplos)].reset_index(drop=True)
+
+
+class ContactImporter:
+    """
+    Importa un DataFrame (o un trozo de él) en bloque. `importar()` devuelve
+    {'nuevos', 'actualizados', 'omitidos', 'errores': [{'fila', 'cedula', 'motivo'}]}.
+    """
+
+    def importar(self, df):
+        datos = normalizar(df)
+        errores = []
+        if datos.empty:
+            return {'nuevos': 0, 'actualizados': 0, 'omitidos': 0, 'errores': errores}
+
+        with transaction.atomic():
+            ciudades = self._resolver_ciudades(datos['ciudad'])
+            datos['ciudad_id'] = datos['ciudad'].str.lower().map(ciudades)
+            farmacias = self._resolver_farmacias(datos)
+            datos['farmacia_id'] = datos['farmacia'].map(farmacias)
+            for fila in datos[(datos['farmacia'] != '') & datos['farmacia_id'].isna()].itertuples():
+                errores.append({'fila': fila.fila, 'cedula': fila.cedula,
+                                'motivo': f"Farmacia {fila.farmacia} sin ciudad: se importó sin farmacia"})
+
+            contactos, rechazados, adoptados = self._depurar(datos)
+            errores.extend(rechazados)
+            self._adoptar(adoptados)
+            existentes = self._ids_por_cedula(contactos['cedula'])
+            self._upsert(contactos)
+
+            ids = self._ids_por_cedula(contactos['cedula'])
+            aceptadas = datos[datos['cedula'].isin(contactos['cedula']) & ~datos['fila'].isin([e['fila'] for e in rechazados])]
+            self._vincular_medicamentos(aceptadas, ids)
+
+        # Los teléfonos de contactos existentes pudieron cambiar: fuera de la caché de identidad
+        for contacto_id in existentes.values():
+            identidades.invalidate_contact(contacto_id)
+        # bulk_create no envía señales: los segmentos guardados revisan estos contactos en su próximo refresco
+        refrescador.marcar(ids.values())
+
+        nuevos = len(set(ids) - set(existentes))
+        return {
+            'nuevos': nuevos,
+            'actualizados': len(contactos) - nuevos,
+            'omitidos': len(rechazados),
+            'errores': sorted(errores, key=lambda e: e['fila']),
+        }
+
+    # --- Catálogos (una consulta cada uno) ---
+
+    def _resolver_ciudades(self, nombres):
+        """{nombre en minúsculas: ciudad_id}, creando las que falten"""
+        pedidas = {n.lower(): n.title() for n in nombres.unique() if n}
+        if not pedidas:
+            return {}
+        ciudades = {nombre.lower(): cid for cid, nombre in Ciudad.objects.values_list('id', 'nombre')}
+        faltantes = [nombre for clave, nombre in pedidas.items() if clave not in ciudades]
+        if faltantes:
+            Ciudad.objects.bulk_create([Ciudad(nombre=n) for n in faltantes], ignore_conflicts=True)
+            for cid, nombre in Ciudad.objects.filter(nombre__in=faltantes).values_list('id', 'nombre'):
+                ciudades[nombre.lower()] = cid
+        return ciudades
+
+    def _resolver_farmacias(self, datos):
+        """{codigo: farmacia_id}; una farmacia nueva toma la ciudad de su primera fila (obligatoria)"""
+        codigos = [c for c in datos['farmacia'].unique() if c]
+        if not codigos:
+            return {}
+        farmacias = {}
+        for lote in _por_lotes(codigos):
+            farmacias.update(Farmacia.objects.filter(codigo__in=lote).values_list('codigo', 'id'))
+        ciudad_por_codigo = (
+            datos[(datos['farmacia'] != '') & datos['ciudad_id'].notna()]
+            .drop_duplicates('farmacia').set_index('farmacia')['ciudad_id']
+        )
+        nuevas = [
+            Farmacia(codigo=codigo, nombre=f"Farmacia {codigo}", ciudad_id=int(ciudad_por_codigo[codigo]))
+            for codigo in codigos if codigo not in farmacias and codigo in ciudad_por_codigo
+        ]
+        if nuevas:
+            Farmacia.objects.bulk_create(nuevas, ignore_conflicts=True)
+            farmacias.update(
+                Farmacia.objects.filter(codigo__in=[f.codigo for f in nuevas]).values_list('codigo', 'id')
+            )
+        return farmacias
+
+    def _resolver_productos(self, nombres):
+        """{nombre en minúsculas: producto_id}, creando los que falten"""
+        pedidos = {n.lower(): n.title() for n in nombres.unique() if n}
+        if not pedidos:
+            return {}
+        productos = {nombre.lower(): pid for pid, nombre in ProductoCRM.objects.values_list('id', 'nombre')}
+        faltantes = [nombre for clave, nombre in pedidos.items() if clave not in productos]
+        if faltantes:
+            ProductoCRM.objects.bulk_create([ProductoCRM(nombre=n) for n in faltantes], ignore_conflicts=True)
+            for pid, nombre in ProductoCRM.objects.filter(nombre__in=faltantes).values_list('id', 'nombre'):
+                productos[nombre.lower()] = pid
+        return productos
+
+    # --- Contactos ---
+
+    def _ids_por_cedula(self, cedulas):
+        ids = {}
+        for lote in _por_lotes(cedulas.unique()):
+            ids.update(CrmContact.objects.filter(cedula__in=lote).values_list('cedula', 'id'))
+        return ids
+
+    def _depurar(self, datos):
+        """
+        Una fila por cédula (gana la última) y sin teléfonos en conflicto: un teléfono que ya
+        pertenece a otro contacto (en el archivo o en la base) rechaza la fila en vez de abortar todo.
+        Si el dueño del teléfono no tiene cédula y la cédula de la fila es nueva, el contacto se adopta.
+        Devuelve (contactos, rechazados, {contacto_id: cédula a asignar}).
+        """
+        contactos = datos.drop_duplicates('cedula', keep='last')
+        rechazados = []
+
+        repetidos = contactos.duplicated('telefono', keep='first')
+        for fila in contactos[repetidos].itertuples():
+            rechazados.append({'fila': fila.fila, 'cedula': fila.cedula, 'motivo': f"Teléfono {fila.telefono} repetido en el archivo con otra cédula"})
+        contactos = contactos[~repetidos]
+
+        duenos = {}  # teléfono -> (id, cédula) del contacto que ya lo tiene
+        for lote in _por_lotes(contactos['telefono'].unique()):
+            for telefono, contacto_id, cedula in CrmContact.objects.filter(telefono__in=lote).values_list('telefono', 'id', 'cedula'):
+                duenos[telefono] = (contacto_id, cedula)
+        # Cédulas de las filas que podrían adoptar un contacto sin cédula: si ya existen, son de otro contacto
+        candidatas = [f.cedula for f in contactos.itertuples() if f.telefono in duenos and not duenos[f.telefono][1]]
+        registradas = self._ids_por_cedula(pd.Series(candidatas, dtype=object))
+
+        adoptados, ajenas = {}, []
+        for fila in contactos.itertuples():
+            if fila.telefono not in duenos:
+                continue
+            contacto_id, cedula = duenos[fila.telefono]
+            if cedula == fila.cedula:
+                continue
+            if not cedula and fila.cedula not in registradas:
+                adoptados[contacto_id] = fila.cedula
+                continue
+            ajenas.append(fila.Index)
+            motivo = (f"Teléfono {fila.telefono} ya registrado con otra cédula" if cedula else
+                      f"Teléfono {fila.telefono} ya registrado en un contacto sin cédula y la cédula {fila.cedula} pertenece a otro contacto")
+            rechazados.append({'fila': fila.fila, 'cedula': fila.cedula, 'motivo': motivo})
+        return contactos.drop(index=ajenas), rechazados, adoptados
+
+    def _adoptar(self, adoptados):
+        """Asigna por pk la cédula del archivo a contactos sin cédula (el upsert los encuentra después)"""
+        if adoptados:
+            CrmContact.objects.bulk_update(
+                [CrmContact(pk=contacto_id, cedula=cedula) for contacto_id, cedula in adoptados.items()],
+                ['cedula'], batch_size=TAMANO_LOTE
+            )
+
+    def _upsert(self, contactos):
+        objetos = [
+            CrmContact(
+                cedula=c.cedula,
+                telefono=c.telefono,
+                nombres=c.nombres,
+                apellidos=c.apellidos,
+                email=c.email or None,
+                zona_barrio=c.zona_barrio or None,
+                ciudad_id=int(c.ciudad_id) if pd.notna(c.ciudad_id) else None,
+                farmacia_origen_id=int(c.farmacia_id) if pd.notna(c.farmacia_id) else None,
+                fecha_nacimiento=c.fecha_nacimiento,
+                es_edad_estimada=bool(c.es_edad_estimada),
+            )
+            for c in contactos.itertuples()
+        ]
+        # MySQL resuelve el conflicto con ON DUPLICATE KEY (sin columna objetivo); el resto necesita la cédula
+        unique_fields = ['cedula'] if connection.features.supports_update_conflicts_with_target else None
+        CrmContact.objects.bulk_create(
+            objetos, batch_size=TAMANO_LOTE,
+            update_conflicts=True, unique_fields=unique_fields, update_fields=CAMPOS_UPSERT
+        )
+
+    def _vincular_medicamentos(self, datos, ids):
+        """Filas de la tabla intermedia contacto <-> producto; los pares ya existentes se ignoran"""
+        con_medicamento = datos[datos['medicamento'] != '']
+        if con_medicamento.empty:
+            return
+        productos = self._resolver_productos(con_medicamento['medicamento'])
+        campo = CrmContact.medicamentos_comprados.field
+        Through = CrmContact.medicamentos_comprados.through
+        pares = {
+            (ids[f.cedula], productos[f.medicamento.lower()])
+            for f in con_medicamento.itertuples()
+            if f.cedula in ids and f.medicamento.lower() in productos
+        }
+        Through.objects.bulk_create(
+            [Through(**{f'{campo.m2m_field_name()}_id': c, f'{campo.m2m_reverse_field_name()}_id': p}) for c, p in pares],
+            batch_size=TAMANO_LOTE, ignore_conflicts=True
+        )
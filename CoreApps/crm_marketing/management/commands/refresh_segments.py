@@ -0,0 +1,47 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+from CoreApps.crm_marketing.models import SegmentoGuardado
+from CoreApps.crm_marketing.segment_refresh import refrescador
+
+
+class Command(BaseCommand):
+    help = 'Mantiene al día la membresía materializada de los segmentos guardados (recálculos vencidos y contactos modificados).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--segmento', type=int, default=None, help='Recalcular por completo solo este segmento')
+        parser.add_argument('--completo', action='store_true', help='Recalcular por completo todos los segmentos')
+        parser.add_argument('--loop', action='store_true', help='Seguir refrescando periódicamente')
+        parser.add_argument('--idle-sleep', type=float, default=60.0, help='Segundos de espera entre pasadas en modo --loop')
+
+    def handle(self, *args, **options):
+        if options['segmento']:
+            if not SegmentoGuardado.objects.filter(id=options['segmento']).exists():
+                raise CommandError(f"No existe el segmento {options['segmento']}")
+            self._recalcular(options['segmento'])
+            return
+
+        if options['completo']:
+            SegmentoGuardado.objects.update(requiere_recalculo=True)
+
+        self.stdout.write(self.style.SUCCESS('✅ [Segmentos] Refrescando membresías...'))
+        try:
+            while True:
+                close_old_connections()
+                for segmento in list(refrescador.vencidos()):
+                    self._recalcular(segmento.pk)
+                revisados = refrescador.refrescar_pendientes()
+                if revisados:
+                    self.stdout.write(f"🔄 {revisados} contactos modificados revisados contra los segmentos.")
+                if not options['loop']:
+                    break
+                time.sleep(options['idle_sleep'])
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.WARNING('\n🛑 Refresco de segmentos detenido por el usuario (Ctrl+C).'))
+
+    def _recalcular(self, segmento_id):
+        altas, bajas = refrescador.recalcular(segmento_id)
+        segmento = SegmentoGuardado.objects.get(pk=segmento_id)
+        self.stdout.write(self.style.SUCCESS(
+            f"   ✅ Segmento '{segmento.nombre}': {segmento.total_miembros} miembros (+{altas} / -{bajas})."
+        ))
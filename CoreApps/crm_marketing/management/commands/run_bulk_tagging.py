@@ -0,0 +1,49 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+from CoreApps.crm_marketing.models import EtiquetadoMasivo
+from CoreApps.crm_marketing.tagging import etiquetador
+
+
+class Command(BaseCommand):
+    help = 'Procesa los etiquetados masivos pendientes y reanuda los interrumpidos desde su último lote confirmado.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--job', type=int, default=None, help='Procesar solo esta operación (también si quedó en ERROR)')
+        parser.add_argument('--loop', action='store_true', help='Seguir atento a operaciones nuevas o huérfanas')
+        parser.add_argument('--idle-sleep', type=float, default=30.0, help='Segundos de espera entre revisiones en modo --loop')
+
+    def handle(self, *args, **options):
+        if options['job']:
+            if not EtiquetadoMasivo.objects.filter(id=options['job']).exists():
+                raise CommandError(f"No existe el etiquetado masivo {options['job']}")
+            self._ejecutar(options['job'], reintentar_error=True)
+            return
+
+        self.stdout.write(self.style.SUCCESS('✅ [Etiquetado] Buscando operaciones pendientes o huérfanas...'))
+        try:
+            while True:
+                close_old_connections()
+                # Las recién lanzadas las procesa el hilo del servidor web; aquí solo las abandonadas
+                ids = list(etiquetador.huerfanas().values_list('id', flat=True))
+                for job_id in ids:
+                    self._ejecutar(job_id)
+                if not options['loop']:
+                    break
+                if not ids:
+                    time.sleep(options['idle_sleep'])
+        except KeyboardInterrupt:
+            # El lote en curso se revierte; la operación se reanuda desde el último confirmado
+            self.stdout.write(self.style.WARNING('\n🛑 Etiquetado detenido por el usuario (Ctrl+C).'))
+
+    def _ejecutar(self, job_id, reintentar_error=False):
+        self.stdout.write(f"👉 Etiquetado masivo #{job_id}...")
+        job = etiquetador.ejecutar(job_id, reintentar_error=reintentar_error)
+        if job is None:
+            self.stdout.write(self.style.WARNING(f"   ⚠️ Etiquetado #{job_id} terminado o en manos de otro proceso."))
+        elif job.estado == 'ERROR':
+            self.stdout.write(self.style.ERROR(f"   ❌ Etiquetado #{job.id} interrumpido tras {job.procesados} contactos: {job.mensaje_error}"))
+        else:
+            self.stdout.write(self.style.SUCCESS(
+                f"   ✅ Etiquetado #{job.id} completado: {job.afectados} de {job.total} contactos cambiaron."
+            ))
@@ -0,0 +1,52 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+from CoreApps.crm_marketing.models import ImportJob
+from CoreApps.crm_marketing.import_jobs import import_runner
+
+
+class Command(BaseCommand):
+    help = 'Procesa los trabajos de importación pendientes y reanuda los interrumpidos desde su último trozo confirmado.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--job', type=int, default=None, help='Procesar solo este trabajo (también si quedó en ERROR)')
+        parser.add_argument('--loop', action='store_true', help='Seguir atento a trabajos nuevos o huérfanos')
+        parser.add_argument('--idle-sleep', type=float, default=30.0, help='Segundos de espera entre revisiones en modo --loop')
+
+    def handle(self, *args, **options):
+        if options['job']:
+            if not ImportJob.objects.filter(id=options['job']).exists():
+                raise CommandError(f"No existe el trabajo de importación {options['job']}")
+            self._ejecutar(options['job'], reintentar_error=True)
+            return
+
+        self.stdout.write(self.style.SUCCESS('✅ [Importaciones] Buscando trabajos pendientes o huérfanos...'))
+        try:
+            while True:
+                close_old_connections()
+                ids = list(import_runner.reanudables().values_list('id', flat=True))
+                for job_id in ids:
+                    self._ejecutar(job_id)
+                if not options['loop']:
+                    break
+                if not ids:
+                    time.sleep(options['idle_sleep'])
+        except KeyboardInterrupt:
+            # El trozo en curso se revierte; el trabajo se reanuda desde el último confirmado
+            self.stdout.write(self.style.WARNING('\n🛑 Importaciones detenidas por el usuario (Ctrl+C).'))
+
+    def _ejecutar(self, job_id, reintentar_error=False):
+        self.stdout.write(f"👉 Importación #{job_id}...")
+        job = import_runner.ejecutar(job_id, reintentar_error=reintentar_error, al_avanzar=self._progreso)
+        if job is None:
+            self.stdout.write(self.style.WARNING(f"   ⚠️ Importación #{job_id} terminada o en manos de otro proceso."))
+        elif job.estado == 'ERROR':
+            self.stdout.write(self.style.ERROR(f"   ❌ Importación #{job.id} interrumpida en la fila {job.filas_procesadas + 2}: {job.mensaje_error}"))
+        else:
+            self.stdout.write(self.style.SUCCESS(
+                f"   ✅ Importación #{job.id} completada: {job.nuevos} nuevos, {job.actualizados} actualizados, "
+                f"{len(job.errores)} advertencias."
+            ))
+
+    def _progreso(self, job):
+        self.stdout.write(f"      {job.filas_procesadas}/{job.total_filas} filas ({job.porcentaje}%)")
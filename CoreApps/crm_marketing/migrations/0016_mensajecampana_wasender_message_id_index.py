@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-18 11:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm_marketing', '0015_crmcontact_fecha_ultima_actividad_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='mensajecampana',
+            name='wasender_message_id',
+            field=models.CharField(blank=True, db_index=True, max_length=150, null=True, verbose_name='ID de Mensaje en WASender'),
+        ),
+    ]
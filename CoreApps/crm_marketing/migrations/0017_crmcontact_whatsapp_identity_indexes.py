@@ -0,0 +1,23 @@
+# Generated by Django 6.0 on 2026-10-18 10:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm_marketing', '0016_mensajecampana_wasender_message_id_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='crmcontact',
+            name='whatsapp_jid',
+            field=models.CharField(blank=True, db_index=True, max_length=150, null=True, verbose_name='WhatsApp JID'),
+        ),
+        migrations.AlterField(
+            model_name='crmcontact',
+            name='whatsapp_lid',
+            field=models.CharField(blank=True, db_index=True, max_length=150, null=True, verbose_name='WhatsApp LID (Linked Device ID)'),
+        ),
+    ]
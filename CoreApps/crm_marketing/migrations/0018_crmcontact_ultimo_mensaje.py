@@ -0,0 +1,45 @@
+# Generated by Django 6.0 on 2026-10-18 11:15
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def poblar_ultimo_mensaje(apps, schema_editor):
+    """Rellena el puntero de último mensaje de los contactos que ya tienen historial"""
+    CrmContact = apps.get_model('crm_marketing', 'CrmContact')
+    ChatMensaje = apps.get_model('chat', 'ChatMensaje')
+    ultimo = ChatMensaje.objects.filter(contacto_id=OuterRef('pk')).order_by('-fecha_mensaje', '-id')
+    CrmContact.objects.filter(id__in=ChatMensaje.objects.values('contacto_id')).update(
+        ultimo_mensaje=Subquery(ultimo.values('id')[:1]),
+        fecha_ultimo_mensaje=Subquery(ultimo.values('fecha_mensaje')[:1]),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_webhookinbox'),
+        ('crm_marketing', '0017_crmcontact_whatsapp_identity_indexes'),
+        ('main', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='crmcontact',
+            name='fecha_ultimo_mensaje',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Fecha del último mensaje'),
+        ),
+        migrations.AddField(
+            model_name='crmcontact',
+            name='ultimo_mensaje',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.chatmensaje'),
+        ),
+        migrations.AddIndex(
+            model_name='crmcontact',
+            index=models.Index(fields=['fecha_ultimo_mensaje', 'id'], name='crm_contact_ultimo_msg_idx'),
+        ),
+        migrations.RunPython(poblar_ultimo_mensaje, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 6.0 on 2026-10-18 15:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm_marketing', '0018_crmcontact_ultimo_mensaje'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='crmconfig',
+            name='campanas_envios_simultaneos',
+            field=models.PositiveIntegerField(default=3, help_text='Envíos de campaña en curso a la vez (peticiones a WASender)'),
+        ),
+        migrations.AddField(
+            model_name='crmconfig',
+            name='campanas_jitter_segundos',
+            field=models.PositiveIntegerField(default=5, help_text='Retardo aleatorio adicional (0..N segundos) entre envíos para no parecer un bot'),
+        ),
+        migrations.AddField(
+            model_name='crmconfig',
+            name='campanas_mensajes_por_minuto',
+            field=models.PositiveIntegerField(default=6, help_text='Máximo de mensajes de campaña por minuto para la cuenta de WhatsApp'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 6.0 on 2026-10-18 18:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm_marketing', '0021_importjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='campanadifusion',
+            name='audiencia_procesada',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='campanadifusion',
+            name='total_audiencia',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AlterField(
+            model_name='campanadifusion',
+            name='estado',
+            field=models.CharField(choices=[('BORRADOR', 'Borrador'), ('ENCOLANDO', 'Encolando...'), ('PROGRAMADA', 'Programada'), ('ENVIANDO', 'Enviando...'), ('COMPLETADA', 'Completada'), ('ERROR', 'Error')], default='BORRADOR', max_length=20),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-18 11:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm_marketing', '0022_campanadifusion_encolado'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='crmcontact',
+            name='fecha_nacimiento',
+            field=models.DateField(blank=True, db_index=True, null=True, verbose_name='Fecha de Nacimiento'),
+        ),
+    ]
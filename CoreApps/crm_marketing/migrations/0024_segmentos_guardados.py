@@ -0,0 +1,63 @@
+# Generated by Django 6.0 on 2026-10-18 11:40
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm_marketing', '0023_crmcontact_fecha_nacimiento_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContactoSegmentoPendiente',
+            fields=[
+                ('contacto', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='+', serialize=False, to='crm_marketing.crmcontact')),
+                ('fecha_marcado', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Contacto pendiente de segmentar',
+                'verbose_name_plural': 'Contactos pendientes de segmentar',
+            },
+        ),
+        migrations.CreateModel(
+            name='SegmentoGuardado',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('nombre', models.CharField(max_length=150, unique=True, verbose_name='Nombre del Segmento')),
+                ('filtros', models.JSONField(blank=True, default=dict, help_text='Especificación del filtro (ver FiltroSegmento.a_dict)')),
+                ('total_miembros', models.PositiveIntegerField(default=0, editable=False)),
+                ('requiere_recalculo', models.BooleanField(default=True, editable=False, help_text='Filtros nuevos o modificados: falta el recálculo completo')),
+                ('fecha_recalculo', models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Último recálculo completo')),
+                ('fecha_creacion', models.DateTimeField(auto_now_add=True)),
+                ('usuario', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='segmentos_crm', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Segmento Guardado',
+                'verbose_name_plural': 'Segmentos Guardados',
+                'ordering': ['nombre'],
+            },
+        ),
+        migrations.AddField(
+            model_name='campanadifusion',
+            name='segmento',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='campanas', to='crm_marketing.segmentoguardado', verbose_name='Segmento Guardado'),
+        ),
+        migrations.CreateModel(
+            name='MiembroSegmento',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('contacto', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='segmentos_miembro', to='crm_marketing.crmcontact')),
+                ('segmento', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='miembros', to='crm_marketing.segmentoguardado')),
+            ],
+            options={
+                'verbose_name': 'Miembro de Segmento',
+                'verbose_name_plural': 'Miembros de Segmentos',
+                'unique_together': {('segmento', 'contacto')},
+            },
+        ),
+    ]
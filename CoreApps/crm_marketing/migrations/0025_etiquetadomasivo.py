@@ -0,0 +1,38 @@
+# Generated by Django 6.0 on 2026-10-18 12:20
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm_marketing', '0024_segmentos_guardados'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EtiquetadoMasivo',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('operacion', models.CharField(choices=[('AGREGAR', 'Agregar etiqueta'), ('QUITAR', 'Quitar etiqueta'), ('REEMPLAZAR', 'Reemplazar todas sus etiquetas por esta')], default='AGREGAR', max_length=20)),
+                ('filtros', models.JSONField(blank=True, default=dict, help_text='Argumentos de FiltroSegmento (incluye contactos y segmento)')),
+                ('estado', models.CharField(choices=[('PENDIENTE', 'Pendiente'), ('PROCESANDO', 'Procesando'), ('COMPLETADO', 'Completado'), ('ERROR', 'Error')], db_index=True, default='PENDIENTE', max_length=20)),
+                ('total', models.PositiveIntegerField(default=0, help_text='Contactos del segmento al lanzar la operación')),
+                ('procesados', models.PositiveIntegerField(default=0)),
+                ('afectados', models.PositiveIntegerField(default=0, help_text='Contactos que ganaron o perdieron la etiqueta')),
+                ('mensaje_error', models.TextField(blank=True, null=True)),
+                ('fecha_creacion', models.DateTimeField(auto_now_add=True)),
+                ('fecha_fin', models.DateTimeField(blank=True, null=True)),
+                ('etiqueta', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='operaciones_masivas', to='crm_marketing.etiqueta')),
+                ('usuario', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='etiquetados_crm', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Etiquetado Masivo',
+                'verbose_name_plural': 'Etiquetados Masivos',
+                'ordering': ['-fecha_creacion'],
+            },
+        ),
+    ]
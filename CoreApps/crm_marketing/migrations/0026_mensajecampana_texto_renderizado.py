@@ -0,0 +1,24 @@
+# Generated by Django 6.0 on 2026-10-18 12:55
+
+import CoreApps.crm_marketing.rendering
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm_marketing', '0025_etiquetadomasivo'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mensajecampana',
+            name='texto_renderizado',
+            field=models.TextField(blank=True, editable=False, null=True),
+        ),
+        migrations.AlterField(
+            model_name='campanadifusion',
+            name='mensaje_plantilla',
+            field=models.TextField(validators=[CoreApps.crm_marketing.rendering.validar_plantilla], verbose_name='Mensaje de WhatsApp'),
+        ),
+    ]
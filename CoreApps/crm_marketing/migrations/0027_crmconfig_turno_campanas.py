@@ -0,0 +1,32 @@
+# Generated by Django 6.0 on 2026-10-18 17:05
+
+import django.core.validators
+from decimal import Decimal
+from django.db import migrations, models
+
+
+def ritmo_anterior(apps, schema_editor):
+    """Las filas que conservan el valor por defecto anterior (6/min) vuelven al ritmo histórico de 25 s"""
+    CrmConfig = apps.get_model('crm_marketing', 'CrmConfig')
+    CrmConfig.objects.filter(campanas_mensajes_por_minuto=6).update(campanas_mensajes_por_minuto=Decimal('2.4'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm_marketing', '0026_mensajecampana_texto_renderizado'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='crmconfig',
+            name='campanas_siguiente_turno',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AlterField(
+            model_name='crmconfig',
+            name='campanas_mensajes_por_minuto',
+            field=models.DecimalField(decimal_places=1, default=Decimal('2.4'), help_text='Máximo de mensajes de campaña por minuto para la cuenta de WhatsApp (2.4 = uno cada 25 s)', max_digits=5, validators=[django.core.validators.MinValueValidator(Decimal('0.1'))]),
+        ),
+        migrations.RunPython(ritmo_anterior, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-18 17:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm_marketing', '0027_crmconfig_turno_campanas'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importjob',
+            name='reclamado_por',
+            field=models.CharField(blank=True, editable=False, help_text='Token del proceso que lo ejecuta', max_length=100, null=True),
+        ),
+    ]
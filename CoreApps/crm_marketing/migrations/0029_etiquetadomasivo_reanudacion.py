@@ -0,0 +1,28 @@
+# Generated by Django 6.0 on 2026-10-18 18:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm_marketing', '0028_importjob_reclamado_por'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='etiquetadomasivo',
+            name='fecha_latido',
+            field=models.DateTimeField(blank=True, help_text='Última señal de vida del proceso que lo ejecuta', null=True),
+        ),
+        migrations.AddField(
+            model_name='etiquetadomasivo',
+            name='reclamado_por',
+            field=models.CharField(blank=True, editable=False, help_text='Token del proceso que lo ejecuta', max_length=100, null=True),
+        ),
+        migrations.AddField(
+            model_name='etiquetadomasivo',
+            name='ultimo_id',
+            field=models.PositiveIntegerField(default=0, help_text='Último contacto del lote confirmado (punto de reanudación)'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 6.0 on 2026-10-18 19:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm_marketing', '0029_etiquetadomasivo_reanudacion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='campanadifusion',
+            name='encolado_ultimo_id',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Último contacto encolado (punto de reanudación)'),
+        ),
+        migrations.AddField(
+            model_name='campanadifusion',
+            name='fecha_latido',
+            field=models.DateTimeField(blank=True, editable=False, help_text='Última señal de vida del proceso que la encola', null=True),
+        ),
+        migrations.AddField(
+            model_name='campanadifusion',
+            name='reclamado_por',
+            field=models.CharField(blank=True, editable=False, help_text='Token del proceso que la encola', max_length=100, null=True),
+        ),
+    ]
@@ -1,6 +1,9 @@
 from django.db import models
+from decimal import Decimal
+from django.core.validators import MinValueValidator
 from django.conf import settings
 from CoreApps.main.models import Ciudad
+from .rendering import validar_plantilla
 
 class Farmacia(models.Model):
     codigo = models.CharField(max_length=50, unique=True, verbose_name="Código de Farmacia")
@@ -42,14 +45,14 @@ class CrmContact(models.Model):
     nombres = models.CharField(max_length=150, verbose_name="Nombres")
     apellidos = models.CharField(max_length=150, verbose_name="Apellidos")
     cedula = models.CharField(max_length=20, unique=True, blank=True, null=True, verbose_name="Cédula/RUC")
-    fecha_nacimiento = models.DateField(blank=True, null=True, verbose_name="Fecha de Nacimiento")
+    fecha_nacimiento = models.DateField(blank=True, null=True, db_index=True, verbose_name="Fecha de Nacimiento")
     es_edad_estimada = models.BooleanField(default=False, help_text="True si no se dio fecha exacta y se calculó el año base a su edad proporcionada.")
 
     
     # Contacto
     telefono = models.CharField(max_length=20, unique=True, null=True, blank=True, verbose_name="Teléfono (WhatsApp)")
-    whatsapp_jid = models.CharField(max_length=150, blank=True, null=True, verbose_name="WhatsApp JID")
-    whatsapp_lid = models.CharField(max_length=150, blank=True, null=True, verbose_name="WhatsApp LID (Linked Device ID)")
+    whatsapp_jid = models.CharField(max_length=150, blank=True, null=True, db_index=True, verbose_name="WhatsApp JID")
+    whatsapp_lid = models.CharField(max_length=150, blank=True, null=True, db_index=True, verbose_name="WhatsApp LID (Linked Device ID)")
     email = models.EmailField(blank=True, null=True, verbose_name="Correo Electrónico")
     
     # Ubicación (Relacionado a main.Ciudad)
@@ -92,6 +95,12 @@ class CrmContact(models.Model):
     fecha_primer_contacto = models.DateTimeField(null=True, blank=True, verbose_name="Fecha de Primer Contacto")
     tiempo_respuesta_inicial = models.DurationField(null=True, blank=True, verbose_name="Tiempo de Respuesta Inicial")
 
+    # Desnormalización para el Inbox (mantenida por CoreApps.chat con UPDATEs atómicos): puntero al último
+    # mensaje y su fecha. Quien guarde una instancia cargada hace rato usa update_fields o relee estos campos.
+    CAMPOS_ULTIMO_MENSAJE = ('ultimo_mensaje', 'fecha_ultimo_mensaje')
+    ultimo_mensaje = models.ForeignKey('chat.ChatMensaje', on_delete=models.SET_NULL, null=True, blank=True, related_name='+', editable=False)
+    fecha_ultimo_mensaje = models.DateTimeField(null=True, blank=True, editable=False, verbose_name="Fecha del último mensaje")
+
     @property
     def is_hidden_number(self):
         """Verifica si el número almacenado es en realidad un LID de WhatsApp."""
@@ -112,6 +121,10 @@ class CrmContact(models.Model):
         verbose_name = "Contacto CRM"
         verbose_name_plural = "Contactos CRM"
         ordering = ['-fecha_registro']
+        indexes = [
+            # Paginación por cursor del Inbox (ORDER BY fecha_ultimo_mensaje DESC, id DESC)
+            models.Index(fields=['fecha_ultimo_mensaje', 'id'], name='crm_contact_ultimo_msg_idx'),
+        ]
 
     def __str__(self):
         return f"{self.nombres} {self.apellidos} ({self.telefono})"
@@ -147,9 +160,68 @@ class CrmContact(models.Model):
         """Devuelve una lista de nombres de campañas en las que ha participado"""
         return list(self.mensajes_campana.all().values_list('campana__nombre', flat=True).distinct())
 
+    @staticmethod
+    def get_campanas_nombres_bulk(contacto_ids):
+        """Igual que get_campanas_nombres pero para muchos contactos en una sola consulta: {contacto_id: [nombres]}"""
+        resultado = {}
+        filas = MensajeCampana.objects.filter(contacto_id__in=contacto_ids).values_list('contacto_id', 'campana__nombre').distinct()
+        for contacto_id, nombre in filas:
+            resultado.setdefault(contacto_id, []).append(nombre)
+        return resultado
+
+class SegmentoGuardado(models.Model):
+    """
+    Segmento con nombre cuya membresía se materializa en MiembroSegmento (ver segment_refresh.py).
+    `filtros` guarda la especificación de FiltroSegmento (segments.py); campañas y lista de contactos
+    apuntan al segmento leyendo sus miembros en lugar de recalcular los filtros.
+    """
+    nombre = models.CharField(max_length=150, unique=True, verbose_name="Nombre del Segmento")
+    filtros = models.JSONField(default=dict, blank=True, help_text="Especificación del filtro (ver FiltroSegmento.a_dict)")
+    usuario = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True, related_name='segmentos_crm')
+
+    total_miembros = models.PositiveIntegerField(default=0, editable=False)
+    requiere_recalculo = models.BooleanField(default=True, editable=False, help_text="Filtros nuevos o modificados: falta el recálculo completo")
+    fecha_recalculo = models.DateTimeField(null=True, blank=True, editable=False, verbose_name="Último recálculo completo")
+    fecha_creacion = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = "Segmento Guardado"
+        verbose_name_plural = "Segmentos Guardados"
+        ordering = ['nombre']
+
+    def __str__(self):
+        return self.nombre
+
+    def get_filtro(self):
+        from .segments import FiltroSegmento
+        return FiltroSegmento.desde_dict(self.filtros)
+
+
+class MiembroSegmento(models.Model):
+    """Tabla materializada segmento <-> contacto (una fila por miembro)"""
+    segmento = models.ForeignKey(SegmentoGuardado, on_delete=models.CASCADE, related_name='miembros')
+    contacto = models.ForeignKey(CrmContact, on_delete=models.CASCADE, related_name='segmentos_miembro')
+
+    class Meta:
+        verbose_name = "Miembro de Segmento"
+        verbose_name_plural = "Miembros de Segmentos"
+        unique_together = ('segmento', 'contacto')
+
+
+class ContactoSegmentoPendiente(models.Model):
+    """Contactos modificados (datos, etiquetas o productos) cuya pertenencia a los segmentos falta revisar"""
+    contacto = models.OneToOneField(CrmContact, on_delete=models.CASCADE, primary_key=True, related_name='+')
+    fecha_marcado = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = "Contacto pendiente de segmentar"
+        verbose_name_plural = "Contactos pendientes de segmentar"
+
+
 class CampanaDifusion(models.Model):
     ESTADOS = [
         ('BORRADOR', 'Borrador'),
+        ('ENCOLANDO', 'Encolando...'),
         ('PROGRAMADA', 'Programada'),
         ('ENVIANDO', 'Enviando...'),
         ('COMPLETADA', 'Completada'),
@@ -157,7 +229,7 @@ class CampanaDifusion(models.Model):
     ]
 
     nombre = models.CharField(max_length=200, verbose_name="Nombre de la Campaña")
-    mensaje_plantilla = models.TextField(verbose_name="Mensaje de WhatsApp")
+    mensaje_plantilla = models.TextField(validators=[validar_plantilla], verbose_name="Mensaje de WhatsApp")
     
     # Filtros de Audiencia
     ciudades_objetivo = models.ManyToManyField(Ciudad, blank=True, verbose_name="Filtro por Ciudad")
@@ -167,11 +239,19 @@ class CampanaDifusion(models.Model):
     
     edad_minima = models.PositiveIntegerField(blank=True, null=True, verbose_name="Edad Mínima (Filtro)")
     edad_maxima = models.PositiveIntegerField(blank=True, null=True, verbose_name="Edad Máxima (Filtro)")
+    segmento = models.ForeignKey(SegmentoGuardado, on_delete=models.PROTECT, null=True, blank=True, related_name='campanas', verbose_name="Segmento Guardado")
     
     estado = models.CharField(max_length=20, choices=ESTADOS, default='BORRADOR')
     fecha_programada = models.DateTimeField(blank=True, null=True, verbose_name="Enviar a partir de")
     fecha_creacion = models.DateTimeField(auto_now_add=True)
 
+    # Progreso del encolado en bloque (ver enqueue.py)
+    total_audiencia = models.PositiveIntegerField(default=0, editable=False)
+    audiencia_procesada = models.PositiveIntegerField(default=0, editable=False)
+    encolado_ultimo_id = models.PositiveIntegerField(default=0, editable=False, help_text="Último contacto encolado (punto de reanudación)")
+    fecha_latido = models.DateTimeField(null=True, blank=True, editable=False, help_text="Última señal de vida del proceso que la encola")
+    reclamado_por = models.CharField(max_length=100, null=True, blank=True, editable=False, help_text="Token del proceso que la encola")
+
     class Meta:
         verbose_name = "Campaña de Difusión"
         verbose_name_plural = "Campañas de Difusión"
@@ -181,45 +261,23 @@ class CampanaDifusion(models.Model):
         return self.nombre
 
     def get_audiencia(self):
-        """Calcula el número de personas que coinciden con los filtros. Lógica AND."""
-        from django.db.models import Q
-        import datetime
-        
-        # Iniciar con todos los contactos
-        qs = CrmContact.objects.all()
-
-        if self.ciudades_objetivo.exists():
-            qs = qs.filter(ciudad__in=self.ciudades_objetivo.all())
-            
-        if self.farmacias_objetivo.exists():
-            qs = qs.filter(farmacia_origen__in=self.farmacias_objetivo.all())
-            
-        if self.etiquetas_objetivo.exists():
-            for etiqueta in self.etiquetas_objetivo.all():
-                qs = qs.filter(etiquetas=etiqueta)
-                
-        if self.medicamentos_objetivo.exists():
-            for med in self.medicamentos_objetivo.all():
-                qs = qs.filter(medicamentos_comprados=med)
-
-        # Filtro de Edad
-        if self.edad_minima is not None or self.edad_maxima is not None:
-            hoy = datetime.date.today()
-            
-            # Si piden edad MINIMA = 18, significa que deben haber nacido HACE MÁS de 18 años.
-            # O sea, fecha_nacimiento <= HOY - 18 años
-            if self.edad_minima is not None:
-                # Calculo de forma simplificada restando años
-                fecha_tope_min = datetime.date(hoy.year - self.edad_minima, hoy.month, hoy.day)
-                qs = qs.filter(fecha_nacimiento__lte=fecha_tope_min)
-                
-            # Si piden edad MAXIMA = 65, deben haber nacido HACE MENOS de 65 años.
-            # O sea, fecha_nacimiento >= HOY - 65 años
-            if self.edad_maxima is not None:
-                fecha_tope_max = datetime.date(hoy.year - self.edad_maxima, hoy.month, hoy.day)
-                qs = qs.filter(fecha_nacimiento__gte=fecha_tope_max)
-
-        return qs.distinct()
+        """Contactos que coinciden con los filtros. Lógica AND (ver segments.py)."""
+        from .segments import FiltroSegmento
+        return FiltroSegmento.desde_campana(self).aplicar()
+
+    def contar_audiencia(self):
+        """Si la campaña solo apunta a un segmento, el total ya está materializado (sin consultar contactos)"""
+        from .segments import FiltroSegmento
+        filtro = FiltroSegmento.desde_campana(self)
+        if self.segmento_id and filtro.solo_segmento:
+            return self.segmento.total_miembros
+        return filtro.aplicar().count()
+
+    @property
+    def porcentaje_encolado(self):
+        if not self.total_audiencia:
+            return 0
+        return min(100, int(self.audiencia_procesada * 100 / self.total_audiencia))
 
 
 class DiffusionLog(models.Model):
@@ -253,10 +311,16 @@ class MensajeCampana(models.Model):
     campana = models.ForeignKey(CampanaDifusion, on_delete=models.CASCADE, related_name='mensajes_cola')
     contacto = models.ForeignKey(CrmContact, on_delete=models.CASCADE, related_name='mensajes_campana')
     estado = models.CharField(max_length=20, choices=ESTADOS, default='PENDIENTE')
+    # Texto personalizado renderizado al encolar (ver rendering.py); el envío lo usa tal cual
+    texto_renderizado = models.TextField(blank=True, null=True, editable=False)
     
     # Rastrear con Webhooks
-    wasender_message_id = models.CharField(max_length=150, blank=True, null=True, verbose_name="ID de Mensaje en WASender")
+    wasender_message_id = models.CharField(max_length=150, blank=True, null=True, db_index=True, verbose_name="ID de Mensaje en WASender")
     error_log = models.TextField(blank=True, null=True)
+
+    # Lease del worker de notificaciones que lo está enviando (CoreApps/notifications/leases.py)
+    reclamado_por = models.CharField(max_length=100, blank=True, null=True, editable=False)
+    reclamado_hasta = models.DateTimeField(blank=True, null=True, editable=False, db_index=True)
     
     fecha_creacion = models.DateTimeField(auto_now_add=True)
     fecha_actualizacion = models.DateTimeField(auto_now=True)
@@ -274,6 +338,13 @@ class CrmConfig(models.Model):
     """Configuración global del CRM (Single Row)"""
     tiempo_alerta_leads = models.PositiveIntegerField(default=30, help_text="Tiempo en minutos para resaltar leads sin atender")
     respuestas_rapidas = models.JSONField(default=list, help_text="Lista de objetos { 'label': '...', 'text': '...' }")
+
+    # Ritmo de envío de campañas (anti-spam): lo aplica el dispatcher del worker con un token bucket
+    campanas_mensajes_por_minuto = models.DecimalField(max_digits=5, decimal_places=1, default=Decimal('2.4'), validators=[MinValueValidator(Decimal('0.1'))], help_text="Máximo de mensajes de campaña por minuto para la cuenta de WhatsApp (2.4 = uno cada 25 s)")
+    campanas_envios_simultaneos = models.PositiveIntegerField(default=3, help_text="Envíos de campaña en curso a la vez (peticiones a WASender)")
+    campanas_jitter_segundos = models.PositiveIntegerField(default=5, help_text="Retardo aleatorio adicional (0..N segundos) entre envíos para no parecer un bot")
+    # Próximo turno libre del token bucket, compartido por todos los workers (lo escribe el dispatcher)
+    campanas_siguiente_turno = models.DateTimeField(null=True, blank=True, editable=False)
     
     fecha_actualizacion = models.DateTimeField(auto_now=True)
 
@@ -289,6 +360,105 @@ class CrmConfig(models.Model):
         obj, created = cls.objects.get_or_create(id=1)
         return obj
 
+class ImportJob(models.Model):
+    """
+    Importación masiva en segundo plano (contactos CRM o pacientes) procesada por trozos.
+    Cada trozo se confirma en una transacción junto con `filas_procesadas`, así un trabajo
+    interrumpido se reanuda desde el último trozo confirmado (ver import_jobs.py).
+    """
+    TIPOS = [
+        ('CONTACTOS', 'Contactos CRM (Farmacias)'),
+        ('PACIENTES', 'Pacientes y Recordatorios'),
+    ]
+    ESTADOS = [
+        ('PENDIENTE', 'Pendiente'),
+        ('PROCESANDO', 'Procesando'),
+        ('COMPLETADO', 'Completado'),
+        ('ERROR', 'Error'),
+    ]
+    tipo = models.CharField(max_length=20, choices=TIPOS, default='CONTACTOS')
+    archivo = models.FileField(upload_to='imports/', verbose_name="Archivo Excel/CSV")
+    estado = models.CharField(max_length=20, choices=ESTADOS, default='PENDIENTE', db_index=True)
+    usuario = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True, related_name='importaciones')
+
+    total_filas = models.PositiveIntegerField(default=0)
+    filas_procesadas = models.PositiveIntegerField(default=0, help_text="Filas de datos confirmadas (punto de reanudación)")
+    nuevos = models.PositiveIntegerField(default=0)
+    actualizados = models.PositiveIntegerField(default=0)
+    omitidos = models.PositiveIntegerField(default=0)
+    errores = models.JSONField(default=list, blank=True, help_text="Lista de { 'fila', 'cedula', 'motivo' }")
+    extras = models.JSONField(default=dict, blank=True, help_text="Contadores propios del tipo (ej. recordatorios generados)")
+    mensaje_error = models.TextField(blank=True, null=True)
+
+    fecha_creacion = models.DateTimeField(auto_now_add=True)
+    fecha_inicio = models.DateTimeField(null=True, blank=True)
+    fecha_latido = models.DateTimeField(null=True, blank=True, help_text="Última señal de vida del proceso que lo ejecuta")
+    reclamado_por = models.CharField(max_length=100, null=True, blank=True, editable=False, help_text="Token del proceso que lo ejecuta")
+    fecha_fin = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = "Trabajo de Importación"
+        verbose_name_plural = "Trabajos de Importación"
+        ordering = ['-fecha_creacion']
+
+    def __str__(self):
+        return f"Importación {self.get_tipo_display()} #{self.id} [{self.estado}]"
+
+    @property
+    def porcentaje(self):
+        if not self.total_filas:
+            return 100 if self.estado == 'COMPLETADO' else 0
+        return min(100, int(self.filas_procesadas * 100 / self.total_filas))
+
+
+class EtiquetadoMasivo(models.Model):
+    """
+    Operación masiva de etiquetas sobre un segmento de contactos (ver tagging.py). Inserta o borra
+    filas de la tabla intermedia contacto <-> etiqueta por lotes; las grandes corren en segundo plano.
+    """
+    OPERACIONES = [
+        ('AGREGAR', 'Agregar etiqueta'),
+        ('QUITAR', 'Quitar etiqueta'),
+        ('REEMPLAZAR', 'Reemplazar todas sus etiquetas por esta'),
+    ]
+    ESTADOS = [
+        ('PENDIENTE', 'Pendiente'),
+        ('PROCESANDO', 'Procesando'),
+        ('COMPLETADO', 'Completado'),
+        ('ERROR', 'Error'),
+    ]
+    etiqueta = models.ForeignKey(Etiqueta, on_delete=models.CASCADE, related_name='operaciones_masivas')
+    operacion = models.CharField(max_length=20, choices=OPERACIONES, default='AGREGAR')
+    filtros = models.JSONField(default=dict, blank=True, help_text="Argumentos de FiltroSegmento (incluye contactos y segmento)")
+    estado = models.CharField(max_length=20, choices=ESTADOS, default='PENDIENTE', db_index=True)
+    usuario = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True, related_name='etiquetados_crm')
+
+    total = models.PositiveIntegerField(default=0, help_text="Contactos del segmento al lanzar la operación")
+    procesados = models.PositiveIntegerField(default=0)
+    afectados = models.PositiveIntegerField(default=0, help_text="Contactos que ganaron o perdieron la etiqueta")
+    ultimo_id = models.PositiveIntegerField(default=0, help_text="Último contacto del lote confirmado (punto de reanudación)")
+    mensaje_error = models.TextField(blank=True, null=True)
+
+    fecha_creacion = models.DateTimeField(auto_now_add=True)
+    fecha_latido = models.DateTimeField(null=True, blank=True, help_text="Última señal de vida del proceso que lo ejecuta")
+    reclamado_por = models.CharField(max_length=100, null=True, blank=True, editable=False, help_text="Token del proceso que lo ejecuta")
+    fecha_fin = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = "Etiquetado Masivo"
+        verbose_name_plural = "Etiquetados Masivos"
+        ordering = ['-fecha_creacion']
+
+    def __str__(self):
+        return f"{self.get_operacion_display()} '{self.etiqueta}' #{self.id} [{self.estado}]"
+
+    @property
+    def porcentaje(self):
+        if not self.total:
+            return 100 if self.estado == 'COMPLETADO' else 0
+        return min(100, int(self.procesados * 100 / self.total))
+
+
 class CrmMediaTemplate(models.Model):
     """Plantillas de archivos multimedia (Cuentas bancarias, promociones, etc.)"""
     MEDIA_TYPES = [
@@ -0,0 +1,79 @@
+"""
+Plantillas de mensajes de campaña: `{variable}` se reemplaza con datos del contacto.
+
+La plantilla se compila una vez en un plan (trozos de texto fijo y variables) y se valida al guardar
+la campaña. Al encolar, los textos personalizados se renderizan en bloque a partir de una consulta
+.values() con los JOINs necesarios (ver enqueue.py) y quedan guardados en MensajeCampana, así el
+envío solo lee el texto final.
+"""
+import functools
+import re
+from django.core.exceptions import ValidationError
+
+# Variable de la plantilla -> lookup de CrmContact para .values()
+VARIABLES = {
+    'nombres': 'nombres',
+    'apellidos': 'apellidos',
+    'ciudad': 'ciudad__nombre',
+    'farmacia': 'farmacia_origen__nombre',
+    'telefono': 'telefono',
+}
+
+PATRON_VARIABLE = re.compile(r'\{(\w+)\}')
+
+
+class PlanMensaje:
+    """Plantilla compilada: `campos` son los lookups que hay que leer del contacto"""
+
+    def __init__(self, plantilla):
+        self.trozos = []  # (texto fijo, lookup o None)
+        desconocidas = []
+        inicio = 0
+        for m in PATRON_VARIABLE.finditer(plantilla):
+            if m.group(1) not in VARIABLES:
+                desconocidas.append(m.group(0))
+                continue
+            self.trozos.append((plantilla[inicio:m.start()], VARIABLES[m.group(1)]))
+            inicio = m.end()
+        self.trozos.append((plantilla[inicio:], None))
+        self.desconocidas = desconocidas
+        self.campos = sorted({lookup for _, lookup in self.trozos if lookup})
+
+    def renderizar(self, datos):
+        """`datos`: dict de un .values() del contacto con (al menos) los `campos` del plan"""
+        partes = []
+        for texto, lookup in self.trozos:
+            partes.append(texto)
+            if lookup:
+                partes.append(datos.get(lookup) or '')
+        return ''.join(partes)
+
+
+@functools.lru_cache(maxsize=64)
+def compilar_plantilla(plantilla):
+    return PlanMensaje(plantilla)
+
+
+def validar_plantilla(plantilla):
+    """Validador del campo mensaje_plantilla: solo variables conocidas"""
+    desconocidas = compilar_plantilla(plantilla).desconocidas
+    if desconocidas:
+        raise ValidationError(
+            "Variables no reconocidas: %(desconocidas)s. Usa solo %(validas)s.",
+            params={
+                'desconocidas': ', '.join(sorted(set(desconocidas))),
+                'validas': ', '.join(f'{{{v}}}' for v in VARIABLES),
+            },
+            code='variable_desconocida',
+        )
+
+
+def datos_contacto(contacto):
+    """Los mismos datos que da .values() para una instancia ya cargada (envíos sin texto precalculado)"""
+    return {
+        'nombres': contacto.nombres,
+        'apellidos': contacto.apellidos,
+        'ciudad__nombre': contacto.ciudad.nombre if contacto.ciudad else None,
+        'farmacia_origen__nombre': contacto.farmacia_origen.nombre if contacto.farmacia_origen else None,
+        'telefono': contacto.telefono,
+    }
@@ -0,0 +1,148 @@
+"""
+Mantenimiento de la membresía materializada de los segmentos guardados (MiembroSegmento).
+
+- Recálculo completo de un segmento: se comparan sus filtros contra la tabla de miembros y solo se
+  borran/insertan las diferencias. Se hace al crear o editar el segmento y una vez al día para los
+  que filtran por edad (los cumpleaños cambian el resultado sin que nadie toque el contacto).
+- Refresco incremental: las señales (y los procesos en bloque, como la importación) anotan en
+  ContactoSegmentoPendiente los contactos que cambiaron; cada pasada revisa solo esos contactos
+  contra cada segmento, así el coste es proporcional a los cambios y no al tamaño de la base.
+El refresco periódico lo ejecuta `manage.py refresh_segments --loop`.
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import transaction, close_old_connections
+from django.db.models import Exists, F, OuterRef
+from django.utils import timezone
+
+from .models import SegmentoGuardado, MiembroSegmento, ContactoSegmentoPendiente
+
+logger = logging.getLogger(__name__)
+
+
+class SegmentRefresher:
+
+    def __init__(self):
+        self.tamano_lote = getattr(settings, 'CRM_SEGMENTOS_LOTE', 2000)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    # --- Marcado de cambios ---
+
+    def marcar(self, contacto_ids):
+        """Anota contactos cuya pertenencia a los segmentos hay que revisar en la próxima pasada"""
+        contacto_ids = {c for c in contacto_ids if c}
+        if not contacto_ids or not SegmentoGuardado.objects.exists():
+            return
+        ContactoSegmentoPendiente.objects.bulk_create(
+            [ContactoSegmentoPendiente(contacto_id=c) for c in contacto_ids],
+            batch_size=self.tamano_lote, ignore_conflicts=True
+        )
+
+    # --- Recálculo completo ---
+
+    def programar(self, segmento_id):
+        """Recálculo completo en segundo plano tras confirmar la transacción (crear/editar desde la web)"""
+        transaction.on_commit(lambda: self._enviar(segmento_id))
+
+    def _enviar(self, segmento_id):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='crm-segmentos')
+        self._executor.submit(self._procesar, segmento_id)
+
+    def _procesar(self, segmento_id):
+        close_old_connections()
+        try:
+            self.recalcular(segmento_id)
+        except Exception:
+            # Sigue con requiere_recalculo=True: lo retoma refresh_segments
+            logger.exception(f"Error recalculando el segmento {segmento_id}")
+        finally:
+            close_old_connections()
+
+    def recalcular(self, segmento_id):
+        """Sincroniza la tabla de miembros con los filtros del segmento; devuelve (altas, bajas)"""
+        segmento = SegmentoGuardado.objects.get(pk=segmento_id)
+        audiencia = segmento.get_filtro().aplicar().order_by()
+        miembros = MiembroSegmento.objects.filter(segmento_id=segmento_id)
+
+        bajas, _ = miembros.exclude(contacto_id__in=audiencia.values('id')).delete()
+
+        # Altas por rangos de id (keyset): solo los que aún no son miembros
+        faltantes = audiencia.exclude(
+            Exists(miembros.filter(contacto_id=OuterRef('pk')))
+        ).order_by('id').values_list('id', flat=True)
+        altas, ultimo = 0, 0
+        while True:
+            ids = list(faltantes.filter(id__gt=ultimo)[:self.tamano_lote])
+            if not ids:
+                break
+            MiembroSegmento.objects.bulk_create(
+                [MiembroSegmento(segmento_id=segmento_id, contacto_id=c) for c in ids], ignore_conflicts=True
+            )
+            altas += len(ids)
+            ultimo = ids[-1]
+
+        SegmentoGuardado.objects.filter(pk=segmento_id).update(
+            total_miembros=miembros.count(), requiere_recalculo=False, fecha_recalculo=timezone.now()
+        )
+        return altas, bajas
+
+    def vencidos(self):
+        """Segmentos sin calcular, o que filtran por edad y no se recalcularon hoy"""
+        hoy = timezone.localdate()
+        for segmento in SegmentoGuardado.objects.all():
+            if segmento.requiere_recalculo or segmento.fecha_recalculo is None:
+                yield segmento
+            elif segmento.get_filtro().usa_edad and timezone.localdate(segmento.fecha_recalculo) < hoy:
+                yield segmento
+
+    # --- Refresco incremental ---
+
+    def refrescar_pendientes(self):
+        """Revisa los contactos marcados contra cada segmento ya calculado; devuelve cuántos revisó"""
+        revisados = 0
+        while True:
+            ids = list(ContactoSegmentoPendiente.objects.order_by('pk').values_list('pk', flat=True)[:self.tamano_lote])
+            if not ids:
+                break
+            # Se desmarcan dentro de la misma transacción: si un contacto vuelve a cambiar mientras
+            # tanto, su nueva marca espera al commit y se revisa en la siguiente vuelta
+            with transaction.atomic():
+                ContactoSegmentoPendiente.objects.filter(pk__in=ids).delete()
+                for segmento in SegmentoGuardado.objects.filter(requiere_recalculo=False):
+                    self._revisar(segmento, ids)
+            revisados += len(ids)
+        return revisados
+
+    def _revisar(self, segmento, ids):
+        dentro = set(segmento.get_filtro().aplicar().filter(id__in=ids).values_list('id', flat=True))
+        miembros = MiembroSegmento.objects.filter(segmento=segmento, contacto_id__in=ids)
+        actuales = set(miembros.values_list('contacto_id', flat=True))
+
+        altas, bajas = dentro - actuales, actuales - dentro
+        if bajas:
+            miembros.filter(contacto_id__in=bajas).delete()
+        if altas:
+            MiembroSegmento.objects.bulk_create(
+                [MiembroSegmento(segmento=segmento, contacto_id=c) for c in altas], ignore_conflicts=True
+            )
+        if altas or bajas:
+            SegmentoGuardado.objects.filter(pk=segmento.pk).update(
+                total_miembros=F('total_miembros') + len(altas) - len(bajas)
+            )
+
+    def refrescar(self):
+        """Una pasada completa: recálculos vencidos y luego los contactos marcados"""
+        recalculados = 0
+        for segmento in list(self.vencidos()):
+            self.recalcular(segmento.pk)
+            recalculados += 1
+        return recalculados, self.refrescar_pendientes()
+
+
+# Instancia compartida por proceso
+refrescador = SegmentRefresher()
@@ -0,0 +1,150 @@
+"""
+Compilador de segmentos de contactos CRM: un único lugar que traduce los filtros (ciudad, farmacia,
+etiquetas, productos comprados, rango de edad) a SQL. Lo usan la lista de contactos, el etiquetado
+masivo, la audiencia de las campañas y el cálculo de los segmentos guardados.
+
+Las condiciones M2M no hacen JOIN sobre el queryset principal (cada JOIN multiplica filas y obliga a
+un DISTINCT sobre todo el resultado):
+- "alguna de" -> EXISTS (SELECT 1 FROM tabla_intermedia WHERE contacto = fila AND valor IN (...))
+- "todas"     -> id IN (SELECT contacto FROM tabla_intermedia WHERE valor IN (...)
+                        GROUP BY contacto HAVING COUNT(*) = n)
+Ambas se resuelven con los índices de la tabla intermedia, y el conteo queda como un COUNT(*) simple.
+"""
+import datetime
+from django.db.models import Count, Exists, OuterRef, Q
+
+from .models import CrmContact
+
+
+def _ids(valores):
+    """Ids enteros de un getlist() o iterable; una opción vacía ('Todos') anula el filtro"""
+    valores = list(valores or [])
+    if '' in valores:
+        return []
+    return [int(v) for v in valores if str(v).strip().isdigit()]
+
+
+def _entero(valor):
+    try:
+        return int(valor) if valor not in (None, '') else None
+    except (TypeError, ValueError):
+        return None
+
+
+def fecha_hace_anios(anios, hoy=None):
+    """Misma fecha de hoy hace `anios` años (el 29 de febrero cae en el 28 si el año no es bisiesto)"""
+    hoy = hoy or datetime.date.today()
+    try:
+        return hoy.replace(year=hoy.year - anios)
+    except ValueError:
+        return hoy.replace(year=hoy.year - anios, day=28)
+
+
+class FiltroSegmento:
+    """
+    Especificación de un segmento. `etiquetas_todas` / `productos_todos` eligen entre exigir todas
+    las etiquetas/productos (campañas) o bastar con alguno (lista de contactos y etiquetado masivo).
+    `contactos` restringe a ids concretos (selección por checkbox) y `segmento` a los miembros
+    materializados de un SegmentoGuardado.
+    """
+    # Campos que se guardan en SegmentoGuardado.filtros
+    CAMPOS = ('ciudades', 'farmacias', 'etiquetas', 'productos', 'edad_minima', 'edad_maxima',
+              'etiquetas_todas', 'productos_todos')
+
+    def __init__(self, ciudades=(), farmacias=(), etiquetas=(), productos=(), edad_minima=None,
+                 edad_maxima=None, etiquetas_todas=True, productos_todos=True, contactos=(), segmento=None):
+        self.ciudades = _ids(ciudades)
+        self.farmacias = _ids(farmacias)
+        self.etiquetas = _ids(etiquetas)
+        self.productos = _ids(productos)
+        self.edad_minima = _entero(edad_minima)
+        self.edad_maxima = _entero(edad_maxima)
+        self.etiquetas_todas = etiquetas_todas
+        self.productos_todos = productos_todos
+        self.contactos = _ids(contactos)
+        self.segmento = _entero(segmento)
+
+    @classmethod
+    def desde_params(cls, params):
+        """Filtros de la lista de contactos (GET) o del etiquetado masivo (POST): basta una coincidencia"""
+        return cls(
+            ciudades=params.getlist('ciudad'),
+            farmacias=params.getlist('farmacia'),
+            etiquetas=params.getlist('etiqueta'),
+            productos=params.getlist('medicamento'),
+            edad_minima=params.get('edad_min'),
+            edad_maxima=params.get('edad_max'),
+            etiquetas_todas=False,
+            productos_todos=False,
+            segmento=params.get('segmento'),
+        )
+
+    @classmethod
+    def desde_campana(cls, campana):
+        """Audiencia de una campaña: lógica AND entre etiquetas y entre productos"""
+        return cls(
+            ciudades=campana.ciudades_objetivo.values_list('id', flat=True),
+            farmacias=campana.farmacias_objetivo.values_list('id', flat=True),
+            etiquetas=campana.etiquetas_objetivo.values_list('id', flat=True),
+            productos=campana.medicamentos_objetivo.values_list('id', flat=True),
+            edad_minima=campana.edad_minima,
+            edad_maxima=campana.edad_maxima,
+            segmento=campana.segmento_id,
+        )
+
+    @classmethod
+    def desde_dict(cls, datos):
+        return cls(**{k: v for k, v in (datos or {}).items() if k in cls.CAMPOS})
+
+    def a_dict(self):
+        """Especificación serializable para SegmentoGuardado.filtros (sin contactos ni segmento)"""
+        return {campo: getattr(self, campo) for campo in self.CAMPOS}
+
+    @property
+    def usa_edad(self):
+        """Los filtros de edad cambian de resultado con el paso de los días (cumpleaños)"""
+        return self.edad_minima is not None or self.edad_maxima is not None
+
+    @property
+    def solo_segmento(self):
+        return not any([self.ciudades, self.farmacias, self.etiquetas, self.productos, self.contactos, self.usa_edad])
+
+    def aplicar(self, qs=None):
+        """Queryset de CrmContact del segmento, sin DISTINCT"""
+        qs = CrmContact.objects.all() if qs is None else qs
+
+        if self.segmento:
+            # (segmento, contacto) es único: el JOIN con la tabla materializada no duplica filas
+            qs = qs.filter(segmentos_miembro__segmento_id=self.segmento)
+        if self.contactos:
+            qs = qs.filter(id__in=self.contactos)
+        if self.ciudades:
+            qs = qs.filter(ciudad_id__in=self.ciudades)
+        if self.farmacias:
+            qs = qs.filter(farmacia_origen_id__in=self.farmacias)
+        if self.etiquetas:
+            qs = qs.filter(self._condicion_m2m(CrmContact.etiquetas, self.etiquetas, self.etiquetas_todas))
+        if self.productos:
+            qs = qs.filter(self._condicion_m2m(CrmContact.medicamentos_comprados, self.productos, self.productos_todos))
+
+        # Edad mínima N: nacidos hace N años o antes; edad máxima M: aún sin cumplir M+1 años
+        # (nacidos después del corte de M+1, así quien ya cumplió M sigue dentro hasta su próximo cumpleaños)
+        if self.edad_minima is not None:
+            qs = qs.filter(fecha_nacimiento__lte=fecha_hace_anios(self.edad_minima))
+        if self.edad_maxima is not None:
+            qs = qs.filter(fecha_nacimiento__gt=fecha_hace_anios(self.edad_maxima + 1))
+        return qs
+
+    def _condicion_m2m(self, descriptor, ids, todas):
+        """EXISTS (alguna) o id IN (... GROUP BY HAVING COUNT = n) (todas) sobre la tabla intermedia"""
+        campo = descriptor.field
+        Through = descriptor.through
+        origen = f'{campo.m2m_field_name()}_id'
+        destino = f'{campo.m2m_reverse_field_name()}_id'
+        filas = Through.objects.filter(**{f'{destino}__in': ids})
+
+        if not todas or len(ids) == 1:
+            return Exists(filas.filter(**{origen: OuterRef('pk')}))
+        # La tabla intermedia es única por (contacto, valor): contar filas basta para "tiene todas"
+        con_todas = filas.values(origen).annotate(n=Count('pk')).filter(n=len(set(ids))).values(origen)
+        return Q(pk__in=con_todas)
@@ -0,0 +1,98 @@
+from django.db.models import F
+from django.db.models.signals import post_delete, post_init, post_save, pre_delete, m2m_changed
+from django.dispatch import receiver
+from .models import CrmContact, Etiqueta, ProductoCRM, Farmacia, SegmentoGuardado, MiembroSegmento
+from .identity import identidades
+from .segment_refresh import refrescador
+
+# Campos del contacto (attname) que usan los filtros de segmento
+CAMPOS_SEGMENTO = ('ciudad_id', 'farmacia_origen_id', 'fecha_nacimiento')
+# Marca de campo diferido (.only()/.defer()) al cargar la instancia
+_DIFERIDO = object()
+
+
+@receiver(post_delete, sender=CrmContact)
+def invalidar_identidad_contacto(sender, instance, **kwargs):
+    """
+    Al eliminar un contacto (borrado manual o fusión de fantasmas LID)
+    se descartan sus entradas de la caché de identidad.
+    """
+    identidades.invalidate_contact(instance.pk)
+
+
+def _valores_segmento(instance):
+    return {campo: instance.__dict__.get(campo, _DIFERIDO) for campo in CAMPOS_SEGMENTO}
+
+
+@receiver(post_init, sender=CrmContact)
+def recordar_campos_segmento(sender, instance, **kwargs):
+    """Valores cargados de los campos de segmento, para saber al guardar si cambiaron de verdad"""
+    instance._segmento_original = _valores_segmento(instance)
+
+
+@receiver(post_save, sender=CrmContact)
+def marcar_contacto_segmentos(sender, instance, created, **kwargs):
+    """Contacto nuevo o con ciudad/farmacia/nacimiento modificados: revisar sus segmentos"""
+    actuales = _valores_segmento(instance)
+    if created or any(
+        valor is not _DIFERIDO and valor != instance._segmento_original[campo]
+        for campo, valor in actuales.items()
+    ):
+        refrescador.marcar([instance.pk])
+    # Guardados posteriores de la misma instancia se comparan contra lo ya guardado
+    instance._segmento_original = actuales
+
+
+def _marcar_m2m(instance, action, reverse, pk_set, descriptor):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        refrescador.marcar([instance.pk])
+    elif action == 'pre_clear':
+        # Se vacía una etiqueta/producto: sus contactos se leen antes de borrar las filas
+        campo = descriptor.field
+        refrescador.marcar(descriptor.through.objects.filter(
+            **{f'{campo.m2m_reverse_field_name()}_id': instance.pk}
+        ).values_list(f'{campo.m2m_field_name()}_id', flat=True))
+    else:
+        refrescador.marcar(pk_set or [])
+
+
+@receiver(m2m_changed, sender=CrmContact.etiquetas.through)
+def marcar_etiquetas_segmentos(sender, instance, action, reverse, model, pk_set, **kwargs):
+    _marcar_m2m(instance, action, reverse, pk_set, CrmContact.etiquetas)
+
+
+@receiver(m2m_changed, sender=CrmContact.medicamentos_comprados.through)
+def marcar_productos_segmentos(sender, instance, action, reverse, model, pk_set, **kwargs):
+    _marcar_m2m(instance, action, reverse, pk_set, CrmContact.medicamentos_comprados)
+
+
+@receiver(pre_delete, sender=CrmContact)
+def descontar_miembro_segmentos(sender, instance, **kwargs):
+    """El borrado en cascada quita sus filas de MiembroSegmento: se descuenta del total materializado"""
+    segmentos = MiembroSegmento.objects.filter(contacto=instance).values('segmento_id')
+    SegmentoGuardado.objects.filter(id__in=segmentos, total_miembros__gt=0).update(total_miembros=F('total_miembros') - 1)
+
+
+# Clave de SegmentoGuardado.filtros que referencia cada catálogo
+CLAVE_CATALOGO = {Etiqueta: 'etiquetas', ProductoCRM: 'productos', Farmacia: 'farmacias'}
+
+
+@receiver(post_delete, sender=Etiqueta)
+@receiver(post_delete, sender=ProductoCRM)
+@receiver(post_delete, sender=Farmacia)
+def recalcular_segmentos_catalogo(sender, instance, **kwargs):
+    """
+    El borrado en cascada de la tabla intermedia (o el SET_NULL de la farmacia) no envía señales:
+    los segmentos que filtran por el elemento borrado se recalculan en segundo plano.
+    """
+    clave = CLAVE_CATALOGO[sender]
+    afectados = [
+        segmento.pk for segmento in SegmentoGuardado.objects.only('filtros')
+        if instance.pk in (segmento.filtros.get(clave) or [])
+    ]
+    if afectados:
+        SegmentoGuardado.objects.filter(pk__in=afectados).update(requiere_recalculo=True)
+        for segmento_id in afectados:
+            refrescador.programar(segmento_id)
@@ -0,0 +1,203 @@
+"""
+Etiquetado masivo (agregar, quitar o reemplazar etiquetas) sobre un segmento de contactos.
+
+En lugar de un `contacto.etiquetas.add()` por contacto (2 consultas cada uno, más las señales m2m):
+- Los ids del segmento se recorren por rangos de id (keyset, sin OFFSET) en lotes grandes.
+- Por lote: una consulta de las filas existentes en la tabla intermedia, un bulk_create
+  (ignore_conflicts) con las que faltan y/o un DELETE por ids. Solo se escriben los cambios reales,
+  así `afectados` es exacto y relanzar una operación interrumpida es seguro.
+- Operaciones grandes corren en un hilo de fondo y avanzan `procesados` por lote (EtiquetadoMasivo).
+- Cada lote confirma junto con su progreso, el punto de reanudación (`ultimo_id`) y el latido, solo si
+  la operación sigue siendo de este proceso (token `reclamado_por`). Si el proceso web se recicla, la
+  operación queda PENDIENTE o sin latido y `run_bulk_tagging` (o el botón Reanudar) la retoma desde
+  el último lote confirmado.
+bulk_create y los DELETE en bloque no envían m2m_changed: los contactos cambiados se marcan a mano
+para el refresco de los segmentos guardados.
+"""
+import logging
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import transaction, close_old_connections
+from django.db.models import F, Q
+from django.utils import timezone
+
+from CoreApps.notifications.leases import nuevo_worker_id
+from .models import CrmContact, EtiquetadoMasivo
+from .import_jobs import ReclamoPerdido
+from .segments import FiltroSegmento
+from .segment_refresh import refrescador
+
+logger = logging.getLogger(__name__)
+
+Through = CrmContact.etiquetas.through
+COL_CONTACTO = f'{CrmContact.etiquetas.field.m2m_field_name()}_id'
+COL_ETIQUETA = f'{CrmContact.etiquetas.field.m2m_reverse_field_name()}_id'
+
+
+def filtros_operacion(filtro):
+    """Argumentos de FiltroSegmento a guardar en EtiquetadoMasivo.filtros (incluye selección y segmento)"""
+    return {**filtro.a_dict(), 'contactos': filtro.contactos, 'segmento': filtro.segmento}
+
+
+class BulkTagger:
+
+    def __init__(self):
+        self.tamano_lote = getattr(settings, 'CRM_ETIQUETADO_LOTE', 5000)
+        self.umbral_sincrono = getattr(settings, 'CRM_ETIQUETADO_SINCRONO', 5000)
+        self.segundos_huerfano = getattr(settings, 'CRM_ETIQUETADO_STALE_SECONDS', 300)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def lanzar(self, etiqueta, operacion, filtro, usuario=None):
+        """
+        Registra la operación y la ejecuta en la petición si el segmento es pequeño, o en segundo plano.
+        Devuelve el EtiquetadoMasivo (COMPLETADO/ERROR si se ejecutó, PENDIENTE si quedó en cola).
+        """
+        job = EtiquetadoMasivo.objects.create(
+            etiqueta=etiqueta, operacion=operacion, filtros=filtros_operacion(filtro),
+            usuario=usuario, total=filtro.aplicar().count()
+        )
+        if job.total <= self.umbral_sincrono:
+            return self.ejecutar(job.pk)
+        self.programar(job.pk)
+        return job
+
+    def programar(self, job_id):
+        """Ejecuta la operación en el hilo de fondo cuando confirme la transacción en curso"""
+        transaction.on_commit(lambda: self._enviar(job_id))
+
+    def _enviar(self, job_id):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='crm-etiquetado')
+        self._executor.submit(self._procesar, job_id)
+
+    def _procesar(self, job_id):
+        close_old_connections()
+        try:
+            self.ejecutar(job_id)
+        finally:
+            close_old_connections()
+
+    # --- Reclamo y reanudación ---
+
+    def _reclamables(self, reintentar_error=False):
+        limite = timezone.now() - datetime.timedelta(seconds=self.segundos_huerfano)
+        condicion = Q(estado='PENDIENTE') | (
+            Q(estado='PROCESANDO') & (Q(fecha_latido__isnull=True) | Q(fecha_latido__lt=limite))
+        )
+        if reintentar_error:
+            condicion |= Q(estado='ERROR')
+        return EtiquetadoMasivo.objects.filter(condicion)
+
+    def reanudables(self):
+        """Operaciones pendientes o huérfanas (su proceso dejó de latir) que se pueden retomar"""
+        return self._reclamables().order_by('fecha_creacion')
+
+    def huerfanas(self):
+        """Reanudables que nadie va a procesar: PENDIENTES o sin latido desde hace más del límite"""
+        limite = timezone.now() - datetime.timedelta(seconds=self.segundos_huerfano)
+        return self.reanudables().filter(fecha_creacion__lt=limite)
+
+    def reclamar(self, job_id, reintentar_error=False):
+        """UPDATE condicional: solo un proceso gana la operación. Devuelve el token del reclamo o None"""
+        token = nuevo_worker_id()
+        reclamada = self._reclamables(reintentar_error).filter(pk=job_id).update(
+            estado='PROCESANDO', fecha_latido=timezone.now(), reclamado_por=token, mensaje_error=None, fecha_fin=None
+        )
+        return token if reclamada else None
+
+    def _cerrar(self, job_id, token, **campos):
+        EtiquetadoMasivo.objects.filter(pk=job_id, reclamado_por=token).update(
+            reclamado_por=None, fecha_fin=timezone.now(), **campos
+        )
+
+    # --- Ejecución ---
+
+    def ejecutar(self, job_id, reintentar_error=False):
+        """
+        Procesa una operación PENDIENTE o huérfana (o en ERROR con `reintentar_error`) desde su último lote confirmado.
+        Devuelve el EtiquetadoMasivo actualizado, o None si otro proceso la tiene o ya terminó.
+        """
+        token = self.reclamar(job_id, reintentar_error)
+        if not token:
+            return None
+        job = EtiquetadoMasivo.objects.get(pk=job_id)
+        operacion = {'AGREGAR': self._agregar, 'QUITAR': self._quitar, 'REEMPLAZAR': self._reemplazar}[job.operacion]
+        try:
+            audiencia = FiltroSegmento(**job.filtros).aplicar()
+            for ids in self._lotes(audiencia, desde=job.ultimo_id):
+                with transaction.atomic():
+                    cambiados = operacion(job.etiqueta_id, ids)
+                    vigente = EtiquetadoMasivo.objects.filter(pk=job_id, reclamado_por=token).update(
+                        procesados=F('procesados') + len(ids), afectados=F('afectados') + len(cambiados),
+                        ultimo_id=ids[-1], fecha_latido=timezone.now()
+                    )
+                    if not vigente:
+                        raise ReclamoPerdido(job_id)
+                refrescador.marcar(cambiados)
+        except ReclamoPerdido:
+            logger.warning(f"Etiquetado masivo {job_id} retomado por otro proceso; se abandona sin confirmar el lote en curso")
+            return None
+        except Exception as e:
+            # Lo ya confirmado queda aplicado; al reanudar se sigue desde `ultimo_id`
+            logger.exception(f"Error en el etiquetado masivo {job_id}")
+            self._cerrar(job_id, token, estado='ERROR', mensaje_error=str(e))
+        else:
+            self._cerrar(job_id, token, estado='COMPLETADO')
+        job.refresh_from_db()
+        return job
+
+    def _lotes(self, audiencia, desde=0):
+        """Ids del segmento posteriores a `desde` por rangos de id (keyset, sin OFFSET)"""
+        ids_qs = audiencia.order_by('id').values_list('id', flat=True)
+        ultimo = desde
+        while True:
+            ids = list(ids_qs.filter(id__gt=ultimo)[:self.tamano_lote])
+            if not ids:
+                return
+            yield ids
+            ultimo = ids[-1]
+
+    def _con_etiqueta(self, etiqueta_id, ids):
+        return set(Through.objects.filter(**{COL_ETIQUETA: etiqueta_id, f'{COL_CONTACTO}__in': ids})
+                   .values_list(COL_CONTACTO, flat=True))
+
+    def _insertar(self, etiqueta_id, contacto_ids):
+        Through.objects.bulk_create(
+            [Through(**{COL_CONTACTO: c, COL_ETIQUETA: etiqueta_id}) for c in contacto_ids],
+            batch_size=self.tamano_lote, ignore_conflicts=True
+        )
+
+    # --- Operaciones por lote: devuelven los contactos que cambiaron ---
+
+    def _agregar(self, etiqueta_id, ids):
+        faltantes = set(ids) - self._con_etiqueta(etiqueta_id, ids)
+        if faltantes:
+            self._insertar(etiqueta_id, faltantes)
+        return faltantes
+
+    def _quitar(self, etiqueta_id, ids):
+        con_etiqueta = self._con_etiqueta(etiqueta_id, ids)
+        if con_etiqueta:
+            Through.objects.filter(**{COL_ETIQUETA: etiqueta_id, f'{COL_CONTACTO}__in': con_etiqueta}).delete()
+        return con_etiqueta
+
+    def _reemplazar(self, etiqueta_id, ids):
+        """Cada contacto queda solo con esta etiqueta"""
+        filas = Through.objects.filter(**{f'{COL_CONTACTO}__in': ids}).values_list(COL_CONTACTO, COL_ETIQUETA)
+        con_etiqueta, con_otras = set(), set()
+        for contacto_id, otra_id in filas:
+            (con_etiqueta if otra_id == etiqueta_id else con_otras).add(contacto_id)
+        if con_otras:
+            Through.objects.filter(**{f'{COL_CONTACTO}__in': con_otras}).exclude(**{COL_ETIQUETA: etiqueta_id}).delete()
+        faltantes = set(ids) - con_etiqueta
+        if faltantes:
+            self._insertar(etiqueta_id, faltantes)
+        return faltantes | con_otras
+
+
+# Instancia compartida por proceso
+etiquetador = BulkTagger()
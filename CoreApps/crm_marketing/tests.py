@@ -1,3 +1,463 @@
-from django.test import TestCase
+import shutil
+import datetime
+import tempfile
+import pandas as pd
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.test import TestCase, override_settings
+from django.utils import timezone
 
-# Create your tests here.
+from CoreApps.main.models import Ciudad
+from .models import (
+    ImportJob, CrmContact, Etiqueta, ProductoCRM, Farmacia, SegmentoGuardado, MiembroSegmento, ContactoSegmentoPendiente,
+    EtiquetadoMasivo, CampanaDifusion, MensajeCampana
+)
+from .import_jobs import ImportJobRunner, ReclamoPerdido
+from .importer import ContactImporter
+from .segments import FiltroSegmento, fecha_hace_anios
+from .segment_refresh import refrescador
+from .tagging import BulkTagger, filtros_operacion
+from .rendering import compilar_plantilla, validar_plantilla, datos_contacto
+from .enqueue import CampaignEnqueuer, EncoladoEnCurso
+
+
+class MotorDePrueba:
+    """Motor de importación que registra las filas recibidas y puede fallar en un trozo concreto"""
+
+    def __init__(self, fallar_en=None):
+        self.filas = []
+        self.fallar_en = fallar_en
+
+    def importar(self, df):
+        if self.fallar_en is not None and self.fallar_en in df.index:
+            raise RuntimeError('fallo simulado')
+        self.filas.extend(df['cedula'])
+        return {'nuevos': len(df), 'actualizados': 0, 'omitidos': 0, 'errores': []}
+
+
+class ImportacionReanudableTests(TestCase):
+    """Trabajos de importación por trozos: se reanudan desde el último trozo confirmado"""
+
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        ajustes = override_settings(MEDIA_ROOT=media)
+        ajustes.enable()
+        self.addCleanup(ajustes.disable)
+
+        csv = 'cedula,nombres\n' + ''.join(f'{i:010d},Persona {i}\n' for i in range(10))
+        self.job = ImportJob.objects.create(tipo='CONTACTOS', archivo=ContentFile(csv.encode(), name='contactos.csv'))
+        self.runner = ImportJobRunner()
+
+    def test_reanuda_tras_un_error_sin_repetir_filas(self):
+        with self.assertLogs('CoreApps.crm_marketing.import_jobs', 'ERROR'):
+            job = self.runner.ejecutar(self.job.id, motor=MotorDePrueba(fallar_en=7), tamano_trozo=3)
+        self.assertEqual(job.estado, 'ERROR')
+        self.assertEqual(job.filas_procesadas, 6)
+        self.assertEqual(job.nuevos, 6)
+
+        # Un ERROR solo se retoma si se pide explícitamente
+        self.assertIsNone(self.runner.ejecutar(self.job.id, motor=MotorDePrueba(), tamano_trozo=3))
+
+        motor = MotorDePrueba()
+        job = self.runner.ejecutar(self.job.id, reintentar_error=True, motor=motor, tamano_trozo=3)
+        self.assertEqual(job.estado, 'COMPLETADO')
+        self.assertEqual(motor.filas, [f'{i:010d}' for i in range(6, 10)])
+        self.assertEqual((job.nuevos, job.filas_procesadas, job.total_filas), (10, 10, 10))
+        self.assertIsNone(ImportJob.objects.get(id=self.job.id).reclamado_por)
+
+    def test_solo_se_retoma_un_trabajo_sin_latido(self):
+        ImportJob.objects.filter(id=self.job.id).update(
+            estado='PROCESANDO', reclamado_por='otro', fecha_latido=timezone.now(), filas_procesadas=3
+        )
+        self.assertIsNone(self.runner.reclamar(self.job.id))
+        self.assertNotIn(self.job.id, self.runner.reanudables().values_list('id', flat=True))
+
+        viejo = timezone.now() - datetime.timedelta(seconds=self.runner.segundos_huerfano + 1)
+        ImportJob.objects.filter(id=self.job.id).update(fecha_latido=viejo)
+        self.assertIn(self.job.id, self.runner.reanudables().values_list('id', flat=True))
+
+        motor = MotorDePrueba()
+        job = self.runner.ejecutar(self.job.id, motor=motor, tamano_trozo=4)
+        self.assertEqual(job.estado, 'COMPLETADO')
+        self.assertEqual(motor.filas, [f'{i:010d}' for i in range(3, 10)])
+
+    def test_proceso_desplazado_no_confirma_su_trozo(self):
+        token = self.runner.reclamar(self.job.id)
+        job = ImportJob.objects.get(id=self.job.id)
+        # Otro proceso retoma el trabajo mientras este importaba el trozo
+        ImportJob.objects.filter(id=self.job.id).update(reclamado_por='otro')
+
+        trozo = pd.DataFrame({'cedula': ['0000000001']}, index=[0])
+        with self.assertRaises(ReclamoPerdido):
+            self.runner._confirmar_trozo(job, token, MotorDePrueba(), trozo, 1)
+        job.refresh_from_db()
+        self.assertEqual((job.filas_procesadas, job.nuevos), (0, 0))
+
+
+class ImportadorContactosTests(TestCase):
+    """Conflictos de teléfono en la importación en bloque: se rechaza la fila o se adopta el contacto, nunca se aborta el trozo"""
+
+    def _importar(self, *filas):
+        columnas = ['CEDULA', 'TELEFONO', 'NOMBRES', 'MEDICAMENTO']
+        return ContactImporter().importar(pd.DataFrame([dict(zip(columnas, f)) for f in filas]))
+
+    def test_adopta_contacto_de_whatsapp_sin_cedula(self):
+        organico = CrmContact.objects.create(nombres='WhatsApp', apellidos='', telefono='+593991112222')
+        resultado = self._importar(('1712345678', '0991112222', 'Ana', 'Ibuprofeno'), ('1798765432', '0993334444', 'Luis', ''))
+
+        self.assertEqual((resultado['nuevos'], resultado['actualizados'], resultado['omitidos']), (1, 1, 0))
+        organico.refresh_from_db()
+        self.assertEqual((organico.cedula, organico.nombres), ('1712345678', 'Ana'))
+        self.assertEqual(list(organico.medicamentos_comprados.values_list('nombre', flat=True)), ['Ibuprofeno'])
+        self.assertEqual(CrmContact.objects.count(), 2)
+
+    def test_rechaza_si_la_cedula_ya_es_de_otro_contacto(self):
+        CrmContact.objects.create(nombres='WhatsApp', apellidos='', telefono='+593991112222')
+        CrmContact.objects.create(nombres='Ana', apellidos='', cedula='1712345678', telefono='+593995556666')
+        resultado = self._importar(('1712345678', '0991112222', 'Ana'), ('1798765432', '0993334444', 'Luis'))
+
+        self.assertEqual((resultado['nuevos'], resultado['omitidos']), (1, 1))
+        self.assertIn('sin cédula', resultado['errores'][0]['motivo'])
+        self.assertIsNone(CrmContact.objects.get(telefono='+593991112222').cedula)
+        self.assertEqual(CrmContact.objects.get(cedula='1712345678').telefono, '+593995556666')
+
+    def test_rechaza_telefono_de_otra_cedula_en_la_base(self):
+        CrmContact.objects.create(nombres='Luis', apellidos='', cedula='1798765432', telefono='+593991112222')
+        resultado = self._importar(('1712345678', '0991112222', 'Ana'))
+
+        self.assertEqual((resultado['nuevos'], resultado['actualizados'], resultado['omitidos']), (0, 0, 1))
+        self.assertIn('otra cédula', resultado['errores'][0]['motivo'])
+        self.assertEqual(CrmContact.objects.get(telefono='+593991112222').cedula, '1798765432')
+
+    def test_rechaza_telefono_repetido_en_el_archivo(self):
+        CrmContact.objects.create(nombres='WhatsApp', apellidos='', telefono='+593991112222')
+        resultado = self._importar(('1712345678', '0991112222', 'Ana'), ('1798765432', '0991112222', 'Luis'))
+
+        self.assertEqual((resultado['actualizados'], resultado['omitidos']), (1, 1))
+        self.assertEqual(resultado['errores'][0]['fila'], 3)
+        self.assertIn('repetido en el archivo', resultado['errores'][0]['motivo'])
+        self.assertEqual(CrmContact.objects.get(telefono='+593991112222').cedula, '1712345678')
+
+
+class FiltroSegmentoTests(TestCase):
+    """Compilador de segmentos: "alguna de" / "todas" en etiquetas y productos, y cortes de edad"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.quito = Ciudad.objects.create(nombre='Quito')
+        cls.cuenca = Ciudad.objects.create(nombre='Cuenca')
+        cls.farmacia = Farmacia.objects.create(codigo='F1', nombre='Central', ciudad=cls.quito)
+        cls.vip, cls.nuevo = Etiqueta.objects.create(nombre='vip'), Etiqueta.objects.create(nombre='nuevo')
+        cls.ibuprofeno = ProductoCRM.objects.create(nombre='Ibuprofeno')
+        cls.paracetamol = ProductoCRM.objects.create(nombre='Paracetamol')
+
+        cls.ambas = CrmContact.objects.create(nombres='Ambas', apellidos='X', ciudad=cls.quito, farmacia_origen=cls.farmacia)
+        cls.ambas.etiquetas.add(cls.vip, cls.nuevo)
+        cls.ambas.medicamentos_comprados.add(cls.ibuprofeno, cls.paracetamol)
+        cls.solo_vip = CrmContact.objects.create(nombres='Vip', apellidos='X', ciudad=cls.cuenca)
+        cls.solo_vip.etiquetas.add(cls.vip)
+        cls.solo_vip.medicamentos_comprados.add(cls.ibuprofeno)
+        cls.sin_nada = CrmContact.objects.create(nombres='Nada', apellidos='X')
+
+    def _ids(self, **kwargs):
+        return set(FiltroSegmento(**kwargs).aplicar().values_list('id', flat=True))
+
+    def test_etiquetas_alguna_y_todas(self):
+        etiquetas = [self.vip.id, self.nuevo.id]
+        self.assertEqual(self._ids(etiquetas=etiquetas, etiquetas_todas=False), {self.ambas.id, self.solo_vip.id})
+        self.assertEqual(self._ids(etiquetas=etiquetas, etiquetas_todas=True), {self.ambas.id})
+        # Con una sola etiqueta ambos modos coinciden
+        self.assertEqual(self._ids(etiquetas=[self.vip.id], etiquetas_todas=True), {self.ambas.id, self.solo_vip.id})
+
+    def test_productos_alguno_y_todos(self):
+        productos = [self.ibuprofeno.id, self.paracetamol.id]
+        self.assertEqual(self._ids(productos=productos, productos_todos=False), {self.ambas.id, self.solo_vip.id})
+        self.assertEqual(self._ids(productos=productos, productos_todos=True), {self.ambas.id})
+
+    def test_sin_filas_duplicadas(self):
+        # Un contacto con varias etiquetas coincidentes aparece una sola vez (sin JOIN ni DISTINCT)
+        filtro = FiltroSegmento(etiquetas=[self.vip.id, self.nuevo.id], etiquetas_todas=False)
+        self.assertEqual(filtro.aplicar().count(), 2)
+
+    def test_ciudad_farmacia_y_opcion_todos(self):
+        self.assertEqual(self._ids(ciudades=[self.quito.id, self.cuenca.id]), {self.ambas.id, self.solo_vip.id})
+        self.assertEqual(self._ids(farmacias=[str(self.farmacia.id)]), {self.ambas.id})
+        # La opción vacía ("Todos") anula el filtro
+        self.assertEqual(len(self._ids(ciudades=['', str(self.quito.id)])), 3)
+
+    def test_ida_y_vuelta_por_dict(self):
+        filtro = FiltroSegmento(etiquetas=[self.vip.id, self.nuevo.id], etiquetas_todas=False, edad_minima='18')
+        copia = FiltroSegmento.desde_dict(filtro.a_dict())
+        self.assertEqual(copia.a_dict(), filtro.a_dict())
+        self.assertEqual(copia.edad_minima, 18)
+        self.assertTrue(copia.usa_edad)
+
+    def test_corte_de_edad_el_29_de_febrero(self):
+        # Hoy 29/02 (bisiesto) y el año de corte no es bisiesto: cae en el 28
+        self.assertEqual(fecha_hace_anios(18, hoy=datetime.date(2024, 2, 29)), datetime.date(2006, 2, 28))
+        self.assertEqual(fecha_hace_anios(4, hoy=datetime.date(2024, 2, 29)), datetime.date(2020, 2, 29))
+        # Nacido un 29/02: el 28/02 de un año no bisiesto aún no cumple, el 01/03 sí
+        nacimiento = datetime.date(2000, 2, 29)
+        self.assertFalse(nacimiento <= fecha_hace_anios(23, hoy=datetime.date(2023, 2, 28)))
+        self.assertTrue(nacimiento <= fecha_hace_anios(23, hoy=datetime.date(2023, 3, 1)))
+
+    def test_rango_de_edad_incluye_los_limites(self):
+        cumple_hoy = CrmContact.objects.create(nombres='Treinta', apellidos='X', fecha_nacimiento=fecha_hace_anios(30))
+        cumple_manana = CrmContact.objects.create(
+            nombres='Veintinueve', apellidos='X', fecha_nacimiento=fecha_hace_anios(30) + datetime.timedelta(days=1)
+        )
+        cumplio_hace_meses = CrmContact.objects.create(
+            nombres='Veintinueve', apellidos='Y', fecha_nacimiento=fecha_hace_anios(29) - datetime.timedelta(days=100)
+        )
+        self.assertEqual(self._ids(edad_minima=30), {cumple_hoy.id})
+        # Quien ya cumplió 29 sigue teniendo 29 hasta su próximo cumpleaños
+        self.assertEqual(self._ids(edad_maxima=29), {cumple_manana.id, cumplio_hace_meses.id})
+        self.assertEqual(self._ids(edad_minima=29, edad_maxima=29), {cumple_manana.id, cumplio_hace_meses.id})
+        self.assertEqual(self._ids(edad_minima=30, edad_maxima=30), {cumple_hoy.id})
+
+
+class RefrescoSegmentosTests(TestCase):
+    """Membresía materializada: recálculo completo y refresco incremental de los contactos marcados"""
+
+    def setUp(self):
+        self.quito = Ciudad.objects.create(nombre='Quito')
+        self.cuenca = Ciudad.objects.create(nombre='Cuenca')
+        self.vip = Etiqueta.objects.create(nombre='vip')
+        self.ana = CrmContact.objects.create(nombres='Ana', apellidos='X', ciudad=self.quito)
+        self.luis = CrmContact.objects.create(nombres='Luis', apellidos='X', ciudad=self.cuenca)
+        self.segmento = SegmentoGuardado.objects.create(nombre='Quito', filtros={'ciudades': [self.quito.id]})
+        refrescador.recalcular(self.segmento.pk)
+
+    def _miembros(self, segmento=None):
+        segmento = segmento or self.segmento
+        segmento.refresh_from_db()
+        ids = set(MiembroSegmento.objects.filter(segmento=segmento).values_list('contacto_id', flat=True))
+        self.assertEqual(segmento.total_miembros, len(ids))
+        return ids
+
+    def _pendientes(self):
+        return set(ContactoSegmentoPendiente.objects.values_list('contacto_id', flat=True))
+
+    def test_recalculo_completo(self):
+        self.assertEqual(self._miembros(), {self.ana.id})
+        self.assertFalse(self.segmento.requiere_recalculo)
+
+        self.segmento.filtros = {'ciudades': [self.cuenca.id]}
+        self.segmento.save()
+        altas, bajas = refrescador.recalcular(self.segmento.pk)
+        self.assertEqual((altas, bajas), (1, 1))
+        self.assertEqual(self._miembros(), {self.luis.id})
+
+    def test_cambio_de_ciudad_se_refresca_incrementalmente(self):
+        ContactoSegmentoPendiente.objects.all().delete()
+        self.luis.ciudad = self.quito
+        self.luis.save()
+        self.ana.ciudad = self.cuenca
+        self.ana.save()
+        self.assertEqual(self._pendientes(), {self.ana.id, self.luis.id})
+
+        self.assertEqual(refrescador.refrescar_pendientes(), 2)
+        self.assertEqual(self._miembros(), {self.luis.id})
+        self.assertEqual(self._pendientes(), set())
+
+    def test_guardado_sin_cambios_de_segmento_no_marca(self):
+        ContactoSegmentoPendiente.objects.all().delete()
+        contacto = CrmContact.objects.get(pk=self.ana.pk)
+        contacto.nombres = 'Ana María'
+        contacto.save()
+        # Una instancia con campos diferidos tampoco cuenta como cambio
+        parcial = CrmContact.objects.only('id', 'nombres').get(pk=self.luis.pk)
+        parcial.nombres = 'Luis Alberto'
+        parcial.save(update_fields=['nombres'])
+        self.assertEqual(self._pendientes(), set())
+
+    def test_etiquetas_marcan_al_contacto(self):
+        por_etiqueta = SegmentoGuardado.objects.create(nombre='VIP', filtros={'etiquetas': [self.vip.id]})
+        refrescador.recalcular(por_etiqueta.pk)
+        ContactoSegmentoPendiente.objects.all().delete()
+
+        self.luis.etiquetas.add(self.vip)
+        self.assertEqual(self._pendientes(), {self.luis.id})
+        refrescador.refrescar_pendientes()
+        self.assertEqual(self._miembros(por_etiqueta), {self.luis.id})
+
+        self.vip.contactos.clear()
+        refrescador.refrescar_pendientes()
+        self.assertEqual(self._miembros(por_etiqueta), set())
+
+    def test_borrar_contacto_descuenta_del_total(self):
+        self.ana.delete()
+        self.assertEqual(self._miembros(), set())
+
+    def test_borrar_catalogo_recalcula_solo_los_segmentos_que_lo_usan(self):
+        por_etiqueta = SegmentoGuardado.objects.create(nombre='VIP', filtros={'etiquetas': [self.vip.id]})
+        refrescador.recalcular(por_etiqueta.pk)
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.vip.delete()
+        por_etiqueta.refresh_from_db()
+        self.segmento.refresh_from_db()
+        self.assertTrue(por_etiqueta.requiere_recalculo)
+        self.assertFalse(self.segmento.requiere_recalculo)
+        self.assertEqual(len(callbacks), 1)
+
+
+class EtiquetadoMasivoTests(TestCase):
+    """Agregar / quitar / reemplazar: `afectados` cuenta solo los contactos que cambiaron de verdad"""
+
+    def setUp(self):
+        self.etiqueta = Etiqueta.objects.create(nombre='vip')
+        self.otra = Etiqueta.objects.create(nombre='frecuente')
+        self.contactos = [CrmContact.objects.create(nombres=f'C{i}', apellidos='X') for i in range(5)]
+        self.ids = [c.id for c in self.contactos]
+        self.tagger = BulkTagger()
+        self.tagger.tamano_lote = 2
+
+    def _con(self, etiqueta):
+        return set(etiqueta.contactos.values_list('id', flat=True))
+
+    def _lanzar(self, operacion, ids=None):
+        return self.tagger.lanzar(self.etiqueta, operacion, FiltroSegmento(contactos=ids or self.ids))
+
+    def test_agregar(self):
+        self.contactos[0].etiquetas.add(self.etiqueta)
+        job = self._lanzar('AGREGAR')
+        self.assertEqual((job.estado, job.total, job.procesados, job.afectados), ('COMPLETADO', 5, 5, 4))
+        self.assertEqual(self._con(self.etiqueta), set(self.ids))
+
+        # Relanzar no cambia nada
+        self.assertEqual(self._lanzar('AGREGAR').afectados, 0)
+
+    def test_quitar(self):
+        for c in self.contactos[:2]:
+            c.etiquetas.add(self.etiqueta, self.otra)
+        job = self._lanzar('QUITAR')
+        self.assertEqual((job.procesados, job.afectados), (5, 2))
+        self.assertEqual(self._con(self.etiqueta), set())
+        self.assertEqual(self._con(self.otra), set(self.ids[:2]))
+
+    def test_reemplazar(self):
+        self.contactos[0].etiquetas.add(self.etiqueta)              # ya estaba solo con ella: sin cambio
+        self.contactos[1].etiquetas.add(self.etiqueta, self.otra)   # pierde la otra
+        self.contactos[2].etiquetas.add(self.otra)                  # pierde la otra y gana esta
+        job = self._lanzar('REEMPLAZAR')
+        self.assertEqual((job.procesados, job.afectados), (5, 4))
+        self.assertEqual(self._con(self.etiqueta), set(self.ids))
+        self.assertEqual(self._con(self.otra), set())
+
+    def test_reanuda_desde_el_ultimo_lote_confirmado(self):
+        filtro = FiltroSegmento(contactos=self.ids)
+        job = EtiquetadoMasivo.objects.create(
+            etiqueta=self.etiqueta, operacion='AGREGAR', filtros=filtros_operacion(filtro), total=5,
+            estado='ERROR', procesados=2, afectados=2, ultimo_id=self.ids[1]
+        )
+        self.assertIsNone(self.tagger.ejecutar(job.pk))
+
+        job = self.tagger.ejecutar(job.pk, reintentar_error=True)
+        self.assertEqual((job.estado, job.procesados, job.afectados, job.ultimo_id), ('COMPLETADO', 5, 5, self.ids[-1]))
+        # Solo se procesaron los contactos posteriores al punto de reanudación
+        self.assertEqual(self._con(self.etiqueta), set(self.ids[2:]))
+        self.assertIsNone(job.reclamado_por)
+
+    def test_operacion_con_latido_vigente_no_se_reclama(self):
+        job = EtiquetadoMasivo.objects.create(
+            etiqueta=self.etiqueta, operacion='AGREGAR', filtros=filtros_operacion(FiltroSegmento(contactos=self.ids)),
+            total=5, estado='PROCESANDO', reclamado_por='otro', fecha_latido=timezone.now()
+        )
+        self.assertIsNone(self.tagger.ejecutar(job.pk))
+        self.assertNotIn(job.pk, self.tagger.reanudables().values_list('pk', flat=True))
+
+        EtiquetadoMasivo.objects.filter(pk=job.pk).update(
+            fecha_latido=timezone.now() - datetime.timedelta(seconds=self.tagger.segundos_huerfano + 1)
+        )
+        self.assertEqual(self.tagger.ejecutar(job.pk).afectados, 5)
+
+
+class PlantillaMensajeTests(TestCase):
+    """Plantillas de campaña compiladas una vez y renderizadas por contacto"""
+
+    def test_renderiza_variables_conocidas(self):
+        plan = compilar_plantilla('Hola {nombres} {apellidos}, te esperamos en {farmacia} ({ciudad}).')
+        self.assertEqual(plan.campos, ['apellidos', 'ciudad__nombre', 'farmacia_origen__nombre', 'nombres'])
+        datos = {'nombres': 'Ana', 'apellidos': 'Paz', 'ciudad__nombre': 'Quito', 'farmacia_origen__nombre': 'Central'}
+        self.assertEqual(plan.renderizar(datos), 'Hola Ana Paz, te esperamos en Central (Quito).')
+
+    def test_valores_vacios_y_texto_sin_variables(self):
+        plan = compilar_plantilla('{nombres}: tu farmacia es {farmacia}')
+        self.assertEqual(plan.renderizar({'nombres': 'Ana', 'farmacia_origen__nombre': None}), 'Ana: tu farmacia es ')
+        self.assertEqual(compilar_plantilla('Sin variables').renderizar({}), 'Sin variables')
+
+    def test_variable_desconocida_queda_literal_y_no_valida(self):
+        plan = compilar_plantilla('Hola {nombre} {nombres}')
+        self.assertEqual(plan.desconocidas, ['{nombre}'])
+        self.assertEqual(plan.renderizar({'nombres': 'Ana'}), 'Hola {nombre} Ana')
+
+        with self.assertRaises(ValidationError) as ctx:
+            validar_plantilla('Hola {nombre} {edad} {nombre}')
+        self.assertEqual(ctx.exception.code, 'variable_desconocida')
+        self.assertIn('{edad}, {nombre}', ctx.exception.messages[0])
+        validar_plantilla('Hola {nombres}')
+
+    def test_la_campana_valida_su_plantilla(self):
+        campana = CampanaDifusion(nombre='Prueba', mensaje_plantilla='Hola {apodo}')
+        with self.assertRaises(ValidationError) as ctx:
+            campana.full_clean()
+        self.assertIn('mensaje_plantilla', ctx.exception.message_dict)
+
+    def test_misma_salida_desde_values_y_desde_la_instancia(self):
+        quito = Ciudad.objects.create(nombre='Quito')
+        contacto = CrmContact.objects.create(nombres='Ana', apellidos='Paz', ciudad=quito, telefono='+593990000001')
+        plan = compilar_plantilla('{nombres} de {ciudad} ({farmacia}) {telefono}')
+        fila = CrmContact.objects.values(*plan.campos).get(pk=contacto.pk)
+        self.assertEqual(plan.renderizar(fila), plan.renderizar(datos_contacto(contacto)))
+        self.assertEqual(plan.renderizar(fila), 'Ana de Quito () +593990000001')
+
+    def test_el_encolado_guarda_el_texto_final(self):
+        for nombre in ('Ana', 'Luis'):
+            CrmContact.objects.create(nombres=nombre, apellidos='X')
+        campana = CampanaDifusion.objects.create(nombre='Prueba', mensaje_plantilla='Hola {nombres}!')
+        self.assertEqual(CampaignEnqueuer().lanzar(campana), 2)
+        self.assertEqual(
+            sorted(MensajeCampana.objects.filter(campana=campana).values_list('texto_renderizado', flat=True)),
+            ['Hola Ana!', 'Hola Luis!']
+        )
+
+
+class EncoladoCampanaTests(TestCase):
+    """Un solo proceso encola cada campaña; los encolados huérfanos se retoman donde quedaron"""
+
+    def setUp(self):
+        self.ids = [CrmContact.objects.create(nombres=f'C{i}', apellidos='X').id for i in range(5)]
+        self.campana = CampanaDifusion.objects.create(nombre='Prueba', mensaje_plantilla='Hola {nombres}')
+        self.encolador = CampaignEnqueuer()
+        self.encolador.tamano_lote = 2
+
+    def test_no_se_relanza_mientras_el_encolado_late(self):
+        token = self.encolador.reclamar(self.campana.pk, total=5, desde_borrador=True)
+        self.assertIsNotNone(token)
+        with self.assertRaises(EncoladoEnCurso):
+            self.encolador.lanzar(self.campana)
+        self.assertFalse(self.encolador.huerfanas().exists())
+
+    def test_huerfana_sigue_desde_su_ultimo_lote(self):
+        self.encolador.reclamar(self.campana.pk, total=5, desde_borrador=True)
+        CampanaDifusion.objects.filter(pk=self.campana.pk).update(
+            audiencia_procesada=2, encolado_ultimo_id=self.ids[1],
+            fecha_latido=timezone.now() - datetime.timedelta(seconds=self.encolador.segundos_huerfano + 1)
+        )
+        self.assertEqual(list(self.encolador.huerfanas().values_list('pk', flat=True)), [self.campana.pk])
+
+        self.assertEqual(self.encolador.lanzar(self.campana), 3)
+        self.campana.refresh_from_db()
+        self.assertEqual((self.campana.estado, self.campana.audiencia_procesada), ('PROGRAMADA', 5))
+        self.assertIsNone(self.campana.reclamado_por)
+
+    def test_proceso_desplazado_abandona_sin_confirmar(self):
+        token = self.encolador.reclamar(self.campana.pk, total=5, desde_borrador=True)
+        CampanaDifusion.objects.filter(pk=self.campana.pk).update(reclamado_por='otro')
+        with self.assertLogs('CoreApps.crm_marketing.enqueue', 'WARNING'):
+            self.assertIsNone(self.encolador.encolar(self.campana.pk, token))
+        self.assertFalse(MensajeCampana.objects.filter(campana=self.campana).exists())
+        self.campana.refresh_from_db()
+        self.assertEqual(self.campana.estado, 'ENCOLANDO')
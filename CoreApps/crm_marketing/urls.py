@@ -10,6 +10,9 @@ urlpatterns = [
     path('contactos/bulk-tag/', views.AssignTagsBulkView.as_view(), name='bulk_add_tag'),
     path('contactos/importar/', views.ContactImportView.as_view(), name='import_data'),
     path('contactos/importar/plantilla/', views.DownloadImportTemplateView.as_view(), name='download_import_template'),
+    path('contactos/importar/<int:pk>/estado/', views.ImportJobStatusAPIView.as_view(), name='import_job_status'),
+    path('contactos/importar/<int:pk>/errores/', views.ImportJobReportView.as_view(), name='import_job_report'),
+    path('contactos/importar/<int:pk>/reanudar/', views.ImportJobResumeView.as_view(), name='import_job_resume'),
     
 
     # Campañas
@@ -18,14 +21,24 @@ urlpatterns = [
     path('campanas/<int:pk>/editar/', views.CampanaUpdateView.as_view(), name='campaign_edit'),
     path('campanas/<int:pk>/preview/', views.CampaignPreviewView.as_view(), name='campaign_preview'),
     path('campanas/<int:pk>/execute/', views.CampaignExecuteView.as_view(), name='campaign_execute'),
+    path('campanas/<int:pk>/encolado/', views.CampaignEnqueueStatusAPIView.as_view(), name='campaign_enqueue_status'),
     path('campanas/<int:pk>/reporte/', views.CampaignReportView.as_view(), name='campaign_report'),
     path('campanas/<int:pk>/eliminar/', views.CampanaDeleteView.as_view(), name='campaign_delete'),
     
+    # Segmentos guardados
+    path('segmentos/', views.SegmentoListView.as_view(), name='segment_list'),
+    path('segmentos/crear/', views.SegmentoCreateView.as_view(), name='segment_create'),
+    path('segmentos/<int:pk>/recalcular/', views.SegmentoRecalcularView.as_view(), name='segment_refresh'),
+    path('segmentos/<int:pk>/estado/', views.SegmentoStatusAPIView.as_view(), name='segment_status'),
+    path('segmentos/<int:pk>/eliminar/', views.SegmentoDeleteView.as_view(), name='segment_delete'),
+
     # Etiquetas
     path('etiquetas/', views.EtiquetaListView.as_view(), name='etiqueta_list'),
     path('etiquetas/crear/', views.EtiquetaCreateView.as_view(), name='etiqueta_create'),
     path('etiquetas/<int:pk>/editar/', views.EtiquetaUpdateView.as_view(), name='etiqueta_edit'),
     path('etiquetas/<int:pk>/eliminar/', views.EtiquetaDeleteView.as_view(), name='etiqueta_delete'),
+    path('etiquetas/masivo/<int:pk>/estado/', views.EtiquetadoMasivoStatusAPIView.as_view(), name='bulk_tag_status'),
+    path('etiquetas/masivo/<int:pk>/reanudar/', views.EtiquetadoMasivoResumeView.as_view(), name='bulk_tag_resume'),
     
     # Pipeline / Kanban
     path('pipeline/', views.PipelineBoardView.as_view(), name='pipeline_board'),
@@ -1,10 +1,18 @@
+import csv
 import pandas as pd
-from django.shortcuts import render, redirect
-from django.urls import reverse_lazy
+from django.shortcuts import render, redirect, get_object_or_404
+from django.http import HttpResponse, JsonResponse
+from django.urls import reverse, reverse_lazy
 from django.contrib import messages
 from django.views.generic import ListView, DetailView, FormView, UpdateView, View, CreateView, DeleteView
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
-from .models import CrmContact, Farmacia, Etiqueta, ProductoCRM, CrmConfig, CrmMediaTemplate
+from .models import CrmContact, Farmacia, Etiqueta, ProductoCRM, CrmConfig, CrmMediaTemplate, ImportJob, SegmentoGuardado, EtiquetadoMasivo
+from .import_jobs import import_runner
+from .enqueue import encolador, EncoladoEnCurso
+from .segments import FiltroSegmento
+from .segment_refresh import refrescador
+from .tagging import etiquetador
+from .rendering import compilar_plantilla
 from CoreApps.main.models import Ciudad
 
 class GestorCrmMixin(LoginRequiredMixin, UserPassesTestMixin):
@@ -15,7 +23,10 @@ class GestorCrmMixin(LoginRequiredMixin, UserPassesTestMixin):
 class CrmConfigUpdateView(GestorCrmMixin, UpdateView):
     model = CrmConfig
     template_name = 'crm_marketing/config_form.html'
-    fields = ['tiempo_alerta_leads', 'respuestas_rapidas']
+    fields = [
+        'tiempo_alerta_leads', 'respuestas_rapidas',
+        'campanas_mensajes_por_minuto', 'campanas_envios_simultaneos', 'campanas_jitter_segundos',
+    ]
     
     def get_object(self, queryset=None):
         return CrmConfig.get_solo()
@@ -55,41 +66,8 @@ class CrmContactListView(GestorCrmMixin, ListView):
     context_object_name = 'contactos'
     
     def get_queryset(self):
-        qs = super().get_queryset()
-        # Filtros ampliados (Soportando multi-select con getlist)
-        ciudades_ids = self.request.GET.getlist('ciudad')
-        farmacias_ids = self.request.GET.getlist('farmacia')
-        productos_ids = self.request.GET.getlist('medicamento')
-        etiquetas_ids = self.request.GET.getlist('etiqueta')
-        edad_min = self.request.GET.get('edad_min')
-        edad_max = self.request.GET.get('edad_max')
-        
-        if ciudades_ids and '' not in ciudades_ids:
-            qs = qs.filter(ciudad_id__in=ciudades_ids)
-        if farmacias_ids and '' not in farmacias_ids:
-            qs = qs.filter(farmacia_origen_id__in=farmacias_ids)
-        if productos_ids and '' not in productos_ids:
-            qs = qs.filter(medicamentos_comprados__id__in=productos_ids).distinct()
-        if etiquetas_ids and '' not in etiquetas_ids:
-            qs = qs.filter(etiquetas__id__in=etiquetas_ids).distinct()
-            
-        # Filtro de Edad calculando con Datetime
-        if edad_min or edad_max:
-            import datetime
-            hoy = datetime.date.today()
-            if edad_min:
-                try:
-                    fecha_tope_min = datetime.date(hoy.year - int(edad_min), hoy.month, hoy.day)
-                    qs = qs.filter(fecha_nacimiento__lte=fecha_tope_min)
-                except ValueError:
-                    pass
-            if edad_max:
-                try:
-                    fecha_tope_max = datetime.date(hoy.year - int(edad_max), hoy.month, hoy.day)
-                    qs = qs.filter(fecha_nacimiento__gte=fecha_tope_max)
-                except ValueError:
-                    pass
-                    
+        # Filtros ampliados (multi-select con getlist), compilados en segments.py
+        qs = FiltroSegmento.desde_params(self.request.GET).aplicar(super().get_queryset())
         return qs.select_related('ciudad', 'farmacia_origen').prefetch_related('etiquetas', 'medicamentos_comprados')
 
     def get_context_data(self, **kwargs):
@@ -98,6 +76,7 @@ class CrmContactListView(GestorCrmMixin, ListView):
         context['farmacias'] = Farmacia.objects.all()
         context['productos'] = ProductoCRM.objects.all()
         context['etiquetas'] = Etiqueta.objects.all()
+        context['segmentos'] = SegmentoGuardado.objects.all()
         return context
 
 class CrmContactDetailView(GestorCrmMixin, DetailView):
@@ -113,6 +92,11 @@ class CrmContactUpdateView(GestorCrmMixin, UpdateView):
         'fecha_nacimiento', 'es_edad_estimada', 'ciudad', 'zona_barrio', 
         'farmacia_origen', 'etiquetas', 'medicamentos_comprados', 'es_proveedor'
     ]
+
+    def form_valid(self, form):
+        # El chat pudo mover el puntero del último mensaje desde que se cargó el contacto
+        form.instance.refresh_from_db(fields=CrmContact.CAMPOS_ULTIMO_MENSAJE)
+        return super().form_valid(form)
     
     def get_success_url(self):
         messages.success(self.request, "Contacto actualizado correctamente.")
@@ -137,9 +121,10 @@ class CrmContactDeleteView(GestorCrmMixin, View):
         return redirect('crm_marketing:contact_list')
 
 class AssignTagsBulkView(GestorCrmMixin, View):
-    """Vista que recibe filtros por GET/POST y una etiqueta, y se la asigna a todos los contactos resultantes"""
+    """Vista que recibe filtros por POST y una etiqueta, y la agrega, quita o reemplaza en todos los contactos resultantes"""
     def post(self, request, *args, **kwargs):
         etiqueta_id = request.POST.get('etiqueta_id')
+        operacion = request.POST.get('operacion') or 'AGREGAR'
         contact_ids = request.POST.getlist('contact_ids') # IDs seleccionados por checkbox
         
         # Filtros (para fallback si no hay contact_ids o para redirección)
@@ -153,49 +138,33 @@ class AssignTagsBulkView(GestorCrmMixin, View):
         if not etiqueta_id:
             messages.error(request, "Debes seleccionar una etiqueta.")
             return redirect('crm_marketing:contact_list')
+        if operacion not in dict(EtiquetadoMasivo.OPERACIONES):
+            messages.error(request, "Operación de etiquetado no válida.")
+            return redirect('crm_marketing:contact_list')
 
         # Si el usuario seleccionó contactos específicos por checkbox, usamos esos.
         # Si no, aplicamos a todo el resultado del filtro actual.
+        # El rango de edad aplica en ambos casos.
         if contact_ids:
-            qs = CrmContact.objects.filter(id__in=contact_ids)
+            filtro = FiltroSegmento(contactos=contact_ids, edad_minima=edad_min, edad_maxima=edad_max)
         else:
-            qs = CrmContact.objects.all()
-            if ciudades_ids and '' not in ciudades_ids:
-                qs = qs.filter(ciudad_id__in=ciudades_ids)
-            if farmacias_ids and '' not in farmacias_ids:
-                qs = qs.filter(farmacia_origen_id__in=farmacias_ids)
-            if productos_ids and '' not in productos_ids:
-                qs = qs.filter(medicamentos_comprados__id__in=productos_ids)
-            if filtros_etiquetas_ids and '' not in filtros_etiquetas_ids:
-                qs = qs.filter(etiquetas__id__in=filtros_etiquetas_ids)
-            
-            qs = qs.distinct()
-            
-        if edad_min or edad_max:
-            import datetime
-            hoy = datetime.date.today()
-            if edad_min:
-                try:
-                    fecha_tope_min = datetime.date(hoy.year - int(edad_min), hoy.month, hoy.day)
-                    qs = qs.filter(fecha_nacimiento__lte=fecha_tope_min)
-                except ValueError:
-                    pass
-            if edad_max:
-                try:
-                    fecha_tope_max = datetime.date(hoy.year - int(edad_max), hoy.month, hoy.day)
-                    qs = qs.filter(fecha_nacimiento__gte=fecha_tope_max)
-                except ValueError:
-                    pass
+            filtro = FiltroSegmento.desde_params(request.POST)
 
         try:
             etiqueta = Etiqueta.objects.get(id=etiqueta_id)
-            total = qs.count()
-            # Asignación masiva m2m es iterativa o requiere loop (debido a validaciones M2M)
-            # Para pocos miles es rápido
-            for contacto in qs:
-                contacto.etiquetas.add(etiqueta)
-            
-            messages.success(request, f"¡Éxito! Se asignó la etiqueta '{etiqueta.nombre}' a {total} prospectos.")
+            # Filas de la tabla intermedia en bloque (ver tagging.py); segmentos grandes en segundo plano
+            job = etiquetador.lanzar(etiqueta, operacion, filtro, usuario=request.user)
+            if job.estado == 'COMPLETADO':
+                resumen = {
+                    'AGREGAR': f"Se asignó la etiqueta '{etiqueta.nombre}' a {job.afectados} de {job.total} prospectos.",
+                    'QUITAR': f"Se quitó la etiqueta '{etiqueta.nombre}' a {job.afectados} de {job.total} prospectos.",
+                    'REEMPLAZAR': f"'{etiqueta.nombre}' quedó como única etiqueta; cambiaron {job.afectados} de {job.total} prospectos.",
+                }[operacion]
+                messages.success(request, f"¡Éxito! {resumen}")
+            elif job.estado == 'ERROR':
+                messages.error(request, f"El etiquetado se interrumpió tras {job.procesados} contactos: {job.mensaje_error}")
+            else:
+                messages.info(request, f"⏳ Etiquetando {job.total} prospectos en segundo plano. Sigue el avance en Administrar Etiquetas.")
         except Etiqueta.DoesNotExist:
             messages.error(request, "La etiqueta seleccionada no existe.")
 
@@ -212,6 +181,7 @@ class AssignTagsBulkView(GestorCrmMixin, View):
             if eid: query_params.append(f"etiqueta={eid}")
         if edad_min: query_params.append(f"edad_min={edad_min}")
         if edad_max: query_params.append(f"edad_max={edad_max}")
+        if request.POST.get('segmento'): query_params.append(f"segmento={request.POST['segmento']}")
         
         if query_params:
             url = f"{url}?{'&'.join(query_params)}"
@@ -221,138 +191,73 @@ class AssignTagsBulkView(GestorCrmMixin, View):
 class ContactImportView(GestorCrmMixin, FormView):
     template_name = 'crm_marketing/import_data.html'
     success_url = reverse_lazy('crm_marketing:contact_list')
+    FORMATOS = ('.xlsx', '.xls', '.csv')
 
     # No usamos form class, manejamos el request directamente en post para simplificar file upload
     def post(self, request, *args, **kwargs):
         excel_file = request.FILES.get('excel_file')
-        if not excel_file:
+        if not excel_file or not excel_file.name.lower().endswith(self.FORMATOS):
             messages.error(request, "Por favor sube un archivo Excel válido.")
             return redirect('crm_marketing:import_data')
-        
-        try:
-            df = pd.read_excel(excel_file)
-            
-            nuevos = 0
-            actualizados = 0
-            
-            # Limpiamos NaN a strings vacíos o None
-            df = df.where(pd.notnull(df), None)
-            
-            for index, row in df.iterrows():
-                # Campos mandatorios: telefono ahora pasa a ser recomendado, pero cedula manda. 
-                # Sin embargo, exigiremos telefono porque es para WhatsApp
-                # --- CORRECCIÓN: Limpieza de Teléfono (Basura de Excel) ---
-                telefono = str(row.get('TELEFONO', '')).strip()
-                if telefono.endswith('.0'): telefono = telefono[:-2]
-                # ---------------------------------------------------------
-
-                # Omitir si está vacío o si es uno de los números de ejemplo exactos de la plantilla
-                if not telefono or telefono == 'None' or telefono in ['0991234567', '0987654321']:
-                    continue
-                
-                # Cédula como identificador principal
-                cedula = str(row.get('CEDULA', '')).strip()
-                if cedula.endswith('.0'): cedula = cedula[:-2] # Limpiar .0 de Excel
-
-                # --- CORRECCIÓN: Recuperar cero inicial perdido por Excel ---
-                if len(cedula) == 9 and cedula.isdigit():
-                    cedula = '0' + cedula
-
-                if not cedula or cedula == 'None' or cedula == '':
-                    # Si no hay cédula, intentamos usar el teléfono como fallback
-                    cedula = telefono 
-                # -----------------------------------------------------------
-
-                # Limpiador básico de teléfono a formato +593...
-                if telefono.startswith('09'):
-                    telefono = '+593' + telefono[1:]
-                elif telefono.startswith('9'):
-                    telefono = '+593' + telefono
-                
-                nombres = str(row.get('NOMBRES', '')).strip()
-                apellidos = str(row.get('APELLIDOS', '')).strip()
-                if nombres == 'None': nombres = 'Desconocido'
-                if apellidos == 'None': apellidos = ''
-                
-                # Procesamiento de Correo y Dirección
-                email = str(row.get('EMAIL', '')).strip()
-                if email == 'None': email = ''
-                
-                direccion = str(row.get('DIRECCION', '')).strip()
-                if direccion == 'None': direccion = ''
-                
-                # Procesamiento de Ciudad
-                ciudad_nombre = str(row.get('CIUDAD', '')).strip()
-                ciudad_obj = None
-                if ciudad_nombre and ciudad_nombre != 'None':
-                    ciudad_obj, _ = Ciudad.objects.get_or_create(nombre__iexact=ciudad_nombre, defaults={'nombre': ciudad_nombre.title()})
-                
-                # Procesamiento de Farmacia
-                farmacia_codigo = str(row.get('CODIGO_FARMACIA', '')).strip()
-                farmacia_obj = None
-                if farmacia_codigo and farmacia_codigo != 'None':
-                    farmacia_obj, _ = Farmacia.objects.get_or_create(codigo=farmacia_codigo, defaults={'nombre': f"Farmacia {farmacia_codigo}", 'ciudad': ciudad_obj})
-                
-                # Procesamiento de Edad o Fecha de nacimiento
-                import datetime
-                fecha_nac = None
-                es_estimada = False
-                
-                fecha_excel = row.get('FECHA_NACIMIENTO', None)
-                edad_excel = row.get('EDAD', None)
-                
-                if pd.notnull(fecha_excel) and str(fecha_excel).strip() != 'None' and str(fecha_excel).strip() != '':
-                    try:
-                        # Puede que venga como datetime de excel o string
-                        if isinstance(fecha_excel, datetime.datetime):
-                            fecha_nac = fecha_excel.date()
-                        else:
-                            fecha_nac = pd.to_datetime(fecha_excel).date()
-                    except:
-                        pass
-                
-                if not fecha_nac and pd.notnull(edad_excel) and str(edad_excel).strip() != 'None' and str(edad_excel).strip() != '':
-                    try:
-                        edad_val = int(edad_excel)
-                        es_estimada = True
-                        hoy = datetime.date.today()
-                        fecha_nac = datetime.date(hoy.year - edad_val, 1, 1) # Asumimos 1 Enero
-                    except:
-                        pass
-
-                contacto, created = CrmContact.objects.update_or_create(
-                    cedula=cedula,
-                    defaults={
-                        'telefono': telefono,
-                        'nombres': nombres,
-                        'apellidos': apellidos,
-                        'email': email if email else None,
-                        'zona_barrio': direccion if direccion else None,
-                        'ciudad': ciudad_obj,
-                        'farmacia_origen': farmacia_obj,
-                        'fecha_nacimiento': fecha_nac,
-                        'es_edad_estimada': es_estimada
-                    }
-                )
-                
-                if created: nuevos += 1
-                else: actualizados += 1
-                
-                # Procesar medicamento (ProductoCRM)
-                medicamento_nombre = str(row.get('MEDICAMENTO', '')).strip()
-                if medicamento_nombre and medicamento_nombre != 'None':
-                    producto_obj, _ = ProductoCRM.objects.get_or_create(nombre__iexact=medicamento_nombre, defaults={'nombre': medicamento_nombre.title()})
-                    contacto.medicamentos_comprados.add(producto_obj)
-
-            messages.success(request, f"¡Importación exitosa! {nuevos} contactos creados, {actualizados} actualizados.")
-            return redirect(self.success_url)
-            
-        except Exception as e:
-            messages.error(request, f"Error al procesar el archivo: {str(e)}")
-            return redirect('crm_marketing:import_data')
+
+        # El archivo se procesa en segundo plano por trozos (ver import_jobs.py): la petición responde
+        # de inmediato y la página consulta el progreso con ImportJobStatusAPIView
+        job = ImportJob.objects.create(tipo='CONTACTOS', archivo=excel_file, usuario=request.user)
+        import_runner.programar(job.id)
+        messages.info(request, "Archivo recibido. La importación se está procesando en segundo plano.")
+        return redirect(f"{reverse('crm_marketing:import_data')}?job={job.id}")
 
     def get(self, request, *args, **kwargs):
-        return render(request, self.template_name)
+        trabajos = ImportJob.objects.filter(tipo='CONTACTOS').select_related('usuario')
+        job = trabajos.filter(id=request.GET.get('job')).first() if request.GET.get('job', '').isdigit() else None
+        return render(request, self.template_name, {
+            'job': job,
+            'trabajos': trabajos[:10],
+        })
+
+
+class ImportJobStatusAPIView(GestorCrmMixin, View):
+    """Progreso de un trabajo de importación (la página de importación lo consulta periódicamente)"""
+    def get(self, request, pk, *args, **kwargs):
+        job = get_object_or_404(ImportJob, pk=pk)
+        return JsonResponse({
+            'id': job.id,
+            'estado': job.estado,
+            'total_filas': job.total_filas,
+            'filas_procesadas': job.filas_procesadas,
+            'porcentaje': job.porcentaje,
+            'nuevos': job.nuevos,
+            'actualizados': job.actualizados,
+            'omitidos': job.omitidos,
+            'total_errores': len(job.errores),
+            'mensaje_error': job.mensaje_error or '',
+        })
+
+
+class ImportJobReportView(GestorCrmMixin, View):
+    """Descarga en CSV los errores por fila de un trabajo de importación"""
+    def get(self, request, pk, *args, **kwargs):
+        job = get_object_or_404(ImportJob, pk=pk)
+        response = HttpResponse(content_type='text/csv; charset=utf-8')
+        response['Content-Disposition'] = f'attachment; filename="errores_importacion_{job.id}.csv"'
+        response.write('\ufeff')  # BOM: Excel abre el CSV con tildes correctas
+        writer = csv.writer(response)
+        writer.writerow(['FILA', 'CEDULA', 'MOTIVO'])
+        for error in job.errores:
+            writer.writerow([error.get('fila'), error.get('cedula'), error.get('motivo')])
+        return response
+
+
+class ImportJobResumeView(GestorCrmMixin, View):
+    """Reanuda un trabajo interrumpido (ERROR o sin latido) desde su último trozo confirmado"""
+    def post(self, request, pk, *args, **kwargs):
+        job = get_object_or_404(ImportJob, pk=pk)
+        if job.estado == 'ERROR':
+            # Vuelve a la cola como PENDIENTE; el runner lo reclama sin perder lo ya confirmado
+            ImportJob.objects.filter(id=job.id, estado='ERROR').update(estado='PENDIENTE')
+        import_runner.programar(job.id)
+        messages.info(request, f"Importación #{job.id} reanudada desde la fila {job.filas_procesadas + 2}.")
+        return redirect(f"{reverse('crm_marketing:import_data')}?job={job.id}")
 
 
 from io import BytesIO
@@ -399,7 +304,7 @@ class CampanaCreateView(GestorCrmMixin, CreateView):
     fields = [
         'nombre', 'mensaje_plantilla', 
         'ciudades_objetivo', 'etiquetas_objetivo', 'farmacias_objetivo', 'medicamentos_objetivo',
-        'edad_minima', 'edad_maxima', 'fecha_programada'
+        'edad_minima', 'edad_maxima', 'segmento', 'fecha_programada'
     ]
     success_url = reverse_lazy('crm_marketing:campaign_list')
 
@@ -422,6 +327,7 @@ class CampanaCreateView(GestorCrmMixin, CreateView):
         context['farmacias'] = Farmacia.objects.all()
         context['etiquetas'] = Etiqueta.objects.all()
         context['productos'] = ProductoCRM.objects.all()
+        context['segmentos'] = SegmentoGuardado.objects.all()
         return context
 
 class CampanaDetailView(GestorCrmMixin, DetailView):
@@ -433,7 +339,7 @@ class CampanaDetailView(GestorCrmMixin, DetailView):
         context = super().get_context_data(**kwargs)
         # Inyecta al template los usuarios que pasaron el filtro para previsualizar
         audiencia_qs = self.object.get_audiencia()
-        context['audiencia_total'] = audiencia_qs.count()
+        context['audiencia_total'] = self.object.contar_audiencia()
         context['contactos_preview'] = audiencia_qs[:50] # Mostrar los primeros 50 para no colgar el navegador
         return context
 
@@ -447,7 +353,7 @@ class CampanaUpdateView(GestorCrmMixin, UpdateView):
     fields = [
         'nombre', 'mensaje_plantilla', 
         'ciudades_objetivo', 'etiquetas_objetivo', 'farmacias_objetivo', 'medicamentos_objetivo',
-        'edad_minima', 'edad_maxima', 'fecha_programada'
+        'edad_minima', 'edad_maxima', 'segmento', 'fecha_programada'
     ]
     success_url = reverse_lazy('crm_marketing:campaign_list')
 
@@ -462,6 +368,7 @@ class CampanaUpdateView(GestorCrmMixin, UpdateView):
         context['farmacias'] = Farmacia.objects.all()
         context['etiquetas'] = Etiqueta.objects.all()
         context['productos'] = ProductoCRM.objects.all()
+        context['segmentos'] = SegmentoGuardado.objects.all()
         context['is_update'] = True
         return context
 
@@ -484,35 +391,50 @@ class CampaignPreviewView(GestorCrmMixin, DetailView):
         context = super().get_context_data(**kwargs)
         if self.object.estado != 'BORRADOR':
             messages.warning(self.request, "Esta campaña ya no está en borrador.")
+        # Con un segmento guardado el total sale de la tabla materializada y la muestra recorre sus miembros
         audiencia_qs = self.object.get_audiencia()
-        context['audiencia_total'] = audiencia_qs.count()
+        context['audiencia_total'] = self.object.contar_audiencia()
         context['contactos_preview'] = audiencia_qs[:50]
+        plan = compilar_plantilla(self.object.mensaje_plantilla)
+        primero = audiencia_qs.values('id', *plan.campos).first()
+        context['mensaje_ejemplo'] = plan.renderizar(primero) if primero else None
         return context
 
 class CampaignExecuteView(GestorCrmMixin, View):
     def post(self, request, pk, *args, **kwargs):
         try:
-            campana = CampanaDifusion.objects.get(pk=pk, estado='BORRADOR')
-            audiencia = campana.get_audiencia()
-            
-            mensajes_creados = 0
-            for contacto in audiencia:
-                obj, created = MensajeCampana.objects.get_or_create(
-                    campana=campana,
-                    contacto=contacto,
-                    defaults={'estado': 'PENDIENTE'}
-                )
-                if created: mensajes_creados += 1
-            
-            campana.estado = 'PROGRAMADA'
-            campana.save()
-            
-            messages.success(request, f"🚀 Campaña iniciada. Se han encolado {mensajes_creados} mensajes exitosamente.")
+            campana = CampanaDifusion.objects.get(pk=pk, estado__in=['BORRADOR', 'ENCOLANDO'])
+            if campana.segmento_id and campana.segmento.requiere_recalculo:
+                messages.warning(request, f"El segmento '{campana.segmento.nombre}' aún se está calculando. Intenta de nuevo en unos minutos.")
+                return redirect('crm_marketing:campaign_list')
+            # Inserción en bloque (ver enqueue.py); audiencias grandes se encolan en segundo plano
+            mensajes_creados = encolador.lanzar(campana)
+
+            if mensajes_creados is None:
+                campana.refresh_from_db(fields=['total_audiencia'])
+                messages.info(request, f"⏳ Encolando {campana.total_audiencia} mensajes en segundo plano. La campaña se programará al terminar.")
+            else:
+                messages.success(request, f"🚀 Campaña iniciada. Se han encolado {mensajes_creados} mensajes exitosamente.")
+        except EncoladoEnCurso:
+            campana.refresh_from_db(fields=['total_audiencia', 'audiencia_procesada'])
+            messages.info(request, f"⏳ La campaña ya se está encolando ({campana.audiencia_procesada}/{campana.total_audiencia}). Espera a que termine.")
         except CampanaDifusion.DoesNotExist:
             messages.error(request, "La campaña no existe o ya fue lanzada.")
         
         return redirect('crm_marketing:campaign_list')
 
+
+class CampaignEnqueueStatusAPIView(GestorCrmMixin, View):
+    """Progreso del encolado de una campaña (la lista de campañas lo consulta mientras está ENCOLANDO)"""
+    def get(self, request, pk, *args, **kwargs):
+        campana = get_object_or_404(CampanaDifusion, pk=pk)
+        return JsonResponse({
+            'estado': campana.estado,
+            'total_audiencia': campana.total_audiencia,
+            'audiencia_procesada': campana.audiencia_procesada,
+            'porcentaje': campana.porcentaje_encolado,
+        })
+
 class CampaignReportView(GestorCrmMixin, DetailView):
     model = CampanaDifusion
     template_name = 'crm_marketing/campaign_report.html'
@@ -533,11 +455,108 @@ class CampaignReportView(GestorCrmMixin, DetailView):
         context['errores'] = mensajes.filter(estado='ERROR').count()
         return context
 
+# --- Segmentos Guardados (membresía materializada, ver segment_refresh.py) ---
+class SegmentoListView(GestorCrmMixin, ListView):
+    model = SegmentoGuardado
+    template_name = 'crm_marketing/segment_list.html'
+    context_object_name = 'segmentos'
+
+    def get_queryset(self):
+        return super().get_queryset().select_related('usuario')
+
+
+class SegmentoCreateView(GestorCrmMixin, View):
+    """Guarda los filtros actuales de la lista de contactos como segmento y lo calcula en segundo plano"""
+    def post(self, request, *args, **kwargs):
+        nombre = (request.POST.get('nombre') or '').strip()
+        if not nombre:
+            messages.error(request, "Debes darle un nombre al segmento.")
+            return redirect('crm_marketing:contact_list')
+        if SegmentoGuardado.objects.filter(nombre=nombre).exists():
+            messages.error(request, f"Ya existe un segmento llamado '{nombre}'.")
+            return redirect('crm_marketing:contact_list')
+
+        segmento = SegmentoGuardado.objects.create(
+            nombre=nombre, filtros=FiltroSegmento.desde_params(request.POST).a_dict(), usuario=request.user
+        )
+        refrescador.programar(segmento.pk)
+        messages.success(request, f"Segmento '{nombre}' guardado. Sus miembros se están calculando.")
+        return redirect('crm_marketing:segment_list')
+
+
+class SegmentoRecalcularView(GestorCrmMixin, View):
+    def post(self, request, pk, *args, **kwargs):
+        if SegmentoGuardado.objects.filter(pk=pk).update(requiere_recalculo=True):
+            refrescador.programar(pk)
+            messages.info(request, "Recalculando el segmento en segundo plano.")
+        else:
+            messages.error(request, "El segmento no existe.")
+        return redirect('crm_marketing:segment_list')
+
+
+class SegmentoDeleteView(GestorCrmMixin, View):
+    def post(self, request, pk, *args, **kwargs):
+        from django.db.models import ProtectedError
+        try:
+            SegmentoGuardado.objects.get(pk=pk).delete()
+            messages.success(request, "Segmento eliminado correctamente.")
+        except SegmentoGuardado.DoesNotExist:
+            messages.error(request, "El segmento no existe.")
+        except ProtectedError:
+            messages.error(request, "No se puede eliminar: hay campañas que usan este segmento.")
+        return redirect('crm_marketing:segment_list')
+
+
+class SegmentoStatusAPIView(GestorCrmMixin, View):
+    """Total materializado de un segmento (la lista de segmentos lo consulta mientras se calcula)"""
+    def get(self, request, pk, *args, **kwargs):
+        segmento = get_object_or_404(SegmentoGuardado, pk=pk)
+        return JsonResponse({
+            'total_miembros': segmento.total_miembros,
+            'requiere_recalculo': segmento.requiere_recalculo,
+        })
+
 # --- FASE 11.5: Gestión de Etiquetas CRM ---
 class EtiquetaListView(GestorCrmMixin, ListView):
     model = Etiqueta
     template_name = 'crm_marketing/etiqueta_list.html'
     context_object_name = 'etiquetas'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        operaciones = list(EtiquetadoMasivo.objects.select_related('etiqueta', 'usuario')[:10])
+        # Pendientes o sin latido cuyo proceso se perdió (ej. reinicio del servidor web)
+        reanudables = set(etiquetador.huerfanas().filter(pk__in=[op.pk for op in operaciones]).values_list('pk', flat=True))
+        for op in operaciones:
+            op.reanudable = op.estado == 'ERROR' or op.pk in reanudables
+        context['operaciones'] = operaciones
+        return context
+
+
+class EtiquetadoMasivoResumeView(GestorCrmMixin, View):
+    """Reanuda un etiquetado masivo interrumpido (ERROR, pendiente o sin latido) desde su último lote confirmado"""
+    def post(self, request, pk, *args, **kwargs):
+        job = get_object_or_404(EtiquetadoMasivo, pk=pk)
+        if job.estado == 'ERROR':
+            # Vuelve a la cola como PENDIENTE; el hilo de fondo lo reclama sin rehacer lo ya confirmado
+            EtiquetadoMasivo.objects.filter(pk=job.pk, estado='ERROR').update(estado='PENDIENTE')
+        etiquetador.programar(job.pk)
+        messages.info(request, f"Etiquetado #{job.pk} reanudado tras {job.procesados} de {job.total} contactos.")
+        return redirect('crm_marketing:etiqueta_list')
+
+
+class EtiquetadoMasivoStatusAPIView(GestorCrmMixin, View):
+    """Progreso de un etiquetado masivo (la página de etiquetas lo consulta mientras corre)"""
+    def get(self, request, pk, *args, **kwargs):
+        job = get_object_or_404(EtiquetadoMasivo, pk=pk)
+        return JsonResponse({
+            'estado': job.estado,
+            'total': job.total,
+            'procesados': job.procesados,
+            'afectados': job.afectados,
+            'porcentaje': job.porcentaje,
+            'mensaje_error': job.mensaje_error,
+        })
     
 class EtiquetaCreateView(GestorCrmMixin, CreateView):
     model = Etiqueta
@@ -623,6 +642,8 @@ class PipelineBoardView(GestorCrmMixin, TemplateView):
         context['media_templates'] = CrmMediaTemplate.objects.all()
         context['columnas'] = columnas
         context['dias_seleccionados'] = dias_param
+        from CoreApps.chat.events import sse_habilitado
+        context['chat_events_sse'] = sse_habilitado()
         return context
 
 @method_decorator(csrf_exempt, name='dispatch')
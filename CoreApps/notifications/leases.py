@@ -0,0 +1,94 @@
+"""
+Reclamo de filas con lease para correr varios workers de notificaciones en paralelo sin duplicar envíos.
+
+Un worker reclama filas con SELECT ... FOR UPDATE SKIP LOCKED (otros procesos saltan las bloqueadas
+en vez de esperar) y las marca con su identificador (`reclamado_por`) y una expiración
+(`reclamado_hasta`). Mientras el lease está vigente ningún otro worker las toma; si el proceso muere
+a mitad de un envío, el lease caduca y la fila vuelve a estar disponible (entrega al-menos-una-vez).
+
+Modelos que lo usan: AppointmentReminder y MensajeCampana (campos `reclamado_por`, `reclamado_hasta`).
+Las pausas anti-spam entre envíos de un carril también se comparten entre workers (`reservar_turno`).
+"""
+import os
+import uuid
+import socket
+import datetime
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+
+def nuevo_worker_id():
+    """Identificador único del proceso: host:pid:aleatorio (distinto tras cada reinicio)"""
+    return f"{socket.gethostname()[:60]}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+def disponibles(queryset, ahora=None):
+    """Filas sin lease o con el lease caducado"""
+    ahora = ahora or timezone.now()
+    return queryset.filter(Q(reclamado_hasta__isnull=True) | Q(reclamado_hasta__lt=ahora))
+
+
+def reclamar(queryset, worker_id, cantidad, segundos):
+    """
+    Reclama hasta `cantidad` filas del queryset (en su orden) para `worker_id` durante `segundos`.
+    Devuelve la lista de ids reclamados.
+    """
+    ahora = timezone.now()
+    # FOR UPDATE OF: no bloquear las filas de las tablas del JOIN (p. ej. la campaña) donde se soporte
+    of = ('self',) if connection.features.has_select_for_update_of else ()
+    with transaction.atomic():
+        ids = list(
+            disponibles(queryset, ahora)
+            .select_for_update(skip_locked=True, of=of)
+            .values_list('id', flat=True)[:cantidad]
+        )
+        if ids:
+            queryset.model.objects.filter(id__in=ids).update(
+                reclamado_por=worker_id,
+                reclamado_hasta=ahora + datetime.timedelta(seconds=segundos)
+            )
+    return ids
+
+
+def cerrar(instancia, worker_id, **campos):
+    """
+    Guarda el resultado del envío y suelta el lease, solo si el lease sigue siendo de este worker.
+    Devuelve False si otro worker lo reclamó tras caducar (el resultado se descarta).
+    """
+    campos = {'reclamado_por': None, 'reclamado_hasta': None, **campos}
+    if 'fecha_actualizacion' in {f.name for f in instancia._meta.fields}:
+        campos['fecha_actualizacion'] = timezone.now()  # .update() no dispara auto_now
+    actualizadas = type(instancia).objects.filter(id=instancia.id, reclamado_por=worker_id).update(**campos)
+    for campo, valor in campos.items():
+        setattr(instancia, campo, valor)
+    return bool(actualizadas)
+
+
+def liberar(modelo, worker_id):
+    """Suelta todos los leases de este worker (apagado ordenado)"""
+    return modelo.objects.filter(reclamado_por=worker_id).update(reclamado_por=None, reclamado_hasta=None)
+
+
+def reencolar_caducados(modelo):
+    """Limpia los leases caducados de workers caídos; devuelve cuántas filas vuelven a la cola"""
+    return modelo.objects.filter(
+        reclamado_por__isnull=False, reclamado_hasta__lt=timezone.now()
+    ).update(reclamado_por=None, reclamado_hasta=None)
+
+
+def reservar_turno(carril, segundos):
+    """
+    Pausa mínima entre envíos de un carril, común a todos los workers (fila de TurnoEnvio bloqueada).
+    Devuelve 0 si este worker obtuvo el turno (el siguiente queda a `segundos`) o los segundos que faltan.
+    """
+    from .models import TurnoEnvio
+    TurnoEnvio.objects.get_or_create(carril=carril)
+    with transaction.atomic():
+        turno = TurnoEnvio.objects.select_for_update().get(carril=carril)
+        ahora = timezone.now()
+        if turno.siguiente and turno.siguiente > ahora:
+            return (turno.siguiente - ahora).total_seconds()
+        turno.siguiente = ahora + datetime.timedelta(seconds=segundos)
+        turno.save(update_fields=['siguiente'])
+    return 0
@@ -1,211 +1,194 @@
-import time
+import signal
 import datetime
+from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.db import close_old_connections
 from django.utils import timezone
 from CoreApps.appointments.models import AppointmentReminder
 from CoreApps.notifications.models import NotificationLog
 from CoreApps.notifications.services import WASenderService
+from CoreApps.notifications.wasender_client import wasender
+from CoreApps.notifications.scheduler import LaneScheduler
+from CoreApps.notifications import leases
+
+# Prioridades de los carriles (menor = se atiende primero cuando varios están listos)
+PRIORIDAD_RECORDATORIOS = 0
+PRIORIDAD_CAMPANAS = 1
+PRIORIDAD_MANTENIMIENTO = 2
+
 
 class Command(BaseCommand):
-    help = 'Worker unificado que envía recordatorios a pacientes un día antes.'
+    help = 'Worker unificado que envía recordatorios a pacientes un día antes y las campañas de difusión.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--worker-id', default=None, help='Identificador del worker para los leases (por defecto host:pid:aleatorio)')
+        parser.add_argument('--lease-segundos', type=int, default=None, help='Duración del lease de cada envío reclamado')
 
     def handle(self, *args, **options):
-        self.stdout.write(self.style.SUCCESS('✅ [Worker] Iniciando servicio de notificaciones...'))
-        
+        from CoreApps.crm_marketing.dispatcher import CampaignDispatcher
+        from CoreApps.crm_marketing.models import MensajeCampana
+
+        # Varios workers pueden correr a la vez: cada fila se reclama con un lease (SKIP LOCKED)
+        self.worker_id = options['worker_id'] or leases.nuevo_worker_id()
+        self.lease_segundos = options['lease_segundos'] or getattr(settings, 'WORKER_LEASE_SEGUNDOS', 300)
+        self.stdout.write(self.style.SUCCESS(f'✅ [Worker {self.worker_id}] Iniciando servicio de notificaciones...'))
+
+        # Pausa anti-spam entre recordatorios: un turno compartido por todos los workers, no un sleep
+        self.intervalo_recordatorios = getattr(settings, 'WORKER_RECORDATORIOS_INTERVALO', 300)
+        self.reintento_fallidos = getattr(settings, 'WORKER_RECORDATORIOS_REINTENTO', 1800)
+
+        self.scheduler = LaneScheduler(al_fallar=self._reportar_error)
+        self.dispatcher = CampaignDispatcher(
+            self.stdout, self.style,
+            al_liberar=lambda: self.scheduler.programar('campanas', 0),
+            worker_id=self.worker_id, lease_segundos=self.lease_segundos
+        )
+        self.scheduler.agregar('recordatorios', PRIORIDAD_RECORDATORIOS, self._carril_recordatorios, intervalo_inactivo=30)
+        self.scheduler.agregar('campanas', PRIORIDAD_CAMPANAS, self._carril_campanas, intervalo_inactivo=30)
+        self.scheduler.agregar('mantenimiento', PRIORIDAD_MANTENIMIENTO, self._carril_mantenimiento, intervalo_inactivo=60)
+
+        # SIGTERM (systemd / supervisor): terminar el paso en curso y apagar ordenadamente
+        self.detenido = False
+        signal.signal(signal.SIGTERM, self._detener)
         try:
-            while True:
-                # 1. Definir Fechas Clave (Zona Horaria Local del Server)
-                ahora = timezone.now()
-                ahora_local = timezone.localtime(ahora)
-                hoy = ahora_local.date()
-                manana = hoy + datetime.timedelta(days=1)
-                
-                # Formato log
-                prefix = f"[{ahora_local.strftime('%d/%m/%Y %H:%M')}]"
-
-                try:
-                    # =================================================================
-                    # FASE 1: LIMPIEZA DE EXPIRADOS (Mantenimiento)
-                    # =================================================================
-                    # Si un recordatorio PENDIENTE tiene fecha menor a hoy, ya expiró.
-                    expirados = AppointmentReminder.objects.filter(
-                        estado='PENDIENTE',
-                        fecha_limite_sugerida__lt=hoy
-                    )
-                    count_exp = expirados.count()
-                    if count_exp > 0:
-                        expirados.update(estado='EXPIRADO')
-                        self.stdout.write(f"{prefix} 🧹 Limpieza: {count_exp} recordatorios marcados como EXPIRADO.")
-
-                    hubo_actividad = False
-
-                    # =================================================================
-                    # FASE 2: DETECCCION DE COLA (Pendientes para Mañana)
-                    # =================================================================
-                    cola_envio = AppointmentReminder.objects.filter(
-                        fecha_limite_sugerida=manana,
-                        estado__in=['PENDIENTE', 'FALLO_ENVIO'] 
-                    ).order_by('id')
-
-                    total_cola = cola_envio.count()
-
-                    if total_cola > 0:
-                        self.stdout.write(f"{prefix} 📨 Encolados para mañana ({manana}): {total_cola} mensajes.")
-                        hubo_actividad = True
-                        
-                        # Para no bloquear, solo procesamos los recordatorios uno a uno con sleep
-                        for recordatorio in cola_envio:
-                            paciente = recordatorio.paciente
-                            telefono = paciente.telefono
-                            nombre = f"{paciente.first_name}"
-                            tema = str(recordatorio)
-                            
-                            mensaje = f"👋 Hola {nombre}, te recordamos que mañana cumple la fecha para: *{tema}*.\n\n"
-                            mensaje += "Por favor, contáctanos para agendar tu visita o coordinar el servicio.\n"
-                            mensaje += "Somos Hola Enfermera 💙."
-
-                            self.stdout.write(f"   👉 Procesando Recordatorio: {paciente}...")
-
-                            exito = False
-                            respuesta = ""
-                            
-                            try:
-                                resp_service = WASenderService.send_message(telefono, mensaje)
-                                exito = True
-                                respuesta = str(resp_service)
-                            except Exception as e:
-                                exito = False
-                                respuesta = f"Error: {str(e)}"
-                                self.stdout.write(self.style.ERROR(f"      ❌ Fallo envío: {e}"))
-
-                            if exito:
-                                recordatorio.estado = 'CONTACTADO'
-                                recordatorio.save()
-                                self.stdout.write(self.style.SUCCESS(f"      ✅ Recordatorio Enviado."))
-                            else:
-                                recordatorio.estado = 'FALLO_ENVIO' 
-                                recordatorio.save()
-
-                            NotificationLog.objects.create(
-                                recordatorio=recordatorio,
-                                enviado=exito,
-                                respuesta_api=respuesta
-                            )
-
-                            self.stdout.write(f"      ⏳ Esperando 5 minutos (Recordatorios)...")
-                            time.sleep(300) 
-                    
-                    # =================================================================
-                    # FASE 3: DETECCIÓN DE CAMPAÑAS DE MARKETING
-                    # =================================================================
-                    from django.db.models import Q
-                    from CoreApps.crm_marketing.models import MensajeCampana
-
-                    campanas_activas = MensajeCampana.objects.filter(
-                        estado='PENDIENTE',
-                        campana__estado__in=['PROGRAMADA', 'ENVIANDO']
-                    ).filter(
-                        Q(campana__fecha_programada__isnull=True) | Q(campana__fecha_programada__lte=ahora)
-                    ).order_by('id')
-
-                    total_campanas = campanas_activas.count()
-                    
-                    if total_campanas > 0:
-                        hubo_actividad = True
-                        self.stdout.write(f"{prefix} 📢 Campañas en cola: {total_campanas} mensajes pendientes.")
-                        
-                        # Procesamos solo de 10 en 10 para volver rápido a revisar si hay recordatorios médicos
-                        lote = campanas_activas[:10]
-                        for msg in lote:
-                            # Marcar campaña general como enviando
-                            if msg.campana.estado != 'ENVIANDO':
-                                msg.campana.estado = 'ENVIANDO'
-                                msg.campana.save(update_fields=['estado'])
-                            
-                            telefono = msg.contacto.telefono
-                            plantilla = msg.campana.mensaje_plantilla
-                            
-                            # Reemplazos dinámicos avanzados
-                            datos_contacto = {
-                                '{nombres}': msg.contacto.nombres or '',
-                                '{apellidos}': msg.contacto.apellidos or '',
-                                '{ciudad}': msg.contacto.ciudad.nombre if msg.contacto.ciudad else '',
-                                '{farmacia}': msg.contacto.farmacia_origen.nombre if msg.contacto.farmacia_origen else '',
-                                '{telefono}': msg.contacto.telefono or '',
-                            }
-                            
-                            texto_final = plantilla
-                            for tag, valor in datos_contacto.items():
-                                if tag in texto_final:
-                                    texto_final = texto_final.replace(tag, valor)
-                            
-                            self.stdout.write(f"   👉 Campaña ({msg.campana.nombre}) a {telefono}...")
-                            
-                            exito = False
-                            try:
-                                resp_service = WASenderService.send_message(telefono, texto_final)
-                                if isinstance(resp_service, dict):
-                                    exito = True
-                                    try:
-                                        msg.wasender_message_id = resp_service.get('data', {}).get('key', {}).get('id', '')
-                                    except:
-                                        pass
-                                elif resp_service == True:
-                                    exito = True
-                            except Exception as e:
-                                msg.error_log = str(e)
-                            
-                            if exito:
-                                msg.estado = 'ENVIADO'
-                                self.stdout.write(self.style.SUCCESS(f"      ✅ Masivo Enviado."))
-                                
-                                # --- NUEVO: Sincronizar con el historial de Chat CRM ---
-                                try:
-                                    import uuid
-                                    from CoreApps.chat.models import ChatMensaje
-                                    
-                                    w_id = msg.wasender_message_id
-                                    if not w_id:
-                                        w_id = f"local_camp_{uuid.uuid4().hex[:12]}"
-                                        
-                                    ChatMensaje.objects.create(
-                                        contacto=msg.contacto,
-                                        direccion='OUTBOUND',
-                                        texto=texto_final,
-                                        wasender_message_id=w_id,
-                                        estado_envio='ENVIADO'
-                                    )
-                                except Exception as e_sync:
-                                    self.stdout.write(self.style.ERROR(f"      ⚠️ Error sincronizando chat: {e_sync}"))
-                                # ------------------------------------------------------
-                            else:
-                                msg.estado = 'ERROR'
-                                self.stdout.write(self.style.ERROR(f"      ❌ Masivo Fallido."))
-                            
-                            msg.save()
-                            
-                            # Retardo anti-spam de campañas (Más corto porque son muchos)
-                            self.stdout.write(f"      ⏳ Esperando 25s (Anti-Spam)...")
-                            time.sleep(25)
-                            
-                        # Actualizar estado a COMPLETADA si ya no hay pendientes
-                        for c in set([m.campana for m in lote]):
-                            restantes = MensajeCampana.objects.filter(campana=c, estado='PENDIENTE').count()
-                            if restantes == 0:
-                                c.estado = 'COMPLETADA'
-                                c.save(update_fields=['estado'])
-                                self.stdout.write(self.style.SUCCESS(f"🎯 Campaña '{c.nombre}' FINALIZADA."))
-
-                    # =================================================================
-                    # REPOSO
-                    # =================================================================
-                    if not hubo_actividad:
-                        self.stdout.write(f"{prefix} 💤 Nada pendiente (Recordatorios o Campañas). Durmiendo 30 segundos...")
-                        time.sleep(30)
-
-                except Exception as e:
-                    self.stdout.write(self.style.ERROR(f"🔥 CRITICAL ERROR EN WORKER: {e}"))
-                    time.sleep(60)
-
+            self.scheduler.correr(detener=lambda: self.detenido)
+            self.stdout.write(self.style.WARNING('🛑 Worker detenido (SIGTERM).'))
         except KeyboardInterrupt:
             self.stdout.write(self.style.WARNING('\n🛑 Worker detenido por el usuario (Ctrl+C).'))
+        finally:
+            # Si el proceso muere sin llegar aquí, los leases caducan solos y otro worker retoma las filas
+            self.dispatcher.detener()
+            leases.liberar(AppointmentReminder, self.worker_id)
+            leases.liberar(MensajeCampana, self.worker_id)
+
+    def _detener(self, signum, frame):
+        self.detenido = True
+        self.scheduler.despertar()
+
+    def _prefix(self):
+        return f"[{timezone.localtime().strftime('%d/%m/%Y %H:%M')}]"
+
+    def _reportar_error(self, carril, error):
+        self.stdout.write(self.style.ERROR(f"🔥 CRITICAL ERROR EN WORKER (carril {carril.nombre}): {error}"))
+        close_old_connections()
+
+    # =================================================================
+    # CARRIL 1: RECORDATORIOS MÉDICOS (Pendientes para Mañana)
+    # =================================================================
+    def _carril_recordatorios(self):
+        """Envía UN recordatorio y devuelve la pausa anti-spam hasta el siguiente"""
+        close_old_connections()
+        manana = timezone.localdate() + datetime.timedelta(days=1)
+
+        # Pendientes primero; los fallidos vuelven a la cola cuando vence su espera de reintento
+        cola = AppointmentReminder.objects.filter(
+            fecha_limite_sugerida=manana,
+            estado__in=['PENDIENTE', 'FALLO_ENVIO']
+        ).order_by('-estado', 'id')
+        if not leases.disponibles(cola).exists():
+            return None
+        # La pausa es de la cuenta, no del proceso: con N workers sigue saliendo uno cada intervalo
+        espera = leases.reservar_turno('recordatorios', self.intervalo_recordatorios)
+        if espera:
+            return espera
+
+        ids = leases.reclamar(cola, self.worker_id, 1, self.lease_segundos)
+        if not ids:
+            return None
+        recordatorio = AppointmentReminder.objects.select_related('paciente').get(id=ids[0])
+
+        paciente = recordatorio.paciente
+        telefono = paciente.telefono
+        nombre = f"{paciente.first_name}"
+        tema = str(recordatorio)
+
+        mensaje = f"👋 Hola {nombre}, te recordamos que mañana cumple la fecha para: *{tema}*.\n\n"
+        mensaje += "Por favor, contáctanos para agendar tu visita o coordinar el servicio.\n"
+        mensaje += "Somos Hola Enfermera 💙."
+
+        self.stdout.write(f"{self._prefix()} 👉 Procesando Recordatorio para mañana ({manana}): {paciente}...")
+
+        exito = False
+        respuesta = ""
+
+        try:
+            resp_service = WASenderService.send_message(telefono, mensaje)
+            exito = True
+            respuesta = str(resp_service)
+        except Exception as e:
+            exito = False
+            respuesta = f"Error: {str(e)}"
+            self.stdout.write(self.style.ERROR(f"      ❌ Fallo envío: {e}"))
+
+        if exito:
+            leases.cerrar(recordatorio, self.worker_id, estado='CONTACTADO')
+            self.stdout.write(self.style.SUCCESS(f"      ✅ Recordatorio Enviado."))
+        else:
+            # Sin dueño pero con `reclamado_hasta` futuro: ningún worker lo reintenta antes de tiempo
+            leases.cerrar(
+                recordatorio, self.worker_id, estado='FALLO_ENVIO',
+                reclamado_hasta=timezone.now() + datetime.timedelta(seconds=self.reintento_fallidos)
+            )
+
+        NotificationLog.objects.create(
+            recordatorio=recordatorio,
+            enviado=exito,
+            respuesta_api=respuesta
+        )
+        return self.intervalo_recordatorios
+
+    # =================================================================
+    # CARRIL 2: CAMPAÑAS DE MARKETING
+    # =================================================================
+    def _carril_campanas(self):
+        # Ritmo y concurrencia según CrmConfig (token bucket del dispatcher)
+        close_old_connections()
+        return self.dispatcher.paso(timezone.now())
+
+    # =================================================================
+    # CARRIL 3: LIMPIEZA DE EXPIRADOS Y ESTADO DE COLAS (Mantenimiento)
+    # =================================================================
+    def _carril_mantenimiento(self):
+        close_old_connections()
+        prefix = self._prefix()
+        hoy = timezone.localdate()
+
+        # Si un recordatorio PENDIENTE tiene fecha menor a hoy, ya expiró.
+        count_exp = AppointmentReminder.objects.filter(
+            estado='PENDIENTE',
+            fecha_limite_sugerida__lt=hoy
+        ).update(estado='EXPIRADO')
+        if count_exp > 0:
+            self.stdout.write(f"{prefix} 🧹 Limpieza: {count_exp} recordatorios marcados como EXPIRADO.")
+
+        # Leases caducados de workers caídos: esas filas vuelven a la cola
+        from CoreApps.crm_marketing.models import MensajeCampana
+        huerfanos = leases.reencolar_caducados(AppointmentReminder) + leases.reencolar_caducados(MensajeCampana)
+        if huerfanos:
+            self.stdout.write(f"{prefix} 🧹 {huerfanos} envíos huérfanos (lease caducado) reencolados.")
+
+        # Campañas cuyo encolado quedó a medias (proceso web reiniciado): se terminan en un hilo de este worker
+        from CoreApps.crm_marketing.enqueue import encolador
+        retomadas = encolador.retomar_huerfanas()
+        if retomadas:
+            self.stdout.write(f"{prefix} 🧹 {retomadas} campañas con el encolado interrumpido retomadas.")
+
+        total_cola = AppointmentReminder.objects.filter(
+            fecha_limite_sugerida=hoy + datetime.timedelta(days=1),
+            estado__in=['PENDIENTE', 'FALLO_ENVIO']
+        ).count()
+        total_campanas = self.dispatcher.pendientes(timezone.now()).count()
+
+        if total_cola or total_campanas:
+            self.stdout.write(
+                f"{prefix} 📨 Recordatorios para mañana: {total_cola} | "
+                f"📢 Campañas en cola: {total_campanas} ({self.dispatcher.en_vuelo()} enviándose)"
+            )
+        else:
+            self.stdout.write(f"{prefix} 💤 Nada pendiente (Recordatorios o Campañas).")
+
+        # Latencias de WASender de este proceso desde el último resumen
+        if wasender.resumen_pendiente():
+            for linea in wasender.resumen():
+                self.stdout.write(f"{prefix} 📈 {linea}")
+        return None
@@ -0,0 +1,20 @@
+# Generated by Django 6.0 on 2026-10-18 17:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notifications', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TurnoEnvio',
+            fields=[
+                ('carril', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('siguiente', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
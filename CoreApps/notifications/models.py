@@ -14,3 +14,15 @@ class NotificationLog(models.Model):
     def __str__(self):
         estado = "Enviado" if self.enviado else "Fallo"
         return f"{self.fecha_intento.strftime('%Y-%m-%d %H:%M')} - {estado} - {self.recordatorio.paciente}"
+
+
+class TurnoEnvio(models.Model):
+    """
+    Próximo envío permitido de un carril con pausa anti-spam (ej. recordatorios), compartido por
+    todos los workers: se reserva bajo select_for_update (ver leases.reservar_turno).
+    """
+    carril = models.CharField(max_length=50, primary_key=True)
+    siguiente = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.carril}: {self.siguiente}"
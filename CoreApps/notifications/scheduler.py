@@ -0,0 +1,104 @@
+"""
+Planificador por carriles del worker de notificaciones (`whatsapp_worker_holaenfermera`).
+
+Cada carril (recordatorios, campañas, mantenimiento) es una tarea que hace UNA unidad de trabajo
+y devuelve cuándo quiere volver a ejecutarse. Las pausas de ritmo (anti-spam) son temporizadores
+en un heap de próximos instantes, no sleeps bloqueantes: mientras un carril espera su turno los
+demás siguen avanzando. Si varios carriles están listos a la vez gana el de menor prioridad
+numérica, así los recordatorios médicos siempre adelantan al tráfico de marketing.
+"""
+import time
+import heapq
+import logging
+import itertools
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class Carril:
+
+    def __init__(self, nombre, prioridad, tarea, intervalo_inactivo=30, espera_error=60):
+        self.nombre = nombre
+        self.prioridad = prioridad
+        self.tarea = tarea
+        self.intervalo_inactivo = intervalo_inactivo
+        self.espera_error = espera_error
+        self.proximo = None
+
+
+class LaneScheduler:
+
+    def __init__(self, espera_maxima=30, al_fallar=None):
+        self.espera_maxima = espera_maxima
+        self.al_fallar = al_fallar  # callback(carril, excepcion) para reportar errores de una tarea
+        self._heap = []  # (instante, prioridad, desempate, carril)
+        self._contador = itertools.count()
+        self._carriles = {}
+        self._lock = threading.Lock()
+        self._despertar = threading.Event()
+
+    def agregar(self, nombre, prioridad, tarea, **kwargs):
+        """
+        `tarea()` devuelve los segundos hasta su próxima ejecución (0 = en cuanto le toque),
+        o None si no tenía trabajo (se vuelve a consultar tras `intervalo_inactivo`).
+        """
+        carril = Carril(nombre, prioridad, tarea, **kwargs)
+        self._carriles[nombre] = carril
+        self.programar(nombre, 0)
+        return carril
+
+    def programar(self, nombre, segundos):
+        """Reprograma el carril; thread-safe (p. ej. un hilo de envío que libera un cupo)"""
+        carril = self._carriles[nombre]
+        instante = time.monotonic() + max(segundos, 0)
+        with self._lock:
+            carril.proximo = instante
+            heapq.heappush(self._heap, (instante, carril.prioridad, next(self._contador), carril))
+        self._despertar.set()
+
+    def despertar(self):
+        """Interrumpe la espera en curso (p. ej. para atender una señal de apagado)"""
+        self._despertar.set()
+
+    def _tomar_listo(self):
+        """Saca del heap el carril listo de mayor prioridad, o devuelve la espera hasta el siguiente"""
+        with self._lock:
+            ahora = time.monotonic()
+            listos = []
+            while self._heap and self._heap[0][0] <= ahora:
+                entrada = heapq.heappop(self._heap)
+                if entrada[3].proximo == entrada[0]:  # Las entradas reprogramadas quedan obsoletas
+                    listos.append(entrada)
+            if not listos:
+                return None, (self._heap[0][0] - ahora if self._heap else self.espera_maxima)
+            listos.sort(key=lambda e: (e[1], e[0]))
+            for entrada in listos[1:]:
+                heapq.heappush(self._heap, entrada)
+            carril = listos[0][3]
+            carril.proximo = None
+            return carril, 0
+
+    def ejecutar_siguiente(self):
+        self._despertar.clear()  # Antes de mirar el heap: una reprogramación concurrente no se pierde
+        carril, espera = self._tomar_listo()
+        if carril is None:
+            self._despertar.wait(min(espera, self.espera_maxima))
+            return None
+        try:
+            siguiente = carril.tarea()
+            if siguiente is None:
+                siguiente = carril.intervalo_inactivo
+        except Exception as e:
+            logger.exception(f"Error en el carril '{carril.nombre}'")
+            if self.al_fallar:
+                self.al_fallar(carril, e)
+            siguiente = carril.espera_error
+        # Un despertar externo durante la tarea ya pudo reprogramarlo antes
+        if carril.proximo is None:
+            self.programar(carril.nombre, siguiente)
+        return carril
+
+    def correr(self, detener=lambda: False):
+        while not detener():
+            self.ejecutar_siguiente()
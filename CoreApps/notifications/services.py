@@ -4,12 +4,12 @@ from django.template.loader import render_to_string
 from django.utils.html import strip_tags
 import logging
 
-import requests
 import json
 import re
 import os
 import mimetypes
 from django.conf import settings
+from .wasender_client import wasender
 
 logger = logging.getLogger(__name__)
 
@@ -83,7 +83,7 @@ class WASenderService:
             with open(file_path, 'rb') as f:
                 raw_headers = headers.copy()
                 raw_headers['Content-Type'] = mime_type
-                response = requests.post(api_url, headers=raw_headers, data=f, timeout=60)
+                response = wasender.post('upload', api_url, headers=raw_headers, data=f, idempotent=True)
                 
             print(f"📡 [WASender-Upload] Status: {response.status_code}")
             response.raise_for_status()
@@ -161,7 +161,7 @@ class WASenderService:
         print(f"📦 Payload Híbrido: {json.dumps(payload, indent=2)}")
 
         try:
-            response = requests.post(api_url, headers=headers, json=payload, timeout=30)
+            response = wasender.post('send', api_url, headers=headers, json=payload, timeout=(5, 30))
             print(f"📡 [WASender-SendMedia] Status: {response.status_code}")
             print(f"📄 Respuesta: {response.text}")
             response.raise_for_status()
@@ -224,7 +224,7 @@ class WASenderService:
         }
         
         try:
-            response = requests.post(api_url, headers=headers, json=payload, timeout=20)
+            response = wasender.post('send', api_url, headers=headers, json=payload)
             response.raise_for_status()
             return response.json()
         except Exception as e:
@@ -275,7 +275,7 @@ class WASenderService:
         print(f"Header Auth: Bearer {api_key[:10]}...")
         
         try:
-            response = requests.post(api_url, headers=headers, json=payload, timeout=20)
+            response = wasender.post('send', api_url, headers=headers, json=payload)
             
             # --- DEBUG RESPUESTA ---
             print(f"📡 STATUS CODE: {response.status_code}")
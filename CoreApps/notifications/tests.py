@@ -1,3 +1,82 @@
+import datetime
 from django.test import TestCase
+from django.utils import timezone
 
-# Create your tests here.
+from CoreApps.crm_marketing.models import CrmContact, CampanaDifusion, MensajeCampana
+from . import leases
+from .models import TurnoEnvio
+
+
+class LeasesTests(TestCase):
+    """Reclamo de filas con lease entre workers (MensajeCampana como modelo de prueba)"""
+
+    def setUp(self):
+        campana = CampanaDifusion.objects.create(nombre='Prueba', mensaje_plantilla='Hola', estado='PROGRAMADA')
+        self.mensajes = [
+            MensajeCampana.objects.create(
+                campana=campana,
+                contacto=CrmContact.objects.create(nombres=f'C{i}', apellidos='X', telefono=f'+59399000000{i}')
+            )
+            for i in range(3)
+        ]
+        self.cola = MensajeCampana.objects.filter(estado='PENDIENTE').order_by('id')
+
+    def _caducar(self, ids):
+        MensajeCampana.objects.filter(id__in=ids).update(reclamado_hasta=timezone.now() - datetime.timedelta(seconds=1))
+
+    def test_un_worker_no_toma_lo_reclamado_por_otro(self):
+        primeros = leases.reclamar(self.cola, 'w1', 2, 60)
+        segundos = leases.reclamar(self.cola, 'w2', 2, 60)
+
+        self.assertEqual(primeros, [m.id for m in self.mensajes[:2]])
+        self.assertEqual(segundos, [self.mensajes[2].id])
+        self.assertEqual(leases.reclamar(self.cola, 'w3', 2, 60), [])
+        self.assertFalse(leases.disponibles(self.cola).exists())
+
+    def test_lease_caducado_vuelve_a_estar_disponible(self):
+        ids = leases.reclamar(self.cola, 'w1', 3, 60)
+        self._caducar(ids[:1])
+
+        self.assertEqual(list(leases.disponibles(self.cola).values_list('id', flat=True)), ids[:1])
+        self.assertEqual(leases.reclamar(self.cola, 'w2', 3, 60), ids[:1])
+
+    def test_cerrar_descarta_el_resultado_de_un_lease_perdido(self):
+        ids = leases.reclamar(self.cola, 'w1', 1, 60)
+        self._caducar(ids)
+        leases.reclamar(self.cola, 'w2', 1, 60)
+
+        mensaje = MensajeCampana.objects.get(id=ids[0])
+        self.assertFalse(leases.cerrar(mensaje, 'w1', estado='ENVIADO'))
+        mensaje.refresh_from_db()
+        self.assertEqual((mensaje.estado, mensaje.reclamado_por), ('PENDIENTE', 'w2'))
+
+        self.assertTrue(leases.cerrar(mensaje, 'w2', estado='ENVIADO'))
+        mensaje.refresh_from_db()
+        self.assertEqual(mensaje.estado, 'ENVIADO')
+        self.assertIsNone(mensaje.reclamado_por)
+
+    def test_reencolar_caducados_y_liberar(self):
+        ids = leases.reclamar(self.cola, 'w1', 2, 60)
+        leases.reclamar(self.cola, 'w2', 1, 60)
+        self._caducar(ids[:1])
+
+        self.assertEqual(leases.reencolar_caducados(MensajeCampana), 1)
+        self.assertEqual(leases.liberar(MensajeCampana, 'w1'), 1)
+        self.assertEqual(list(MensajeCampana.objects.filter(reclamado_por__isnull=False).values_list('reclamado_por', flat=True)), ['w2'])
+
+
+class TurnoEnvioTests(TestCase):
+    """Pausa anti-spam de un carril compartida entre workers"""
+
+    def test_un_solo_turno_por_pausa(self):
+        self.assertEqual(leases.reservar_turno('recordatorios', 300), 0)
+        espera = leases.reservar_turno('recordatorios', 300)
+        self.assertGreater(espera, 290)
+        self.assertLessEqual(espera, 300)
+        # Los carriles no comparten turno
+        self.assertEqual(leases.reservar_turno('otro', 300), 0)
+
+    def test_turno_vencido_se_vuelve_a_dar(self):
+        leases.reservar_turno('recordatorios', 300)
+        TurnoEnvio.objects.filter(carril='recordatorios').update(siguiente=timezone.now() - datetime.timedelta(seconds=1))
+        self.assertEqual(leases.reservar_turno('recordatorios', 300), 0)
@@ -0,0 +1,169 @@
+"""
+Cliente HTTP compartido para WASenderAPI.
+
+Una sola requests.Session con pool de conexiones keep-alive (se reutiliza el TLS entre envíos),
+timeouts (conexión, lectura) por tipo de endpoint, reintentos con backoff exponencial + jitter
+y un histograma de latencias por endpoint para diagnóstico (`wasender.metricas()`).
+El histograma es del proceso: los comandos de larga duración (worker de notificaciones, consumidor de la
+bandeja) vuelcan `wasender.resumen()` en su salida cada WASENDER_METRICAS_INTERVALO segundos.
+
+Política de reintentos:
+- 429 (rate limit) y timeouts de conexión: siempre (la petición no llegó a procesarse).
+- 5xx y errores de red a mitad de petición: solo en llamadas idempotentes (decrypt, descarga, upload).
+  Un envío de mensaje NO se reintenta ante un 5xx para no duplicar el WhatsApp al paciente.
+"""
+import time
+import random
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# (timeout de conexión, timeout de lectura) en segundos por tipo de endpoint
+TIMEOUTS = {
+    'send': (5, 20),
+    'upload': (5, 60),
+    'decrypt': (5, 15),
+    'download': (5, 30),
+    'default': (5, 20),
+}
+
+# Límites superiores (ms) de los buckets del histograma de latencia
+BUCKETS_MS = [50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+
+
+class WASenderClient:
+
+    def __init__(self):
+        self.intervalo_metricas = getattr(settings, 'WASENDER_METRICAS_INTERVALO', 900)
+        self.pool_size = getattr(settings, 'WASENDER_HTTP_POOL_SIZE', 10)
+        self.max_reintentos = getattr(settings, 'WASENDER_HTTP_MAX_RETRIES', 3)
+        self.backoff_base = getattr(settings, 'WASENDER_HTTP_BACKOFF', 0.5)
+        self.timeouts = {**TIMEOUTS, **getattr(settings, 'WASENDER_HTTP_TIMEOUTS', {})}
+        self._session = None
+        self._lock = threading.Lock()
+        self._histogramas = {}
+        self._ultimo_resumen = time.monotonic()
+
+    @property
+    def session(self):
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self._session = session
+        return self._session
+
+    def post(self, endpoint, url, idempotent=False, **kwargs):
+        return self.request('POST', endpoint, url, idempotent=idempotent, **kwargs)
+
+    def get(self, endpoint, url, idempotent=True, **kwargs):
+        return self.request('GET', endpoint, url, idempotent=idempotent, **kwargs)
+
+    def request(self, method, endpoint, url, idempotent=False, **kwargs):
+        """
+        Ejecuta la petición con el timeout del endpoint y la política de reintentos.
+        Devuelve el Response (incluso de error HTTP) o lanza la excepción de red del último intento.
+        """
+        kwargs.setdefault('timeout', self.timeouts.get(endpoint, self.timeouts['default']))
+        cuerpo = kwargs.get('data')
+        intento = 0
+        while True:
+            intento += 1
+            if intento > 1 and hasattr(cuerpo, 'seek'):
+                cuerpo.seek(0)  # Subidas de archivo: se re-envía desde el principio
+            inicio = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.exceptions.ConnectTimeout as e:
+                self._registrar(endpoint, inicio, 'error')
+                if intento > self.max_reintentos:
+                    raise
+                self._esperar(endpoint, intento, e)
+                continue
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                self._registrar(endpoint, inicio, 'error')
+                if not idempotent or intento > self.max_reintentos:
+                    raise
+                self._esperar(endpoint, intento, e)
+                continue
+
+            self._registrar(endpoint, inicio, response.status_code)
+            reintentable = response.status_code == 429 or (idempotent and response.status_code >= 500)
+            if not reintentable or intento > self.max_reintentos:
+                return response
+            response.close()
+            self._esperar(endpoint, intento, f"HTTP {response.status_code}", response.headers.get('Retry-After'))
+
+    def _esperar(self, endpoint, intento, motivo, retry_after=None):
+        espera = self.backoff_base * (2 ** (intento - 1)) * random.uniform(0.5, 1.5)
+        if retry_after and str(retry_after).isdigit():
+            espera = max(espera, min(int(retry_after), 30))
+        logger.warning(f"WASender [{endpoint}] reintento {intento}/{self.max_reintentos} en {espera:.1f}s: {motivo}")
+        time.sleep(espera)
+
+    # --- Métricas ---
+
+    def _registrar(self, endpoint, inicio, resultado):
+        ms = (time.perf_counter() - inicio) * 1000
+        with self._lock:
+            h = self._histogramas.setdefault(endpoint, {
+                'buckets': [0] * (len(BUCKETS_MS) + 1), 'count': 0, 'sum_ms': 0.0, 'max_ms': 0.0, 'resultados': {}
+            })
+            indice = next((i for i, limite in enumerate(BUCKETS_MS) if ms <= limite), len(BUCKETS_MS))
+            h['buckets'][indice] += 1
+            h['count'] += 1
+            h['sum_ms'] += ms
+            h['max_ms'] = max(h['max_ms'], ms)
+            h['resultados'][str(resultado)] = h['resultados'].get(str(resultado), 0) + 1
+
+    def metricas(self, reset=False):
+        """
+        Histograma de latencias por endpoint:
+        {'send': {'count', 'avg_ms', 'max_ms', 'buckets': {'<=50ms': n, ..., '>30000ms': n}, 'resultados': {'200': n}}}
+        """
+        with self._lock:
+            datos = {}
+            for endpoint, h in self._histogramas.items():
+                etiquetas = [f'<={b}ms' for b in BUCKETS_MS] + [f'>{BUCKETS_MS[-1]}ms']
+                datos[endpoint] = {
+                    'count': h['count'],
+                    'avg_ms': round(h['sum_ms'] / h['count'], 1) if h['count'] else 0,
+                    'max_ms': round(h['max_ms'], 1),
+                    'buckets': dict(zip(etiquetas, h['buckets'])),
+                    'resultados': dict(h['resultados']),
+                }
+            if reset:
+                self._histogramas = {}
+                self._ultimo_resumen = time.monotonic()
+            return datos
+
+    def resumen_pendiente(self):
+        """True si pasó WASENDER_METRICAS_INTERVALO desde el último resumen"""
+        return time.monotonic() - self._ultimo_resumen >= self.intervalo_metricas
+
+    def resumen(self):
+        """Una línea por endpoint (llamadas, media, p95 aproximado por bucket, máximo y códigos) y reinicia el histograma"""
+        lineas = []
+        for endpoint, m in sorted(self.metricas(reset=True).items()):
+            acumulado, p95 = 0, None
+            for etiqueta, n in m['buckets'].items():
+                acumulado += n
+                if acumulado >= m['count'] * 0.95:
+                    p95 = etiqueta
+                    break
+            lineas.append(
+                f"WASender [{endpoint}]: {m['count']} llamadas | media {m['avg_ms']} ms | p95 {p95} | "
+                f"máx {m['max_ms']} ms | {m['resultados']}"
+            )
+        return lineas
+
+
+# Instancia compartida por proceso
+wasender = WASenderClient()
@@ -0,0 +1,382 @@
+"""
+Motor de importación de pacientes y recordatorios desde el Excel histórico (Saneamiento Automático).
+
+Lo usan el comando `import_patients` y los trabajos de importación en segundo plano
+(CoreApps/crm_marketing/import_jobs.py), que le pasan el archivo por trozos. Por trozo, en bloque:
+1. Sanea cada fila en memoria (cédula, nombres, teléfonos, email) y parsea las fechas de dosis
+   columna a columna con pandas.
+2. Precarga en una consulta los usuarios existentes por cédula, los emails/usernames ocupados y los
+   perfiles, y resuelve cada producto distinto del trozo una sola vez.
+3. Crea usuarios, perfiles y recordatorios con bulk_create y actualiza los existentes con bulk_update.
+
+create_user() por fila era lo más lento: el hash PBKDF2 de la clave (= cédula) tarda cientos de ms.
+Aquí los hashes se calculan en un pool de procesos, o se omiten (clave inutilizable) con
+`claves='inutilizable'`; esos pacientes reciben su clave después desde el admin de usuarios.
+Las filas con datos inválidos (email ocupado, campos demasiado largos) se reportan como error sin
+descartar el trozo.
+"""
+import os
+import re
+import time
+import datetime
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+
+from CoreApps.users.models import User, CustomerProfile
+from CoreApps.appointments.models import AppointmentReminder
+from CoreApps.services.models import Medication, Service
+
+# Columnas de fechas futuras del Excel y la etiqueta de cada dosis
+COLUMNAS_DOSIS = [
+    ('FECHA DE PROXIMA DOSIS O LLAMADA DE SGTO(PRIMERA DOSIS)', 'Primera Dosis'),
+    ('FECHA DE PROXIMA DOSIS O LLAMADA DE SGTO(SEGUNDA DOSIS)', 'Segunda Dosis'),
+    ('FECHA DE PROXIMA DOSIS O LLAMADA DE SGTO(TERCERA DOSIS)', 'Tercera Dosis'),
+]
+
+# Formatos de fecha a probar, en orden (Basado en tu análisis)
+FORMATOS_FECHA = [
+    '%d %m %Y',   # "30 6 2025"
+    '%Y-%m-%d',   # "2025-07-03"
+    '%m-%d-%Y',   # "11-27-2024"
+    '%d/%m/%Y',   # "30/06/2025"
+    '%Y/%m/%d',   # "2025/07/03"
+    '%d-%m-%Y',   # "30-06-2025"
+]
+
+VACIOS = ['nan', 'none', '']
+
+TAMANO_LOTE = 1000
+
+
+def parsear_fechas(serie):
+    """
+    Descifra una columna de fechas locas de una vez: las celdas que ya son fecha se respetan y el
+    texto se prueba formato por formato solo en las celdas que sigan sin resolver.
+    Devuelve una lista de date/None alineada con la serie.
+    """
+    es_fecha = serie.map(lambda v: isinstance(v, (datetime.date, pd.Timestamp)))
+    fechas = pd.to_datetime(serie.where(es_fecha), errors='coerce')
+    texto = serie.where(~es_fecha & serie.notna()).astype('string').str.strip()
+    for fmt in FORMATOS_FECHA:
+        faltan = (fechas.isna() & texto.notna() & (texto != '')).fillna(False).astype(bool)
+        if not faltan.any():
+            break
+        fechas[faltan] = pd.to_datetime(texto[faltan], format=fmt, errors='coerce')
+    return [f.date() if pd.notna(f) else None for f in fechas]
+
+
+def _texto(valor):
+    return '' if valor is None or (not isinstance(valor, str) and pd.isna(valor)) else str(valor).strip()
+
+
+def _nota(valor):
+    # Las celdas vacías llegan como NaN (pd.read_excel) o None (lectura por trozos con openpyxl)
+    return _texto(valor).replace('nan', '')
+
+
+def _por_lotes(valores, tamano=TAMANO_LOTE):
+    valores = list(valores)
+    for i in range(0, len(valores), tamano):
+        yield valores[i:i + tamano]
+
+
+def _max_length(modelo, campo):
+    return modelo._meta.get_field(campo).max_length
+
+
+class PatientImporter:
+    """
+    Importa un DataFrame (o un trozo) del Excel de pacientes. `importar()` devuelve
+    {'nuevos', 'actualizados', 'omitidos', 'errores': [{'fila', 'cedula', 'motivo'}], 'extras': {'recordatorios'}}.
+    El índice del DataFrame debe ser la posición de la fila bajo el encabezado (fila Excel = índice + 2).
+
+    `claves`: 'cedula' (clave = cédula, hash en `hash_workers` procesos) o 'inutilizable' (sin hash).
+    """
+
+    def __init__(self, claves='cedula', hash_workers=None):
+        self.claves = claves
+        self.hash_workers = hash_workers or os.cpu_count() or 1
+
+    def importar(self, df):
+        resultado = {'nuevos': 0, 'actualizados': 0, 'omitidos': 0, 'errores': [], 'extras': {'recordatorios': 0}}
+        filas = self._normalizar(df, resultado)
+        if not filas:
+            return resultado
+
+        with transaction.atomic():
+            usuarios, modificados, filas = self._preparar_usuarios(filas, resultado)
+            self._guardar_usuarios(usuarios, modificados)
+            self._guardar_perfiles(filas, usuarios)
+            resultado['extras']['recordatorios'] = self._crear_recordatorios(filas, usuarios)
+        return resultado
+
+    # =================================================
+    # FASE A: SANEAMIENTO (en memoria, sin consultas)
+    # =================================================
+
+    def _normalizar(self, df, resultado):
+        fechas = {col: parsear_fechas(df[col]) if col in df.columns else [None] * len(df) for col, _ in COLUMNAS_DOSIS}
+        filas = []
+        for posicion, (index, row) in enumerate(zip(df.index, df.to_dict('records'))):
+            fila = self._normalizar_fila(index, row)
+            fila['dosis'] = [(etiqueta, fechas[col][posicion]) for col, etiqueta in COLUMNAS_DOSIS if fechas[col][posicion]]
+            motivo = self._validar(fila)
+            if motivo:
+                resultado['omitidos'] += 1
+                resultado['errores'].append({'fila': fila['fila'], 'cedula': fila['cedula'], 'motivo': motivo})
+            else:
+                filas.append(fila)
+        return filas
+
+    def _normalizar_fila(self, index, row):
+        # 1. CÉDULA
+        raw_cedula = _texto(row.get('CEDULA /RUC'))
+        if raw_cedula.lower() in VACIOS + ['0', '0.0']:
+            # CASO: Sin Cédula -> Generar TMP (base 36 para que quepa en los 13 caracteres del campo)
+            cedula = f"TMP{self._base36(int(time.time()))}{self._base36(int(index))}"
+            es_temporal = True
+        else:
+            # Eliminar decimales si vinieron (ej: 999.0 -> 999)
+            cedula = raw_cedula.split('.')[0]
+            # Corrección de ceros (Si tiene 9, asumimos falta el 0 inicial)
+            if len(cedula) == 9 and cedula.isdigit():
+                cedula = "0" + cedula
+            es_temporal = False
+
+        # 2. NOMBRES Y APELLIDOS (sin prefijos comunes)
+        raw_nombre = _texto(row.get('NOMBRE DEL CLIENTE')) or 'Paciente Sin Nombre'
+        raw_nombre = re.sub(r'^(SRA\.?|SR\.?|DR\.?|DRA\.?)\s+', '', raw_nombre, flags=re.IGNORECASE)
+        parts = raw_nombre.split(' ', 1)  # Dividir solo en el primer espacio
+        first_name = parts[0].strip()
+        last_name = parts[1].strip() if len(parts) > 1 else "."  # Apellido punto si no hay
+
+        # 3. TELÉFONOS (Desdoblamiento)
+        raw_telefono = _texto(row.get('TELEFONO')).replace('.0', '')  # Quitar .0 de excel
+        telefono_principal = ""
+        telefono_secundario = ""
+        if raw_telefono.lower() not in VACIOS:
+            tels = raw_telefono.split('/')
+            t1 = re.sub(r'[^\d]', '', tels[0])
+            if len(t1) == 9: t1 = "0" + t1
+            telefono_principal = t1
+            if len(tels) > 1:
+                t2 = re.sub(r'[^\d]', '', tels[1])
+                if len(t2) == 9: t2 = "0" + t2
+                telefono_secundario = f" / Alt: {t2}"
+
+        # 4. EMAIL (Ficticio si falta)
+        raw_email = _texto(row.get('CORREO'))
+        email = f"{cedula}@holaenfermera.com" if raw_email.lower() in VACIOS else raw_email
+
+        observaciones = []
+        if telefono_secundario:
+            observaciones.append(telefono_secundario)
+        if es_temporal:
+            observaciones.append("⚠️ CÉDULA PENDIENTE (Generada por Sistema)")
+
+        ciudad = _texto(row.get('CIUDAD'))
+        producto = _texto(row.get('PRODUCTO'))
+
+        # NOTAS MAESTRAS
+        nota_base = (
+            f"IMPORTACIÓN | "
+            f"Atendido el: {_nota(row.get('FECHA DE ATENCION'))} | "
+            f"Por: {_nota(row.get('ENFERMERO'))} | "
+            f"Nota Original: {_nota(row.get('COMENTARIOS'))} | "
+            f"Compró: {_nota(row.get('COMPRO'))}"
+        )
+
+        return {
+            'fila': int(index) + 2,
+            'cedula': cedula,
+            'first_name': first_name,
+            'last_name': last_name,
+            'telefono': telefono_principal,
+            'email': User.objects.normalize_email(email),
+            'ciudad': '' if ciudad.lower() in VACIOS else ciudad,
+            'observaciones': observaciones,
+            'producto': '' if producto.lower() in VACIOS else producto,
+            'nota_base': nota_base,
+        }
+
+    def _validar(self, fila):
+        """Lo que antes reventaba la fila en la BD (DataError) se detecta aquí, sin tumbar el lote"""
+        limites = [
+            ('cedula', 'cedula'), ('first_name', 'first_name'), ('last_name', 'last_name'),
+            ('telefono', 'telefono'), ('email', 'email'),
+        ]
+        for clave, campo in limites:
+            maximo = _max_length(User, campo)
+            if maximo and len(fila[clave]) > maximo:
+                return f"{User._meta.get_field(campo).verbose_name} demasiado largo ({len(fila[clave])} > {maximo})"
+        if len(fila['ciudad']) > _max_length(CustomerProfile, 'ciudad'):
+            return "Ciudad demasiado larga"
+        return None
+
+    def _base36(self, numero):
+        digitos = '0123456789abcdefghijklmnopqrstuvwxyz'
+        texto = ''
+        while True:
+            numero, resto = divmod(numero, 36)
+            texto = digitos[resto] + texto
+            if not numero:
+                return texto
+
+    # =================================================
+    # FASE B: USUARIOS (Upsert en bloque)
+    # =================================================
+
+    def _preparar_usuarios(self, filas, resultado):
+        """
+        Aplica las filas en orden sobre los usuarios precargados, como hacía el bucle fila a fila:
+        la primera aparición de una cédula nueva crea el usuario y las siguientes lo actualizan.
+        Devuelve ({cedula: User} con los nuevos aún sin pk, cédulas existentes modificadas, filas aceptadas).
+        """
+        cedulas = {f['cedula'] for f in filas}
+        usuarios = {}
+        for lote in _por_lotes(cedulas):
+            usuarios.update({u.cedula: u for u in User.objects.filter(cedula__in=lote)})
+        existentes = set(usuarios)
+
+        # Email y username son únicos: los que ya usa otra persona rechazan la fila nueva
+        emails = {f['email'] for f in filas}
+        ocupados = set()
+        for lote in _por_lotes(emails):
+            ocupados.update(e.lower() for e in User.objects.filter(email__in=lote).values_list('email', flat=True))
+        usernames = set()
+        for lote in _por_lotes(cedulas - existentes):
+            usernames.update(User.objects.filter(username__in=lote).values_list('username', flat=True))
+
+        modificados, aceptadas = set(), []
+        for fila in filas:
+            usuario = usuarios.get(fila['cedula'])
+            if usuario is None:
+                motivo = None
+                if fila['email'].lower() in ocupados:
+                    motivo = f"El correo {fila['email']} ya está registrado"
+                elif fila['cedula'] in usernames:
+                    motivo = f"El usuario {fila['cedula']} ya existe con otra cédula"
+                if motivo:
+                    resultado['omitidos'] += 1
+                    resultado['errores'].append({'fila': fila['fila'], 'cedula': fila['cedula'], 'motivo': motivo})
+                    continue
+                ocupados.add(fila['email'].lower())
+                usuarios[fila['cedula']] = User(
+                    username=User.normalize_username(fila['cedula']),
+                    email=fila['email'],
+                    first_name=fila['first_name'],
+                    last_name=fila['last_name'],
+                    cedula=fila['cedula'],
+                    telefono=fila['telefono'],
+                    rol=User.Roles.CLIENTE,
+                )
+                resultado['nuevos'] += 1
+            else:
+                # Actualizar Existente (actualizamos contacto)
+                if fila['telefono']:
+                    usuario.telefono = fila['telefono']
+                usuario.first_name = fila['first_name']
+                usuario.last_name = fila['last_name']
+                if usuario.pk:
+                    modificados.add(fila['cedula'])
+                resultado['actualizados'] += 1
+            aceptadas.append(fila)
+        return usuarios, modificados, aceptadas
+
+    def _guardar_usuarios(self, usuarios, modificados):
+        nuevos = [u for u in usuarios.values() if not u.pk]
+        self._asignar_claves(nuevos)
+        User.objects.bulk_create(nuevos, batch_size=TAMANO_LOTE)
+        # bulk_create no devuelve pk en MySQL: se recuperan por cédula
+        sin_pk = [u for u in nuevos if not u.pk]
+        for lote in _por_lotes(sin_pk):
+            ids = dict(User.objects.filter(cedula__in=[u.cedula for u in lote]).values_list('cedula', 'id'))
+            for u in lote:
+                u.pk = ids[u.cedula]
+        User.objects.bulk_update(
+            [usuarios[c] for c in modificados], ['first_name', 'last_name', 'telefono'], batch_size=TAMANO_LOTE
+        )
+
+    def _asignar_claves(self, nuevos):
+        """Clave = Cédula, con los hashes repartidos en procesos; o inutilizable (sin hash)"""
+        if not nuevos:
+            return
+        if self.claves == 'inutilizable':
+            for u in nuevos:
+                u.set_unusable_password()
+            return
+        cedulas = [u.cedula for u in nuevos]
+        if self.hash_workers > 1 and len(cedulas) > 1:
+            with ProcessPoolExecutor(max_workers=self.hash_workers) as pool:
+                hashes = list(pool.map(make_password, cedulas, chunksize=max(1, len(cedulas) // (self.hash_workers * 4))))
+        else:
+            hashes = [make_password(c) for c in cedulas]
+        for u, h in zip(nuevos, hashes):
+            u.password = h
+
+    # =================================================
+    # FASE C: PERFILES
+    # =================================================
+
+    def _guardar_perfiles(self, filas, usuarios):
+        ids = {usuarios[f['cedula']].pk for f in filas}
+        perfiles = {}
+        for lote in _por_lotes(ids):
+            perfiles.update({p.user_id: p for p in CustomerProfile.objects.filter(user_id__in=lote)})
+        existentes = set(perfiles)
+
+        for fila in filas:
+            user_id = usuarios[fila['cedula']].pk
+            perfil = perfiles.setdefault(user_id, CustomerProfile(user_id=user_id))
+            if fila['ciudad']:
+                perfil.ciudad = fila['ciudad']
+            # Guardar datos extra en observaciones del perfil
+            if fila['observaciones']:
+                perfil.alergias = f"{perfil.alergias or ''} | {' '.join(fila['observaciones'])}"
+
+        CustomerProfile.objects.bulk_create(
+            [p for user_id, p in perfiles.items() if user_id not in existentes], batch_size=TAMANO_LOTE
+        )
+        CustomerProfile.objects.bulk_update(
+            [perfiles[user_id] for user_id in existentes], ['ciudad', 'alergias'], batch_size=TAMANO_LOTE
+        )
+
+    # =================================================
+    # FASE D: PRODUCTOS Y RECORDATORIOS (Desdoblamiento)
+    # =================================================
+
+    def _resolver_productos(self, productos):
+        """{producto: (medicamento, texto_externo)} con una búsqueda por producto distinto del trozo"""
+        resueltos = {}
+        for producto in productos:
+            # Medicamento o Servicio (búsqueda insensible a mayúsculas); si no, texto libre
+            medicamento = Medication.objects.filter(nombre__icontains=producto).first()
+            if medicamento:
+                resueltos[producto] = (medicamento, None)
+                continue
+            servicio = Service.objects.filter(nombre__icontains=producto).first()
+            # El recordatorio no tiene campo servicio: va en el texto externo
+            resueltos[producto] = (None, servicio.nombre if servicio else producto)
+        return resueltos
+
+    def _crear_recordatorios(self, filas, usuarios):
+        con_dosis = [f for f in filas if f['dosis']]
+        productos = self._resolver_productos({f['producto'] for f in con_dosis if f['producto']})
+        recordatorios = []
+        for fila in con_dosis:
+            medicamento, externo = productos.get(fila['producto'], (None, None))
+            for etiqueta, fecha in fila['dosis']:
+                recordatorios.append(AppointmentReminder(
+                    paciente_id=usuarios[fila['cedula']].pk,
+                    medicamento_catalogo=medicamento,
+                    medicamento_externo=externo,
+                    fecha_limite_sugerida=fecha,
+                    notas=f"{etiqueta} - {fila['nota_base']}",
+                    estado='PENDIENTE',
+                    origen='SISTEMA',
+                ))
+        # Sin save(): la fecha ya viene del Excel y el post_save solo actúa sobre recordatorios AGENDADO
+        AppointmentReminder.objects.bulk_create(recordatorios, batch_size=TAMANO_LOTE)
+        return len(recordatorios)
@@ -1,258 +1,112 @@
-import pandas as pd
-import re
-import time
-from datetime import datetime
-from django.core.management.base import BaseCommand
+import os
+from django.core.files import File
+from django.core.management.base import BaseCommand, CommandError
 from django.db import transaction
-from django.utils import timezone
-from django.conf import settings
 
-# Importamos tus modelos
-from CoreApps.users.models import User, CustomerProfile
-from CoreApps.appointments.models import AppointmentReminder
-from CoreApps.services.models import Medication, Service
+from CoreApps.crm_marketing.models import ImportJob
+from CoreApps.crm_marketing.import_jobs import import_runner, leer_por_trozos
+from CoreApps.users.importer import PatientImporter
+
 
 class Command(BaseCommand):
     help = 'Importar pacientes y recordatorios desde Excel (Saneamiento Automático)'
 
     def add_arguments(self, parser):
-        parser.add_argument('excel_file', type=str, help='Ruta al archivo Excel (.xlsx)')
+        parser.add_argument('excel_file', type=str, nargs='?', help='Ruta al archivo Excel (.xlsx) o CSV')
+        parser.add_argument('--resume', type=int, default=None, metavar='JOB_ID',
+                            help='Reanudar un trabajo interrumpido desde su último trozo confirmado')
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help='Filas por trozo (una transacción y un bulk_create por trozo)')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Procesa todo el archivo y revierte al final: solo reporta qué pasaría')
+        parser.add_argument('--sin-clave', action='store_true',
+                            help='Crea los pacientes con clave inutilizable (sin hash); se asigna luego desde el admin')
+        parser.add_argument('--hash-workers', type=int, default=None,
+                            help='Procesos para calcular los hashes de clave (por defecto, uno por CPU)')
 
     def handle(self, *args, **kwargs):
-        file_path = kwargs['excel_file']
-        self.stdout.write(self.style.WARNING(f'Iniciando lectura de: {file_path} ...'))
+        # La lectura por trozos, los commits por trozo y la reanudación viven en ImportJobRunner
+        # (CoreApps/crm_marketing/import_jobs.py); el upsert en bloque en CoreApps/users/importer.py
+        # En simulación no se calculan hashes: nada se guarda
+        motor = PatientImporter(
+            claves='inutilizable' if kwargs['sin_clave'] or kwargs['dry_run'] else 'cedula',
+            hash_workers=kwargs['hash_workers']
+        )
+        tamano = kwargs['batch_size'] or import_runner.tamano_trozo
+
+        if kwargs['dry_run']:
+            if not kwargs['excel_file']:
+                raise CommandError('--dry-run necesita la ruta del archivo')
+            self._simular(kwargs['excel_file'], motor, tamano)
+            return
 
+        if kwargs['resume']:
+            job = ImportJob.objects.filter(id=kwargs['resume'], tipo='PACIENTES').first()
+            if not job:
+                raise CommandError(f"No existe el trabajo de importación de pacientes {kwargs['resume']}")
+            self.stdout.write(self.style.WARNING(f'Reanudando trabajo {job.id} desde la fila {job.filas_procesadas + 2} ...'))
+        else:
+            file_path = kwargs['excel_file']
+            if not file_path:
+                raise CommandError('Indica la ruta del archivo o --resume JOB_ID')
+            self.stdout.write(self.style.WARNING(f'Iniciando lectura de: {file_path} ...'))
+            try:
+                with open(file_path, 'rb') as f:
+                    job = ImportJob.objects.create(tipo='PACIENTES', archivo=File(f, name=os.path.basename(file_path)))
+            except OSError as e:
+                self.stdout.write(self.style.ERROR(f'Error leyendo archivo: {e}'))
+                return
+            self.stdout.write(f'Trabajo de importación {job.id} creado (reanudable con --resume {job.id})')
+
+        job = import_runner.ejecutar(
+            job.id, reintentar_error=True, al_avanzar=self._progreso, motor=motor, tamano_trozo=tamano
+        )
+        if job is None:
+            raise CommandError('El trabajo ya terminó o lo está procesando otro proceso.')
+
+        for error in job.errores:
+            self.stdout.write(self.style.ERROR(f"Error en fila {error['fila']}: {error['motivo']}"))
+
+        if job.estado == 'ERROR':
+            self.stdout.write(self.style.ERROR(
+                f"\n=== PROCESO INTERRUMPIDO en la fila {job.filas_procesadas + 2}: {job.mensaje_error} ===\n"
+                f"Corrige el problema y reanuda con: manage.py import_patients --resume {job.id}"
+            ))
+        else:
+            # RESUMEN FINAL
+            self.stdout.write(self.style.SUCCESS(f"\n=== PROCESO TERMINADO ==="))
+        self._resumen(job.nuevos, job.actualizados, job.extras.get('recordatorios', 0))
+
+    def _simular(self, file_path, motor, tamano):
+        self.stdout.write(self.style.WARNING(f'Simulación (--dry-run) de: {file_path} ...'))
+        totales = {'nuevos': 0, 'actualizados': 0, 'recordatorios': 0}
+        errores = []
         try:
-            # Leemos el Excel con Pandas (detecta automáticamente los tipos)
-            df = pd.read_excel(file_path)
-            # Limpiamos espacios en nombres de columnas
-            df.columns = df.columns.str.strip()
-            
-            total_rows = len(df)
-            self.stdout.write(f'Filas detectadas: {total_rows}')
-
-        except Exception as e:
+            # Un solo atomic para todo el archivo: los trozos siguientes ven lo "creado" por los anteriores
+            with open(file_path, 'rb') as f, transaction.atomic():
+                for trozo, siguiente in leer_por_trozos(f, file_path, tamano):
+                    if trozo.empty:
+                        continue
+                    resultado = motor.importar(trozo)
+                    totales['nuevos'] += resultado['nuevos']
+                    totales['actualizados'] += resultado['actualizados']
+                    totales['recordatorios'] += resultado['extras']['recordatorios']
+                    errores.extend(resultado['errores'])
+                    self.stdout.write(f'  {siguiente} filas simuladas')
+                transaction.set_rollback(True)
+        except OSError as e:
             self.stdout.write(self.style.ERROR(f'Error leyendo archivo: {e}'))
             return
 
-        count_creados = 0
-        count_actualizados = 0
-        count_recordatorios = 0
-
-        # --- ITERACIÓN FILA POR FILA ---
-        for index, row in df.iterrows():
-            try:
-                with transaction.atomic(): # Si algo falla en esta fila, no se guarda nada de esta fila
-                    
-                    # =================================================
-                    # FASE A: SANEAMIENTO DE PACIENTE
-                    # =================================================
-                    
-                    # 1. CÉDULA
-                    raw_cedula = str(row.get('CEDULA /RUC', '')).strip()
-                    # Limpieza básica de "nan", "0", "0.0" que deja pandas
-                    if raw_cedula.lower() in ['nan', '0', '0.0', 'None', '']:
-                        # CASO: Sin Cédula -> Generar TMP
-                        timestamp = int(time.time())
-                        cedula_final = f"TMP-{timestamp}-{index}"
-                        es_temporal = True
-                    else:
-                        # Eliminar decimales si vinieron (ej: 999.0 -> 999)
-                        cedula_final = raw_cedula.split('.')[0]
-                        # Corrección de ceros (Si tiene 9, asumimos falta el 0 inicial)
-                        if len(cedula_final) == 9 and cedula_final.isdigit():
-                            cedula_final = "0" + cedula_final
-                        es_temporal = False
-
-                    # 2. NOMBRES Y APELLIDOS
-                    raw_nombre = str(row.get('NOMBRE DEL CLIENTE', 'Paciente Sin Nombre')).strip()
-                    # Quitar prefijos comunes
-                    raw_nombre = re.sub(r'^(SRA\.?|SR\.?|DR\.?|DRA\.?)\s+', '', raw_nombre, flags=re.IGNORECASE)
-                    
-                    parts = raw_nombre.split(' ', 1) # Dividir solo en el primer espacio
-                    first_name = parts[0].strip()
-                    last_name = parts[1].strip() if len(parts) > 1 else "." # Apellido punto si no hay
-
-                    # 3. TELÉFONOS (Desdoblamiento)
-                    raw_telefono = str(row.get('TELEFONO', '')).strip().replace('.0', '') # Quitar .0 de excel
-                    telefono_principal = ""
-                    telefono_secundario = ""
-
-                    if raw_telefono and raw_telefono.lower() != 'nan':
-                        tels = str(raw_telefono).split('/')
-                        # Limpiar principal
-                        t1 = re.sub(r'[^\d]', '', tels[0])
-                        if len(t1) == 9: t1 = "0" + t1
-                        telefono_principal = t1
-
-                        # Limpiar secundario si existe
-                        if len(tels) > 1:
-                            t2 = re.sub(r'[^\d]', '', tels[1])
-                            if len(t2) == 9: t2 = "0" + t2
-                            telefono_secundario = f" / Alt: {t2}"
-
-                    # 4. EMAIL (Ficticio si falta)
-                    raw_email = str(row.get('CORREO', '')).strip()
-                    if not raw_email or raw_email.lower() == 'nan':
-                        email_final = f"{cedula_final}@holaenfermera.com"
-                    else:
-                        email_final = raw_email
-
-                    # =================================================
-                    # FASE B: PERSISTENCIA USUARIO (Upsert)
-                    # =================================================
-                    user_created = False
-                    
-                    # Buscamos por cédula (que es el username)
-                    user = User.objects.filter(cedula=cedula_final).first()
-
-                    if not user:
-                        # Crear Nuevo
-                        user = User.objects.create_user(
-                            username=cedula_final,
-                            email=email_final,
-                            password=cedula_final, # Clave = Cédula
-                            first_name=first_name,
-                            last_name=last_name,
-                            cedula=cedula_final,
-                            telefono=telefono_principal,
-                            rol=User.Roles.CLIENTE
-                        )
-                        user_created = True
-                        count_creados += 1
-                    else:
-                        # Actualizar Existente (Opcional, actualizamos contacto)
-                        if telefono_principal:
-                            user.telefono = telefono_principal
-                        user.first_name = first_name
-                        user.last_name = last_name
-                        user.save()
-                        count_actualizados += 1
+        for error in errores:
+            self.stdout.write(self.style.ERROR(f"Error en fila {error['fila']}: {error['motivo']}"))
+        self.stdout.write(self.style.SUCCESS(f"\n=== SIMULACIÓN TERMINADA (no se guardó nada) ==="))
+        self._resumen(totales['nuevos'], totales['actualizados'], totales['recordatorios'])
 
-                    # Crear/Actualizar Perfil
-                    perfil, _ = CustomerProfile.objects.get_or_create(user=user)
-                    
-                    # Guardar datos extra en observaciones del perfil
-                    ciudad = str(row.get('CIUDAD', '')).strip()
-                    if ciudad and ciudad.lower() != 'nan':
-                        perfil.ciudad = ciudad
-                    
-                    observaciones_perfil = []
-                    if telefono_secundario:
-                        observaciones_perfil.append(telefono_secundario)
-                    if es_temporal:
-                        observaciones_perfil.append("⚠️ CÉDULA PENDIENTE (Generada por Sistema)")
-                    
-                    if observaciones_perfil:
-                        perfil.alergias = f"{perfil.alergias or ''} | {' '.join(observaciones_perfil)}"
-                    
-                    perfil.save()
+    def _resumen(self, nuevos, actualizados, recordatorios):
+        self.stdout.write(f"Pacientes Nuevos: {nuevos}")
+        self.stdout.write(f"Pacientes Actualizados: {actualizados}")
+        self.stdout.write(f"Recordatorios Generados: {recordatorios}")
 
-                    # =================================================
-                    # FASE C: INTERPRETACIÓN DEL PRODUCTO
-                    # =================================================
-                    raw_producto = str(row.get('PRODUCTO', '')).strip()
-                    med_obj = None
-                    service_obj = None
-                    med_externo = None
-
-                    if raw_producto and raw_producto.lower() != 'nan':
-                        # Intentar buscar Medicamento (búsqueda insensible a mayúsculas)
-                        med_match = Medication.objects.filter(nombre__icontains=raw_producto).first()
-                        if med_match:
-                            med_obj = med_match
-                        else:
-                            # Intentar buscar Servicio
-                            serv_match = Service.objects.filter(nombre__icontains=raw_producto).first()
-                            if serv_match:
-                                service_obj = serv_match
-                            else:
-                                # Texto libre
-                                med_externo = raw_producto
-
-                    # =================================================
-                    # FASE D: NOTAS MAESTRAS
-                    # =================================================
-                    raw_enfermero = str(row.get('ENFERMERO', '')).replace('nan', '')
-                    raw_comentarios = str(row.get('COMENTARIOS', '')).replace('nan', '')
-                    raw_compro = str(row.get('COMPRO', '')).replace('nan', '')
-                    raw_fecha_atencion = str(row.get('FECHA DE ATENCION', '')).replace('nan', '')
-
-                    nota_base = (
-                        f"IMPORTACIÓN | "
-                        f"Atendido el: {raw_fecha_atencion} | "
-                        f"Por: {raw_enfermero} | "
-                        f"Nota Original: {raw_comentarios} | "
-                        f"Compró: {raw_compro}"
-                    )
-
-                    # =================================================
-                    # FASE E: CREACIÓN DE RECORDATORIOS (Desdoblamiento)
-                    # =================================================
-                    
-                    # Lista de columnas de fechas futuras en tu Excel
-                    # Ajusta los nombres EXACTOS según tu Excel real
-                    columnas_dosis = [
-                        ('FECHA DE PROXIMA DOSIS O LLAMADA DE SGTO(PRIMERA DOSIS)', 'Primera Dosis'),
-                        ('FECHA DE PROXIMA DOSIS O LLAMADA DE SGTO(SEGUNDA DOSIS)', 'Segunda Dosis'),
-                        ('FECHA DE PROXIMA DOSIS O LLAMADA DE SGTO(TERCERA DOSIS)', 'Tercera Dosis'), 
-                    ]
-
-                    for col_name, etiqueta in columnas_dosis:
-                        fecha_raw = row.get(col_name)
-                        fecha_valida = self.parse_fecha_rara(fecha_raw)
-
-                        if fecha_valida:
-                            # Crear Recordatorio
-                            AppointmentReminder.objects.create(
-                                paciente=user,
-                                medicamento_catalogo=med_obj,
-                                # Si tenemos servicio pero el modelo reminder no tiene campo servicio, lo ponemos en texto externo
-                                medicamento_externo=med_externo or (service_obj.nombre if service_obj else None),
-                                fecha_limite_sugerida=fecha_valida,
-                                notas=f"{etiqueta} - {nota_base}",
-                                estado='PENDIENTE',
-                                origen='SISTEMA' 
-                            )
-                            count_recordatorios += 1
-
-            except Exception as e:
-                self.stdout.write(self.style.ERROR(f"Error en fila {index + 2}: {e}"))
-                continue # Seguimos con la siguiente fila
-
-        # RESUMEN FINAL
-        self.stdout.write(self.style.SUCCESS(f"\n=== PROCESO TERMINADO ==="))
-        self.stdout.write(f"Pacientes Nuevos: {count_creados}")
-        self.stdout.write(f"Pacientes Actualizados: {count_actualizados}")
-        self.stdout.write(f"Recordatorios Generados: {count_recordatorios}")
-
-    def parse_fecha_rara(self, fecha_valor):
-        """
-        Intenta descifrar formatos de fecha locos. Retorna objeto date o None.
-        """
-        if pd.isna(fecha_valor) or str(fecha_valor).strip() == '':
-            return None
-        
-        # Si Pandas ya lo reconoció como fecha (Timestamp)
-        if isinstance(fecha_valor, (datetime, pd.Timestamp)):
-            return fecha_valor.date()
-
-        fecha_str = str(fecha_valor).strip()
-        
-        # Lista de formatos a probar (Basado en tu análisis)
-        formatos = [
-            '%d %m %Y',   # "30 6 2025"
-            '%Y-%m-%d',   # "2025-07-03"
-            '%m-%d-%Y',   # "11-27-2024"
-            '%d/%m/%Y',   # "30/06/2025"
-            '%Y/%m/%d',   # "2025/07/03"
-            '%d-%m-%Y',   # "30-06-2025"
-        ]
-
-        for fmt in formatos:
-            try:
-                return datetime.strptime(fecha_str, fmt).date()
-            except ValueError:
-                continue
-        
-        return None # No se pudo entender la fecha
\ No newline at end of file
+    def _progreso(self, job):
+        self.stdout.write(f'  {job.filas_procesadas}/{job.total_filas} filas confirmadas ({job.porcentaje}%)')
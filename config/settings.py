@@ -201,6 +201,84 @@ GOOGLE_MAPS_API_KEY = os.getenv('GOOGLE_MAPS_API_KEY')
 WASENDER_API_KEY = os.getenv('WASENDERAPI_API_KEY')
 WASENDER_BASE_URL = os.getenv('WASENDERAPI_BASE_URL', 'https://wasenderapi.com/api/')
 WASENDER_WEBHOOK_SECRET = os.getenv('WASENDER_WEBHOOK_SECRET')
+# Ingesta asíncrona: el webhook solo encola en WebhookInbox (procesar con `manage.py process_webhook_inbox`)
+WASENDER_WEBHOOK_ASYNC = os.getenv('WASENDER_WEBHOOK_ASYNC', 'False').lower() in ('1', 'true', 'yes')
+# Cliente HTTP compartido (CoreApps/notifications/wasender_client.py): pool keep-alive y reintentos
+WASENDER_HTTP_POOL_SIZE = 10       # Conexiones reutilizables por host
+WASENDER_HTTP_MAX_RETRIES = 3      # Reintentos ante 429 / 5xx (5xx solo en llamadas idempotentes)
+WASENDER_HTTP_TIMEOUTS = {         # (conexión, lectura) en segundos por endpoint
+    'send': (5, 20),
+    'upload': (5, 60),
+    'decrypt': (5, 15),
+    'download': (5, 30),
+}
+WASENDER_METRICAS_INTERVALO = 900  # Segundos entre resúmenes de latencia en la salida del worker y del consumidor
+
+# Captura de payloads de webhooks (CoreApps/chat/capture.py): segmentos JSONL rotados y comprimidos
+WEBHOOK_CAPTURE_ENABLED = os.getenv('WEBHOOK_CAPTURE_ENABLED', 'True').lower() in ('1', 'true', 'yes')
+WEBHOOK_CAPTURE_DIR = os.path.join(BASE_DIR, 'logs', 'webhooks')
+WEBHOOK_CAPTURE_MAX_BYTES = 20 * 1024 * 1024   # Rotación por tamaño (además de la diaria)
+WEBHOOK_CAPTURE_MAX_SEGMENTS = 60              # Segmentos comprimidos que se conservan
+WEBHOOK_CAPTURE_STALE_SECONDS = 2 * 24 * 3600  # Segmento sin comprimir y sin escrituras: su proceso murió
+WEBHOOK_CAPTURE_QUEUE_SIZE = 1000              # Si se llena, se descartan capturas (nunca se bloquea el webhook)
+# Tasa de muestreo por evento (0.0 - 1.0); 'default' aplica al resto. Los acuses son muy frecuentes y poco útiles.
+WEBHOOK_CAPTURE_SAMPLING = {
+    'default': float(os.getenv('WEBHOOK_CAPTURE_SAMPLE_RATE', '1.0')),
+    'messages.update': 0.1,
+    'message-receipt.update': 0.1,
+    'message.ack': 0.1,
+}
+
+# Eventos en tiempo real del Inbox (SSE en /chat/api/chats/events/, requiere ASGI).
+# Desactivado por defecto: con WSGI (WSGI_APPLICATION) cada pestaña retendría un worker para siempre.
+# InProcessBackend solo reparte dentro del proceso; el polling del frontend mantiene su ritmo normal.
+CHAT_EVENTS_SSE = os.getenv('CHAT_EVENTS_SSE', 'False').lower() in ('1', 'true', 'yes')
+CHAT_EVENTS_BACKEND = 'CoreApps.chat.events.InProcessBackend'
+CHAT_EVENTS_HEARTBEAT = 15  # Segundos entre pings para mantener viva la conexión
+
+# Caché de multimedia decriptada (CoreApps/chat/media_cache.py): archivos por hash de contenido con expulsión LRU
+CHAT_MEDIA_CACHE_DIR = os.path.join(MEDIA_ROOT, 'wasender_cache')
+CHAT_MEDIA_CACHE_MAX_BYTES = int(os.getenv('CHAT_MEDIA_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+# Prefetch de adjuntos entrantes (CoreApps/chat/media_prefetch.py): decripta y cachea en segundo plano
+CHAT_MEDIA_PREFETCH_ENABLED = os.getenv('CHAT_MEDIA_PREFETCH_ENABLED', 'True').lower() in ('1', 'true', 'yes')
+CHAT_MEDIA_PREFETCH_WORKERS = 2
+CHAT_MEDIA_PREFETCH_RETRIES = 3
+CHAT_MEDIA_PREFETCH_MAX_BYTES = {  # Tope por tipo; los tipos ausentes no se prefetchean
+    'AUDIO': 16 * 1024 * 1024,
+    'IMAGE': 10 * 1024 * 1024,
+    'DOCUMENT': 20 * 1024 * 1024,
+    'VIDEO': 32 * 1024 * 1024,
+}
+
+# Worker de notificaciones (planificador por carriles): pausa anti-spam entre recordatorios (común a todos
+# los workers, ver leases.reservar_turno) y tiempo antes de reintentar un recordatorio fallido (segundos)
+WORKER_RECORDATORIOS_INTERVALO = 300
+WORKER_RECORDATORIOS_REINTENTO = 1800
+# Lease de cada envío reclamado por un worker; debe superar el peor caso de una llamada a WASender
+# con reintentos. Si el worker muere, la fila vuelve a la cola al caducar (se puede reenviar una vez)
+WORKER_LEASE_SEGUNDOS = 300
+
+# Importaciones masivas en segundo plano (CoreApps/crm_marketing/import_jobs.py): filas confirmadas por
+# transacción y segundos sin latido tras los que un trabajo PROCESANDO se retoma (run_import_jobs).
+# El límite efectivo es al menos CHUNK_SIZE * SEGUNDOS_POR_FILA (peor caso de un trozo, ej. hash PBKDF2)
+CRM_IMPORT_CHUNK_SIZE = 2000
+CRM_IMPORT_STALE_SECONDS = 300
+CRM_IMPORT_SEGUNDOS_POR_FILA = 0.5
+# Encolado de campañas (CoreApps/crm_marketing/enqueue.py): contactos por bulk_create y audiencia
+# máxima que se encola dentro de la petición; por encima se encola en segundo plano. Un encolado sin
+# latido durante STALE_SECONDS lo retoma el carril de mantenimiento de whatsapp_worker_holaenfermera
+CRM_CAMPANA_LOTE_ENCOLADO = 2000
+CRM_CAMPANA_ENCOLADO_SINCRONO = 5000
+CRM_CAMPANA_ENCOLADO_STALE_SECONDS = 300
+# Segmentos guardados (CoreApps/crm_marketing/segment_refresh.py): contactos por lote al recalcular la
+# membresía materializada; el refresco periódico corre con `manage.py refresh_segments --loop`
+CRM_SEGMENTOS_LOTE = 2000
+# Etiquetado masivo (CoreApps/crm_marketing/tagging.py): contactos por lote y tamaño máximo del segmento
+# que se etiqueta dentro de la petición; por encima corre en segundo plano. Una operación PROCESANDO sin
+# latido durante STALE_SECONDS se retoma con `manage.py run_bulk_tagging --loop`
+CRM_ETIQUETADO_LOTE = 5000
+CRM_ETIQUETADO_SINCRONO = 5000
+CRM_ETIQUETADO_STALE_SECONDS = 300
 
 print(f"WASenderAPI Key loaded: {WASENDER_API_KEY is not None and len(WASENDER_API_KEY) > 0}")
 print(f"WASenderAPI Base URL loaded: {WASENDER_BASE_URL}")
@@ -37,6 +37,7 @@ def cleanup_duplicates():
                 for other in others:
                     # Mover mensajes
                     ChatMensaje.objects.filter(contacto=other).update(contacto=main)
+                    ChatMensaje.recalcular_ultimo_mensaje([main.id])
                     # Mantener whatsapp_jid si el principal no lo tiene
                     if not main.whatsapp_jid and other.whatsapp_jid:
                         main.whatsapp_jid = other.whatsapp_jid
@@ -45,7 +46,8 @@ def cleanup_duplicates():
                     if not main.telefono.startswith('+') and other.telefono.startswith('+'):
                         main.telefono = other.telefono
                     
-                    main.save()
+                    # Solo los campos tocados: el puntero de último mensaje se acaba de recalcular arriba
+                    main.save(update_fields=['whatsapp_jid', 'telefono'])
                     # Eliminar el duplicado
                     other_id = other.id
                     other.delete()